@@ -18,11 +18,14 @@
  * --wal-file-path %p --wal-file-name %f', to move backups into arclog_path.
  * Where archlog_path is $BACKUP_PATH/wal/system_id.
  * Currently it just copies wal files to the new location.
+ * With 'wal_summary' the summary of block references of the previous WAL
+ * segment is also written to speed up PAGE backups.
  * TODO: Planned options: list the arclog content,
  * compute and validate checksums.
  */
 int
-do_archive_push(char *wal_file_path, char *wal_file_name, bool overwrite)
+do_archive_push(char *wal_file_path, char *wal_file_name, bool overwrite,
+				bool wal_summary)
 {
 	char		backup_wal_file_path[MAXPGPATH];
 	char		absolute_wal_file_path[MAXPGPATH];
@@ -45,7 +48,7 @@ do_archive_push(char *wal_file_path, char *wal_file_name, bool overwrite)
 
 	/* verify that archive-push --instance parameter is valid */
 	config = readBackupCatalogConfigFile();
-	system_id = get_system_identifier(current_dir);
+	system_id = get_system_identifier(current_dir, false);
 
 	if (config->pgdata == NULL)
 		elog(ERROR, "cannot read pg_probackup.conf for this instance");
@@ -63,8 +66,10 @@ do_archive_push(char *wal_file_path, char *wal_file_name, bool overwrite)
 
 	elog(INFO, "pg_probackup archive-push from %s to %s", absolute_wal_file_path, backup_wal_file_path);
 
-	if (compress_alg == PGLZ_COMPRESS)
-		elog(ERROR, "pglz compression is not supported");
+	if (compress_alg == PGLZ_COMPRESS || compress_alg == ZSTD_COMPRESS ||
+		compress_alg == LZ4_COMPRESS)
+		elog(ERROR, "%s compression is not supported",
+			 deparse_compress_alg(compress_alg));
 
 #ifdef HAVE_LIBZ
 	if (compress_alg == ZLIB_COMPRESS)
@@ -73,6 +78,35 @@ do_archive_push(char *wal_file_path, char *wal_file_name, bool overwrite)
 
 	push_wal_file(absolute_wal_file_path, backup_wal_file_path, is_compress,
 				  overwrite);
+
+	if (IsXLogFileName(wal_file_name))
+	{
+		char		summary_path[MAXPGPATH];
+		uint32		tli,
+					log,
+					seg;
+
+		/* The summary of the overwritten segment is outdated */
+		snprintf(summary_path, lengthof(summary_path), "%s%s",
+				 backup_wal_file_path, WAL_SUMMARY_SUFFIX);
+		if (overwrite && fileExists(summary_path) && unlink(summary_path) != 0)
+			elog(ERROR, "Cannot remove WAL summary file \"%s\": %s",
+				 summary_path, strerror(errno));
+
+		/*
+		 * Records of the previous segment may continue in this one, so now
+		 * the previous segment can be summarized.
+		 */
+		if (wal_summary &&
+			sscanf(wal_file_name, "%08X%08X%08X", &tli, &log, &seg) == 3)
+		{
+			XLogSegNo	segno = (uint64) log * XLogSegmentsPerXLogId + seg;
+
+			if (segno > 0)
+				summarize_wal_segment(arclog_path, tli, segno - 1);
+		}
+	}
+
 	elog(INFO, "pg_probackup archive-push completed successfully");
 
 	return 0;
@@ -24,6 +24,7 @@
 #include "datapagemap.h"
 #include "libpq/pqsignal.h"
 #include "pgtar.h"
+#include "pqexpbuffer.h"
 #include "receivelog.h"
 #include "storage/bufpage.h"
 #include "streamutil.h"
@@ -46,8 +47,20 @@ const char *progname = "pg_probackup";
 /* list of files contained in backup */
 static parray *backup_files_list = NULL;
 
-/* We need critical section for datapagemap_add() in case of using threads */
-static pthread_mutex_t backup_pagemap_mutex = PTHREAD_MUTEX_INITIALIZER;
+/*
+ * Files which were copied by the interrupted run of the resumed backup,
+ * sorted by path relative to PGDATA.
+ */
+static parray *resume_files_list = NULL;
+/* Parent of the resumed backup */
+static time_t resume_parent_backup = 0;
+
+/*
+ * Journal of the files which are already copied, so that an interrupted
+ * backup can be resumed.
+ */
+static FILE *backup_journal = NULL;
+static pthread_mutex_t backup_journal_mutex = PTHREAD_MUTEX_INITIALIZER;
 
 /*
  * We need to wait end of WAL streaming before execute pg_stop_backup().
@@ -94,6 +107,15 @@ static void backup_disconnect(bool fatal, void *userdata);
 
 static void *backup_files(void *arg);
 static void *remote_backup_files(void *arg);
+static void split_data_files(parray *files, parray *prev_files, parray *parts);
+static void prepare_backup_resume(void);
+static bool resume_file(pgFile *file, const char *to_root);
+static pgFile *resume_file_lookup(pgFile *file);
+static void open_backup_journal(void);
+static void close_backup_journal(void);
+static void journal_file(pgFile *file);
+static bool file_is_unchanged(pgFile *file, pgFile *prev_file, struct stat *st,
+							  time_t prev_start_time);
 
 static void do_backup_instance(void);
 
@@ -113,6 +135,20 @@ static void get_remote_pgdata_filelist(parray *files);
 static void ReceiveFileList(parray* files, PGconn *conn, PGresult *res, int rownum);
 static void	remote_copy_file(PGconn *conn, pgFile* file);
 
+/* Ptrack map of the relation returned by pg_ptrack_get_and_clear() */
+typedef struct PtrackMap
+{
+	Oid			relOid;
+	char	   *map;			/* NULL if ptrack file is missing */
+	size_t		size;
+} PtrackMap;
+
+/*
+ * Maximum number of relations which ptrack maps are requested by a single
+ * query.
+ */
+#define PTRACK_MAP_BATCH	1000
+
 /* Ptrack functions */
 static void pg_ptrack_clear(void);
 static bool pg_ptrack_support(void);
@@ -120,10 +156,8 @@ static bool pg_ptrack_enable(void);
 static bool pg_checksum_enable(void);
 static bool pg_is_in_recovery(void);
 static bool pg_ptrack_get_and_clear_db(Oid dbOid, Oid tblspcOid);
-static char *pg_ptrack_get_and_clear(Oid tablespace_oid,
-									 Oid db_oid,
-									 Oid rel_oid,
-									 size_t *result_size);
+static parray *pg_ptrack_get_and_clear_rels(Oid tablespace_oid, Oid db_oid,
+											Oid *rel_oids, int n);
 static XLogRecPtr get_last_ptrack_lsn(void);
 
 /* Check functions */
@@ -284,11 +318,9 @@ remote_copy_file(PGconn *conn, pgFile* file)
 {
 	PGresult	*res;
 	char		*copybuf = NULL;
-	char		buf[32768];
 	FILE		*out;
 	char		database_path[MAXPGPATH];
 	char		to_path[MAXPGPATH];
-	bool skip_padding = false;
 
 	pgBackupGetPath(&current, database_path, lengthof(database_path),
 					DATABASE_DIR);
@@ -304,17 +336,16 @@ remote_copy_file(PGconn *conn, pgFile* file)
 
 	INIT_CRC32C(file->crc);
 
-	/* read from stream and write to backup file */
+	/*
+	 * Read from stream and write to backup file. The server keeps sending
+	 * the next chunks into the socket buffer while the current one is
+	 * written, so the chunk is written directly from the libpq buffer.
+	 */
 	while (1)
 	{
 		int			row_length;
 		int			errno_tmp;
-		int			write_buffer_size = 0;
-		if (copybuf != NULL)
-		{
-			PQfreemem(copybuf);
-			copybuf = NULL;
-		}
+		size_t		write_size;
 
 		row_length = PQgetCopyData(conn, &copybuf, 0);
 
@@ -324,49 +355,70 @@ remote_copy_file(PGconn *conn, pgFile* file)
 		if (row_length == -1)
 			break;
 
-		if (!skip_padding)
+		/* The file is padded to the tar block size, skip the padding */
+		write_size = Min((size_t) row_length, file->size - file->read_size);
+		if (write_size > 0)
 		{
-			write_buffer_size = Min(row_length, sizeof(buf));
-			memcpy(buf, copybuf, write_buffer_size);
-			COMP_CRC32C(file->crc, buf, write_buffer_size);
+			COMP_CRC32C(file->crc, copybuf, write_size);
 
-			/* TODO calc checksum*/
-			if (fwrite(buf, 1, write_buffer_size, out) != write_buffer_size)
+			if (fwrite(copybuf, 1, write_size, out) != write_size)
 			{
 				errno_tmp = errno;
 				/* oops */
 				FIN_CRC32C(file->crc);
 				fclose(out);
-				PQfinish(conn);
+				PQfreemem(copybuf);
 				elog(ERROR, "cannot write to \"%s\": %s", to_path,
 					strerror(errno_tmp));
 			}
 
-			file->read_size += write_buffer_size;
-		}
-		if (file->read_size >= file->size)
-		{
-			skip_padding = true;
+			file->read_size += write_size;
 		}
+
+		PQfreemem(copybuf);
+		copybuf = NULL;
 	}
 
 	res = PQgetResult(conn);
 
-	/* File is not found. That's normal. */
 	if (PQresultStatus(res) != PGRES_COMMAND_OK)
 	{
 		elog(ERROR, "final receive failed: status %d ; %s",PQresultStatus(res), PQerrorMessage(conn));
 	}
+	PQclear(res);
 
 	file->write_size = (int64) file->read_size;
 	FIN_CRC32C(file->crc);
 
-	fclose(out);
+	if (fclose(out))
+		elog(ERROR, "cannot write \"%s\": %s", to_path, strerror(errno));
+}
+
+/*
+ * Wait for the end of the current command, so that the connection can be
+ * used for the next one.
+ */
+static void
+remote_finish_command(PGconn *conn)
+{
+	PGresult   *res;
+
+	while ((res = PQgetResult(conn)) != NULL)
+	{
+		if (PQresultStatus(res) != PGRES_COMMAND_OK)
+			elog(ERROR, "unexpected result of replication command: %s",
+				 PQerrorMessage(conn));
+		PQclear(res);
+	}
 }
 
 /*
  * Take a remote backup of the PGDATA at a file level.
  * Copy all directories and files listed in backup_files_list.
+ *
+ * A replication connection is opened once per thread and all files are
+ * requested through it one after another, instead of opening a new
+ * connection for each file.
  */
 static void *
 remote_backup_files(void *arg)
@@ -393,7 +445,11 @@ remote_backup_files(void *arg)
 		if (!pg_atomic_test_set_flag(&file->lock))
 			continue;
 
-		file_backup_conn = pgut_connect_replication(pgut_dbname);
+		if (file_backup_conn == NULL)
+		{
+			file_backup_conn = pgut_connect_replication(pgut_dbname);
+			arguments->backup_conn = file_backup_conn;
+		}
 
 		/* check for interrupt */
 		if (interrupted)
@@ -404,6 +460,7 @@ remote_backup_files(void *arg)
 		if (PQsendQuery(file_backup_conn, query_str) == 0)
 			elog(ERROR,"%s: could not send replication command \"%s\": %s",
 				PROGRAM_NAME, query_str, PQerrorMessage(file_backup_conn));
+		pfree(query_str);
 
 		res = PQgetResult(file_backup_conn);
 
@@ -411,16 +468,16 @@ remote_backup_files(void *arg)
 		if (PQresultStatus(res) == PGRES_COMMAND_OK)
 		{
 			PQclear(res);
-			PQfinish(file_backup_conn);
+			remote_finish_command(file_backup_conn);
 			continue;
 		}
 
 		if (PQresultStatus(res) != PGRES_COPY_OUT)
 		{
 			PQclear(res);
-			PQfinish(file_backup_conn);
 			elog(ERROR, "Could not get COPY data stream: %s", PQerrorMessage(file_backup_conn));
 		}
+		PQclear(res);
 
 		/* read the header of the file */
 		row_length = PQgetCopyData(file_backup_conn, &copybuf, 0);
@@ -435,13 +492,20 @@ remote_backup_files(void *arg)
 		if(row_length != 512)
 			elog(ERROR, "Invalid tar block header size: %d\n", row_length);
 		file->size = read_tar_number(&copybuf[124], 12);
+		PQfreemem(copybuf);
 
 		/* receive the data from stream and write to backup file */
 		remote_copy_file(file_backup_conn, file);
+		remote_finish_command(file_backup_conn);
 
 		elog(VERBOSE, "File \"%s\". Copied " INT64_FORMAT " bytes",
 			 file->path, file->write_size);
+	}
+
+	if (file_backup_conn)
+	{
 		PQfinish(file_backup_conn);
+		arguments->backup_conn = NULL;
 	}
 
 	/* Data files transferring is successful */
@@ -470,6 +534,7 @@ do_backup_instance(void)
 
 	pgBackup   *prev_backup = NULL;
 	parray	   *prev_backup_filelist = NULL;
+	parray	   *backup_files_parts;
 
 	elog(LOG, "Database backup start");
 
@@ -523,6 +588,7 @@ do_backup_instance(void)
 
 		pgBackupGetPath(prev_backup, prev_backup_filelist_path,
 						lengthof(prev_backup_filelist_path), DATABASE_FILE_LIST);
+
 		/* Files of previous backup needed by DELTA backup */
 		prev_backup_filelist = dir_read_file_list(NULL, prev_backup_filelist_path);
 
@@ -530,6 +596,11 @@ do_backup_instance(void)
 		prev_backup_start_lsn = prev_backup->start_lsn;
 		current.parent_backup = prev_backup->start_time;
 
+		if (resume_backup && current.parent_backup != resume_parent_backup)
+			elog(ERROR, "Cannot resume backup %s, its parent backup is not "
+				 "the last valid backup anymore",
+				 base36enc(current.start_time));
+
 		pgBackupWriteBackupControlFile(&current);
 	}
 
@@ -570,6 +641,23 @@ do_backup_instance(void)
 		join_path_components(dst_backup_path, database_path, PG_XLOG_DIR);
 		dir_create_dir(dst_backup_path, DIR_PERMISSION);
 
+		/* WAL streamed by the interrupted run doesn't match the new start LSN */
+		if (resume_backup)
+		{
+			parray	   *xlog_files_list = parray_new();
+
+			dir_list_file(xlog_files_list, dst_backup_path, false, true, false);
+			for (i = 0; i < parray_num(xlog_files_list); i++)
+			{
+				pgFile	   *file = (pgFile *) parray_get(xlog_files_list, i);
+
+				if (S_ISREG(file->mode))
+					pgFileDelete(file);
+			}
+			parray_walk(xlog_files_list, pgFileFree);
+			parray_free(xlog_files_list);
+		}
+
 		stream_thread_arg.basedir = dst_backup_path;
 
 		/*
@@ -697,6 +785,15 @@ do_backup_instance(void)
 	if (prev_backup_filelist)
 		parray_qsort(prev_backup_filelist, pgFileComparePath);
 
+	/*
+	 * Split large data files into block ranges, so that several threads can
+	 * back up a single file.
+	 */
+	backup_files_parts = parray_new();
+	if (!is_remote_backup && num_threads > 1)
+		split_data_files(backup_files_list, prev_backup_filelist,
+						 backup_files_parts);
+
 	/* init thread args with own file lists */
 	threads = (pthread_t *) palloc(sizeof(pthread_t) * num_threads);
 	threads_args = (backup_files_arg *) palloc(sizeof(backup_files_arg)*num_threads);
@@ -708,14 +805,22 @@ do_backup_instance(void)
 		arg->from_root = pgdata;
 		arg->to_root = database_path;
 		arg->files_list = backup_files_list;
+		arg->parts_list = backup_files_parts;
 		arg->prev_filelist = prev_backup_filelist;
 		arg->prev_start_lsn = prev_backup_start_lsn;
+		arg->prev_start_time = prev_backup ? prev_backup->start_time : 0;
 		arg->backup_conn = NULL;
 		arg->cancel_conn = NULL;
 		/* By default there are some error */
 		arg->ret = 1;
 	}
 
+	open_backup_journal();
+
+	/* Compression threads are separate from threads reading data files */
+	if (!is_remote_backup)
+		start_compress_workers(compress_threads);
+
 	/* Run threads */
 	elog(LOG, "Start transfering data files");
 	for (i = 0; i < num_threads; i++)
@@ -737,11 +842,19 @@ do_backup_instance(void)
 		if (threads_args[i].ret == 1)
 			backup_isok = false;
 	}
+	stop_compress_workers();
 	if (backup_isok)
 		elog(LOG, "Data files are transfered");
 	else
 		elog(ERROR, "Data files transferring failed");
 
+	/* Pages put into the page store are flushed to disk at once */
+	if (current.dedup)
+		page_store_finish();
+
+	/* Parts are owned by their files */
+	parray_free(backup_files_parts);
+
 	/* clean previous backup file list */
 	if (prev_backup_filelist)
 	{
@@ -771,12 +884,7 @@ do_backup_instance(void)
 				calc_file_checksum(file);
 			/* Remove file path root prefix*/
 			if (strstr(file->path, database_path) == file->path)
-			{
-				char	   *ptr = file->path;
-
-				file->path = pstrdup(GetRelativePath(ptr, database_path));
-				free(ptr);
-			}
+				pgFileSetPath(file, GetRelativePath(file->path, database_path));
 		}
 
 		/* Add xlog files into the list of backed up files */
@@ -786,6 +894,7 @@ do_backup_instance(void)
 
 	/* Print the list of files to backup catalog */
 	pgBackupWriteFileList(&current, backup_files_list, pgdata);
+	close_backup_journal();
 
 	/* Compute summary of size of regular files in the backup */
 	for (i = 0; i < parray_num(backup_files_list); i++)
@@ -796,13 +905,20 @@ do_backup_instance(void)
 			current.data_bytes += 4096;
 
 		/* Count the amount of the data actually copied */
-		if (S_ISREG(file->mode))
+		if (S_ISREG(file->mode) && file->write_size != BYTES_INVALID)
 			current.data_bytes += file->write_size;
 	}
 
 	parray_walk(backup_files_list, pgFileFree);
 	parray_free(backup_files_list);
 	backup_files_list = NULL;
+
+	if (resume_files_list)
+	{
+		parray_walk(resume_files_list, pgFileFree);
+		parray_free(resume_files_list);
+		resume_files_list = NULL;
+	}
 }
 
 /*
@@ -829,6 +945,22 @@ do_backup(time_t start_time)
 	current.compress_alg = compress_alg;
 	current.compress_level = compress_level;
 
+	if (dedup)
+	{
+#if PG_VERSION_NUM < 100000
+		elog(ERROR, "Page deduplication requires PostgreSQL 10 or newer");
+#endif
+		if (is_remote_backup)
+			elog(WARNING, "Page deduplication is not supported by remote backup, "
+				 "option --dedup is ignored");
+		else
+		{
+			current.dedup = true;
+			current.format_version = BACKUP_FORMAT_VERSION;
+		}
+	}
+	current.block_index = block_index;
+
 	/* Confirm data block size and xlog block size are compatible */
 	confirm_block_size("block_size", BLCKSZ);
 	confirm_block_size("wal_block_size", XLOG_BLCKSZ);
@@ -895,14 +1027,21 @@ do_backup(time_t start_time)
 	if (!is_remote_backup)
 		check_system_identifiers();
 
+	if (current.dedup)
+		dir_create_dir(page_store_path, DIR_PERMISSION);
 
 	/* Start backup. Update backup status. */
 	current.status = BACKUP_STATUS_RUNNING;
-	current.start_time = start_time;
+	if (resume_backup)
+		prepare_backup_resume();
+	else
+	{
+		current.start_time = start_time;
 
-	/* Create backup directory and BACKUP_CONTROL_FILE */
-	if (pgBackupCreateDir(&current))
-		elog(ERROR, "cannot create backup directory");
+		/* Create backup directory and BACKUP_CONTROL_FILE */
+		if (pgBackupCreateDir(&current))
+			elog(ERROR, "cannot create backup directory");
+	}
 	pgBackupWriteBackupControlFile(&current);
 
 	elog(LOG, "Backup destination is initialized");
@@ -1025,7 +1164,7 @@ check_system_identifiers(void)
 	uint64		system_id_conn;
 	uint64		system_id_pgdata;
 
-	system_id_pgdata = get_system_identifier(pgdata);
+	system_id_pgdata = get_system_identifier(pgdata, false);
 	system_id_conn = get_remote_system_identifier(backup_conn);
 
 	if (system_id_conn != system_identifier)
@@ -1341,29 +1480,58 @@ pg_ptrack_get_and_clear_db(Oid dbOid, Oid tblspcOid)
 	return result;
 }
 
-/* Read and clear ptrack files of the target relation.
- * Result is a bytea ptrack map of all segments of the target relation.
+static int
+ptrack_map_compare(const void *a, const void *b)
+{
+	Oid			a_oid = (*(PtrackMap * const *) a)->relOid;
+	Oid			b_oid = (*(PtrackMap * const *) b)->relOid;
+
+	if (a_oid > b_oid)
+		return 1;
+	else if (a_oid < b_oid)
+		return -1;
+	return 0;
+}
+
+static void
+ptrack_map_free(void *map)
+{
+	PtrackMap  *ptrack_map = (PtrackMap *) map;
+
+	if (ptrack_map->map)
+		PQfreemem(ptrack_map->map);
+	free(ptrack_map);
+}
+
+/*
+ * Read and clear ptrack files of the relations of one database.
+ * Each map is a bytea ptrack map of all segments of the relation.
+ * Maps of up to PTRACK_MAP_BATCH relations are requested by a single query,
+ * so the number of round trips doesn't depend on the number of relations.
+ *
+ * Returns array of PtrackMap sorted by relOid, or NULL if the database
+ * doesn't exist anymore or it is template0.
  * case 1: we know a tablespace_oid, db_oid, and rel_filenode
  * case 2: we know db_oid and rel_filenode (no tablespace_oid, because file in pg_default)
  * case 3: we know only rel_filenode (because file in pg_global)
  */
-static char *
-pg_ptrack_get_and_clear(Oid tablespace_oid, Oid db_oid, Oid rel_filenode,
-						size_t *result_size)
+static parray *
+pg_ptrack_get_and_clear_rels(Oid tablespace_oid, Oid db_oid,
+							 Oid *rel_oids, int n)
 {
 	PGconn	   *tmp_conn;
-	PGresult   *res_db,
-			   *res;
+	PGresult   *res;
 	char	   *params[2];
-	char	   *result;
-	char	   *val;
+	PQExpBufferData oids;
+	parray	   *maps;
+	int			i;
 
 	params[0] = palloc(64);
-	params[1] = palloc(64);
 
 	/* regular file (not in directory 'global') */
 	if (db_oid != 0)
 	{
+		PGresult   *res_db;
 		char	   *dbname;
 
 		sprintf(params[0], "%i", db_oid);
@@ -1375,64 +1543,88 @@ pg_ptrack_get_and_clear(Oid tablespace_oid, Oid db_oid, Oid rel_filenode,
 		 * It could have been deleted since previous backup.
 		 */
 		if (PQntuples(res_db) != 1 || PQnfields(res_db) != 1)
+		{
+			PQclear(res_db);
+			pfree(params[0]);
 			return NULL;
+		}
 
 		dbname = PQgetvalue(res_db, 0, 0);
 
 		if (strcmp(dbname, "template0") == 0)
 		{
 			PQclear(res_db);
+			pfree(params[0]);
 			return NULL;
 		}
 
 		tmp_conn = pgut_connect(dbname);
-		sprintf(params[0], "%i", tablespace_oid);
-		sprintf(params[1], "%i", rel_filenode);
-		res = pgut_execute(tmp_conn, "SELECT pg_catalog.pg_ptrack_get_and_clear($1, $2)",
-						   2, (const char **)params);
-
-		if (PQnfields(res) != 1)
-			elog(ERROR, "cannot get ptrack file from database \"%s\" by tablespace oid %u and relation oid %u",
-				 dbname, tablespace_oid, rel_filenode);
 		PQclear(res_db);
-		pgut_disconnect(tmp_conn);
 	}
-	/* file in directory 'global' */
+	/*
+	 * file in directory 'global'
+	 * Use backup_conn, cause we can do it from any database.
+	 */
 	else
+		tmp_conn = backup_conn;
+
+	maps = parray_new();
+	initPQExpBuffer(&oids);
+	sprintf(params[0], "%i", tablespace_oid);
+
+	for (i = 0; i < n; i += PTRACK_MAP_BATCH)
 	{
-		/*
-		 * execute ptrack_get_and_clear for relation in pg_global
-		 * Use backup_conn, cause we can do it from any database.
-		 */
-		sprintf(params[0], "%i", tablespace_oid);
-		sprintf(params[1], "%i", rel_filenode);
-		res = pgut_execute(backup_conn, "SELECT pg_catalog.pg_ptrack_get_and_clear($1, $2)",
+		int			batch_n = Min(n - i, PTRACK_MAP_BATCH);
+		int			j;
+
+		/* Array of relation oids in the text form: {1,2,3} */
+		resetPQExpBuffer(&oids);
+		appendPQExpBufferChar(&oids, '{');
+		for (j = 0; j < batch_n; j++)
+			appendPQExpBuffer(&oids, j > 0 ? ",%u" : "%u", rel_oids[i + j]);
+		appendPQExpBufferChar(&oids, '}');
+		params[1] = oids.data;
+
+		res = pgut_execute(tmp_conn,
+						   "SELECT r.oid, pg_catalog.pg_ptrack_get_and_clear($1, r.oid) "
+						   "FROM unnest($2::oid[]) AS r(oid)",
 						   2, (const char **)params);
 
-		if (PQnfields(res) != 1)
-			elog(ERROR, "cannot get ptrack file from pg_global tablespace and relation oid %u",
-			 rel_filenode);
-	}
+		if (PQnfields(res) != 2)
+			elog(ERROR, "cannot get ptrack files from database %u by tablespace oid %u",
+				 db_oid, tablespace_oid);
 
-	val = PQgetvalue(res, 0, 0);
+		for (j = 0; j < PQntuples(res); j++)
+		{
+			PtrackMap  *ptrack_map = pgut_new(PtrackMap);
+			char	   *val = PQgetvalue(res, j, 1);
 
-	/* TODO Now pg_ptrack_get_and_clear() returns bytea ending with \x.
-	 * It should be fixed in future ptrack releases, but till then we
-	 * can parse it.
-	 */
-	if (strcmp("x", val+1) == 0)
-	{
-		/* Ptrack file is missing */
-		return NULL;
+			ptrack_map->relOid = (Oid) strtoul(PQgetvalue(res, j, 0), NULL, 10);
+			ptrack_map->map = NULL;
+			ptrack_map->size = 0;
+
+			/* TODO Now pg_ptrack_get_and_clear() returns bytea ending with \x.
+			 * It should be fixed in future ptrack releases, but till then we
+			 * can parse it.
+			 */
+			if (!PQgetisnull(res, j, 1) && strcmp("x", val+1) != 0)
+				ptrack_map->map = (char *) PQunescapeBytea((unsigned char *) val,
+														   &ptrack_map->size);
+			/* Otherwise ptrack file is missing */
+
+			parray_append(maps, ptrack_map);
+		}
+		PQclear(res);
 	}
 
-	result = (char *) PQunescapeBytea((unsigned char *) PQgetvalue(res, 0, 0),
-									  result_size);
-	PQclear(res);
+	if (tmp_conn != backup_conn)
+		pgut_disconnect(tmp_conn);
+
+	termPQExpBuffer(&oids);
 	pfree(params[0]);
-	pfree(params[1]);
 
-	return result;
+	parray_qsort(maps, ptrack_map_compare);
+	return maps;
 }
 
 /*
@@ -1835,8 +2027,7 @@ pg_stop_backup(pgBackup *backup)
 			{
 				file = pgFileNew(backup_label, true);
 				calc_file_checksum(file);
-				free(file->path);
-				file->path = strdup(PG_BACKUP_LABEL_FILE);
+				pgFileSetPath(file, PG_BACKUP_LABEL_FILE);
 				parray_append(backup_files_list, file);
 			}
 		}
@@ -1880,8 +2071,7 @@ pg_stop_backup(pgBackup *backup)
 				file = pgFileNew(tablespace_map, true);
 				if (S_ISREG(file->mode))
 					calc_file_checksum(file);
-				free(file->path);
-				file->path = strdup(PG_TABLESPACE_MAP_FILE);
+				pgFileSetPath(file, PG_TABLESPACE_MAP_FILE);
 				parray_append(backup_files_list, file);
 			}
 		}
@@ -2010,6 +2200,329 @@ backup_disconnect(bool fatal, void *userdata)
 		pgut_disconnect(master_conn);
 }
 
+/*
+ * Split large data files into parts of FILE_PART_BLOCKS blocks, which are
+ * backed up by backup_files() threads independently.
+ */
+static void
+split_data_files(parray *files, parray *prev_files, parray *parts)
+{
+	int			i;
+
+	for (i = 0; i < parray_num(files); i++)
+	{
+		pgFile	   *file = (pgFile *) parray_get(files, i);
+
+		if (!S_ISREG(file->mode) || !file->is_datafile || file->is_cfs ||
+			file->size <= FILE_PART_SIZE)
+			continue;
+
+		/* The file is probably already copied by the resumed backup */
+		if (resume_file_lookup(file))
+			continue;
+
+		/* Check that file exist in previous backup, as backup_files() does */
+		if (current.backup_mode != BACKUP_MODE_FULL)
+		{
+			pgFile		key;
+
+			key.path = GetRelativePath(file->path, pgdata);
+			if (parray_bsearch(prev_files, &key, pgFileComparePath))
+				file->exists_in_prev = true;
+		}
+
+		/* Unchanged file is skipped by backup_data_file() at once */
+		if ((current.backup_mode == BACKUP_MODE_DIFF_PAGE ||
+			 current.backup_mode == BACKUP_MODE_DIFF_PTRACK) &&
+			file->pagemap.bitmapsize == PageBitmapIsEmpty &&
+			file->exists_in_prev && !file->pagemap_isabsent)
+			continue;
+
+		pgFileSplit(file, file->size / BLCKSZ, parts);
+	}
+}
+
+/*
+ * Check whether non-data file didn't change since previous backup. The file
+ * is unchanged if it has the same size and modification time as in previous
+ * backup, and it wasn't modified after previous backup had started. Otherwise
+ * if the size is the same, compare CRC of the file with CRC of its copy.
+ */
+static bool
+file_is_unchanged(pgFile *file, pgFile *prev_file, struct stat *st,
+				  time_t prev_start_time)
+{
+	FILE	   *in;
+	pg_crc32	crc;
+	char		buf[BLCKSZ];
+	size_t		read_len;
+
+	file->size = st->st_size;
+	file->mtime = st->st_mtime;
+
+	/* Old backups don't have size and mtime of files */
+	if (prev_file->mtime == 0 || file->size != prev_file->size)
+		return false;
+
+	if (file->mtime == prev_file->mtime && file->mtime < prev_start_time)
+		return true;
+
+	in = fopen(file->path, PG_BINARY_R);
+	if (in == NULL)
+		/* The file will be handled by copy_file() */
+		return false;
+
+	INIT_CRC32C(crc);
+	for (;;)
+	{
+		int64		io_start;
+
+		if (interrupted)
+			elog(ERROR, "interrupted during backup");
+
+		io_start = io_throttle_start(sizeof(buf));
+		read_len = fread(buf, 1, sizeof(buf), in);
+		io_throttle_end(io_start);
+		if (read_len == 0)
+			break;
+		COMP_CRC32C(crc, buf, read_len);
+	}
+	FIN_CRC32C(crc);
+
+	if (ferror(in))
+	{
+		fclose(in);
+		return false;
+	}
+	fclose(in);
+
+	return crc == prev_file->crc;
+}
+
+/*
+ * Find the backup to resume and read the journal of files copied by its
+ * interrupted run.
+ *
+ * The resumed backup gets new start LSN from pg_start_backup(), so a file
+ * copied by the interrupted run is reused only if it wasn't modified since
+ * the interrupted run had started, see resume_file_lookup().
+ */
+static void
+prepare_backup_resume(void)
+{
+	parray	   *backup_list;
+	pgBackup   *backup = NULL;
+	char		path[MAXPGPATH];
+	FILE	   *fp;
+	long		len = 0;
+	long		pos = 0;
+	int			c;
+
+	if (is_remote_backup)
+		elog(ERROR, "Remote backup cannot be resumed");
+	if (current.backup_mode == BACKUP_MODE_DIFF_PTRACK)
+		elog(ERROR, "PTRACK backup cannot be resumed, ptrack maps are "
+			 "cleared by the interrupted backup");
+
+	/* Only the last backup of the instance can be resumed */
+	backup_list = catalog_get_backup_list(INVALID_BACKUP_ID);
+	if (parray_num(backup_list) > 0)
+		backup = (pgBackup *) parray_get(backup_list, 0);
+	if (backup == NULL)
+		elog(ERROR, "There are no backups to resume");
+	if (current.backup_id != INVALID_BACKUP_ID &&
+		backup->start_time != current.backup_id)
+		elog(ERROR, "Backup %s is not the last backup of the instance",
+			 base36enc(current.backup_id));
+
+	if (backup->status != BACKUP_STATUS_RUNNING &&
+		backup->status != BACKUP_STATUS_ERROR)
+		elog(ERROR, "Backup %s has status %s, only RUNNING or ERROR backup "
+			 "can be resumed",
+			 base36enc(backup->start_time), status2str(backup->status));
+	if (backup->backup_mode != current.backup_mode)
+		elog(ERROR, "Backup %s has backup mode %s",
+			 base36enc(backup->start_time),
+			 deparse_backup_mode(backup->backup_mode));
+	if (backup->stream != current.stream)
+		elog(ERROR, "Backup %s was taken %s --stream",
+			 base36enc(backup->start_time), backup->stream ? "with" : "without");
+	if (backup->dedup != current.dedup)
+		elog(ERROR, "Backup %s was taken %s --dedup",
+			 base36enc(backup->start_time), backup->dedup ? "with" : "without");
+	if (backup->block_index != current.block_index)
+		elog(ERROR, "Backup %s was taken %s --block-index",
+			 base36enc(backup->start_time),
+			 backup->block_index ? "with" : "without");
+
+	current.start_time = backup->start_time;
+	resume_parent_backup = backup->parent_backup;
+
+	elog(INFO, "Resuming backup %s", base36enc(current.start_time));
+
+	/* Drop the last entry of the journal if it was written partially */
+	pgBackupGetPath(&current, path, lengthof(path), DATABASE_FILE_JOURNAL);
+	fp = fopen(path, PG_BINARY_R);
+	if (fp == NULL)
+	{
+		if (errno != ENOENT)
+			elog(ERROR, "cannot open file \"%s\": %s", path, strerror(errno));
+	}
+	else
+	{
+		while ((c = fgetc(fp)) != EOF)
+		{
+			pos++;
+			if (c == '\n')
+				len = pos;
+		}
+		if (ferror(fp))
+			elog(ERROR, "cannot read file \"%s\": %s", path, strerror(errno));
+		fclose(fp);
+
+		if (len != pos && truncate(path, len) != 0)
+			elog(ERROR, "cannot truncate file \"%s\": %s", path,
+				 strerror(errno));
+
+		resume_files_list = dir_read_file_list(NULL, path);
+		parray_qsort(resume_files_list, pgFileComparePath);
+	}
+
+	if (resume_files_list == NULL)
+		resume_files_list = parray_new();
+
+	elog(LOG, "Interrupted backup has copied %lu files",
+		 (unsigned long) parray_num(resume_files_list));
+
+	parray_walk(backup_list, pgBackupFree);
+	parray_free(backup_list);
+}
+
+/*
+ * Find the copy of the file made by the interrupted run of the resumed
+ * backup. The copy may be reused if the file has the same size and
+ * modification time and wasn't modified after the interrupted run had
+ * started. pg_start_backup() of the resumed backup flushes all buffers
+ * modified before its start LSN, so the file didn't change since that copy.
+ */
+static pgFile *
+resume_file_lookup(pgFile *file)
+{
+	pgFile		key;
+	pgFile	  **prev_file;
+
+	if (resume_files_list == NULL || !S_ISREG(file->mode))
+		return NULL;
+
+	key.path = GetRelativePath(file->path, pgdata);
+	prev_file = (pgFile **) parray_bsearch(resume_files_list, &key,
+										   pgFileComparePath);
+	if (prev_file == NULL)
+		return NULL;
+
+	if ((*prev_file)->mtime == 0 ||
+		(*prev_file)->mtime != file->mtime ||
+		(*prev_file)->mtime >= current.start_time ||
+		(*prev_file)->size != file->size ||
+		(*prev_file)->is_datafile != file->is_datafile ||
+		(*prev_file)->is_cfs != file->is_cfs)
+		return NULL;
+
+	return *prev_file;
+}
+
+/*
+ * Reuse the copy of the file made by the interrupted run of the resumed
+ * backup if it is unchanged and its CRC is valid.
+ */
+static bool
+resume_file(pgFile *file, const char *to_root)
+{
+	pgFile	   *prev_file = resume_file_lookup(file);
+
+	if (prev_file == NULL)
+		return false;
+
+	if (prev_file->write_size != BYTES_INVALID)
+	{
+		char		to_path[MAXPGPATH];
+		struct stat	st;
+
+		join_path_components(to_path, to_root, prev_file->path);
+		/*
+		 * Pages stored by the interrupted run could be lost if they were not
+		 * flushed to disk, so references of the copy are checked too.
+		 */
+		if (stat(to_path, &st) != 0 || st.st_size != prev_file->write_size ||
+			pgFileGetCRC(to_path) != prev_file->crc ||
+			(current.dedup && prev_file->is_datafile && !prev_file->is_cfs &&
+			 !check_page_references(to_path)))
+		{
+			elog(LOG, "Copy of file \"%s\" made by the interrupted backup is "
+				 "invalid", file->path);
+			return false;
+		}
+	}
+
+	file->write_size = prev_file->write_size;
+	file->crc = prev_file->crc;
+	file->compress_alg = prev_file->compress_alg;
+	file->n_blocks = prev_file->n_blocks;
+
+	return true;
+}
+
+/*
+ * Open DATABASE_FILE_JOURNAL of the current backup for writing. Entries of
+ * the old journal of the resumed backup were already read.
+ */
+static void
+open_backup_journal(void)
+{
+	char		path[MAXPGPATH];
+
+	pgBackupGetPath(&current, path, lengthof(path), DATABASE_FILE_JOURNAL);
+	backup_journal = fopen(path, PG_BINARY_W);
+	if (backup_journal == NULL)
+		elog(ERROR, "cannot open file \"%s\": %s", path, strerror(errno));
+}
+
+/*
+ * Remove the journal, the file list of the backup is written.
+ */
+static void
+close_backup_journal(void)
+{
+	char		path[MAXPGPATH];
+
+	if (backup_journal == NULL)
+		return;
+
+	fclose(backup_journal);
+	backup_journal = NULL;
+
+	pgBackupGetPath(&current, path, lengthof(path), DATABASE_FILE_JOURNAL);
+	if (unlink(path) != 0 && errno != ENOENT)
+		elog(WARNING, "cannot remove file \"%s\": %s", path, strerror(errno));
+}
+
+/*
+ * Append the file which is completely copied into the backup to the journal.
+ */
+static void
+journal_file(pgFile *file)
+{
+	if (backup_journal == NULL)
+		return;
+
+	pthread_lock(&backup_journal_mutex);
+	print_file_entry(backup_journal, file, pgdata);
+	if (fflush(backup_journal) != 0)
+		elog(ERROR, "cannot write file \"%s\": %s", DATABASE_FILE_JOURNAL,
+			 strerror(errno));
+	pthread_mutex_unlock(&backup_journal_mutex);
+}
+
 /*
  * Take a backup of the PGDATA at a file level.
  * Copy all directories and files listed in backup_files_list.
@@ -2025,6 +2538,47 @@ backup_files(void *arg)
 	backup_files_arg *arguments = (backup_files_arg *) arg;
 	int			n_backup_files_list = parray_num(arguments->files_list);
 
+	/* backup parts of large data files */
+	for (i = 0; i < parray_num(arguments->parts_list); i++)
+	{
+		pgFilePart *part = (pgFilePart *) parray_get(arguments->parts_list, i);
+		pgFile	   *file = part->file;
+		char		to_path[MAXPGPATH];
+
+		if (!pg_atomic_test_set_flag(&part->lock))
+			continue;
+
+		/* check for interrupt */
+		if (interrupted)
+			elog(ERROR, "interrupted during backup");
+
+		elog(VERBOSE, "Copying part %d of file \"%s\"", part->partno,
+			 file->path);
+
+		join_path_components(to_path, arguments->to_root,
+							 file->path + strlen(arguments->from_root) + 1);
+		backup_data_file_part(arguments, to_path, part,
+							  arguments->prev_start_lsn,
+							  current.backup_mode,
+							  compress_alg, compress_level);
+
+		/* The thread which finished the last part makes the backup file */
+		if (pg_atomic_add_fetch_u32(&file->n_parts_done, 1) == file->n_parts)
+		{
+			if (!join_data_file_parts(to_path, file, current.backup_mode))
+			{
+				file->write_size = BYTES_INVALID;
+				elog(VERBOSE, "File \"%s\" was not copied to backup", file->path);
+				journal_file(file);
+				continue;
+			}
+
+			elog(VERBOSE, "File \"%s\". Copied "INT64_FORMAT " bytes",
+				 file->path, file->write_size);
+			journal_file(file);
+		}
+	}
+
 	/* backup a file */
 	for (i = 0; i < n_backup_files_list; i++)
 	{
@@ -2036,6 +2590,10 @@ backup_files(void *arg)
 		if (!pg_atomic_test_set_flag(&file->lock))
 			continue;
 
+		/* The file is backed up by parts */
+		if (file->parts)
+			continue;
+
 		/* check for interrupt */
 		if (interrupted)
 			elog(ERROR, "interrupted during backup");
@@ -2072,12 +2630,21 @@ backup_files(void *arg)
 
 		if (S_ISREG(buf.st_mode))
 		{
+			pgFile	  **prev_file = NULL;
+
+			if (resume_file(file, arguments->to_root))
+			{
+				elog(VERBOSE, "Skip file \"%s\", it is copied by the interrupted backup",
+					 file->path);
+				journal_file(file);
+				continue;
+			}
+
 			/* Check that file exist in previous backup */
 			if (current.backup_mode != BACKUP_MODE_FULL)
 			{
 				char	   *relative;
 				pgFile		key;
-				pgFile	  **prev_file;
 
 				relative = GetRelativePath(file->path, arguments->from_root);
 				key.path = relative;
@@ -2104,19 +2671,24 @@ backup_files(void *arg)
 				{
 					file->write_size = BYTES_INVALID;
 					elog(VERBOSE, "File \"%s\" was not copied to backup", file->path);
+					journal_file(file);
 					continue;
 				}
 			}
-			/* TODO:
-			 * Check if file exists in previous backup
-			 * If exists:
-			 *   if mtime > start_backup_time of parent backup,
-			 *    copy file to backup
-			 *   if mtime < start_backup_time
-			 *    calculate crc, compare crc to old file
-			 *      if crc is the same -> skip file
-			 */
-			else if (!copy_file(arguments->from_root, arguments->to_root, file))
+			else if (prev_file &&
+					 file_is_unchanged(file, *prev_file, &buf,
+									   arguments->prev_start_time))
+			{
+				/* The file is taken from previous backup on restore */
+				file->write_size = BYTES_INVALID;
+				file->crc = (*prev_file)->crc;
+				elog(VERBOSE, "Skip file \"%s\", the file didn't change",
+					 file->path);
+				journal_file(file);
+				continue;
+			}
+			else if (!copy_file(arguments->from_root, arguments->to_root, file,
+							   true))
 			{
 				file->write_size = BYTES_INVALID;
 				elog(VERBOSE, "File \"%s\" was not copied to backup", file->path);
@@ -2125,6 +2697,7 @@ backup_files(void *arg)
 
 			elog(VERBOSE, "File \"%s\". Copied "INT64_FORMAT " bytes",
 				 file->path, file->write_size);
+			journal_file(file);
 		}
 		else
 			elog(LOG, "unexpected file type %d", buf.st_mode);
@@ -2276,54 +2849,37 @@ set_cfs_datafiles(parray *files, const char *root, char *relative, size_t i)
 }
 
 /*
- * Find pgfile by given rnode in the backup_files_list
- * and add given blkno to its pagemap.
+ * Get ptrack maps of all relations of the database 'db_file' by a few
+ * queries. Relation files of the database follow the database directory in
+ * the sorted list of files.
  */
-void
-process_block_change(ForkNumber forknum, RelFileNode rnode, BlockNumber blkno)
+static parray *
+get_database_ptrack_maps(parray *files, size_t db_index)
 {
-	char	   *path;
-	char	   *rel_path;
-	BlockNumber blkno_inseg;
-	int			segno;
-	pgFile	  **file_item;
-	pgFile		f;
-
-	segno = blkno / RELSEG_SIZE;
-	blkno_inseg = blkno % RELSEG_SIZE;
-
-	rel_path = relpathperm(rnode, forknum);
-	if (segno > 0)
-		path = psprintf("%s/%s.%u", pgdata, rel_path, segno);
-	else
-		path = psprintf("%s/%s", pgdata, rel_path);
-
-	pg_free(rel_path);
-
-	f.path = path;
-	/* backup_files_list should be sorted before */
-	file_item = (pgFile **) parray_bsearch(backup_files_list, &f,
-										   pgFileComparePath);
+	pgFile	   *db_file = (pgFile *) parray_get(files, db_index);
+	Oid		   *rel_oids;
+	int			n = 0;
+	size_t		i;
+	parray	   *maps;
 
-	/*
-	 * If we don't have any record of this file in the file map, it means
-	 * that it's a relation that did not have much activity since the last
-	 * backup. We can safely ignore it. If it is a new relation file, the
-	 * backup would simply copy it as-is.
-	 */
-	if (file_item)
+	rel_oids = pgut_malloc(sizeof(Oid) * (parray_num(files) - db_index));
+	for (i = db_index + 1; i < parray_num(files); i++)
 	{
-		/* We need critical section only we use more than one threads */
-		if (num_threads > 1)
-			pthread_lock(&backup_pagemap_mutex);
+		pgFile	   *file = (pgFile *) parray_get(files, i);
 
-		datapagemap_add(&(*file_item)->pagemap, blkno_inseg);
+		if (!path_is_prefix_of_path(db_file->path, file->path))
+			break;
 
-		if (num_threads > 1)
-			pthread_mutex_unlock(&backup_pagemap_mutex);
+		/* get ptrack bitmap once for all segments of the file */
+		if (file->is_datafile && file->segno == 0)
+			rel_oids[n++] = file->relOid;
 	}
 
-	pg_free(path);
+	maps = pg_ptrack_get_and_clear_rels(db_file->tblspcOid, db_file->dbOid,
+										rel_oids, n);
+	free(rel_oids);
+
+	return maps;
 }
 
 /*
@@ -2337,8 +2893,7 @@ make_pagemap_from_ptrack(parray *files)
 	size_t		i;
 	Oid dbOid_with_ptrack_init = 0;
 	Oid tblspcOid_with_ptrack_init = 0;
-	char	   *ptrack_nonparsed = NULL;
-	size_t		ptrack_nonparsed_size = 0;
+	parray	   *ptrack_maps = NULL;
 
 	elog(LOG, "Compiling pagemap");
 	for (i = 0; i < parray_num(files); i++)
@@ -2357,6 +2912,14 @@ make_pagemap_from_ptrack(parray *files)
 			Assert(filename != NULL);
 			filename++;
 
+			/* release maps of the previous database */
+			if (ptrack_maps)
+			{
+				parray_walk(ptrack_maps, ptrack_map_free);
+				parray_free(ptrack_maps);
+				ptrack_maps = NULL;
+			}
+
 			/*
 			 * The function pg_ptrack_get_and_clear_db returns true
 			 * if there was a ptrack_init file.
@@ -2369,10 +2932,16 @@ make_pagemap_from_ptrack(parray *files)
 				dbOid_with_ptrack_init = file->dbOid;
 				tblspcOid_with_ptrack_init = file->tblspcOid;
 			}
+			else
+				ptrack_maps = get_database_ptrack_maps(files, i);
 		}
 
 		if (file->is_datafile)
 		{
+			PtrackMap	key;
+			PtrackMap  *key_ptr = &key;
+			PtrackMap **ptrack_map = NULL;
+
 			if (file->tblspcOid == tblspcOid_with_ptrack_init &&
 				file->dbOid == dbOid_with_ptrack_init)
 			{
@@ -2382,19 +2951,18 @@ make_pagemap_from_ptrack(parray *files)
 				continue;
 			}
 
-			/* get ptrack bitmap once for all segments of the file */
-			if (file->segno == 0)
+			if (ptrack_maps)
 			{
-				/* release previous value */
-				pg_free(ptrack_nonparsed);
-				ptrack_nonparsed_size = 0;
-
-				ptrack_nonparsed = pg_ptrack_get_and_clear(file->tblspcOid, file->dbOid,
-											   file->relOid, &ptrack_nonparsed_size);
+				key.relOid = file->relOid;
+				ptrack_map = (PtrackMap **) parray_bsearch(ptrack_maps, key_ptr,
+														   ptrack_map_compare);
 			}
 
-			if (ptrack_nonparsed != NULL)
+			if (ptrack_map != NULL && (*ptrack_map)->map != NULL)
 			{
+				char	   *ptrack_nonparsed = (*ptrack_map)->map;
+				size_t		ptrack_nonparsed_size = (*ptrack_map)->size;
+
 				/*
 				 * pg_ptrack_get_and_clear() returns ptrack with VARHDR cutted out.
 				 * Compute the beginning of the ptrack map related to this segment
@@ -2448,6 +3016,13 @@ make_pagemap_from_ptrack(parray *files)
 			}
 		}
 	}
+
+	if (ptrack_maps)
+	{
+		parray_walk(ptrack_maps, ptrack_map_free);
+		parray_free(ptrack_maps);
+	}
+
 	elog(LOG, "Pagemap compiled");
 //	res = pgut_execute(backup_conn, "SET client_min_messages = warning;", 0, NULL, true);
 //	PQclear(pgut_execute(backup_conn, "CHECKPOINT;", 0, NULL, true));
@@ -2621,22 +3196,29 @@ get_last_ptrack_lsn(void)
 	return lsn;
 }
 
-char *
-pg_ptrack_get_block(backup_files_arg *arguments,
-					Oid dbOid,
-					Oid tblsOid,
-					Oid relOid,
-					BlockNumber blknum,
-					size_t *result_size)
+/*
+ * Get 'n' blocks of the relation by a single query.
+ *
+ * Blocks are returned in the 'pages' array in the order of 'blknums',
+ * a NULL element means that the block was truncated. Pages are allocated by
+ * PQunescapeBytea() and should be freed by the caller.
+ */
+void
+pg_ptrack_get_blocks(backup_files_arg *arguments,
+					 Oid dbOid,
+					 Oid tblsOid,
+					 Oid relOid,
+					 BlockNumber *blknums, int n,
+					 char **pages, size_t *page_sizes)
 {
 	PGresult   *res;
 	char	   *params[4];
-	char	   *result;
+	PQExpBufferData blocks;
+	int			i;
 
 	params[0] = palloc(64);
 	params[1] = palloc(64);
 	params[2] = palloc(64);
-	params[3] = palloc(64);
 
 	/*
 	 * Use tmp_conn, since we may work in parallel threads.
@@ -2645,7 +3227,14 @@ pg_ptrack_get_block(backup_files_arg *arguments,
 	sprintf(params[0], "%i", tblsOid);
 	sprintf(params[1], "%i", dbOid);
 	sprintf(params[2], "%i", relOid);
-	sprintf(params[3], "%u", blknum);
+
+	/* Array of block numbers in the text form: {1,2,3} */
+	initPQExpBuffer(&blocks);
+	appendPQExpBufferChar(&blocks, '{');
+	for (i = 0; i < n; i++)
+		appendPQExpBuffer(&blocks, i > 0 ? ",%u" : "%u", blknums[i]);
+	appendPQExpBufferChar(&blocks, '}');
+	params[3] = blocks.data;
 
 	if (arguments->backup_conn == NULL)
 	{
@@ -2655,35 +3244,34 @@ pg_ptrack_get_block(backup_files_arg *arguments,
 	if (arguments->cancel_conn == NULL)
 		arguments->cancel_conn = PQgetCancel(arguments->backup_conn);
 
-	//elog(LOG, "db %i pg_ptrack_get_block(%i, %i, %u)",dbOid, tblsOid, relOid, blknum);
 	res = pgut_execute_parallel(arguments->backup_conn,
 								arguments->cancel_conn,
-					"SELECT pg_catalog.pg_ptrack_get_block_2($1, $2, $3, $4)",
+					"SELECT pg_catalog.pg_ptrack_get_block_2($1, $2, $3, b.blkno) "
+					"FROM unnest($4::int8[]) WITH ORDINALITY AS b(blkno, n) "
+					"ORDER BY b.n",
 					4, (const char **)params, true);
 
-	if (PQnfields(res) != 1)
+	for (i = 0; i < n; i++)
 	{
-		elog(VERBOSE, "cannot get file block for relation oid %u",
-					   relOid);
-		return NULL;
-	}
+		pages[i] = NULL;
+		page_sizes[i] = 0;
 
-	if (PQgetisnull(res, 0, 0))
-	{
-		elog(VERBOSE, "cannot get file block for relation oid %u",
-				   relOid);
-		return NULL;
-	}
+		if (PQnfields(res) != 1 || i >= PQntuples(res) ||
+			PQgetisnull(res, i, 0))
+		{
+			elog(VERBOSE, "cannot get file block %u for relation oid %u",
+				 blknums[i], relOid);
+			continue;
+		}
 
-	result = (char *) PQunescapeBytea((unsigned char *) PQgetvalue(res, 0, 0),
-									  result_size);
+		pages[i] = (char *) PQunescapeBytea((unsigned char *) PQgetvalue(res, i, 0),
+											&page_sizes[i]);
+	}
 
 	PQclear(res);
 
 	pfree(params[0]);
 	pfree(params[1]);
 	pfree(params[2]);
-	pfree(params[3]);
-
-	return result;
+	termPQExpBuffer(&blocks);
 }
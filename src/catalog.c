@@ -418,11 +418,17 @@ pgBackupWriteControl(FILE *out, pgBackup *backup)
 			deparse_compress_alg(backup->compress_alg));
 	fprintf(out, "compress-level = %d\n", backup->compress_level);
 	fprintf(out, "from-replica = %s\n", backup->from_replica ? "true" : "false");
+	if (backup->dedup)
+		fprintf(out, "dedup = true\n");
+	if (backup->block_index)
+		fprintf(out, "block-index = true\n");
 
 	fprintf(out, "\n#Compatibility\n");
 	fprintf(out, "block-size = %u\n", backup->block_size);
 	fprintf(out, "xlog-block-size = %u\n", backup->wal_block_size);
 	fprintf(out, "checksum-version = %u\n", backup->checksum_version);
+	if (backup->format_version > 1)
+		fprintf(out, "format-version = %u\n", backup->format_version);
 	fprintf(out, "program-version = %s\n", PROGRAM_VERSION);
 	if (backup->server_version[0] != '\0')
 		fprintf(out, "server-version = %s\n", backup->server_version);
@@ -462,6 +468,14 @@ pgBackupWriteControl(FILE *out, pgBackup *backup)
 	if (backup->wal_bytes != BYTES_INVALID)
 		fprintf(out, "wal-bytes = " INT64_FORMAT "\n", backup->wal_bytes);
 
+	/* Pages read again because they failed verification */
+	if (backup->page_retries > 0)
+	{
+		fprintf(out, "page-retries = " INT64_FORMAT "\n", backup->page_retries);
+		fprintf(out, "page-retry-time = " INT64_FORMAT "\n",
+				backup->page_retry_time);
+	}
+
 	fprintf(out, "status = %s\n", status2str(backup->status));
 
 	/* 'parent_backup' is set if it is incremental backup */
@@ -502,12 +516,12 @@ pgBackupWriteFileList(pgBackup *backup, parray *files, const char *root)
 
 	pgBackupGetPath(backup, path, lengthof(path), DATABASE_FILE_LIST);
 
-	fp = fopen(path, "wt");
+	fp = fopen(path, PG_BINARY_W);
 	if (fp == NULL)
 		elog(ERROR, "cannot open file list \"%s\": %s", path,
 			strerror(errno));
 
-	print_file_list(fp, files, root);
+	write_file_list(fp, files, root);
 
 	if (fflush(fp) != 0 ||
 		fsync(fileno(fp)) != 0 ||
@@ -546,17 +560,22 @@ readBackupControlFile(const char *path)
 		{'t', 0, "recovery-time",		&backup->recovery_time, SOURCE_FILE_STRICT},
 		{'I', 0, "data-bytes",			&backup->data_bytes, SOURCE_FILE_STRICT},
 		{'I', 0, "wal-bytes",			&backup->wal_bytes, SOURCE_FILE_STRICT},
+		{'I', 0, "page-retries",		&backup->page_retries, SOURCE_FILE_STRICT},
+		{'I', 0, "page-retry-time",		&backup->page_retry_time, SOURCE_FILE_STRICT},
 		{'u', 0, "block-size",			&backup->block_size, SOURCE_FILE_STRICT},
 		{'u', 0, "xlog-block-size",		&backup->wal_block_size, SOURCE_FILE_STRICT},
 		{'u', 0, "checksum-version",	&backup->checksum_version, SOURCE_FILE_STRICT},
+		{'u', 0, "format-version",		&backup->format_version, SOURCE_FILE_STRICT},
 		{'s', 0, "program-version",		&program_version, SOURCE_FILE_STRICT},
 		{'s', 0, "server-version",		&server_version, SOURCE_FILE_STRICT},
 		{'b', 0, "stream",				&backup->stream, SOURCE_FILE_STRICT},
 		{'s', 0, "status",				&status, SOURCE_FILE_STRICT},
 		{'s', 0, "parent-backup-id",	&parent_backup, SOURCE_FILE_STRICT},
 		{'s', 0, "compress-alg",		&compress_alg, SOURCE_FILE_STRICT},
-		{'u', 0, "compress-level",		&backup->compress_level, SOURCE_FILE_STRICT},
+		{'i', 0, "compress-level",		&backup->compress_level, SOURCE_FILE_STRICT},
 		{'b', 0, "from-replica",		&backup->from_replica, SOURCE_FILE_STRICT},
+		{'b', 0, "dedup",				&backup->dedup, SOURCE_FILE_STRICT},
+		{'b', 0, "block-index",			&backup->block_index, SOURCE_FILE_STRICT},
 		{'s', 0, "primary-conninfo",	&backup->primary_conninfo, SOURCE_FILE_STRICT},
 		{0}
 	};
@@ -728,6 +747,10 @@ parse_compress_alg(const char *arg)
 		return ZLIB_COMPRESS;
 	else if (pg_strncasecmp("pglz", arg, len) == 0)
 		return PGLZ_COMPRESS;
+	else if (pg_strncasecmp("zstd", arg, len) == 0)
+		return ZSTD_COMPRESS;
+	else if (pg_strncasecmp("lz4", arg, len) == 0)
+		return LZ4_COMPRESS;
 	else if (pg_strncasecmp("none", arg, len) == 0)
 		return NONE_COMPRESS;
 	else
@@ -748,6 +771,10 @@ deparse_compress_alg(int alg)
 			return "zlib";
 		case PGLZ_COMPRESS:
 			return "pglz";
+		case ZSTD_COMPRESS:
+			return "zstd";
+		case LZ4_COMPRESS:
+			return "lz4";
 	}
 
 	return NULL;
@@ -772,6 +799,8 @@ pgBackupInit(pgBackup *backup)
 
 	backup->data_bytes = BYTES_INVALID;
 	backup->wal_bytes = BYTES_INVALID;
+	backup->page_retries = 0;
+	backup->page_retry_time = 0;
 
 	backup->compress_alg = COMPRESS_ALG_DEFAULT;
 	backup->compress_level = COMPRESS_LEVEL_DEFAULT;
@@ -779,9 +808,12 @@ pgBackupInit(pgBackup *backup)
 	backup->block_size = BLCKSZ;
 	backup->wal_block_size = XLOG_BLCKSZ;
 	backup->checksum_version = 0;
+	backup->format_version = 1;
 
 	backup->stream = false;
 	backup->from_replica = false;
+	backup->dedup = false;
+	backup->block_index = false;
 	backup->parent_backup = INVALID_BACKUP_ID;
 	backup->parent_backup_link = NULL;
 	backup->primary_conninfo = NULL;
@@ -803,6 +835,21 @@ pgBackupCopy(pgBackup *dst, pgBackup *src)
 		dst->primary_conninfo = pstrdup(src->primary_conninfo);
 }
 
+/*
+ * Check that backup files have the format this binary can read.
+ */
+void
+pgBackupCheckFormat(pgBackup *backup)
+{
+	if (backup->format_version > BACKUP_FORMAT_VERSION)
+		elog(ERROR, "Backup %s has format version %u, but pg_probackup %s "
+			 "supports format versions up to %u. Use newer pg_probackup "
+			 "(backup was taken by pg_probackup %s)",
+			 base36enc(backup->start_time), backup->format_version,
+			 PROGRAM_VERSION, BACKUP_FORMAT_VERSION,
+			 backup->program_version);
+}
+
 /* free pgBackup object */
 void
 pgBackupFree(void *backup)
@@ -230,7 +230,7 @@ readBackupCatalogConfigFile(void)
 		{ 'u', 0, "retention-window",		&(config->retention_window),	SOURCE_FILE_STRICT },
 		/* compression options */
 		{ 'f', 0, "compress-algorithm",		opt_compress_alg,				SOURCE_CMDLINE },
-		{ 'u', 0, "compress-level",			&(config->compress_level),		SOURCE_CMDLINE },
+		{ 'i', 0, "compress-level",			&(config->compress_level),		SOURCE_CMDLINE },
 		/* logging options */
 		{ 'f', 0, "log-level-console",		opt_log_level_console,			SOURCE_CMDLINE },
 		{ 'f', 0, "log-level-file",			opt_log_level_file,				SOURCE_CMDLINE },
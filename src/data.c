@@ -9,22 +9,39 @@
  */
 
 #include "pg_probackup.h"
+#include "utils/thread.h"
 
+#include <fcntl.h>
 #include <unistd.h>
 #include <time.h>
+#include <sys/time.h>
 #include <sys/types.h>
 #include <sys/stat.h>
+#include <sys/mman.h>
+#include <dirent.h>
 
 #include "libpq/pqsignal.h"
 #include "storage/block.h"
 #include "storage/bufpage.h"
 #include "storage/checksum_impl.h"
 #include <common/pg_lzcompress.h>
+#if PG_VERSION_NUM >= 100000
+#include "common/sha2.h"
+#endif
 
 #ifdef HAVE_LIBZ
 #include <zlib.h>
 #endif
 
+#ifdef HAVE_LIBZSTD
+#include <zstd.h>
+#endif
+
+#ifdef HAVE_LIBLZ4
+#include <lz4.h>
+#include <lz4hc.h>
+#endif
+
 #ifdef HAVE_LIBZ
 /* Implementation of zlib compression method */
 static int32
@@ -49,6 +66,67 @@ zlib_decompress(void *dst, size_t dst_size, void const *src, size_t src_size)
 }
 #endif
 
+#ifdef HAVE_LIBZSTD
+/*
+ * Implementation of zstd compression method. Negative levels are "fast"
+ * levels of zstd.
+ */
+static int32
+zstd_compress(void *dst, size_t dst_size, void const *src, size_t src_size,
+			  int level)
+{
+	size_t		rc = ZSTD_compress(dst, dst_size, src, src_size, level);
+
+	/* Compressed page must be smaller than source to be distinguishable */
+	if (ZSTD_isError(rc) || rc >= src_size)
+		return -1;
+
+	return rc;
+}
+
+/* Implementation of zstd decompression method */
+static int32
+zstd_decompress(void *dst, size_t dst_size, void const *src, size_t src_size)
+{
+	size_t		rc = ZSTD_decompress(dst, dst_size, src, src_size);
+
+	return ZSTD_isError(rc) ? -1 : rc;
+}
+#endif
+
+#ifdef HAVE_LIBLZ4
+/*
+ * Implementation of lz4 compression method. Level 1 is the default fast
+ * mode, higher levels use LZ4 HC.
+ */
+static int32
+lz4_compress(void *dst, size_t dst_size, void const *src, size_t src_size,
+			 int level)
+{
+	int			rc;
+
+	if (level <= 1)
+		rc = LZ4_compress_default(src, dst, src_size, dst_size);
+	else
+		rc = LZ4_compress_HC(src, dst, src_size, dst_size, level);
+
+	/* Compressed page must be smaller than source to be distinguishable */
+	if (rc <= 0 || rc >= src_size)
+		return -1;
+
+	return rc;
+}
+
+/* Implementation of lz4 decompression method */
+static int32
+lz4_decompress(void *dst, size_t dst_size, void const *src, size_t src_size)
+{
+	int			rc = LZ4_decompress_safe(src, dst, src_size, dst_size);
+
+	return rc < 0 ? -1 : rc;
+}
+#endif
+
 /*
  * Compresses source into dest using algorithm. Returns the number of bytes
  * written in the destination buffer, or -1 if compression fails.
@@ -65,6 +143,14 @@ do_compress(void* dst, size_t dst_size, void const* src, size_t src_size,
 #ifdef HAVE_LIBZ
 		case ZLIB_COMPRESS:
 			return zlib_compress(dst, dst_size, src, src_size, level);
+#endif
+#ifdef HAVE_LIBZSTD
+		case ZSTD_COMPRESS:
+			return zstd_compress(dst, dst_size, src, src_size, level);
+#endif
+#ifdef HAVE_LIBLZ4
+		case LZ4_COMPRESS:
+			return lz4_compress(dst, dst_size, src, src_size, level);
 #endif
 		case PGLZ_COMPRESS:
 			return pglz_compress(src, src_size, dst, PGLZ_strategy_always);
@@ -89,6 +175,14 @@ do_decompress(void* dst, size_t dst_size, void const* src, size_t src_size,
 #ifdef HAVE_LIBZ
 		case ZLIB_COMPRESS:
 			return zlib_decompress(dst, dst_size, src, src_size);
+#endif
+#ifdef HAVE_LIBZSTD
+		case ZSTD_COMPRESS:
+			return zstd_decompress(dst, dst_size, src, src_size);
+#endif
+#ifdef HAVE_LIBLZ4
+		case LZ4_COMPRESS:
+			return lz4_decompress(dst, dst_size, src, src_size);
 #endif
 		case PGLZ_COMPRESS:
 			return pglz_decompress(src, src_size, dst, dst_size);
@@ -110,6 +204,76 @@ typedef struct BackupPageHeader
 /* Special value for compressed_size field */
 #define PageIsTruncated -2
 #define SkipCurrentPage -3
+/* The page consists of zero bytes, it is stored without payload */
+#define PageIsZeroed -4
+/* The page is in the page store, payload is PageStoreRef */
+#define PageIsReference -5
+/* The page failed verification and will be read again, it isn't written */
+#define PageIsDeferred -6
+
+/*
+ * Pages which failed verification are read again after the rest of the file,
+ * at most PAGE_RETRY_ROUNDS times. The delay before a round starts with
+ * PAGE_RETRY_DELAY microseconds and doubles each round.
+ */
+#define PAGE_RETRY_ROUNDS	10
+#define PAGE_RETRY_DELAY	1000
+
+/* Blocks of the file to be read again */
+typedef struct DeferredPages
+{
+	BlockNumber *blocks;
+	int			n;
+	int			size;
+} DeferredPages;
+
+/* Protects page retry statistics of the current backup */
+static pthread_mutex_t page_retry_lock = PTHREAD_MUTEX_INITIALIZER;
+
+#define PAGE_HASH_SIZE		32
+/* Hash of the page in hex */
+#define PAGE_HASH_NAME_LEN	(PAGE_HASH_SIZE * 2 + 1)
+
+/*
+ * Reference to the page in the page store, it is the payload of the block
+ * with PageIsReference size in the backup file.
+ */
+typedef struct PageStoreRef
+{
+	unsigned char hash[PAGE_HASH_SIZE];	/* SHA-256 of the page */
+	uint32		pack;			/* number of the pack file, 0 is invalid */
+	uint32		item;			/* number of the record in the pack */
+	uint64		offset;			/* offset of the record in the pack */
+} PageStoreRef;
+
+/*
+ * Size of the data following the header of the page in the backup file.
+ */
+static size_t
+page_payload_size(int32 compressed_size)
+{
+	if (compressed_size == PageIsZeroed)
+		return 0;
+	if (compressed_size == PageIsReference)
+		return MAXALIGN(sizeof(PageStoreRef));
+	return MAXALIGN(compressed_size);
+}
+
+/*
+ * Check if the page consists of zero bytes only.
+ */
+static bool
+page_is_zeroed(const char *page)
+{
+	const size_t *words = (const size_t *) page;
+	int			i;
+
+	for (i = 0; i < BLCKSZ / sizeof(size_t); i++)
+		if (words[i] != 0)
+			return false;
+
+	return true;
+}
 
 /* Verify page's header */
 static bool
@@ -133,6 +297,300 @@ parse_page(Page page, XLogRecPtr *lsn)
 	return false;
 }
 
+/*
+ * Maximum number of consecutive blocks read from a data file by a single
+ * pread() call.
+ */
+#define READ_BUFFER_BLOCKS	64
+
+/*
+ * Maximum number of consecutive blocks written into a restored data file by
+ * a single pwrite() call.
+ */
+#define WRITE_BUFFER_BLOCKS	64
+
+/* Size of the buffer of copy_file() */
+#define COPY_BUFFER_SIZE	(64 * BLCKSZ)
+
+/*
+ * Maximum number of blocks fetched from the server by a single
+ * pg_ptrack_get_block_2() query.
+ */
+#define PTRACK_FETCH_BLOCKS	256
+
+/*
+ * Reader of data file pages.
+ *
+ * Runs of consecutive blocks to back up (the whole range of the file or
+ * contiguous runs of set bits of the pagemap) are read into the buffer by
+ * a single pread() call. Then pages are verified and taken from the buffer
+ * one by one.
+ *
+ * Pages fetched via ptrack are requested in batches of the blocks to back up
+ * following the requested one, see page_reader_get_ptrack().
+ */
+typedef struct PageReader
+{
+	int			fd;
+	datapagemap_t *pagemap;		/* blocks to read, NULL to read all blocks */
+	BlockNumber	end_blkno;		/* don't read ahead beyond this block */
+	char	   *raw_buf;		/* allocated memory */
+	char	   *buf;			/* buffer aligned to BLCKSZ */
+	BlockNumber	capacity;		/* size of the buffer in blocks */
+	BlockNumber	first_blkno;	/* first block in the buffer */
+	BlockNumber	n_blocks;		/* number of blocks requested into the buffer */
+	size_t		read_len;		/* number of bytes actually read */
+
+	/* batch of pages fetched via ptrack */
+	BlockNumber *ptrack_blocks;
+	char	  **ptrack_pages;		/* NULL if the block was truncated */
+	size_t	   *ptrack_sizes;
+	int			ptrack_n;		/* number of pages in the batch */
+	int			ptrack_pos;		/* next page to take from the batch */
+} PageReader;
+
+static void
+page_reader_init(PageReader *reader, FILE *in, datapagemap_t *pagemap,
+				 BlockNumber start_blkno, BlockNumber end_blkno)
+{
+	reader->fd = fileno(in);
+	reader->pagemap = pagemap;
+	reader->end_blkno = end_blkno;
+
+	if (end_blkno > start_blkno)
+		reader->capacity = Min(end_blkno - start_blkno, READ_BUFFER_BLOCKS);
+	else
+		reader->capacity = 1;
+
+	reader->raw_buf = pgut_malloc(reader->capacity * BLCKSZ + BLCKSZ);
+	reader->buf = (char *) TYPEALIGN(BLCKSZ, reader->raw_buf);
+	reader->first_blkno = InvalidBlockNumber;
+	reader->n_blocks = 0;
+	reader->read_len = 0;
+
+	reader->ptrack_blocks = NULL;
+	reader->ptrack_pages = NULL;
+	reader->ptrack_sizes = NULL;
+	reader->ptrack_n = 0;
+	reader->ptrack_pos = 0;
+}
+
+static void
+page_reader_release_ptrack(PageReader *reader)
+{
+	int			i;
+
+	for (i = 0; i < reader->ptrack_n; i++)
+		if (reader->ptrack_pages[i])
+			free(reader->ptrack_pages[i]);
+	reader->ptrack_n = 0;
+	reader->ptrack_pos = 0;
+}
+
+static void
+page_reader_free(PageReader *reader)
+{
+	free(reader->raw_buf);
+	reader->raw_buf = NULL;
+	reader->buf = NULL;
+
+	if (reader->ptrack_blocks)
+	{
+		page_reader_release_ptrack(reader);
+		free(reader->ptrack_blocks);
+		free(reader->ptrack_pages);
+		free(reader->ptrack_sizes);
+		reader->ptrack_blocks = NULL;
+		reader->ptrack_pages = NULL;
+		reader->ptrack_sizes = NULL;
+	}
+}
+
+/*
+ * Check that the block is set in the pagemap.
+ */
+static bool
+pagemap_block_is_set(datapagemap_t *map, BlockNumber blkno)
+{
+	int			offset = blkno / 8;
+
+	if (offset >= map->bitmapsize)
+		return false;
+
+	return (map->bitmap[offset] & (1 << (blkno % 8))) != 0;
+}
+
+/*
+ * Get the page 'blknum' of the file via ptrack.
+ *
+ * In PTRACK mode the blocks to back up following 'blknum' are fetched by the
+ * same query and kept in the reader until they are requested. A page which
+ * failed verification in other modes is fetched alone. Returns NULL if the
+ * block was truncated, otherwise the page should be freed by the caller.
+ */
+static char *
+page_reader_get_ptrack(PageReader *reader, backup_files_arg *arguments,
+					   pgFile *file, BlockNumber blknum, BackupMode backup_mode,
+					   size_t *page_size)
+{
+	BlockNumber base_blkno = file->segno * RELSEG_SIZE;
+	char	   *page;
+	int			i;
+
+	for (i = reader->ptrack_pos; i < reader->ptrack_n; i++)
+	{
+		if (reader->ptrack_blocks[i] == base_blkno + blknum)
+			break;
+	}
+
+	if (i == reader->ptrack_n)
+	{
+		BlockNumber blkno;
+		int			n = 0;
+
+		page_reader_release_ptrack(reader);
+
+		if (reader->ptrack_blocks == NULL)
+		{
+			reader->ptrack_blocks = pgut_malloc(sizeof(BlockNumber) * PTRACK_FETCH_BLOCKS);
+			reader->ptrack_pages = pgut_malloc(sizeof(char *) * PTRACK_FETCH_BLOCKS);
+			reader->ptrack_sizes = pgut_malloc(sizeof(size_t) * PTRACK_FETCH_BLOCKS);
+		}
+
+		reader->ptrack_blocks[n++] = base_blkno + blknum;
+		if (backup_mode == BACKUP_MODE_DIFF_PTRACK)
+		{
+			for (blkno = blknum + 1;
+				 blkno < reader->end_blkno && n < PTRACK_FETCH_BLOCKS;
+				 blkno++)
+			{
+				if (reader->pagemap == NULL ||
+					pagemap_block_is_set(reader->pagemap, blkno))
+					reader->ptrack_blocks[n++] = base_blkno + blkno;
+			}
+		}
+
+		pg_ptrack_get_blocks(arguments, file->dbOid, file->tblspcOid,
+							 file->relOid, reader->ptrack_blocks, n,
+							 reader->ptrack_pages, reader->ptrack_sizes);
+		reader->ptrack_n = n;
+		i = 0;
+	}
+
+	page = reader->ptrack_pages[i];
+	*page_size = reader->ptrack_sizes[i];
+	reader->ptrack_pages[i] = NULL;
+	reader->ptrack_pos = i + 1;
+
+	return page;
+}
+
+/*
+ * Read the run of blocks starting from 'blknum' into the reader buffer.
+ */
+static void
+page_reader_fill(PageReader *reader, pgFile *file, BlockNumber blknum)
+{
+	BlockNumber	n_blocks = 1;
+	ssize_t		rc;
+
+	while (n_blocks < reader->capacity &&
+		   blknum + n_blocks < reader->end_blkno &&
+		   (reader->pagemap == NULL ||
+			pagemap_block_is_set(reader->pagemap, blknum + n_blocks)))
+		n_blocks++;
+
+	reader->first_blkno = blknum;
+	reader->n_blocks = n_blocks;
+	reader->read_len = 0;
+
+#ifdef SEEK_DATA
+	{
+		off_t		offset = (off_t) blknum * BLCKSZ;
+		off_t		data_offset;
+
+		/*
+		 * Don't read holes of sparse files, they consist of zero pages.
+		 * Holes up to the end of the file (lseek() fails with ENXIO) and
+		 * filesystems without SEEK_DATA support are handled by reading.
+		 */
+		data_offset = lseek(reader->fd, offset, SEEK_DATA);
+		if (data_offset >= offset + BLCKSZ)
+		{
+			reader->n_blocks = Min(n_blocks, (data_offset - offset) / BLCKSZ);
+			reader->read_len = (size_t) reader->n_blocks * BLCKSZ;
+			memset(reader->buf, 0, reader->read_len);
+			return;
+		}
+	}
+#endif
+
+	/* pread() may return less than requested, read the rest */
+	while (reader->read_len < (size_t) n_blocks * BLCKSZ)
+	{
+		int64		io_start;
+
+		io_start = io_throttle_start(n_blocks * BLCKSZ - reader->read_len);
+		rc = pread(reader->fd, reader->buf + reader->read_len,
+				   n_blocks * BLCKSZ - reader->read_len,
+				   (off_t) blknum * BLCKSZ + reader->read_len);
+		io_throttle_end(io_start);
+		if (rc < 0)
+		{
+			if (errno == EINTR)
+				continue;
+			elog(ERROR, "File: %s, could not read block %u: %s",
+				 file->path, blknum, strerror(errno));
+		}
+		/* End of file */
+		if (rc == 0)
+			break;
+		reader->read_len += rc;
+	}
+}
+
+/*
+ * Copy the block into 'page'. If 'reread' is true or the block isn't in the
+ * buffer yet, the block is read from the file.
+ * Returns the number of bytes read.
+ */
+static size_t
+page_reader_get(PageReader *reader, pgFile *file, BlockNumber blknum,
+				Page page, bool reread)
+{
+	size_t		offset;
+	size_t		read_len;
+
+	if (reread)
+	{
+		ssize_t		rc;
+		int64		io_start;
+
+		/* The page could be read partly flushed, read it again */
+		io_start = io_throttle_start(BLCKSZ);
+		rc = pread(reader->fd, page, BLCKSZ, (off_t) blknum * BLCKSZ);
+		io_throttle_end(io_start);
+		if (rc < 0)
+			elog(ERROR, "File: %s, could not read block %u: %s",
+				 file->path, blknum, strerror(errno));
+		return rc;
+	}
+
+	if (reader->first_blkno == InvalidBlockNumber ||
+		blknum < reader->first_blkno ||
+		blknum >= reader->first_blkno + reader->n_blocks)
+		page_reader_fill(reader, file, blknum);
+
+	offset = (size_t) (blknum - reader->first_blkno) * BLCKSZ;
+	if (reader->read_len <= offset)
+		return 0;
+
+	read_len = Min(reader->read_len - offset, BLCKSZ);
+	memcpy(page, reader->buf + offset, read_len);
+
+	return read_len;
+}
+
 /* Read one page from file directly accessing disk
  * return value:
  * 0  - if the page is not found
@@ -141,17 +599,13 @@ parse_page(Page page, XLogRecPtr *lsn)
  */
 static int
 read_page_from_file(pgFile *file, BlockNumber blknum,
-					FILE *in, Page page, XLogRecPtr *page_lsn)
+					PageReader *reader, bool reread,
+					Page page, XLogRecPtr *page_lsn)
 {
-	off_t		offset = blknum * BLCKSZ;
 	size_t		read_len = 0;
 
 	/* read the block */
-	if (fseek(in, offset, SEEK_SET) != 0)
-		elog(ERROR, "File: %s, could not seek to block %u: %s",
-				file->path, blknum, strerror(errno));
-
-	read_len = fread(page, 1, BLCKSZ, in);
+	read_len = page_reader_get(reader, file, blknum, page, reread);
 
 	if (read_len != BLCKSZ)
 	{
@@ -177,12 +631,8 @@ read_page_from_file(pgFile *file, BlockNumber blknum,
 	 */
 	if (!parse_page(page, page_lsn))
 	{
-		int i;
-		/* Check if the page is zeroed. */
-		for(i = 0; i < BLCKSZ && page[i] == 0; i++);
-
 		/* Page is zeroed. No need to check header and checksum. */
-		if (i == BLCKSZ)
+		if (page_is_zeroed(page))
 		{
 			elog(LOG, "File: %s blknum %u, empty page", file->path, blknum);
 			return 1;
@@ -229,21 +679,26 @@ read_page_from_file(pgFile *file, BlockNumber blknum,
  * and writes it into argument "page". Argument "page"
  * should be a pointer to allocated BLCKSZ of bytes.
  *
+ * If the page fails verification, it is added to 'deferred' to be read again
+ * later by retry_deferred_pages(). If 'deferred' is NULL, the page is read
+ * again from the file. On the last try the page is fetched via ptrack if it
+ * is available, otherwise an error is thrown.
+ *
  * Prints appropriate warnings/errors/etc into log.
  * Returns 0 if page was successfully retrieved
  *         SkipCurrentPage(-3) if we need to skip this page
  *         PageIsTruncated(-2) if the page was truncated
+ *         PageIsDeferred(-6) if the page should be read again
  */
 static int32
 prepare_page(backup_files_arg *arguments,
 			 pgFile *file, XLogRecPtr prev_backup_start_lsn,
 			 BlockNumber blknum, BlockNumber nblocks,
-			 FILE *in, int *n_skipped,
+			 PageReader *reader, int *n_skipped,
 			 BackupMode backup_mode,
-			 Page page)
+			 Page page, DeferredPages *deferred, bool last_try)
 {
 	XLogRecPtr	page_lsn = 0;
-	int			try_again = 100;
 	bool		page_is_valid = false;
 	bool		page_is_truncated = false;
 	BlockNumber absolute_blknum = file->segno * RELSEG_SIZE + blknum;
@@ -255,55 +710,62 @@ prepare_page(backup_files_arg *arguments,
 	/*
 	 * Read the page and verify its header and checksum.
 	 * Under high write load it's possible that we've read partly
-	 * flushed page, so try several times before throwing an error.
+	 * flushed page, so it is read again later before throwing an error.
 	 */
 	if (backup_mode != BACKUP_MODE_DIFF_PTRACK)
 	{
-		while(!page_is_valid && try_again)
-		{
-			int result = read_page_from_file(file, blknum,
-											 in, page, &page_lsn);
-
-			try_again--;
-			if (result == 0)
-			{
-				/* This block was truncated.*/
-				page_is_truncated = true;
-				/* Page is not actually valid, but it is absent
-				 * and we're not going to reread it or validate */
-				page_is_valid = true;
-			}
+		/* The first attempt takes the page from the read buffer */
+		int result = read_page_from_file(file, blknum, reader,
+										 deferred == NULL,
+										 page, &page_lsn);
 
-			if (result == 1)
-				page_is_valid = true;
+		if (result == 0)
+		{
+			/* This block was truncated.*/
+			page_is_truncated = true;
+			/* Page is not actually valid, but it is absent
+			 * and we're not going to reread it or validate */
+			page_is_valid = true;
+		}
 
-			/*
-			 * If ptrack support is available use it to get invalid block
-			 * instead of rereading it 99 times
-			 */
-			//elog(WARNING, "Checksum_Version: %i", current.checksum_version ? 1 : 0);
+		if (result == 1)
+			page_is_valid = true;
 
-			if (result == -1 && is_ptrack_support)
+		if (!page_is_valid && !last_try)
+		{
+			if (deferred)
 			{
-				elog(WARNING, "File %s, block %u, try to fetch via SQL",
-					file->path, blknum);
-				break;
+				if (deferred->n == deferred->size)
+				{
+					deferred->size = Max(deferred->size * 2, 16);
+					deferred->blocks = (BlockNumber *)
+						pg_realloc(deferred->blocks,
+								   sizeof(BlockNumber) * deferred->size);
+				}
+				deferred->blocks[deferred->n++] = blknum;
 			}
+			return PageIsDeferred;
 		}
+
 		/*
-		 * If page is not valid after 100 attempts to read it
-		 * throw an error.
+		 * If page is not valid after all attempts to read it
+		 * throw an error. If ptrack support is available use it
+		 * to get invalid block.
 		 */
-		if(!page_is_valid && !is_ptrack_support)
+		if (!page_is_valid && !is_ptrack_support)
 			elog(ERROR, "Data file checksum mismatch. Canceling backup");
+		if (!page_is_valid)
+			elog(WARNING, "File %s, block %u, try to fetch via SQL",
+				 file->path, blknum);
 	}
 
 	if (backup_mode == BACKUP_MODE_DIFF_PTRACK || (!page_is_valid && is_ptrack_support))
 	{
 		size_t page_size = 0;
 		Page ptrack_page = NULL;
-		ptrack_page = (Page) pg_ptrack_get_block(arguments, file->dbOid, file->tblspcOid,
-										  file->relOid, absolute_blknum, &page_size);
+		ptrack_page = (Page) page_reader_get_ptrack(reader, arguments, file,
+													blknum, backup_mode,
+													&page_size);
 
 		if (ptrack_page == NULL)
 		{
@@ -329,12 +791,12 @@ prepare_page(backup_files_arg *arguments,
 			if (is_checksum_enabled)
 				((PageHeader) page)->pd_checksum = pg_checksum_page(page, absolute_blknum);
 		}
-		/* get lsn from page, provided by pg_ptrack_get_block() */
+		/* get lsn from page, provided by pg_ptrack_get_block_2() */
 		if (backup_mode == BACKUP_MODE_DIFF_DELTA &&
 			file->exists_in_prev &&
 			!page_is_truncated &&
 			!parse_page(page, &page_lsn))
-				elog(ERROR, "Cannot parse page after pg_ptrack_get_block. "
+				elog(ERROR, "Cannot parse page after pg_ptrack_get_block_2. "
 								"Possible risk of a memory corruption");
 
 	}
@@ -355,483 +817,3367 @@ prepare_page(backup_files_arg *arguments,
 	return 0;
 }
 
-static void
-compress_and_backup_page(pgFile *file, BlockNumber blknum,
-						FILE *in, FILE *out, pg_crc32 *crc,
-						int page_state, Page page,
-						CompressAlg calg, int clevel)
+/*
+ * Page store.
+ *
+ * Backups taken with --dedup put data pages into the store of the instance
+ * $BACKUP_PATH/pages/instance_name, and backup files contain only references
+ * to the pages. Pages are appended to pack files "<number>.pack":
+ *
+ *	PagePackRecord followed by the page, compressed and MAXALIGN'ed
+ *	...
+ *
+ * Every command writing into the store starts a new pack, so packs are never
+ * appended by several commands. The pack is flushed to disk when it is full
+ * and at the end of the command, see page_store_finish(). Then the index
+ * "<number>.idx" of records in use is written:
+ *
+ *	PagePackIndexHeader
+ *	PagePackIndexEntry[n_entries], sorted by hash
+ *	CRC32C of everything above
+ *
+ * Records beyond pack_size of the index were written by an interrupted
+ * command. They are added to the index after their hashes are checked, up to
+ * the first damaged one.
+ *
+ * Pages are looked up in the indexes of packs, which are mapped into memory
+ * and searched with bsearch(). A bloom filter per pack, built when the
+ * command loads the store, skips the packs which surely don't contain the
+ * page. Only pages of the pack being written are kept in a hash table, so
+ * the memory used doesn't depend on the size of the store much: the filters
+ * take about PAGE_BLOOM_BITS bits per page.
+ *
+ * Pages which are not referenced by backups anymore are removed by
+ * delete_unused_pages(): their space is freed by punching holes in the pack,
+ * and the pack is removed when none of its records is in use. Records never
+ * move, so references to the remaining pages stay valid.
+ */
+#define PAGE_PACK_SUFFIX		".pack"
+#define PAGE_PACK_INDEX_SUFFIX	".idx"
+#define PAGE_PACK_MAX_SIZE		((uint64) 1024 * 1024 * 1024)
+#define PAGE_PACK_INDEX_MAGIC	0x58495350	/* "PSIX" */
+#define PAGE_PACK_INDEX_VERSION	2	/* 1 had entries in order of records */
+#define PAGE_BLOOM_BITS			10	/* bits of bloom filter per page */
+#define PAGE_BLOOM_PROBES		6	/* bits of the filter set by a page, at
+									 * most (PAGE_HASH_SIZE - 8) / 4 */
+
+/* Header of the page in the pack */
+typedef struct PagePackRecord
 {
-	BackupPageHeader header;
-	size_t		write_buffer_size = sizeof(header);
-	char		write_buffer[BLCKSZ+sizeof(header)];
-	char		compressed_page[BLCKSZ];
+	unsigned char hash[PAGE_HASH_SIZE];
+	int32		compress_alg;
+	int32		compressed_size;	/* BLCKSZ if the page isn't compressed */
+} PagePackRecord;
 
-	if(page_state == SkipCurrentPage)
-		return;
+typedef struct PagePackIndexHeader
+{
+	uint32		magic;
+	uint32		version;
+	uint32		n_records;		/* number of records written into the pack */
+	uint32		n_entries;		/* number of records in use */
+	uint64		pack_size;		/* size of the pack covered by the index */
+} PagePackIndexHeader;
+
+typedef struct PagePackIndexEntry
+{
+	unsigned char hash[PAGE_HASH_SIZE];
+	uint32		item;
+	uint32		size;			/* size of the record with its header */
+	uint64		offset;
+} PagePackIndexEntry;
+
+/* Records of the pack referenced by backups, see delete_unused_pages() */
+typedef struct PagePackUsage
+{
+	uint32		pack;
+	uint32		n_records;
+	bits8	   *used;			/* bitmap of records in use */
+} PagePackUsage;
 
-	header.block = blknum;
-	header.compressed_size = page_state;
+/* Pack opened for reading pages */
+typedef struct PageStoreReader
+{
+	uint32		pack;
+	int			fd;
+} PageStoreReader;
 
-	if(page_state == PageIsTruncated)
+/* Written pack searched for pages by store_page() */
+typedef struct PagePackLookup
+{
+	uint32		pack;
+	uint32		n_entries;
+	const PagePackIndexEntry *entries;	/* sorted by hash, in the mapping */
+	char	   *map;			/* mapped index file */
+	size_t		map_size;
+	uint64		bloom_mask;		/* number of bits of the filter - 1 */
+	uint64	   *bloom;
+} PagePackLookup;
+
+/* Protects the lookup structures and the pack being written */
+static pthread_mutex_t page_store_lock = PTHREAD_MUTEX_INITIALIZER;
+
+/*
+ * Written packs of the store. They are loaded when the first page is stored
+ * by the command.
+ */
+static bool page_store_loaded = false;
+static PagePackLookup *page_store_packs = NULL;
+static uint32 page_store_n_packs = 0;
+static uint32 page_store_packs_size = 0;
+
+/*
+ * Pack being written and entries of its index. Its pages are found in the
+ * open-addressing hash table, empty slots have pack 0.
+ */
+static FILE *page_pack = NULL;
+static uint32 page_pack_num = 0;
+static PagePackIndexHeader page_pack_header;
+static PagePackIndexEntry *page_pack_entries = NULL;
+static uint32 page_pack_entries_size = 0;
+static PageStoreRef *page_pack_table = NULL;
+static size_t page_pack_table_mask = 0;
+static size_t page_pack_table_count = 0;
+
+static void
+page_hash_name(const unsigned char *hash, char *name)
+{
+	static const char hex[] = "0123456789abcdef";
+	int			i;
+
+	for (i = 0; i < PAGE_HASH_SIZE; i++)
 	{
-		/*
-		* The page was truncated. Write only header
-		* to know that we must truncate restored file
-		*/
-		memcpy(write_buffer, &header, sizeof(header));
+		name[i * 2] = hex[hash[i] >> 4];
+		name[i * 2 + 1] = hex[hash[i] & 0x0F];
 	}
-	else
-	{
-		/* The page was not truncated, so we need to compress it */
-		header.compressed_size = do_compress(compressed_page, BLCKSZ,
-											 page, BLCKSZ, calg, clevel);
+	name[PAGE_HASH_SIZE * 2] = '\0';
+}
 
-		file->compress_alg = calg;
-		file->read_size += BLCKSZ;
-		Assert (header.compressed_size <= BLCKSZ);
+static void
+page_pack_get_path(uint32 pack, const char *suffix, char *path)
+{
+	snprintf(path, MAXPGPATH, "%s/%08X%s", page_store_path, pack, suffix);
+}
 
-		/* The page was successfully compressed. */
-		if (header.compressed_size > 0)
-		{
-			memcpy(write_buffer, &header, sizeof(header));
-			memcpy(write_buffer + sizeof(header),
-				   compressed_page, header.compressed_size);
-			write_buffer_size += MAXALIGN(header.compressed_size);
-		}
-		/* Nonpositive value means that compression failed. Write it as is. */
-		else
-		{
-			header.compressed_size = BLCKSZ;
-			memcpy(write_buffer, &header, sizeof(header));
-			memcpy(write_buffer + sizeof(header), page, BLCKSZ);
-			write_buffer_size += header.compressed_size;
-		}
-	}
+static void
+page_hash(Page page, unsigned char *hash)
+{
+#if PG_VERSION_NUM >= 100000
+	pg_sha256_ctx ctx;
+
+	pg_sha256_init(&ctx);
+	pg_sha256_update(&ctx, (uint8 *) page, BLCKSZ);
+	pg_sha256_final(&ctx, hash);
+#else
+	elog(ERROR, "Page deduplication requires PostgreSQL 10 or newer");
+#endif
+}
 
-	/* elog(VERBOSE, "backup blkno %u, compressed_size %d write_buffer_size %ld",
-				  blknum, header.compressed_size, write_buffer_size); */
+/*
+ * Restore the page from the record of the pack and check its hash. The
+ * payload must be read completely.
+ */
+static bool
+page_pack_check_record(const PagePackRecord *record, Page page)
+{
+	const char *payload = (const char *) record + sizeof(PagePackRecord);
+	unsigned char hash[PAGE_HASH_SIZE];
 
-	/* Update CRC */
-	COMP_CRC32C(*crc, write_buffer, write_buffer_size);
+	if (record->compressed_size <= 0 || record->compressed_size > BLCKSZ)
+		return false;
 
-	/* write data page */
-	if(fwrite(write_buffer, 1, write_buffer_size, out) != write_buffer_size)
-	{
-		int			errno_tmp = errno;
+	if (record->compressed_size == BLCKSZ)
+		memcpy(page, payload, BLCKSZ);
+	else if (do_decompress(page, BLCKSZ, payload, record->compressed_size,
+						   record->compress_alg) != BLCKSZ)
+		return false;
 
-		fclose(in);
-		fclose(out);
-		elog(ERROR, "File: %s, cannot write backup at block %u : %s",
-			 file->path, blknum, strerror(errno_tmp));
-	}
+	page_hash(page, hash);
+	return memcmp(hash, record->hash, PAGE_HASH_SIZE) == 0;
+}
 
-	file->write_size += write_buffer_size;
+static int
+page_pack_entry_compare(const void *a, const void *b)
+{
+	return memcmp(((const PagePackIndexEntry *) a)->hash,
+				  ((const PagePackIndexEntry *) b)->hash, PAGE_HASH_SIZE);
 }
 
 /*
- * Backup data file in the from_root directory to the to_root directory with
- * same relative path. If prev_backup_start_lsn is not NULL, only pages with
- * higher lsn will be copied.
- * Not just copy file, but read it block by block (use bitmap in case of
- * incremental backup), validate checksum, optionally compress and write to
- * backup with special header.
+ * Write the index of the pack. Entries are sorted by hash.
  */
-bool
-backup_data_file(backup_files_arg* arguments,
-				 const char *to_path, pgFile *file,
-				 XLogRecPtr prev_backup_start_lsn, BackupMode backup_mode,
-				 CompressAlg calg, int clevel)
+static void
+page_pack_write_index(uint32 pack, PagePackIndexHeader *header,
+					  PagePackIndexEntry *entries)
 {
-	FILE		*in;
-	FILE		*out;
-	BlockNumber	blknum = 0;
-	BlockNumber	nblocks = 0;
-	int			n_blocks_skipped = 0;
-	int			n_blocks_read = 0;
-	int			page_state;
-	char		curr_page[BLCKSZ];
+	char		index_path[MAXPGPATH];
+	char		path_temp[MAXPGPATH];
+	pg_crc32	crc;
+	FILE	   *out;
 
-	/*
-	 * Skip unchanged file only if it exists in previous backup.
-	 * This way we can correctly handle null-sized files which are
-	 * not tracked by pagemap and thus always marked as unchanged.
-	 */
-	if ((backup_mode == BACKUP_MODE_DIFF_PAGE ||
-		backup_mode == BACKUP_MODE_DIFF_PTRACK) &&
-		file->pagemap.bitmapsize == PageBitmapIsEmpty &&
-		file->exists_in_prev && !file->pagemap_isabsent)
+	page_pack_get_path(pack, PAGE_PACK_INDEX_SUFFIX, index_path);
+	snprintf(path_temp, lengthof(path_temp), "%s.partial", index_path);
+
+	if (header->n_entries > 1)
+		qsort(entries, header->n_entries, sizeof(PagePackIndexEntry),
+			  page_pack_entry_compare);
+
+	out = fopen(path_temp, PG_BINARY_W);
+	if (out == NULL)
+		elog(ERROR, "cannot open page store index \"%s\": %s", path_temp,
+			 strerror(errno));
+
+	header->magic = PAGE_PACK_INDEX_MAGIC;
+	header->version = PAGE_PACK_INDEX_VERSION;
+
+	INIT_CRC32C(crc);
+	COMP_CRC32C(crc, header, sizeof(PagePackIndexHeader));
+	if (header->n_entries > 0)
+		COMP_CRC32C(crc, entries,
+					sizeof(PagePackIndexEntry) * header->n_entries);
+	FIN_CRC32C(crc);
+
+	if (fwrite(header, 1, sizeof(PagePackIndexHeader), out) !=
+			sizeof(PagePackIndexHeader) ||
+		(header->n_entries > 0 &&
+		 fwrite(entries, sizeof(PagePackIndexEntry), header->n_entries,
+				out) != header->n_entries) ||
+		fwrite(&crc, 1, sizeof(crc), out) != sizeof(crc))
+		elog(ERROR, "cannot write page store index \"%s\": %s", path_temp,
+			 strerror(errno));
+
+	if (fflush(out) != 0 ||
+		fsync(fileno(out)) != 0 ||
+		fclose(out))
+		elog(ERROR, "cannot write page store index \"%s\": %s", path_temp,
+			 strerror(errno));
+
+	if (rename(path_temp, index_path) < 0)
+		elog(ERROR, "cannot rename \"%s\" to \"%s\": %s",
+			 path_temp, index_path, strerror(errno));
+}
+
+/*
+ * Read the index of the pack. Records written beyond the indexed part of the
+ * pack by an interrupted command are checked and added to the index, and the
+ * index is rewritten. Returns entries of the index, the number of entries is
+ * in header->n_entries.
+ */
+static PagePackIndexEntry *
+page_pack_read_index(uint32 pack, PagePackIndexHeader *header)
+{
+	char		path[MAXPGPATH];
+	PagePackIndexEntry *entries = NULL;
+	uint32		size = 0;
+	pg_crc32	crc;
+	pg_crc32	read_crc;
+	FILE	   *in;
+	bool		valid = false;
+	bool		old_version = false;
+	char		buffer[sizeof(PagePackRecord) + BLCKSZ];
+	PagePackRecord *record = (PagePackRecord *) buffer;
+	DataPage	page;
+	uint32		n_recovered = 0;
+
+	page_pack_get_path(pack, PAGE_PACK_INDEX_SUFFIX, path);
+	in = fopen(path, PG_BINARY_R);
+	if (in == NULL && errno != ENOENT)
+		elog(ERROR, "cannot open page store index \"%s\": %s", path,
+			 strerror(errno));
+
+	if (in != NULL)
 	{
-		/*
-		 * There are no changed blocks since last backup. We want make
-		 * incremental backup, so we should exit.
-		 */
-		elog(VERBOSE, "Skipping the unchanged file: %s", file->path);
-		return false;
+		if (fread(header, 1, sizeof(PagePackIndexHeader), in) ==
+				sizeof(PagePackIndexHeader) &&
+			header->magic == PAGE_PACK_INDEX_MAGIC &&
+			(header->version == PAGE_PACK_INDEX_VERSION ||
+			 header->version == 1) &&
+			header->n_entries <= header->n_records)
+		{
+			/* Entries of the old version are sorted when it is rewritten */
+			old_version = header->version != PAGE_PACK_INDEX_VERSION;
+
+			size = Max(header->n_entries, 64);
+			entries = pgut_newarray(PagePackIndexEntry, size);
+
+			INIT_CRC32C(crc);
+			COMP_CRC32C(crc, header, sizeof(PagePackIndexHeader));
+			if (fread(entries, sizeof(PagePackIndexEntry), header->n_entries,
+					  in) == header->n_entries &&
+				fread(&read_crc, 1, sizeof(read_crc), in) == sizeof(read_crc))
+			{
+				if (header->n_entries > 0)
+					COMP_CRC32C(crc, entries,
+								sizeof(PagePackIndexEntry) * header->n_entries);
+				FIN_CRC32C(crc);
+				valid = EQ_CRC32C(crc, read_crc);
+			}
+		}
+		fclose(in);
+
+		if (!valid)
+			elog(WARNING, "page store index \"%s\" is corrupted, rebuild it",
+				 path);
 	}
 
-	/* reset size summary */
-	file->read_size = 0;
-	file->write_size = 0;
-	INIT_CRC32C(file->crc);
+	if (!valid)
+	{
+		pg_free(entries);
+		size = 64;
+		entries = pgut_newarray(PagePackIndexEntry, size);
+		MemSet(header, 0, sizeof(PagePackIndexHeader));
+	}
 
-	/* open backup mode file for read */
-	in = fopen(file->path, PG_BINARY_R);
+	/* Check records written after the index */
+	page_pack_get_path(pack, PAGE_PACK_SUFFIX, path);
+	in = fopen(path, PG_BINARY_R);
 	if (in == NULL)
+		elog(ERROR, "cannot open page pack \"%s\": %s", path, strerror(errno));
+	if (fseek(in, header->pack_size, SEEK_SET) < 0)
+		elog(ERROR, "cannot seek page pack \"%s\": %s", path, strerror(errno));
+
+	while (fread(record, 1, sizeof(PagePackRecord), in) ==
+		   sizeof(PagePackRecord))
 	{
-		FIN_CRC32C(file->crc);
+		PagePackIndexEntry *entry;
+		size_t		payload_size;
 
-		/*
-		 * If file is not found, this is not en error.
-		 * It could have been deleted by concurrent postgres transaction.
-		 */
-		if (errno == ENOENT)
+		if (record->compressed_size <= 0 || record->compressed_size > BLCKSZ)
+			break;
+		payload_size = MAXALIGN(record->compressed_size);
+		if (fread(buffer + sizeof(PagePackRecord), 1, payload_size, in) !=
+				payload_size ||
+			!page_pack_check_record(record, page.data))
+			break;
+
+		if (header->n_entries == size)
 		{
-			elog(LOG, "File \"%s\" is not found", file->path);
-			return false;
+			size *= 2;
+			entries = (PagePackIndexEntry *) pg_realloc(entries,
+										sizeof(PagePackIndexEntry) * size);
 		}
+		entry = &entries[header->n_entries++];
+		memcpy(entry->hash, record->hash, PAGE_HASH_SIZE);
+		entry->item = header->n_records++;
+		entry->size = sizeof(PagePackRecord) + payload_size;
+		entry->offset = header->pack_size;
+		header->pack_size += entry->size;
+		n_recovered++;
+	}
+	if (ferror(in))
+		elog(ERROR, "cannot read page pack \"%s\": %s", path, strerror(errno));
+	fclose(in);
 
-		elog(ERROR, "cannot open file \"%s\": %s",
-			 file->path, strerror(errno));
+	if (n_recovered > 0 || !valid)
+		elog(LOG, "%u pages of interrupted command are added to the index of "
+			 "page pack \"%s\"", n_recovered, path);
+	if (n_recovered > 0 || !valid || old_version)
+		page_pack_write_index(pack, header, entries);
+
+	return entries;
+}
+
+static int
+page_pack_num_compare(const void *a, const void *b)
+{
+	uint32		pack1 = *(const uint32 *) a;
+	uint32		pack2 = *(const uint32 *) b;
+
+	if (pack1 < pack2)
+		return -1;
+	if (pack1 > pack2)
+		return 1;
+	return 0;
+}
+
+/*
+ * Get sorted numbers of the packs of the page store. Indexes left by
+ * interrupted commands are removed.
+ */
+static uint32 *
+page_store_list_packs(uint32 *n_packs)
+{
+	DIR		   *dir;
+	struct dirent *de;
+	uint32	   *packs = NULL;
+	uint32		size = 0;
+
+	*n_packs = 0;
+
+	dir = opendir(page_store_path);
+	if (dir == NULL)
+	{
+		if (errno == ENOENT)
+			return NULL;
+		elog(ERROR, "cannot open directory \"%s\": %s", page_store_path,
+			 strerror(errno));
 	}
 
-	if (file->size % BLCKSZ != 0)
+	while (errno = 0, (de = readdir(dir)) != NULL)
 	{
-		fclose(in);
-		elog(ERROR, "File: %s, invalid file size %lu", file->path, file->size);
+		uint32		pack;
+		char		suffix[MAXPGPATH];
+
+		if (sscanf(de->d_name, "%08X%s", &pack, suffix) != 2 || pack == 0)
+			continue;
+
+		if (strcmp(suffix, PAGE_PACK_SUFFIX) == 0)
+		{
+			if (*n_packs == size)
+			{
+				size = Max(size * 2, 64);
+				packs = (uint32 *) pg_realloc(packs, sizeof(uint32) * size);
+			}
+			packs[(*n_packs)++] = pack;
+		}
+		else if (strcmp(suffix, PAGE_PACK_INDEX_SUFFIX ".partial") == 0)
+		{
+			char		path[MAXPGPATH];
+
+			join_path_components(path, page_store_path, de->d_name);
+			if (unlink(path) != 0)
+				elog(ERROR, "could not remove file \"%s\": %s", path,
+					 strerror(errno));
+		}
 	}
+	if (errno)
+		elog(ERROR, "could not read directory \"%s\": %s", page_store_path,
+			 strerror(errno));
+	closedir(dir);
+
+	if (*n_packs > 0)
+		qsort(packs, *n_packs, sizeof(uint32), page_pack_num_compare);
+
+	return packs;
+}
+
+/*
+ * Bit of the bloom filter set by the page. SHA-256 is uniformly distributed,
+ * so parts of the hash are used as independent hash values.
+ */
+static uint64
+page_bloom_bit(const unsigned char *hash, int probe, uint64 mask)
+{
+	uint64		bit;
 
 	/*
-	 * Compute expected number of blocks in the file.
-	 * NOTE This is a normal situation, if the file size has changed
-	 * since the moment we computed it.
+	 * Probes overlap by half, the first bytes are left for the hash table.
+	 * The last probe ends at the end of the hash.
 	 */
-	nblocks = file->size/BLCKSZ;
+	memcpy(&bit, hash + sizeof(uint32) * (probe + 1), sizeof(bit));
+	return bit & mask;
+}
 
-	/* open backup file for write  */
-	out = fopen(to_path, PG_BINARY_W);
-	if (out == NULL)
+/*
+ * Add the written pack with the given index to the packs searched for pages.
+ * Entries are used to build the bloom filter, the search goes through the
+ * mapped index file.
+ */
+static void
+page_store_add_pack(uint32 pack, const PagePackIndexHeader *header,
+					const PagePackIndexEntry *entries)
+{
+	PagePackLookup *lookup;
+	char		path[MAXPGPATH];
+	uint64		n_bits;
+	size_t		expected_size;
+	struct stat	st;
+	uint32		i;
+	int			fd;
+
+	if (header->n_entries == 0)
+		return;
+
+	if (page_store_n_packs == page_store_packs_size)
 	{
-		int errno_tmp = errno;
-		fclose(in);
-		elog(ERROR, "cannot open backup file \"%s\": %s",
-			 to_path, strerror(errno_tmp));
+		page_store_packs_size = Max(page_store_packs_size * 2, 64);
+		page_store_packs = (PagePackLookup *)
+			pg_realloc(page_store_packs,
+					   sizeof(PagePackLookup) * page_store_packs_size);
 	}
+	lookup = &page_store_packs[page_store_n_packs];
 
-	/*
-	 * Read each page, verify checksum and write it to backup.
-	 * If page map is empty or file is not present in previous backup
-	 * backup all pages of the relation.
-	 *
-	 * We will enter here if backup_mode is FULL or DELTA.
-	 */
-	if (file->pagemap.bitmapsize == PageBitmapIsEmpty ||
-		file->pagemap_isabsent || !file->exists_in_prev)
+	page_pack_get_path(pack, PAGE_PACK_INDEX_SUFFIX, path);
+	fd = open(path, O_RDONLY | PG_BINARY, 0);
+	if (fd < 0)
+		elog(ERROR, "cannot open page store index \"%s\": %s", path,
+			 strerror(errno));
+	if (fstat(fd, &st) < 0)
+		elog(ERROR, "cannot stat \"%s\": %s", path, strerror(errno));
+
+	expected_size = sizeof(PagePackIndexHeader) +
+		sizeof(PagePackIndexEntry) * (size_t) header->n_entries +
+		sizeof(pg_crc32);
+	if ((size_t) st.st_size != expected_size)
+		elog(ERROR, "page store index \"%s\" has size " INT64_FORMAT
+			 ", expected %lu", path, (int64) st.st_size,
+			 (unsigned long) expected_size);
+
+	lookup->map_size = st.st_size;
+	lookup->map = mmap(NULL, lookup->map_size, PROT_READ, MAP_SHARED, fd, 0);
+	if (lookup->map == MAP_FAILED)
+		elog(ERROR, "cannot map \"%s\": %s", path, strerror(errno));
+	close(fd);
+
+	lookup->pack = pack;
+	lookup->n_entries = header->n_entries;
+	lookup->entries = (const PagePackIndexEntry *)
+		(lookup->map + sizeof(PagePackIndexHeader));
+
+	/* Power of two bits, at least PAGE_BLOOM_BITS per page */
+	n_bits = 64;
+	while (n_bits < (uint64) header->n_entries * PAGE_BLOOM_BITS)
+		n_bits *= 2;
+	lookup->bloom_mask = n_bits - 1;
+	lookup->bloom = (uint64 *) pgut_malloc(n_bits / 8);
+	MemSet(lookup->bloom, 0, n_bits / 8);
+	for (i = 0; i < header->n_entries; i++)
 	{
-		for (blknum = 0; blknum < nblocks; blknum++)
+		int			probe;
+
+		for (probe = 0; probe < PAGE_BLOOM_PROBES; probe++)
 		{
-			page_state = prepare_page(arguments, file, prev_backup_start_lsn,
-									  blknum, nblocks, in, &n_blocks_skipped,
-									  backup_mode, curr_page);
-			compress_and_backup_page(file, blknum, in, out, &(file->crc),
-									  page_state, curr_page, calg, clevel);
-			n_blocks_read++;
-			if (page_state == PageIsTruncated)
-				break;
+			uint64		bit = page_bloom_bit(entries[i].hash, probe,
+											 lookup->bloom_mask);
+
+			lookup->bloom[bit / 64] |= UINT64CONST(1) << (bit % 64);
 		}
-		if (backup_mode == BACKUP_MODE_DIFF_DELTA)
-			file->n_blocks = n_blocks_read;
 	}
-	/*
-	 * If page map is not empty we scan only changed blocks.
-	 *
-	 * We will enter here if backup_mode is PAGE or PTRACK.
-	 */
-	else
+
+	page_store_n_packs++;
+}
+
+/*
+ * Find the page in the written pack.
+ */
+static const PagePackIndexEntry *
+page_pack_lookup(const PagePackLookup *lookup, const unsigned char *hash)
+{
+	PagePackIndexEntry key;
+	int			probe;
+
+	for (probe = 0; probe < PAGE_BLOOM_PROBES; probe++)
 	{
-		datapagemap_iterator_t *iter;
-		iter = datapagemap_iterate(&file->pagemap);
-		while (datapagemap_next(iter, &blknum))
+		uint64		bit = page_bloom_bit(hash, probe, lookup->bloom_mask);
+
+		if ((lookup->bloom[bit / 64] & (UINT64CONST(1) << (bit % 64))) == 0)
+			return NULL;
+	}
+
+	memcpy(key.hash, hash, PAGE_HASH_SIZE);
+	return (const PagePackIndexEntry *) bsearch(&key, lookup->entries,
+												lookup->n_entries,
+												sizeof(PagePackIndexEntry),
+												page_pack_entry_compare);
+}
+
+/*
+ * Find the page with hash ref->hash in the page store and fill in the rest
+ * of the reference. Returns false if the page isn't there.
+ */
+static bool
+page_store_lookup(PageStoreRef *ref)
+{
+	const unsigned char *hash = ref->hash;
+	uint32		i;
+
+	/* Pages of the pack being written */
+	if (page_pack_table_count > 0)
+	{
+		size_t		pos;
+		uint32		start;
+
+		memcpy(&start, hash, sizeof(start));
+		pos = start & page_pack_table_mask;
+		while (page_pack_table[pos].pack != 0)
 		{
-			page_state = prepare_page(arguments, file, prev_backup_start_lsn,
-									  blknum, nblocks, in, &n_blocks_skipped,
-									  backup_mode, curr_page);
-			compress_and_backup_page(file, blknum, in, out, &(file->crc),
-									  page_state, curr_page, calg, clevel);
-			n_blocks_read++;
-			if (page_state == PageIsTruncated)
-				break;
+			if (memcmp(page_pack_table[pos].hash, hash, PAGE_HASH_SIZE) == 0)
+			{
+				*ref = page_pack_table[pos];
+				return true;
+			}
+			pos = (pos + 1) & page_pack_table_mask;
 		}
+	}
 
-		pg_free(file->pagemap.bitmap);
-		pg_free(iter);
+	/* Newer packs first, they are more likely to have recent pages */
+	for (i = page_store_n_packs; i > 0; i--)
+	{
+		const PagePackLookup *lookup = &page_store_packs[i - 1];
+		const PagePackIndexEntry *entry = page_pack_lookup(lookup, hash);
+
+		if (entry)
+		{
+			ref->pack = lookup->pack;
+			ref->item = entry->item;
+			ref->offset = entry->offset;
+			return true;
+		}
 	}
 
-	/* update file permission */
-	if (chmod(to_path, FILE_PERMISSION) == -1)
+	return false;
+}
+
+/*
+ * Add the page of the pack being written to its hash table.
+ */
+static void
+page_pack_table_insert(const PageStoreRef *ref)
+{
+	size_t		pos;
+	uint32		start;
+
+	/* Keep the table at most half full */
+	if ((page_pack_table_count + 1) * 2 > page_pack_table_mask + 1)
 	{
-		int errno_tmp = errno;
+		PageStoreRef *old_table = page_pack_table;
+		size_t		old_size = page_pack_table_mask + 1;
+		size_t		new_size = old_table ? old_size * 2 : 1024;
+		size_t		i;
+
+		if (new_size > SIZE_MAX / sizeof(PageStoreRef))
+			elog(ERROR, "too many pages in page pack %08X", page_pack_num);
+
+		page_pack_table = pgut_newarray(PageStoreRef, new_size);
+		MemSet(page_pack_table, 0, sizeof(PageStoreRef) * new_size);
+		page_pack_table_mask = new_size - 1;
+		page_pack_table_count = 0;
+		if (old_table)
+		{
+			for (i = 0; i < old_size; i++)
+				if (old_table[i].pack != 0)
+					page_pack_table_insert(&old_table[i]);
+			free(old_table);
+		}
+	}
+
+	memcpy(&start, ref->hash, sizeof(start));
+	pos = start & page_pack_table_mask;
+	while (page_pack_table[pos].pack != 0)
+		pos = (pos + 1) & page_pack_table_mask;
+	page_pack_table[pos] = *ref;
+	page_pack_table_count++;
+}
+
+/*
+ * Load indexes of all packs of the store.
+ */
+static void
+page_store_load(void)
+{
+	uint32	   *packs;
+	uint32		n_packs;
+	uint32		i;
+	uint64		n_pages = 0;
+
+	packs = page_store_list_packs(&n_packs);
+	for (i = 0; i < n_packs; i++)
+	{
+		PagePackIndexHeader header;
+		PagePackIndexEntry *entries;
+
+		entries = page_pack_read_index(packs[i], &header);
+		page_store_add_pack(packs[i], &header, entries);
+		n_pages += header.n_entries;
+		pg_free(entries);
+		page_pack_num = Max(page_pack_num, packs[i]);
+	}
+	pg_free(packs);
+	page_store_loaded = true;
+
+	elog(LOG, "page store contains " UINT64_FORMAT " pages in %u packs",
+		 n_pages, n_packs);
+}
+
+/*
+ * Start a new pack.
+ */
+static void
+page_pack_open(void)
+{
+	char		path[MAXPGPATH];
+	int			fd;
+
+	page_pack_num++;
+	page_pack_get_path(page_pack_num, PAGE_PACK_SUFFIX, path);
+	fd = open(path, O_WRONLY | O_CREAT | O_EXCL | PG_BINARY, FILE_PERMISSION);
+	if (fd < 0 || (page_pack = fdopen(fd, PG_BINARY_W)) == NULL)
+		elog(ERROR, "cannot create page pack \"%s\": %s", path,
+			 strerror(errno));
+
+	MemSet(&page_pack_header, 0, sizeof(page_pack_header));
+}
+
+/*
+ * Flush the pack being written to disk and write its index.
+ */
+static void
+page_pack_close(void)
+{
+	char		path[MAXPGPATH];
+
+	page_pack_get_path(page_pack_num, PAGE_PACK_SUFFIX, path);
+	if (fflush(page_pack) != 0 ||
+		fsync(fileno(page_pack)) != 0 ||
+		fclose(page_pack))
+		elog(ERROR, "cannot write page pack \"%s\": %s", path,
+			 strerror(errno));
+	page_pack = NULL;
+
+	page_pack_write_index(page_pack_num, &page_pack_header, page_pack_entries);
+
+	/* Pages of the pack are found through its index from now on */
+	page_store_add_pack(page_pack_num, &page_pack_header, page_pack_entries);
+	pg_free(page_pack_table);
+	page_pack_table = NULL;
+	page_pack_table_mask = 0;
+	page_pack_table_count = 0;
+}
+
+/*
+ * Put the page into the page store unless it is there already. Reference to
+ * the page is returned in ref.
+ */
+static void
+store_page(Page page, PageStoreRef *ref, CompressAlg calg, int clevel)
+{
+	char		buffer[sizeof(PagePackRecord) + BLCKSZ];
+	PagePackRecord *record = (PagePackRecord *) buffer;
+	bool		found;
+	PagePackIndexEntry *entry;
+	size_t		payload_size;
+
+	page_hash(page, ref->hash);
+
+	pthread_lock(&page_store_lock);
+	if (!page_store_loaded)
+		page_store_load();
+	found = page_store_lookup(ref);
+	pthread_mutex_unlock(&page_store_lock);
+
+	if (found)
+		return;
+
+	/* Compress the page without holding the lock */
+	memcpy(record->hash, ref->hash, PAGE_HASH_SIZE);
+	record->compress_alg = calg;
+	record->compressed_size = do_compress(buffer + sizeof(PagePackRecord),
+										  BLCKSZ, page, BLCKSZ, calg, clevel);
+	/* Nonpositive value means that compression failed. Write it as is. */
+	if (record->compressed_size <= 0)
+	{
+		record->compressed_size = BLCKSZ;
+		memcpy(buffer + sizeof(PagePackRecord), page, BLCKSZ);
+	}
+	payload_size = MAXALIGN(record->compressed_size);
+	MemSet(buffer + sizeof(PagePackRecord) + record->compressed_size, 0,
+		   payload_size - record->compressed_size);
+
+	pthread_lock(&page_store_lock);
+
+	/* Another thread could store the same page meanwhile */
+	if (page_store_lookup(ref))
+	{
+		pthread_mutex_unlock(&page_store_lock);
+		return;
+	}
+
+	if (page_pack == NULL)
+		page_pack_open();
+
+	ref->pack = page_pack_num;
+	ref->item = page_pack_header.n_records;
+	ref->offset = page_pack_header.pack_size;
+
+	if (fwrite(buffer, 1, sizeof(PagePackRecord) + payload_size, page_pack) !=
+		sizeof(PagePackRecord) + payload_size)
+		elog(ERROR, "cannot write page pack %08X: %s", page_pack_num,
+			 strerror(errno));
+
+	if (page_pack_header.n_entries == page_pack_entries_size)
+	{
+		page_pack_entries_size = Max(page_pack_entries_size * 2, 1024);
+		page_pack_entries = (PagePackIndexEntry *)
+			pg_realloc(page_pack_entries,
+					   sizeof(PagePackIndexEntry) * page_pack_entries_size);
+	}
+	entry = &page_pack_entries[page_pack_header.n_entries++];
+	memcpy(entry->hash, ref->hash, PAGE_HASH_SIZE);
+	entry->item = ref->item;
+	entry->size = sizeof(PagePackRecord) + payload_size;
+	entry->offset = ref->offset;
+	page_pack_header.n_records++;
+	page_pack_header.pack_size += entry->size;
+
+	page_pack_table_insert(ref);
+
+	if (page_pack_header.pack_size >= PAGE_PACK_MAX_SIZE)
+		page_pack_close();
+
+	pthread_mutex_unlock(&page_store_lock);
+}
+
+/*
+ * Flush pages stored by the command to disk. Must be called before backups
+ * referencing them are marked as valid.
+ */
+void
+page_store_finish(void)
+{
+	uint32		i;
+
+	pthread_lock(&page_store_lock);
+
+	if (page_pack)
+		page_pack_close();
+
+	for (i = 0; i < page_store_n_packs; i++)
+	{
+		munmap(page_store_packs[i].map, page_store_packs[i].map_size);
+		free(page_store_packs[i].bloom);
+	}
+	pg_free(page_store_packs);
+	page_store_packs = NULL;
+	page_store_n_packs = 0;
+	page_store_packs_size = 0;
+	page_store_loaded = false;
+	pg_free(page_pack_entries);
+	page_pack_entries = NULL;
+	page_pack_entries_size = 0;
+
+	pthread_mutex_unlock(&page_store_lock);
+}
+
+static void
+page_store_reader_init(PageStoreReader *reader)
+{
+	reader->pack = 0;
+	reader->fd = -1;
+}
+
+static void
+page_store_reader_close(PageStoreReader *reader)
+{
+	if (reader->fd >= 0)
+		close(reader->fd);
+	page_store_reader_init(reader);
+}
+
+/*
+ * Read the page referenced by ref from the page store and check its hash.
+ * Returns false if the page is missing or corrupted.
+ */
+static bool
+read_store_page(const PageStoreRef *ref, Page page, PageStoreReader *reader)
+{
+	char		buffer[sizeof(PagePackRecord) + BLCKSZ];
+	PagePackRecord *record = (PagePackRecord *) buffer;
+	ssize_t		read_len;
+	int64		io_start;
+
+	if (reader->pack != ref->pack)
+	{
+		char		path[MAXPGPATH];
+
+		page_store_reader_close(reader);
+		page_pack_get_path(ref->pack, PAGE_PACK_SUFFIX, path);
+		reader->fd = open(path, O_RDONLY | PG_BINARY, 0);
+		if (reader->fd < 0)
+			return false;
+		reader->pack = ref->pack;
+	}
+
+	/* The record may be shorter, the rest of the buffer is just not used */
+	io_start = io_throttle_start(sizeof(buffer));
+	read_len = pread(reader->fd, buffer, sizeof(buffer), ref->offset);
+	io_throttle_end(io_start);
+
+	return read_len >= (ssize_t) sizeof(PagePackRecord) &&
+		memcmp(record->hash, ref->hash, PAGE_HASH_SIZE) == 0 &&
+		record->compressed_size > 0 &&
+		read_len >= (ssize_t) (sizeof(PagePackRecord) + record->compressed_size) &&
+		page_pack_check_record(record, page);
+}
+
+/*
+ * Read the page referenced by ref from the page store.
+ */
+static void
+load_page(const PageStoreRef *ref, Page page, PageStoreReader *reader)
+{
+	if (!read_store_page(ref, page, reader))
+	{
+		char		name[PAGE_HASH_NAME_LEN];
+
+		page_hash_name(ref->hash, name);
+		elog(ERROR, "page %s of page pack %08X is missing or corrupted",
+			 name, ref->pack);
+	}
+}
+
+/*
+ * Compress the page and put it with its header into write_buffer, which
+ * should have room for BLCKSZ + sizeof(BackupPageHeader) bytes.
+ * Returns the number of bytes to write.
+ */
+static size_t
+compress_page(char *write_buffer, BlockNumber blknum, int page_state,
+			  Page page, CompressAlg calg, int clevel)
+{
+	BackupPageHeader header;
+	size_t		write_buffer_size = sizeof(header);
+	char		compressed_page[BLCKSZ];
+
+	header.block = blknum;
+	header.compressed_size = page_state;
+
+	if(page_state == PageIsTruncated)
+	{
+		/*
+		* The page was truncated. Write only header
+		* to know that we must truncate restored file
+		*/
+		memcpy(write_buffer, &header, sizeof(header));
+	}
+	else if (page_is_zeroed(page))
+	{
+		/*
+		 * Don't store zero page, write only header. Older versions can't
+		 * read such pages, mark the backup with the new format version.
+		 */
+		header.compressed_size = PageIsZeroed;
+		memcpy(write_buffer, &header, sizeof(header));
+		current.format_version = BACKUP_FORMAT_VERSION;
+	}
+	else if (current.dedup)
+	{
+		PageStoreRef ref;
+
+		/* Put the page into the page store, write only the reference */
+		store_page(page, &ref, calg, clevel);
+		header.compressed_size = PageIsReference;
+		memcpy(write_buffer, &header, sizeof(header));
+		memcpy(write_buffer + sizeof(header), &ref, sizeof(ref));
+		write_buffer_size += MAXALIGN(sizeof(ref));
+	}
+	else
+	{
+		/* The page was not truncated, so we need to compress it */
+		header.compressed_size = do_compress(compressed_page, BLCKSZ,
+											 page, BLCKSZ, calg, clevel);
+
+		Assert (header.compressed_size <= BLCKSZ);
+
+		/* The page was successfully compressed. */
+		if (header.compressed_size > 0)
+		{
+			memcpy(write_buffer, &header, sizeof(header));
+			memcpy(write_buffer + sizeof(header),
+				   compressed_page, header.compressed_size);
+			write_buffer_size += MAXALIGN(header.compressed_size);
+		}
+		/* Nonpositive value means that compression failed. Write it as is. */
+		else
+		{
+			header.compressed_size = BLCKSZ;
+			memcpy(write_buffer, &header, sizeof(header));
+			memcpy(write_buffer + sizeof(header), page, BLCKSZ);
+			write_buffer_size += header.compressed_size;
+		}
+	}
+
+	/* elog(VERBOSE, "backup blkno %u, compressed_size %d write_buffer_size %ld",
+				  blknum, header.compressed_size, write_buffer_size); */
+
+	return write_buffer_size;
+}
+
+/*
+ * Block index of the backup file being written, collected from the pages
+ * passed to write_backup_pages().
+ */
+typedef struct BlockIndexBuilder
+{
+	BlockIndexEntry *entries;
+	uint32		n_entries;
+	uint32		size;
+	BlockNumber	truncated;		/* block of PageIsTruncated header or
+								 * InvalidBlockNumber */
+	uint64		offset;			/* offset of the next page in the file */
+} BlockIndexBuilder;
+
+static void block_index_add(BlockIndexEntry **entries, uint32 *n_entries,
+							uint32 *size, BlockNumber blknum,
+							int32 compressed_size, uint64 offset,
+							pg_crc32 crc);
+static void block_index_write(const char *path, BlockIndexBuilder *index,
+							  uint64 file_size, pg_crc32 file_crc);
+
+static void
+block_index_init(BlockIndexBuilder *index)
+{
+	index->entries = NULL;
+	index->n_entries = 0;
+	index->size = 0;
+	index->truncated = InvalidBlockNumber;
+	index->offset = 0;
+}
+
+/*
+ * Add index entries for the pages of write_buffer, which is written at the
+ * end of the backup file.
+ */
+static void
+block_index_add_pages(BlockIndexBuilder *index, const char *write_buffer,
+					  size_t write_buffer_size)
+{
+	size_t		pos = 0;
+
+	while (pos < write_buffer_size)
+	{
+		BackupPageHeader header;
+		size_t		payload_size = 0;
+
+		memcpy(&header, write_buffer + pos, sizeof(header));
+		if (header.compressed_size == PageIsTruncated)
+			index->truncated = Min(index->truncated, header.block);
+		else
+		{
+			pg_crc32	crc;
+
+			payload_size = page_payload_size(header.compressed_size);
+			INIT_CRC32C(crc);
+			COMP_CRC32C(crc, write_buffer + pos, sizeof(header) + payload_size);
+			FIN_CRC32C(crc);
+			block_index_add(&index->entries, &index->n_entries, &index->size,
+							header.block, header.compressed_size,
+							index->offset + pos + sizeof(header), crc);
+		}
+		pos += sizeof(header) + payload_size;
+	}
+	index->offset += write_buffer_size;
+}
+
+/*
+ * Write compressed pages into the backup file and update its CRC and block
+ * index, if any.
+ */
+static void
+write_backup_pages(pgFile *file, BlockNumber blknum,
+				   FILE *in, FILE *out, pg_crc32 *crc,
+				   BlockIndexBuilder *index,
+				   char *write_buffer, size_t write_buffer_size)
+{
+	/* Update CRC */
+	COMP_CRC32C(*crc, write_buffer, write_buffer_size);
+	if (index)
+		block_index_add_pages(index, write_buffer, write_buffer_size);
+
+	/* write data page */
+	if(fwrite(write_buffer, 1, write_buffer_size, out) != write_buffer_size)
+	{
+		int			errno_tmp = errno;
+
 		fclose(in);
 		fclose(out);
-		elog(ERROR, "cannot change mode of \"%s\": %s", file->path,
-			 strerror(errno_tmp));
+		elog(ERROR, "File: %s, cannot write backup at block %u : %s",
+			 file->path, blknum, strerror(errno_tmp));
+	}
+
+	file->write_size += write_buffer_size;
+}
+
+static void
+compress_and_backup_page(pgFile *file, BlockNumber blknum,
+						FILE *in, FILE *out, pg_crc32 *crc,
+						BlockIndexBuilder *index, int page_state, Page page,
+						CompressAlg calg, int clevel)
+{
+	size_t		write_buffer_size;
+	char		write_buffer[BLCKSZ+sizeof(BackupPageHeader)];
+
+	if(page_state == SkipCurrentPage)
+		return;
+
+	write_buffer_size = compress_page(write_buffer, blknum, page_state, page,
+									  calg, clevel);
+	if (page_state != PageIsTruncated)
+	{
+		file->compress_alg = calg;
+		file->read_size += BLCKSZ;
+	}
+
+	write_backup_pages(file, blknum, in, out, crc, index,
+					   write_buffer, write_buffer_size);
+}
+
+/*
+ * Pool of compression workers.
+ *
+ * Threads reading data files put pages into batches and pass them to the
+ * pool. Compressed batches are written by the thread which read them in the
+ * order of reading, so the order of pages in the backup file and its CRC
+ * don't depend on the compression threads.
+ */
+#define COMPRESS_BATCH_PAGES		32
+/* Maximum number of batches of a file being compressed at the same time */
+#define COMPRESS_BATCHES_IN_FLIGHT	4
+
+typedef struct PageBatch
+{
+	struct PageBatch *next;		/* link in the queue of the pool */
+	CompressAlg	calg;
+	int			clevel;
+	int			n_pages;
+	BlockNumber	blknum[COMPRESS_BATCH_PAGES];
+	int			page_state[COMPRESS_BATCH_PAGES];
+	char		pages[COMPRESS_BATCH_PAGES][BLCKSZ];
+	/* Result of compression */
+	bool		done;
+	size_t		write_size;
+	char		write_buffer[COMPRESS_BATCH_PAGES *
+							 (BLCKSZ + sizeof(BackupPageHeader))];
+} PageBatch;
+
+static struct
+{
+	int			n_threads;		/* 0 if the pool isn't started */
+	pthread_t  *threads;
+	pthread_mutex_t lock;
+	pthread_cond_t queued;		/* new batch is queued or pool is stopped */
+	pthread_cond_t done;		/* batch is compressed */
+	PageBatch  *head;
+	PageBatch  *tail;
+	bool		stop;
+} compress_pool;
+
+/*
+ * Writer of the pages of a single backup file. Compresses pages in place if
+ * the pool of compression workers isn't started.
+ */
+typedef struct PageWriter
+{
+	pgFile	   *file;
+	FILE	   *in;
+	FILE	   *out;
+	pg_crc32   *crc;
+	BlockIndexBuilder *index;	/* NULL if no block index is written */
+	CompressAlg	calg;
+	int			clevel;
+	bool		use_pool;
+	PageBatch  *batch;			/* batch being filled */
+	/* Batches passed to the pool in the order of reading */
+	PageBatch  *in_flight[COMPRESS_BATCHES_IN_FLIGHT];
+	int			first_in_flight;
+	int			n_in_flight;
+	PageBatch  *spare;			/* written batches to reuse */
+} PageWriter;
+
+static void *
+compress_worker(void *arg)
+{
+	pthread_lock(&compress_pool.lock);
+	for (;;)
+	{
+		PageBatch  *batch;
+		int			i;
+
+		while (compress_pool.head == NULL && !compress_pool.stop)
+			pthread_cond_wait(&compress_pool.queued, &compress_pool.lock);
+		if (compress_pool.head == NULL)
+			break;
+
+		batch = compress_pool.head;
+		compress_pool.head = batch->next;
+		if (compress_pool.head == NULL)
+			compress_pool.tail = NULL;
+		pthread_mutex_unlock(&compress_pool.lock);
+
+		batch->write_size = 0;
+		for (i = 0; i < batch->n_pages; i++)
+			batch->write_size += compress_page(batch->write_buffer + batch->write_size,
+											   batch->blknum[i],
+											   batch->page_state[i],
+											   batch->pages[i],
+											   batch->calg, batch->clevel);
+
+		pthread_lock(&compress_pool.lock);
+		batch->done = true;
+		pthread_cond_broadcast(&compress_pool.done);
+	}
+	pthread_mutex_unlock(&compress_pool.lock);
+
+	return NULL;
+}
+
+/*
+ * Start the pool of compression workers used by backup_data_file() and
+ * backup_data_file_part().
+ */
+void
+start_compress_workers(int n_threads)
+{
+	int			i;
+
+	if (n_threads <= 0)
+		return;
+
+	pthread_mutex_init(&compress_pool.lock, NULL);
+	pthread_cond_init(&compress_pool.queued, NULL);
+	pthread_cond_init(&compress_pool.done, NULL);
+	compress_pool.head = compress_pool.tail = NULL;
+	compress_pool.stop = false;
+
+	compress_pool.threads = (pthread_t *) palloc(sizeof(pthread_t) * n_threads);
+	for (i = 0; i < n_threads; i++)
+		pthread_create(&compress_pool.threads[i], NULL, compress_worker, NULL);
+	compress_pool.n_threads = n_threads;
+
+	elog(LOG, "Started %d compression threads", n_threads);
+}
+
+/*
+ * Stop the pool of compression workers. All batches should be written
+ * already.
+ */
+void
+stop_compress_workers(void)
+{
+	int			i;
+
+	if (compress_pool.n_threads == 0)
+		return;
+
+	pthread_lock(&compress_pool.lock);
+	compress_pool.stop = true;
+	pthread_cond_broadcast(&compress_pool.queued);
+	pthread_mutex_unlock(&compress_pool.lock);
+
+	for (i = 0; i < compress_pool.n_threads; i++)
+		pthread_join(compress_pool.threads[i], NULL);
+
+	pfree(compress_pool.threads);
+	compress_pool.threads = NULL;
+	compress_pool.n_threads = 0;
+
+	pthread_cond_destroy(&compress_pool.queued);
+	pthread_cond_destroy(&compress_pool.done);
+	pthread_mutex_destroy(&compress_pool.lock);
+}
+
+static void
+page_writer_init(PageWriter *writer, pgFile *file, FILE *in, FILE *out,
+				 pg_crc32 *crc, BlockIndexBuilder *index, CompressAlg calg,
+				 int clevel)
+{
+	writer->file = file;
+	writer->in = in;
+	writer->out = out;
+	writer->crc = crc;
+	writer->index = index;
+	writer->calg = calg;
+	writer->clevel = clevel;
+	/* There is nothing to do for the pool if there is no compression */
+	writer->use_pool = compress_pool.n_threads > 0 &&
+		calg != NONE_COMPRESS && calg != NOT_DEFINED_COMPRESS;
+	writer->batch = NULL;
+	writer->first_in_flight = 0;
+	writer->n_in_flight = 0;
+	writer->spare = NULL;
+}
+
+/*
+ * Wait until the oldest batch passed to the pool is compressed and write it.
+ */
+static void
+page_writer_write_first(PageWriter *writer)
+{
+	PageBatch  *batch = writer->in_flight[writer->first_in_flight];
+
+	pthread_lock(&compress_pool.lock);
+	while (!batch->done)
+		pthread_cond_wait(&compress_pool.done, &compress_pool.lock);
+	pthread_mutex_unlock(&compress_pool.lock);
+
+	write_backup_pages(writer->file, batch->blknum[0],
+					   writer->in, writer->out, writer->crc, writer->index,
+					   batch->write_buffer, batch->write_size);
+
+	/* The same accounting as in compress_and_backup_page() */
+	if (batch->page_state[batch->n_pages - 1] == PageIsTruncated)
+		writer->file->read_size += (batch->n_pages - 1) * BLCKSZ;
+	else
+		writer->file->read_size += batch->n_pages * BLCKSZ;
+	if (batch->n_pages > 1 ||
+		batch->page_state[0] != PageIsTruncated)
+		writer->file->compress_alg = writer->calg;
+
+	writer->first_in_flight = (writer->first_in_flight + 1) %
+		COMPRESS_BATCHES_IN_FLIGHT;
+	writer->n_in_flight--;
+
+	batch->next = writer->spare;
+	writer->spare = batch;
+}
+
+/*
+ * Pass the batch being filled to the pool.
+ */
+static void
+page_writer_submit(PageWriter *writer)
+{
+	PageBatch  *batch = writer->batch;
+
+	if (writer->n_in_flight == COMPRESS_BATCHES_IN_FLIGHT)
+		page_writer_write_first(writer);
+
+	writer->in_flight[(writer->first_in_flight + writer->n_in_flight) %
+					  COMPRESS_BATCHES_IN_FLIGHT] = batch;
+	writer->n_in_flight++;
+	writer->batch = NULL;
+
+	batch->next = NULL;
+	batch->done = false;
+
+	pthread_lock(&compress_pool.lock);
+	if (compress_pool.tail)
+		compress_pool.tail->next = batch;
+	else
+		compress_pool.head = batch;
+	compress_pool.tail = batch;
+	pthread_cond_signal(&compress_pool.queued);
+	pthread_mutex_unlock(&compress_pool.lock);
+}
+
+/*
+ * Write the page into the backup file. Pages are written in the order of
+ * calls.
+ */
+static void
+page_writer_put(PageWriter *writer, BlockNumber blknum, int page_state,
+				Page page)
+{
+	PageBatch  *batch;
+
+	if (!writer->use_pool)
+	{
+		compress_and_backup_page(writer->file, blknum, writer->in,
+								 writer->out, writer->crc, writer->index,
+								 page_state, page, writer->calg,
+								 writer->clevel);
+		return;
+	}
+
+	if (page_state == SkipCurrentPage)
+		return;
+
+	if (writer->batch == NULL)
+	{
+		if (writer->spare)
+		{
+			writer->batch = writer->spare;
+			writer->spare = writer->spare->next;
+		}
+		else
+			writer->batch = pgut_new(PageBatch);
+
+		writer->batch->calg = writer->calg;
+		writer->batch->clevel = writer->clevel;
+		writer->batch->n_pages = 0;
+	}
+
+	batch = writer->batch;
+	batch->blknum[batch->n_pages] = blknum;
+	batch->page_state[batch->n_pages] = page_state;
+	if (page_state != PageIsTruncated)
+		memcpy(batch->pages[batch->n_pages], page, BLCKSZ);
+	batch->n_pages++;
+
+	if (batch->n_pages == COMPRESS_BATCH_PAGES)
+		page_writer_submit(writer);
+}
+
+/*
+ * Write all remaining pages and release the writer.
+ */
+static void
+page_writer_finish(PageWriter *writer)
+{
+	if (writer->batch)
+		page_writer_submit(writer);
+
+	while (writer->n_in_flight > 0)
+		page_writer_write_first(writer);
+
+	while (writer->spare)
+	{
+		PageBatch  *batch = writer->spare;
+
+		writer->spare = batch->next;
+		free(batch);
+	}
+}
+
+/*
+ * Read again the pages which failed verification while the file was read.
+ * The delay between the rounds grows exponentially, so that concurrent
+ * writes of the pages can complete. The pages are written to the backup
+ * file after all others in ascending order of blocks once all rounds are
+ * done, so the backup file has at most one place where the order of blocks
+ * goes backwards, see restore_data_file().
+ */
+static void
+retry_deferred_pages(backup_files_arg *arguments, pgFile *file,
+					 XLogRecPtr prev_backup_start_lsn, BlockNumber nblocks,
+					 PageReader *reader, PageWriter *writer, int *n_skipped,
+					 BackupMode backup_mode, DeferredPages *deferred)
+{
+	char	   *pages;
+	int		   *page_states;
+	int		   *left;
+	int			n_left;
+	int			round;
+	int			n_retries = 0;
+	int			i;
+	struct timeval start_time,
+				end_time;
+
+	if (deferred->n == 0)
+		return;
+
+	elog(VERBOSE, "File \"%s\", read again %d pages failed verification",
+		 file->path, deferred->n);
+
+	/* Blocks were deferred in ascending order, keep it */
+	pages = (char *) pgut_malloc((size_t) deferred->n * BLCKSZ);
+	page_states = pgut_newarray(int, deferred->n);
+	left = pgut_newarray(int, deferred->n);
+	for (i = 0; i < deferred->n; i++)
+		left[i] = i;
+	n_left = deferred->n;
+
+	gettimeofday(&start_time, NULL);
+	for (round = 0; n_left > 0; round++)
+	{
+		int			n = n_left;
+
+		pg_usleep(PAGE_RETRY_DELAY << round);
+
+		n_left = 0;
+		for (i = 0; i < n; i++)
+		{
+			int			j = left[i];
+
+			n_retries++;
+			page_states[j] = prepare_page(arguments, file,
+										  prev_backup_start_lsn,
+										  deferred->blocks[j], nblocks, reader,
+										  n_skipped, backup_mode,
+										  pages + (size_t) j * BLCKSZ, NULL,
+										  round == PAGE_RETRY_ROUNDS - 1);
+			if (page_states[j] == PageIsDeferred)
+				left[n_left++] = j;
+		}
+	}
+	gettimeofday(&end_time, NULL);
+
+	for (i = 0; i < deferred->n; i++)
+	{
+		/*
+		 * The file was truncated concurrently. Truncation is WAL-logged,
+		 * so the block will be truncated by recovery.
+		 */
+		if (page_states[i] != PageIsTruncated)
+			page_writer_put(writer, deferred->blocks[i], page_states[i],
+							pages + (size_t) i * BLCKSZ);
+	}
+
+	pthread_lock(&page_retry_lock);
+	current.page_retries += n_retries;
+	current.page_retry_time += (end_time.tv_sec - start_time.tv_sec) * 1000 +
+		(end_time.tv_usec - start_time.tv_usec) / 1000;
+	pthread_mutex_unlock(&page_retry_lock);
+
+	pg_free(pages);
+	pg_free(page_states);
+	pg_free(left);
+	pg_free(deferred->blocks);
+	deferred->blocks = NULL;
+	deferred->n = 0;
+	deferred->size = 0;
+}
+
+/*
+ * Backup data file in the from_root directory to the to_root directory with
+ * same relative path. If prev_backup_start_lsn is not NULL, only pages with
+ * higher lsn will be copied.
+ * Not just copy file, but read it block by block (use bitmap in case of
+ * incremental backup), validate checksum, optionally compress and write to
+ * backup with special header.
+ */
+bool
+backup_data_file(backup_files_arg* arguments,
+				 const char *to_path, pgFile *file,
+				 XLogRecPtr prev_backup_start_lsn, BackupMode backup_mode,
+				 CompressAlg calg, int clevel)
+{
+	FILE		*in;
+	FILE		*out;
+	BlockNumber	blknum = 0;
+	BlockNumber	nblocks = 0;
+	int			n_blocks_skipped = 0;
+	int			n_blocks_read = 0;
+	int			page_state;
+	char		curr_page[BLCKSZ];
+	PageReader	reader;
+	PageWriter	writer;
+	BlockIndexBuilder index;
+	DeferredPages deferred = {NULL, 0, 0};
+
+	/*
+	 * Skip unchanged file only if it exists in previous backup.
+	 * This way we can correctly handle null-sized files which are
+	 * not tracked by pagemap and thus always marked as unchanged.
+	 */
+	if ((backup_mode == BACKUP_MODE_DIFF_PAGE ||
+		backup_mode == BACKUP_MODE_DIFF_PTRACK) &&
+		file->pagemap.bitmapsize == PageBitmapIsEmpty &&
+		file->exists_in_prev && !file->pagemap_isabsent)
+	{
+		/*
+		 * There are no changed blocks since last backup. We want make
+		 * incremental backup, so we should exit.
+		 */
+		elog(VERBOSE, "Skipping the unchanged file: %s", file->path);
+		return false;
+	}
+
+	/* reset size summary */
+	file->read_size = 0;
+	file->write_size = 0;
+	INIT_CRC32C(file->crc);
+	block_index_init(&index);
+
+	/* open backup mode file for read */
+	in = fopen(file->path, PG_BINARY_R);
+	if (in == NULL)
+	{
+		FIN_CRC32C(file->crc);
+
+		/*
+		 * If file is not found, this is not en error.
+		 * It could have been deleted by concurrent postgres transaction.
+		 */
+		if (errno == ENOENT)
+		{
+			elog(LOG, "File \"%s\" is not found", file->path);
+			return false;
+		}
+
+		elog(ERROR, "cannot open file \"%s\": %s",
+			 file->path, strerror(errno));
+	}
+
+	if (file->size % BLCKSZ != 0)
+	{
+		fclose(in);
+		elog(ERROR, "File: %s, invalid file size %lu", file->path, file->size);
+	}
+
+	/*
+	 * Compute expected number of blocks in the file.
+	 * NOTE This is a normal situation, if the file size has changed
+	 * since the moment we computed it.
+	 */
+	nblocks = file->size/BLCKSZ;
+
+	/* open backup file for write  */
+	out = fopen(to_path, PG_BINARY_W);
+	if (out == NULL)
+	{
+		int errno_tmp = errno;
+		fclose(in);
+		elog(ERROR, "cannot open backup file \"%s\": %s",
+			 to_path, strerror(errno_tmp));
+	}
+
+	/*
+	 * Read each page, verify checksum and write it to backup.
+	 * If page map is empty or file is not present in previous backup
+	 * backup all pages of the relation.
+	 *
+	 * We will enter here if backup_mode is FULL or DELTA.
+	 */
+	if (file->pagemap.bitmapsize == PageBitmapIsEmpty ||
+		file->pagemap_isabsent || !file->exists_in_prev)
+	{
+		page_reader_init(&reader, in, NULL, 0, nblocks);
+		page_writer_init(&writer, file, in, out, &(file->crc),
+						 current.block_index ? &index : NULL, calg, clevel);
+		for (blknum = 0; blknum < nblocks; blknum++)
+		{
+			page_state = prepare_page(arguments, file, prev_backup_start_lsn,
+									  blknum, nblocks, &reader, &n_blocks_skipped,
+									  backup_mode, curr_page, &deferred, false);
+			/* Deferred pages must be written before the truncation mark */
+			if (page_state == PageIsTruncated)
+				retry_deferred_pages(arguments, file, prev_backup_start_lsn,
+									 nblocks, &reader, &writer,
+									 &n_blocks_skipped, backup_mode, &deferred);
+			if (page_state != PageIsDeferred)
+				page_writer_put(&writer, blknum, page_state, curr_page);
+			n_blocks_read++;
+			if (page_state == PageIsTruncated)
+				break;
+		}
+		retry_deferred_pages(arguments, file, prev_backup_start_lsn,
+							 nblocks, &reader, &writer,
+							 &n_blocks_skipped, backup_mode, &deferred);
+		page_writer_finish(&writer);
+		page_reader_free(&reader);
+		if (backup_mode == BACKUP_MODE_DIFF_DELTA)
+			file->n_blocks = n_blocks_read;
+	}
+	/*
+	 * If page map is not empty we scan only changed blocks.
+	 *
+	 * We will enter here if backup_mode is PAGE or PTRACK.
+	 */
+	else
+	{
+		datapagemap_iterator_t *iter;
+
+		page_reader_init(&reader, in, &file->pagemap, 0, nblocks);
+		page_writer_init(&writer, file, in, out, &(file->crc),
+						 current.block_index ? &index : NULL, calg, clevel);
+		iter = datapagemap_iterate(&file->pagemap);
+		while (datapagemap_next(iter, &blknum))
+		{
+			page_state = prepare_page(arguments, file, prev_backup_start_lsn,
+									  blknum, nblocks, &reader, &n_blocks_skipped,
+									  backup_mode, curr_page, &deferred, false);
+			/* Deferred pages must be written before the truncation mark */
+			if (page_state == PageIsTruncated)
+				retry_deferred_pages(arguments, file, prev_backup_start_lsn,
+									 nblocks, &reader, &writer,
+									 &n_blocks_skipped, backup_mode, &deferred);
+			if (page_state != PageIsDeferred)
+				page_writer_put(&writer, blknum, page_state, curr_page);
+			n_blocks_read++;
+			if (page_state == PageIsTruncated)
+				break;
+		}
+		retry_deferred_pages(arguments, file, prev_backup_start_lsn,
+							 nblocks, &reader, &writer,
+							 &n_blocks_skipped, backup_mode, &deferred);
+		page_writer_finish(&writer);
+		page_reader_free(&reader);
+
+		pg_free(file->pagemap.bitmap);
+		pg_free(iter);
+	}
+
+	/* update file permission */
+	if (chmod(to_path, FILE_PERMISSION) == -1)
+	{
+		int errno_tmp = errno;
+		fclose(in);
+		fclose(out);
+		elog(ERROR, "cannot change mode of \"%s\": %s", file->path,
+			 strerror(errno_tmp));
+	}
+
+	if (fflush(out) != 0 ||
+		fsync(fileno(out)) != 0 ||
+		fclose(out))
+		elog(ERROR, "cannot write backup file \"%s\": %s",
+			 to_path, strerror(errno));
+	fclose(in);
+
+	FIN_CRC32C(file->crc);
+
+	/*
+	 * If we have pagemap then file in the backup can't be a zero size.
+	 * Otherwise, we will clear the last file.
+	 */
+	if (n_blocks_read != 0 && n_blocks_read == n_blocks_skipped)
+	{
+		if (remove(to_path) == -1)
+			elog(ERROR, "cannot remove file \"%s\": %s", to_path,
+				 strerror(errno));
+		pg_free(index.entries);
+		return false;
+	}
+
+	if (current.block_index)
+		block_index_write(to_path, &index, file->write_size, file->crc);
+
+	return true;
+}
+
+/*
+ * Backup block range of the data file described by 'part'.
+ *
+ * The range is written into separate part file "<to_path>.part<N>" in the
+ * same format as the whole backup file. Parts are joined into the backup
+ * file by join_data_file_parts() when all of them are processed, so
+ * several threads can back up different ranges of a single file.
+ */
+void
+backup_data_file_part(backup_files_arg* arguments,
+					  const char *to_path, pgFilePart *part,
+					  XLogRecPtr prev_backup_start_lsn, BackupMode backup_mode,
+					  CompressAlg calg, int clevel)
+{
+	pgFile		file;
+	FILE	   *in;
+	FILE	   *out;
+	char		part_path[MAXPGPATH];
+	BlockNumber	blknum = 0;
+	BlockNumber	nblocks = 0;
+	BlockNumber	end_blkno;
+	int			page_state;
+	char		curr_page[BLCKSZ];
+	PageReader	reader;
+	PageWriter	writer;
+	BlockIndexBuilder index;
+	DeferredPages deferred = {NULL, 0, 0};
+
+	/*
+	 * Work with a private copy of the file entry, so that parallel threads
+	 * don't update the same size counters.
+	 */
+	memcpy(&file, part->file, sizeof(pgFile));
+	file.read_size = 0;
+	file.write_size = 0;
+	INIT_CRC32C(file.crc);
+	block_index_init(&index);
+
+	part->exists = false;
+	part->truncated = false;
+	part->n_blocks_read = 0;
+	part->n_blocks_skipped = 0;
+
+	/* open backup mode file for read */
+	in = fopen(file.path, PG_BINARY_R);
+	if (in == NULL)
+	{
+		/*
+		 * If file is not found, this is not en error.
+		 * It could have been deleted by concurrent postgres transaction.
+		 */
+		if (errno == ENOENT)
+		{
+			elog(LOG, "File \"%s\" is not found", file.path);
+			return;
+		}
+
+		elog(ERROR, "cannot open file \"%s\": %s",
+			 file.path, strerror(errno));
+	}
+
+	if (file.size % BLCKSZ != 0)
+	{
+		fclose(in);
+		elog(ERROR, "File: %s, invalid file size %lu", file.path, file.size);
+	}
+
+	nblocks = file.size/BLCKSZ;
+	end_blkno = Min(nblocks, part->end_blkno);
+
+	/* open part file for write  */
+	snprintf(part_path, lengthof(part_path), "%s.part%d", to_path, part->partno);
+	out = fopen(part_path, PG_BINARY_W);
+	if (out == NULL)
+	{
+		int errno_tmp = errno;
+		fclose(in);
+		elog(ERROR, "cannot open backup file \"%s\": %s",
+			 part_path, strerror(errno_tmp));
+	}
+
+	/* The same choice of blocks as in backup_data_file() */
+	if (file.pagemap.bitmapsize == PageBitmapIsEmpty ||
+		file.pagemap_isabsent || !file.exists_in_prev)
+	{
+		page_reader_init(&reader, in, NULL, part->start_blkno, end_blkno);
+		page_writer_init(&writer, &file, in, out, &(file.crc),
+						 current.block_index ? &index : NULL, calg, clevel);
+		for (blknum = part->start_blkno; blknum < end_blkno; blknum++)
+		{
+			page_state = prepare_page(arguments, &file, prev_backup_start_lsn,
+									  blknum, nblocks, &reader,
+									  &part->n_blocks_skipped,
+									  backup_mode, curr_page, &deferred, false);
+			/* Deferred pages must be written before the truncation mark */
+			if (page_state == PageIsTruncated)
+				retry_deferred_pages(arguments, &file, prev_backup_start_lsn,
+									 nblocks, &reader, &writer,
+									 &part->n_blocks_skipped, backup_mode,
+									 &deferred);
+			if (page_state != PageIsDeferred)
+				page_writer_put(&writer, blknum, page_state, curr_page);
+			part->n_blocks_read++;
+			if (page_state == PageIsTruncated)
+			{
+				part->truncated = true;
+				break;
+			}
+		}
+		retry_deferred_pages(arguments, &file, prev_backup_start_lsn,
+							 nblocks, &reader, &writer,
+							 &part->n_blocks_skipped, backup_mode, &deferred);
+		page_writer_finish(&writer);
+		page_reader_free(&reader);
+	}
+	else
+	{
+		datapagemap_iterator_t *iter;
+
+		page_reader_init(&reader, in, &file.pagemap, part->start_blkno,
+						 end_blkno);
+		page_writer_init(&writer, &file, in, out, &(file.crc),
+						 current.block_index ? &index : NULL, calg, clevel);
+		iter = datapagemap_iterate(&file.pagemap);
+		while (datapagemap_next(iter, &blknum))
+		{
+			if (blknum < part->start_blkno)
+				continue;
+			if (blknum >= part->end_blkno)
+				break;
+
+			page_state = prepare_page(arguments, &file, prev_backup_start_lsn,
+									  blknum, nblocks, &reader,
+									  &part->n_blocks_skipped,
+									  backup_mode, curr_page, &deferred, false);
+			/* Deferred pages must be written before the truncation mark */
+			if (page_state == PageIsTruncated)
+				retry_deferred_pages(arguments, &file, prev_backup_start_lsn,
+									 nblocks, &reader, &writer,
+									 &part->n_blocks_skipped, backup_mode,
+									 &deferred);
+			if (page_state != PageIsDeferred)
+				page_writer_put(&writer, blknum, page_state, curr_page);
+			part->n_blocks_read++;
+			if (page_state == PageIsTruncated)
+			{
+				part->truncated = true;
+				break;
+			}
+		}
+		retry_deferred_pages(arguments, &file, prev_backup_start_lsn,
+							 nblocks, &reader, &writer,
+							 &part->n_blocks_skipped, backup_mode, &deferred);
+		page_writer_finish(&writer);
+		page_reader_free(&reader);
+		pg_free(iter);
+	}
+
+	if (fclose(out))
+		elog(ERROR, "cannot write backup file \"%s\": %s",
+			 part_path, strerror(errno));
+	fclose(in);
+
+	FIN_CRC32C(file.crc);
+
+	part->exists = true;
+	part->read_size = file.read_size;
+	part->write_size = file.write_size;
+	part->crc = file.crc;
+	part->compress_alg = file.compress_alg;
+	/* Offsets are relative to the part, join_data_file_parts() shifts them */
+	part->index_entries = index.entries;
+	part->n_index_entries = index.n_entries;
+	part->index_truncated = index.truncated;
+}
+
+/*
+ * Join part files written by backup_data_file_part() into the backup file
+ * and compute its CRC. Parts following the one where the file was found
+ * truncated are thrown away.
+ *
+ * Returns false if the file shouldn't be included into the backup, the same
+ * way as backup_data_file() does.
+ */
+bool
+join_data_file_parts(const char *to_path, pgFile *file, BackupMode backup_mode)
+{
+	FILE	   *out = NULL;
+	bool		exists = true;
+	bool		truncated = false;
+	int			n_blocks_read = 0;
+	int			n_blocks_skipped = 0;
+	char		buf[BLCKSZ];
+	BlockIndexBuilder index;
+	int			i;
+
+	for (i = 0; i < file->n_parts; i++)
+		if (!file->parts[i].exists)
+			exists = false;
+
+	file->read_size = 0;
+	file->write_size = 0;
+	INIT_CRC32C(file->crc);
+	block_index_init(&index);
+
+	if (exists)
+	{
+		out = fopen(to_path, PG_BINARY_W);
+		if (out == NULL)
+			elog(ERROR, "cannot open backup file \"%s\": %s",
+				 to_path, strerror(errno));
+	}
+
+	for (i = 0; i < file->n_parts; i++)
+	{
+		pgFilePart *part = &file->parts[i];
+		char		part_path[MAXPGPATH];
+		FILE	   *in;
+		size_t		read_len;
+		uint32		j;
+
+		snprintf(part_path, lengthof(part_path), "%s.part%d", to_path,
+				 part->partno);
+
+		if (!part->exists)
+			continue;
+
+		if (exists && !truncated)
+		{
+			in = fopen(part_path, PG_BINARY_R);
+			if (in == NULL)
+				elog(ERROR, "cannot open file \"%s\": %s", part_path,
+					 strerror(errno));
+
+			while ((read_len = fread(buf, 1, sizeof(buf), in)) > 0)
+			{
+				if (fwrite(buf, 1, read_len, out) != read_len)
+					elog(ERROR, "cannot write backup file \"%s\": %s",
+						 to_path, strerror(errno));
+				COMP_CRC32C(file->crc, buf, read_len);
+			}
+			if (ferror(in))
+				elog(ERROR, "cannot read file \"%s\": %s", part_path,
+					 strerror(errno));
+			fclose(in);
+
+			/* Entries of the part follow the preceding parts in the file */
+			for (j = 0; j < part->n_index_entries; j++)
+			{
+				BlockIndexEntry *entry = &part->index_entries[j];
+
+				block_index_add(&index.entries, &index.n_entries, &index.size,
+								entry->block, entry->compressed_size,
+								file->write_size + entry->offset, entry->crc);
+			}
+			index.truncated = Min(index.truncated, part->index_truncated);
+
+			file->read_size += part->read_size;
+			file->write_size += part->write_size;
+			if (part->compress_alg != NOT_DEFINED_COMPRESS)
+				file->compress_alg = part->compress_alg;
+			n_blocks_read += part->n_blocks_read;
+			n_blocks_skipped += part->n_blocks_skipped;
+			truncated = part->truncated;
+		}
+
+		if (remove(part_path) == -1)
+			elog(ERROR, "cannot remove file \"%s\": %s", part_path,
+				 strerror(errno));
+
+		pg_free(part->index_entries);
+		part->index_entries = NULL;
+		part->n_index_entries = 0;
+	}
+
+	FIN_CRC32C(file->crc);
+
+	pg_free(file->pagemap.bitmap);
+	file->pagemap.bitmap = NULL;
+
+	/* The file was deleted by concurrent postgres transaction */
+	if (!exists)
+	{
+		pg_free(index.entries);
+		return false;
+	}
+
+	if (backup_mode == BACKUP_MODE_DIFF_DELTA)
+		file->n_blocks = n_blocks_read;
+
+	/* update file permission */
+	if (chmod(to_path, FILE_PERMISSION) == -1)
+	{
+		int errno_tmp = errno;
+		fclose(out);
+		elog(ERROR, "cannot change mode of \"%s\": %s", to_path,
+			 strerror(errno_tmp));
+	}
+
+	if (fflush(out) != 0 ||
+		fsync(fileno(out)) != 0 ||
+		fclose(out))
+		elog(ERROR, "cannot write backup file \"%s\": %s",
+			 to_path, strerror(errno));
+
+	/* All pages of the file were skipped, see backup_data_file() */
+	if (n_blocks_read != 0 && n_blocks_read == n_blocks_skipped)
+	{
+		if (remove(to_path) == -1)
+			elog(ERROR, "cannot remove file \"%s\": %s", to_path,
+				 strerror(errno));
+		pg_free(index.entries);
+		return false;
+	}
+
+	if (current.block_index)
+		block_index_write(to_path, &index, file->write_size, file->crc);
+
+	return true;
+}
+
+/*
+ * Restore files in the from_root directory to the to_root directory with
+ * same relative path.
+ *
+ * If write_header is true then we add header to each restored block, currently
+ * it is used for MERGE command.
+ */
+void
+restore_data_file(const char *to_path, pgFile *file, bool allow_truncate,
+				  bool write_header)
+{
+	FILE	   *in = NULL;
+	FILE	   *out = NULL;
+	BackupPageHeader header;
+	BlockNumber	blknum = 0,
+				truncate_from = 0;
+	bool		need_truncate = false;
+	bool		deferred_part = false;
+	PageStoreReader reader;
+
+	page_store_reader_init(&reader);
+
+	/* BYTES_INVALID allowed only in case of restoring file from DELTA backup */
+	if (file->write_size != BYTES_INVALID)
+	{
+		/* open backup mode file for read */
+		in = fopen(file->path, PG_BINARY_R);
+		if (in == NULL)
+		{
+			elog(ERROR, "cannot open backup file \"%s\": %s", file->path,
+				 strerror(errno));
+		}
+	}
+
+	/*
+	 * Open backup file for write. 	We use "r+" at first to overwrite only
+	 * modified pages for differential restore. If the file does not exist,
+	 * re-open it with "w" to create an empty file.
+	 */
+	out = fopen(to_path, PG_BINARY_R "+");
+	if (out == NULL && errno == ENOENT)
+		out = fopen(to_path, PG_BINARY_W);
+	if (out == NULL)
+	{
+		int errno_tmp = errno;
+		fclose(in);
+		elog(ERROR, "cannot open restore target file \"%s\": %s",
+			 to_path, strerror(errno_tmp));
+	}
+
+	while (true)
+	{
+		off_t		write_pos;
+		size_t		read_len;
+		DataPage	compressed_page; /* used as read buffer */
+		DataPage	page;
+
+		/* File didn`t changed. Nothig to copy */
+		if (file->write_size == BYTES_INVALID)
+			break;
+
+		/*
+		 * We need to truncate result file if data file in a incremental backup
+		 * less than data file in a full backup. We know it thanks to n_blocks.
+		 *
+		 * It may be equal to -1, then we don't want to truncate the result
+		 * file.
+		 */
+		if (file->n_blocks != BLOCKNUM_INVALID &&
+			(blknum + 1) > file->n_blocks)
+		{
+			truncate_from = blknum;
+			need_truncate = true;
+			break;
+		}
+
+		/* read BackupPageHeader */
+		read_len = fread(&header, 1, sizeof(header), in);
+		if (read_len != sizeof(header))
+		{
+			int errno_tmp = errno;
+			if (read_len == 0 && feof(in))
+				break;		/* EOF found */
+			else if (read_len != 0 && feof(in))
+				elog(ERROR,
+					 "odd size page found at block %u of \"%s\"",
+					 blknum, file->path);
+			else
+				elog(ERROR, "cannot read header of block %u of \"%s\": %s",
+					 blknum, file->path, strerror(errno_tmp));
+		}
+
+		/*
+		 * Blocks go in ascending order. Pages read again after verification
+		 * failure follow the others in ascending order too, so the order may
+		 * go backwards only once.
+		 */
+		if (header.block < blknum)
+		{
+			if (deferred_part)
+				elog(ERROR, "backup is broken at file->path %s block %u",
+					 file->path, blknum);
+			deferred_part = true;
+		}
+
+		blknum = header.block;
+
+		if (header.compressed_size == PageIsTruncated)
+		{
+			/*
+			 * Backup contains information that this block was truncated.
+			 * We need to truncate file to this length.
+			 */
+			truncate_from = blknum;
+			need_truncate = true;
+			break;
+		}
+
+		Assert(header.compressed_size <= BLCKSZ);
+
+		if (header.compressed_size == PageIsZeroed)
+		{
+			/* Zero page has no payload, restore it as uncompressed page */
+			memset(compressed_page.data, 0, BLCKSZ);
+			header.compressed_size = BLCKSZ;
+		}
+		else if (header.compressed_size == PageIsReference)
+		{
+			PageStoreRef ref;
+
+			if (fread(&ref, 1, sizeof(ref), in) != sizeof(ref))
+				elog(ERROR, "cannot read block %u of \"%s\": %s",
+					 blknum, file->path, strerror(errno));
+			load_page(&ref, compressed_page.data, &reader);
+			header.compressed_size = BLCKSZ;
+		}
+		else
+		{
+			int64		io_start;
+
+			io_start = io_throttle_start(MAXALIGN(header.compressed_size));
+			read_len = fread(compressed_page.data, 1,
+				MAXALIGN(header.compressed_size), in);
+			io_throttle_end(io_start);
+			if (read_len != MAXALIGN(header.compressed_size))
+				elog(ERROR, "cannot read block %u of \"%s\" read %lu of %d",
+					blknum, file->path, read_len, header.compressed_size);
+		}
+
+		if (header.compressed_size != BLCKSZ)
+		{
+			int32		uncompressed_size = 0;
+
+			/*
+			 * Pass the exact compressed size, zstd and lz4 don't accept
+			 * the alignment padding after the compressed data.
+			 */
+			uncompressed_size = do_decompress(page.data, BLCKSZ,
+											  compressed_page.data,
+											  header.compressed_size,
+											  file->compress_alg);
+
+			if (uncompressed_size != BLCKSZ)
+				elog(ERROR, "page of file \"%s\" uncompressed to %d bytes. != BLCKSZ",
+					 file->path, uncompressed_size);
+		}
+
+		write_pos = (write_header) ? blknum * (BLCKSZ + sizeof(header)) :
+									 blknum * BLCKSZ;
+
+		/*
+		 * Seek and write the restored page.
+		 */
+		if (fseek(out, write_pos, SEEK_SET) < 0)
+			elog(ERROR, "cannot seek block %u of \"%s\": %s",
+				 blknum, to_path, strerror(errno));
+
+		if (write_header)
+		{
+			if (fwrite(&header, 1, sizeof(header), out) != sizeof(header))
+				elog(ERROR, "cannot write header of block %u of \"%s\": %s",
+					 blknum, file->path, strerror(errno));
+		}
+
+		if (header.compressed_size < BLCKSZ)
+		{
+			if (fwrite(page.data, 1, BLCKSZ, out) != BLCKSZ)
+				elog(ERROR, "cannot write block %u of \"%s\": %s",
+					 blknum, file->path, strerror(errno));
+		}
+		else
+		{
+			/* if page wasn't compressed, we've read full block */
+			if (fwrite(compressed_page.data, 1, BLCKSZ, out) != BLCKSZ)
+				elog(ERROR, "cannot write block %u of \"%s\": %s",
+					 blknum, file->path, strerror(errno));
+		}
+	}
+
+	/*
+	 * DELTA backup have no knowledge about truncated blocks as PAGE or PTRACK do
+	 * But during DELTA backup we read every file in PGDATA and thus DELTA backup
+	 * knows exact size of every file at the time of backup.
+	 * So when restoring file from DELTA backup we, knowning it`s size at
+	 * a time of a backup, can truncate file to this size.
+	 */
+	if (allow_truncate && file->n_blocks != BLOCKNUM_INVALID && !need_truncate)
+	{
+		size_t		file_size = 0;
+
+		/* get file current size */
+		fseek(out, 0, SEEK_END);
+		file_size = ftell(out);
+
+		if (file_size > file->n_blocks * BLCKSZ)
+		{
+			truncate_from = file->n_blocks;
+			need_truncate = true;
+		}
+	}
+
+	if (need_truncate)
+	{
+		off_t		write_pos;
+
+		write_pos = (write_header) ? truncate_from * (BLCKSZ + sizeof(header)) :
+									 truncate_from * BLCKSZ;
+
+		/*
+		 * Truncate file to this length.
+		 */
+		if (ftruncate(fileno(out), write_pos) != 0)
+			elog(ERROR, "cannot truncate \"%s\": %s",
+				 file->path, strerror(errno));
+		elog(INFO, "Delta truncate file %s to block %u",
+			 file->path, truncate_from);
+	}
+
+	/* update file permission */
+	if (chmod(to_path, file->mode) == -1)
+	{
+		int errno_tmp = errno;
+
+		if (in)
+			fclose(in);
+		fclose(out);
+		elog(ERROR, "cannot change mode of \"%s\": %s", to_path,
+			 strerror(errno_tmp));
+	}
+
+	if (fflush(out) != 0 ||
+		fsync(fileno(out)) != 0 ||
+		fclose(out))
+		elog(ERROR, "cannot write \"%s\": %s", to_path, strerror(errno));
+	if (in)
+		fclose(in);
+	page_store_reader_close(&reader);
+}
+
+/*
+ * Block index of the backup data file:
+ *
+ *	BlockIndexHeader
+ *	BlockIndexEntry[n_entries], sorted by block number
+ *	CRC32C of everything above
+ *
+ * The index allows to find a block of the backup file without reading
+ * headers of all preceding blocks. It describes the backup file of the
+ * given size and CRC, and it is ignored if the backup file doesn't match.
+ * Backup files without the index are scanned.
+ */
+#define BLOCK_INDEX_MAGIC	0x58494250	/* "PBIX" */
+#define BLOCK_INDEX_VERSION	1
+
+typedef struct BlockIndexHeader
+{
+	uint32		magic;
+	uint32		version;
+	uint32		n_entries;
+	BlockNumber	truncated;		/* block of PageIsTruncated header or
+								 * InvalidBlockNumber */
+	uint64		file_size;		/* size of the backup file */
+	pg_crc32	file_crc;		/* CRC of the backup file */
+	uint32		padding;
+} BlockIndexHeader;
+
+static int
+block_index_entry_compare(const void *a, const void *b)
+{
+	BlockNumber	block1 = ((const BlockIndexEntry *) a)->block;
+	BlockNumber	block2 = ((const BlockIndexEntry *) b)->block;
+
+	if (block1 < block2)
+		return -1;
+	if (block1 > block2)
+		return 1;
+	return 0;
+}
+
+/*
+ * Append an entry to the growing array of index entries.
+ */
+static void
+block_index_add(BlockIndexEntry **entries, uint32 *n_entries, uint32 *size,
+				BlockNumber blknum, int32 compressed_size, uint64 offset,
+				pg_crc32 crc)
+{
+	BlockIndexEntry *entry;
+
+	if (*n_entries == *size)
+	{
+		*size = Max(*size * 2, 64);
+		*entries = (BlockIndexEntry *) pg_realloc(*entries,
+										sizeof(BlockIndexEntry) * (*size));
+	}
+
+	entry = &(*entries)[(*n_entries)++];
+	MemSet(entry, 0, sizeof(BlockIndexEntry));
+	entry->offset = offset;
+	entry->block = blknum;
+	entry->compressed_size = compressed_size;
+	entry->crc = crc;
+}
+
+/*
+ * Write block index of the backup file 'path' using already sorted entries.
+ */
+static void
+write_block_index_entries(const char *path, BlockIndexEntry *entries,
+						  uint32 n_entries, BlockNumber truncated,
+						  uint64 file_size, pg_crc32 file_crc)
+{
+	char		index_path[MAXPGPATH];
+	char		path_temp[MAXPGPATH];
+	BlockIndexHeader header;
+	pg_crc32	crc;
+	FILE	   *out;
+
+	snprintf(index_path, lengthof(index_path), "%s%s", path,
+			 BLOCK_INDEX_SUFFIX);
+	snprintf(path_temp, lengthof(path_temp), "%s.partial", index_path);
+
+	out = fopen(path_temp, PG_BINARY_W);
+	if (out == NULL)
+		elog(ERROR, "cannot open block index \"%s\": %s", path_temp,
+			 strerror(errno));
+
+	MemSet(&header, 0, sizeof(header));
+	header.magic = BLOCK_INDEX_MAGIC;
+	header.version = BLOCK_INDEX_VERSION;
+	header.n_entries = n_entries;
+	header.truncated = truncated;
+	header.file_size = file_size;
+	header.file_crc = file_crc;
+
+	INIT_CRC32C(crc);
+	COMP_CRC32C(crc, &header, sizeof(header));
+	if (n_entries > 0)
+		COMP_CRC32C(crc, entries, sizeof(BlockIndexEntry) * n_entries);
+	FIN_CRC32C(crc);
+
+	if (fwrite(&header, 1, sizeof(header), out) != sizeof(header) ||
+		(n_entries > 0 &&
+		 fwrite(entries, sizeof(BlockIndexEntry), n_entries, out) != n_entries) ||
+		fwrite(&crc, 1, sizeof(crc), out) != sizeof(crc))
+		elog(ERROR, "cannot write block index \"%s\": %s", path_temp,
+			 strerror(errno));
+
+	/*
+	 * The index isn't synced to disk. It is checked by its CRC and by the
+	 * size and CRC of the backup file, so an index lost in a crash only
+	 * makes readers scan the backup file.
+	 */
+	if (fflush(out) != 0 || fclose(out))
+		elog(ERROR, "cannot write block index \"%s\": %s", path_temp,
+			 strerror(errno));
+
+	if (rename(path_temp, index_path) < 0)
+		elog(ERROR, "cannot rename \"%s\" to \"%s\": %s",
+			 path_temp, index_path, strerror(errno));
+}
+
+/*
+ * Write block index collected while the backup file 'path' was written and
+ * release the entries.
+ */
+static void
+block_index_write(const char *path, BlockIndexBuilder *index,
+				  uint64 file_size, pg_crc32 file_crc)
+{
+	/* Pages read again after verification failure are out of order */
+	if (index->n_entries > 1)
+		qsort(index->entries, index->n_entries, sizeof(BlockIndexEntry),
+			  block_index_entry_compare);
+
+	write_block_index_entries(path, index->entries, index->n_entries,
+							  index->truncated, file_size, file_crc);
+	pg_free(index->entries);
+	index->entries = NULL;
+	index->n_entries = 0;
+	index->size = 0;
+}
+
+/*
+ * Read block index of the backup copy of the data file. Returns NULL if
+ * there is no index or it doesn't describe the copy, the copy should be
+ * scanned then. The number of entries is returned in *n_entries, the block
+ * of truncation mark in *truncated.
+ */
+BlockIndexEntry *
+read_block_index(pgFile *file, uint32 *n_entries, BlockNumber *truncated)
+{
+	char		index_path[MAXPGPATH];
+	FILE	   *in;
+	BlockIndexHeader header;
+	BlockIndexEntry *entries;
+	struct stat	st;
+	pg_crc32	crc;
+	pg_crc32	stored_crc;
+
+	snprintf(index_path, lengthof(index_path), "%s%s", file->path,
+			 BLOCK_INDEX_SUFFIX);
+
+	in = fopen(index_path, PG_BINARY_R);
+	if (in == NULL)
+	{
+		if (errno != ENOENT)
+			elog(ERROR, "cannot open block index \"%s\": %s", index_path,
+				 strerror(errno));
+		return NULL;
+	}
+
+	if (fread(&header, 1, sizeof(header), in) != sizeof(header) ||
+		header.magic != BLOCK_INDEX_MAGIC ||
+		header.version != BLOCK_INDEX_VERSION)
+	{
+		elog(WARNING, "block index \"%s\" is corrupted, it is ignored",
+			 index_path);
+		fclose(in);
+		return NULL;
+	}
+
+	if (header.file_size != (uint64) file->write_size ||
+		header.file_crc != file->crc ||
+		stat(file->path, &st) != 0 ||
+		(uint64) st.st_size != header.file_size)
+	{
+		elog(LOG, "block index \"%s\" doesn't match the backup file, it is ignored",
+			 index_path);
+		fclose(in);
+		return NULL;
+	}
+
+	entries = (BlockIndexEntry *) pg_malloc(sizeof(BlockIndexEntry) *
+											header.n_entries);
+	INIT_CRC32C(crc);
+	COMP_CRC32C(crc, &header, sizeof(header));
+	if (fread(entries, sizeof(BlockIndexEntry), header.n_entries,
+			  in) != header.n_entries ||
+		fread(&stored_crc, 1, sizeof(stored_crc), in) != sizeof(stored_crc))
+	{
+		elog(WARNING, "block index \"%s\" is corrupted, it is ignored",
+			 index_path);
+		pg_free(entries);
+		fclose(in);
+		return NULL;
+	}
+	fclose(in);
+
+	if (header.n_entries > 0)
+		COMP_CRC32C(crc, entries, sizeof(BlockIndexEntry) * header.n_entries);
+	FIN_CRC32C(crc);
+	if (crc != stored_crc)
+	{
+		elog(WARNING, "block index \"%s\" has invalid checksum, it is ignored",
+			 index_path);
+		pg_free(entries);
+		return NULL;
+	}
+
+	*n_entries = header.n_entries;
+	*truncated = header.truncated;
+	return entries;
+}
+
+/*
+ * Remove block index of the backup file 'path' if it exists.
+ */
+void
+remove_block_index(const char *path)
+{
+	char		index_path[MAXPGPATH];
+
+	snprintf(index_path, lengthof(index_path), "%s%s", path,
+			 BLOCK_INDEX_SUFFIX);
+	if (unlink(index_path) != 0 && errno != ENOENT)
+		elog(ERROR, "cannot remove file \"%s\": %s", index_path,
+			 strerror(errno));
+}
+
+/*
+ * Remember location of the block unless it was already found in a newer
+ * backup, see map_data_file_chain().
+ */
+static void
+map_block(BlockLocation **map, BlockNumber *map_size, BlockNumber *nblocks,
+		  int version, BlockNumber blknum, int32 compressed_size, off_t offset)
+{
+	if (blknum < *nblocks && (*map)[blknum].version != -1)
+		return;
+
+	if (blknum >= *map_size)
+	{
+		BlockNumber	new_size = Max(*map_size * 2, blknum + 1);
+
+		*map = (BlockLocation *) pg_realloc(*map,
+											sizeof(BlockLocation) * new_size);
+		*map_size = new_size;
+	}
+	for (; *nblocks <= blknum; (*nblocks)++)
+		(*map)[*nblocks].version = -1;
+
+	(*map)[blknum].version = version;
+	(*map)[blknum].compressed_size = compressed_size;
+	(*map)[blknum].offset = offset;
+}
+
+/*
+ * Find location of every block of the data file in the chain of its copies.
+ *
+ * 'versions' contains copies of the same file ordered from the newest backup
+ * to the oldest one (the last one belongs to the FULL backup). Each block is
+ * taken from the newest copy which contains it. Truncation recorded in a
+ * newer copy (either by PageIsTruncated header or by n_blocks of DELTA
+ * backup) hides blocks of older copies beyond the truncation point. So
+ * restoring blocks using the map gives the same result as restoring each
+ * copy one after another by restore_data_file(), but every block is written
+ * only once. Copies having the block index are not read, locations are
+ * taken from the index.
+ *
+ * Returns array of locations, its size is returned in *nblocks.
+ */
+BlockLocation *
+map_data_file_chain(parray *versions, BlockNumber *nblocks)
+{
+	BlockLocation *map = NULL;
+	BlockNumber	map_size = 0;
+	BlockNumber	limit = InvalidBlockNumber;
+	int			i;
+
+	*nblocks = 0;
+
+	for (i = 0; i < parray_num(versions) && limit > 0; i++)
+	{
+		pgFile	   *file = (pgFile *) parray_get(versions, i);
+		FILE	   *in;
+		BackupPageHeader header;
+		BlockNumber	blknum = 0;
+		BlockNumber	file_limit = InvalidBlockNumber;
+		bool		deferred_part = false;
+		BlockIndexEntry *index;
+		uint32		n_entries;
+		BlockNumber	index_truncated;
+
+		if (file->n_blocks != BLOCKNUM_INVALID)
+			file_limit = file->n_blocks;
+
+		/* Blocks of the file didn't change, only its size could */
+		if (file->write_size == BYTES_INVALID)
+		{
+			limit = Min(limit, file_limit);
+			continue;
+		}
+
+		/* Locations of the blocks are known without reading the copy */
+		index = read_block_index(file, &n_entries, &index_truncated);
+		if (index)
+		{
+			uint32		j;
+
+			for (j = 0; j < n_entries; j++)
+				if (index[j].block < file_limit && index[j].block < limit)
+					map_block(&map, &map_size, nblocks, i, index[j].block,
+							  index[j].compressed_size,
+							  (off_t) index[j].offset);
+			pg_free(index);
+
+			file_limit = Min(file_limit, index_truncated);
+			limit = Min(limit, file_limit);
+			continue;
+		}
+
+		in = fopen(file->path, PG_BINARY_R);
+		if (in == NULL)
+			elog(ERROR, "cannot open backup file \"%s\": %s", file->path,
+				 strerror(errno));
+
+		while (true)
+		{
+			size_t		read_len;
+
+			read_len = fread(&header, 1, sizeof(header), in);
+			if (read_len != sizeof(header))
+			{
+				int errno_tmp = errno;
+				if (read_len == 0 && feof(in))
+					break;		/* EOF found */
+				else if (read_len != 0 && feof(in))
+					elog(ERROR,
+						 "odd size page found at block %u of \"%s\"",
+						 blknum, file->path);
+				else
+					elog(ERROR, "cannot read header of block %u of \"%s\": %s",
+						 blknum, file->path, strerror(errno_tmp));
+			}
+
+			/* The order of blocks may go backwards only once, see above */
+			if (header.block < blknum)
+			{
+				if (deferred_part)
+					elog(ERROR, "backup is broken at file->path %s block %u",
+						 file->path, blknum);
+				deferred_part = true;
+			}
+
+			blknum = header.block;
+
+			if (header.compressed_size == PageIsTruncated)
+			{
+				file_limit = Min(file_limit, blknum);
+				break;
+			}
+
+			Assert(header.compressed_size <= BLCKSZ);
+
+			/*
+			 * Remember the block unless it was truncated or was already found
+			 * in a newer backup.
+			 */
+			if (blknum < file_limit && blknum < limit)
+				map_block(&map, &map_size, nblocks, i, blknum,
+						  header.compressed_size, ftell(in));
+
+			if (fseek(in, page_payload_size(header.compressed_size),
+					  SEEK_CUR) < 0)
+				elog(ERROR, "cannot seek block %u of \"%s\": %s",
+					 blknum, file->path, strerror(errno));
+		}
+
+		fclose(in);
+		limit = Min(limit, file_limit);
+	}
+
+	return map;
+}
+
+/*
+ * Write 'n_blocks' consecutive restored blocks starting from 'start_blkno'
+ * by a single call.
+ */
+static void
+restore_write_blocks(int fd, const char *to_path, const char *buf,
+					 BlockNumber start_blkno, int n_blocks)
+{
+	off_t		offset = (off_t) start_blkno * BLCKSZ;
+	size_t		len = (size_t) n_blocks * BLCKSZ;
+	size_t		written = 0;
+
+	while (written < len)
+	{
+		ssize_t		rc;
+
+		rc = pwrite(fd, buf + written, len - written, offset + written);
+		if (rc < 0)
+		{
+			if (errno == EINTR)
+				continue;
+			elog(ERROR, "cannot write block %u of \"%s\": %s",
+				 start_blkno + (BlockNumber) (written / BLCKSZ), to_path,
+				 strerror(errno));
+		}
+		written += rc;
+	}
+
+#ifdef SYNC_FILE_RANGE_WRITE
+	/*
+	 * Start write-back of the blocks at once, so that flushing the file at
+	 * the end of restore doesn't have to write all of its data.
+	 */
+	(void) sync_file_range(fd, offset, len, SYNC_FILE_RANGE_WRITE);
+#endif
+}
+
+/*
+ * Restore blocks from 'start_blkno' up to 'end_blkno' of the data file
+ * using the map built by map_data_file_chain(). Several threads can restore
+ * different ranges of the same file in parallel.
+ *
+ * Consecutive blocks are restored into a buffer and written by a single
+ * call. The file isn't flushed to disk here, see restore_data_file_finish().
+ *
+ * In case of incremental restore the file may exist already, and only pages
+ * which differ from the backup are written.
+ */
+void
+restore_data_file_range(const char *to_path, parray *versions,
+						BlockLocation *map, BlockNumber nblocks,
+						BlockNumber start_blkno, BlockNumber end_blkno)
+{
+	FILE	  **in;
+	int			fd;
+	struct stat	st;
+	BlockNumber	blknum;
+	BlockNumber	range_end = Min(nblocks, end_blkno);
+	char	   *batch;
+	BlockNumber	batch_start = 0;
+	int			batch_n = 0;
+	BlockNumber	n_written = 0;
+	BlockNumber	n_same = 0;
+	PageStoreReader reader;
+	int			i;
+
+	/*
+	 * The file could be already created by another thread, so don't
+	 * truncate it.
+	 */
+	fd = open(to_path, O_RDWR | O_CREAT | PG_BINARY, FILE_PERMISSION);
+	if (fd < 0)
+		elog(ERROR, "cannot open restore target file \"%s\": %s",
+			 to_path, strerror(errno));
+
+	/*
+	 * Blocks of the range beyond the current end of the file are written
+	 * only by this call, so zero pages there can be left as holes.
+	 */
+	if (fstat(fd, &st) != 0)
+		elog(ERROR, "cannot stat restore target file \"%s\": %s",
+			 to_path, strerror(errno));
+
+#ifdef FALLOC_FL_KEEP_SIZE
+	/*
+	 * Allocate space for the range beyond the end of the file at once, so
+	 * that the file system doesn't extend the file by small pieces. The size
+	 * of the file is kept, it is set by writes, so the checks above and
+	 * other threads restoring the same file are not affected. Failure isn't
+	 * an error, the file system may not support it.
+	 */
+	if ((off_t) range_end * BLCKSZ > st.st_size)
+	{
+		off_t		alloc_start = Max(st.st_size,
+									  (off_t) start_blkno * BLCKSZ);
+
+		(void) fallocate(fd, FALLOC_FL_KEEP_SIZE, alloc_start,
+						 (off_t) range_end * BLCKSZ - alloc_start);
+	}
+#endif
+
+	in = (FILE **) pgut_malloc(sizeof(FILE *) * parray_num(versions));
+	for (i = 0; i < parray_num(versions); i++)
+		in[i] = NULL;
+	page_store_reader_init(&reader);
+
+	batch = (char *) pgut_malloc(WRITE_BUFFER_BLOCKS * BLCKSZ);
+
+	for (blknum = start_blkno; blknum < range_end; blknum++)
+	{
+		BlockLocation *loc = &map[blknum];
+		pgFile	   *file;
+		size_t		read_len;
+		DataPage	compressed_page; /* used as read buffer */
+		DataPage	current_page;
+		char	   *page;
+
+		/* check for interrupt */
+		if (interrupted)
+			elog(ERROR, "interrupted during restore database");
+
+		/*
+		 * The block is absent in all copies, it is a hole in the restored
+		 * file. The existing block is zeroed in case of incremental restore.
+		 */
+		if (loc->version == -1 &&
+			(!restore_incremental || (off_t) blknum * BLCKSZ >= st.st_size))
+			continue;
+
+		/*
+		 * Leave a hole instead of zero page. The last block is written
+		 * anyway to set the size of the file.
+		 */
+		if (loc->version != -1 && loc->compressed_size == PageIsZeroed &&
+			(off_t) blknum * BLCKSZ >= st.st_size && blknum != nblocks - 1)
+			continue;
+
+		/* The block is restored right into the buffer of consecutive blocks */
+		if (batch_n > 0 &&
+			(blknum != batch_start + batch_n || batch_n == WRITE_BUFFER_BLOCKS))
+		{
+			restore_write_blocks(fd, to_path, batch, batch_start, batch_n);
+			n_written += batch_n;
+			batch_n = 0;
+		}
+		if (batch_n == 0)
+			batch_start = blknum;
+		page = batch + (size_t) batch_n * BLCKSZ;
+
+		if (loc->version == -1 || loc->compressed_size == PageIsZeroed)
+			memset(page, 0, BLCKSZ);
+		else
+		{
+			int64		io_start;
+
+			file = (pgFile *) parray_get(versions, loc->version);
+			if (in[loc->version] == NULL)
+			{
+				in[loc->version] = fopen(file->path, PG_BINARY_R);
+				if (in[loc->version] == NULL)
+					elog(ERROR, "cannot open backup file \"%s\": %s",
+						 file->path, strerror(errno));
+			}
+
+			if (fseek(in[loc->version], loc->offset, SEEK_SET) < 0)
+				elog(ERROR, "cannot seek block %u of \"%s\": %s",
+					 blknum, file->path, strerror(errno));
+
+			io_start = io_throttle_start(page_payload_size(loc->compressed_size));
+			read_len = fread(compressed_page.data, 1,
+							 page_payload_size(loc->compressed_size),
+							 in[loc->version]);
+			io_throttle_end(io_start);
+			if (read_len != page_payload_size(loc->compressed_size))
+				elog(ERROR, "cannot read block %u of \"%s\" read %lu of %d",
+					blknum, file->path, read_len, loc->compressed_size);
+
+			if (loc->compressed_size == PageIsReference)
+				load_page((PageStoreRef *) compressed_page.data, page, &reader);
+			else if (loc->compressed_size != BLCKSZ)
+			{
+				int32		uncompressed_size = 0;
+
+				uncompressed_size = do_decompress(page, BLCKSZ,
+												  compressed_page.data,
+												  loc->compressed_size,
+												  file->compress_alg);
+
+				if (uncompressed_size != BLCKSZ)
+					elog(ERROR, "page of file \"%s\" uncompressed to %d bytes. != BLCKSZ",
+						 file->path, uncompressed_size);
+			}
+			else
+				memcpy(page, compressed_page.data, BLCKSZ);
+		}
+
+		/*
+		 * Don't rewrite the existing page which is the same as in backup.
+		 * The buffer slot is reused by the next block.
+		 */
+		if (restore_incremental &&
+			(off_t) (blknum + 1) * BLCKSZ <= st.st_size &&
+			pread(fd, current_page.data, BLCKSZ,
+				  (off_t) blknum * BLCKSZ) == BLCKSZ &&
+			memcmp(current_page.data, page, BLCKSZ) == 0)
+		{
+			n_same++;
+			continue;
+		}
+
+		batch_n++;
+	}
+
+	if (batch_n > 0)
+	{
+		restore_write_blocks(fd, to_path, batch, batch_start, batch_n);
+		n_written += batch_n;
+	}
+
+	if (restore_incremental)
+		elog(VERBOSE, "File \"%s\": %u pages are rewritten, %u pages are the same",
+			 to_path, n_written, n_same);
+
+	for (i = 0; i < parray_num(versions); i++)
+		if (in[i])
+			fclose(in[i]);
+	free(in);
+	free(batch);
+	page_store_reader_close(&reader);
+
+	if (close(fd) != 0)
+		elog(ERROR, "cannot write \"%s\": %s", to_path, strerror(errno));
+}
+
+/*
+ * Set permissions of the restored data file. In case of incremental restore
+ * blocks of the existing file beyond 'nblocks' are truncated. The file is
+ * flushed to disk by the caller after all files are restored.
+ */
+void
+restore_data_file_finish(const char *to_path, mode_t mode,
+						 BlockNumber nblocks)
+{
+	/* update file permission */
+	if (chmod(to_path, mode) == -1)
+		elog(ERROR, "cannot change mode of \"%s\": %s", to_path,
+			 strerror(errno));
+
+	if (restore_incremental &&
+		truncate(to_path, (off_t) nblocks * BLCKSZ) != 0)
+		elog(ERROR, "cannot truncate \"%s\": %s", to_path, strerror(errno));
+}
+
+/*
+ * Restore data file using its copies from the whole chain of backups,
+ * see map_data_file_chain().
+ */
+void
+restore_data_file_chain(const char *to_path, parray *versions, mode_t mode)
+{
+	BlockLocation *map;
+	BlockNumber	nblocks;
+
+	map = map_data_file_chain(versions, &nblocks);
+	restore_data_file_range(to_path, versions, map, nblocks,
+							0, InvalidBlockNumber);
+	pg_free(map);
+
+	restore_data_file_finish(to_path, mode, nblocks);
+}
+
+/*
+ * Merge copies of the data file from an incremental backup and its parents
+ * into a single backup file 'to_path', see map_data_file_chain() about
+ * 'versions'. Pages are copied as they are stored in the copies, only pages
+ * compressed by an algorithm other than 'calg' are decompressed and
+ * compressed again. Blocks are written in ascending order and the
+ * truncation is applied, so the result is a copy of a FULL backup. The
+ * block index of the result is written too.
+ *
+ * Sets write_size, crc, compress_alg and n_blocks of 'file'.
+ */
+void
+merge_data_file(const char *to_path, parray *versions, pgFile *file,
+				CompressAlg calg, int clevel)
+{
+	BlockLocation *map;
+	BlockNumber	nblocks;
+	BlockNumber	blknum;
+	FILE	   *out;
+	FILE	  **in;
+	pg_crc32	crc;
+	int64		write_size = 0;
+	BlockIndexEntry *entries = NULL;
+	uint32		n_entries = 0;
+	uint32		entries_size = 0;
+	int			i;
+
+	map = map_data_file_chain(versions, &nblocks);
+
+	out = fopen(to_path, PG_BINARY_W);
+	if (out == NULL)
+		elog(ERROR, "cannot open merge target file \"%s\": %s",
+			 to_path, strerror(errno));
+
+	in = (FILE **) pgut_malloc(sizeof(FILE *) * parray_num(versions));
+	for (i = 0; i < parray_num(versions); i++)
+		in[i] = NULL;
+
+	INIT_CRC32C(crc);
+	for (blknum = 0; blknum < nblocks; blknum++)
+	{
+		BlockLocation *loc = &map[blknum];
+		pgFile	   *version;
+		BackupPageHeader header;
+		char		write_buffer[BLCKSZ + sizeof(BackupPageHeader)];
+		size_t		write_len;
+		pg_crc32	page_crc;
+
+		/* check for interrupt */
+		if (interrupted)
+			elog(ERROR, "Interrupted during merging backups");
+
+		if (loc->version == -1)
+			continue;
+
+		version = (pgFile *) parray_get(versions, loc->version);
+		header.block = blknum;
+		header.compressed_size = loc->compressed_size;
+		memcpy(write_buffer, &header, sizeof(header));
+		write_len = sizeof(header);
+
+		if (loc->compressed_size != PageIsZeroed)
+		{
+			size_t		payload_size = page_payload_size(loc->compressed_size);
+			size_t		read_len;
+			int64		io_start;
+
+			if (in[loc->version] == NULL)
+			{
+				in[loc->version] = fopen(version->path, PG_BINARY_R);
+				if (in[loc->version] == NULL)
+					elog(ERROR, "cannot open backup file \"%s\": %s",
+						 version->path, strerror(errno));
+			}
+
+			if (fseek(in[loc->version], loc->offset, SEEK_SET) < 0)
+				elog(ERROR, "cannot seek block %u of \"%s\": %s",
+					 blknum, version->path, strerror(errno));
+
+			io_start = io_throttle_start(payload_size);
+			read_len = fread(write_buffer + sizeof(header), 1, payload_size,
+							 in[loc->version]);
+			io_throttle_end(io_start);
+			if (read_len != payload_size)
+				elog(ERROR, "cannot read block %u of \"%s\" read %lu of %d",
+					 blknum, version->path, read_len, loc->compressed_size);
+			write_len += payload_size;
+
+			/* The page is compressed by another algorithm */
+			if (loc->compressed_size != PageIsReference &&
+				loc->compressed_size != BLCKSZ &&
+				version->compress_alg != calg)
+			{
+				DataPage	page;
+				int32		uncompressed_size;
+
+				uncompressed_size = do_decompress(page.data, BLCKSZ,
+												  write_buffer + sizeof(header),
+												  loc->compressed_size,
+												  version->compress_alg);
+				if (uncompressed_size != BLCKSZ)
+					elog(ERROR, "page of file \"%s\" uncompressed to %d bytes. != BLCKSZ",
+						 version->path, uncompressed_size);
+
+				write_len = compress_page(write_buffer, blknum, BLCKSZ,
+										  page.data, calg, clevel);
+			}
+		}
+
+		if (fwrite(write_buffer, 1, write_len, out) != write_len)
+			elog(ERROR, "cannot write block %u of \"%s\": %s",
+				 blknum, to_path, strerror(errno));
+		COMP_CRC32C(crc, write_buffer, write_len);
+
+		if (current.block_index)
+		{
+			/* The header is changed if the page was compressed again */
+			memcpy(&header, write_buffer, sizeof(header));
+			INIT_CRC32C(page_crc);
+			COMP_CRC32C(page_crc, write_buffer, write_len);
+			FIN_CRC32C(page_crc);
+			block_index_add(&entries, &n_entries, &entries_size, blknum,
+							header.compressed_size,
+							write_size + sizeof(header), page_crc);
+		}
+		write_size += write_len;
 	}
+	FIN_CRC32C(crc);
+
+	for (i = 0; i < parray_num(versions); i++)
+		if (in[i])
+			fclose(in[i]);
+	free(in);
+	pg_free(map);
 
 	if (fflush(out) != 0 ||
 		fsync(fileno(out)) != 0 ||
 		fclose(out))
-		elog(ERROR, "cannot write backup file \"%s\": %s",
-			 to_path, strerror(errno));
-	fclose(in);
-
-	FIN_CRC32C(file->crc);
+		elog(ERROR, "cannot write \"%s\": %s", to_path, strerror(errno));
 
-	/*
-	 * If we have pagemap then file in the backup can't be a zero size.
-	 * Otherwise, we will clear the last file.
-	 */
-	if (n_blocks_read != 0 && n_blocks_read == n_blocks_skipped)
-	{
-		if (remove(to_path) == -1)
-			elog(ERROR, "cannot remove file \"%s\": %s", to_path,
-				 strerror(errno));
-		return false;
-	}
+	/* Blocks are written in ascending order, entries are sorted already */
+	if (current.block_index)
+		write_block_index_entries(to_path, entries, n_entries,
+								  InvalidBlockNumber, write_size, crc);
+	pg_free(entries);
 
-	return true;
+	file->write_size = write_size;
+	file->crc = crc;
+	file->compress_alg = calg;
+	file->n_blocks = nblocks;
 }
 
 /*
- * Restore files in the from_root directory to the to_root directory with
- * same relative path.
- *
- * If write_header is true then we add header to each restored block, currently
- * it is used for MERGE command.
+ * Read the next reference to the page store from the backup data file.
+ * Returns false at the end of the file.
  */
-void
-restore_data_file(const char *to_path, pgFile *file, bool allow_truncate,
-				  bool write_header)
+static bool
+read_page_reference(FILE *in, const char *path, PageStoreRef *ref,
+					BlockNumber *blknum)
 {
-	FILE	   *in = NULL;
-	FILE	   *out = NULL;
 	BackupPageHeader header;
-	BlockNumber	blknum = 0,
-				truncate_from = 0;
-	bool		need_truncate = false;
-
-	/* BYTES_INVALID allowed only in case of restoring file from DELTA backup */
-	if (file->write_size != BYTES_INVALID)
-	{
-		/* open backup mode file for read */
-		in = fopen(file->path, PG_BINARY_R);
-		if (in == NULL)
-		{
-			elog(ERROR, "cannot open backup file \"%s\": %s", file->path,
-				 strerror(errno));
-		}
-	}
-
-	/*
-	 * Open backup file for write. 	We use "r+" at first to overwrite only
-	 * modified pages for differential restore. If the file does not exist,
-	 * re-open it with "w" to create an empty file.
-	 */
-	out = fopen(to_path, PG_BINARY_R "+");
-	if (out == NULL && errno == ENOENT)
-		out = fopen(to_path, PG_BINARY_W);
-	if (out == NULL)
-	{
-		int errno_tmp = errno;
-		fclose(in);
-		elog(ERROR, "cannot open restore target file \"%s\": %s",
-			 to_path, strerror(errno_tmp));
-	}
 
-	while (true)
+	while (fread(&header, 1, sizeof(header), in) == sizeof(header))
 	{
-		off_t		write_pos;
-		size_t		read_len;
-		DataPage	compressed_page; /* used as read buffer */
-		DataPage	page;
-
-		/* File didn`t changed. Nothig to copy */
-		if (file->write_size == BYTES_INVALID)
+		if (header.compressed_size == PageIsTruncated)
 			break;
 
-		/*
-		 * We need to truncate result file if data file in a incremental backup
-		 * less than data file in a full backup. We know it thanks to n_blocks.
-		 *
-		 * It may be equal to -1, then we don't want to truncate the result
-		 * file.
-		 */
-		if (file->n_blocks != BLOCKNUM_INVALID &&
-			(blknum + 1) > file->n_blocks)
+		if (header.compressed_size == PageIsReference)
 		{
-			truncate_from = blknum;
-			need_truncate = true;
-			break;
+			if (fread(ref, 1, sizeof(PageStoreRef), in) != sizeof(PageStoreRef))
+				elog(ERROR, "cannot read block %u of \"%s\": %s",
+					 header.block, path, strerror(errno));
+			*blknum = header.block;
+			return true;
 		}
 
-		/* read BackupPageHeader */
-		read_len = fread(&header, 1, sizeof(header), in);
-		if (read_len != sizeof(header))
-		{
-			int errno_tmp = errno;
-			if (read_len == 0 && feof(in))
-				break;		/* EOF found */
-			else if (read_len != 0 && feof(in))
-				elog(ERROR,
-					 "odd size page found at block %u of \"%s\"",
-					 blknum, file->path);
-			else
-				elog(ERROR, "cannot read header of block %u of \"%s\": %s",
-					 blknum, file->path, strerror(errno_tmp));
-		}
+		if (fseek(in, page_payload_size(header.compressed_size),
+				  SEEK_CUR) < 0)
+			elog(ERROR, "cannot seek block %u of \"%s\": %s",
+				 header.block, path, strerror(errno));
+	}
 
-		if (header.block < blknum)
-			elog(ERROR, "backup is broken at file->path %s block %u",
-				 file->path, blknum);
+	if (ferror(in))
+		elog(ERROR, "cannot read backup file \"%s\": %s", path,
+			 strerror(errno));
+	return false;
+}
 
-		blknum = header.block;
+static int
+page_pack_usage_compare(const void *a, const void *b)
+{
+	const PagePackUsage *usage1 = *(PagePackUsage * const *) a;
+	const PagePackUsage *usage2 = *(PagePackUsage * const *) b;
 
-		if (header.compressed_size == PageIsTruncated)
-		{
-			/*
-			 * Backup contains information that this block was truncated.
-			 * We need to truncate file to this length.
-			 */
-			truncate_from = blknum;
-			need_truncate = true;
-			break;
-		}
+	return page_pack_num_compare(&usage1->pack, &usage2->pack);
+}
 
-		Assert(header.compressed_size <= BLCKSZ);
+/*
+ * Get the list of packs of the page store, sorted by number, with empty
+ * bitmaps of records in use.
+ */
+parray *
+page_store_get_packs(void)
+{
+	parray	   *packs = parray_new();
+	uint32	   *nums;
+	uint32		n_packs;
+	uint32		i;
+
+	nums = page_store_list_packs(&n_packs);
+	for (i = 0; i < n_packs; i++)
+	{
+		PagePackUsage *usage = pgut_new(PagePackUsage);
+		PagePackIndexHeader header;
+		size_t		bitmap_size;
+
+		/* Index of the pack is checked and completed if needed */
+		pg_free(page_pack_read_index(nums[i], &header));
+
+		usage->pack = nums[i];
+		usage->n_records = header.n_records;
+		bitmap_size = header.n_records / 8 + 1;
+		usage->used = (bits8 *) pgut_malloc(bitmap_size);
+		MemSet(usage->used, 0, bitmap_size);
+		parray_append(packs, usage);
+	}
+	pg_free(nums);
 
-		read_len = fread(compressed_page.data, 1,
-			MAXALIGN(header.compressed_size), in);
-		if (read_len != MAXALIGN(header.compressed_size))
-			elog(ERROR, "cannot read block %u of \"%s\" read %lu of %d",
-				blknum, file->path, read_len, header.compressed_size);
+	return packs;
+}
 
-		if (header.compressed_size != BLCKSZ)
-		{
-			int32		uncompressed_size = 0;
+static bool
+page_pack_record_used(PagePackUsage *usage, uint32 item)
+{
+	return item < usage->n_records &&
+		(usage->used[item / 8] & (1 << (item % 8))) != 0;
+}
 
-			uncompressed_size = do_decompress(page.data, BLCKSZ,
-											  compressed_page.data,
-											  MAXALIGN(header.compressed_size),
-											  file->compress_alg);
+/*
+ * Mark pages of the page store referenced by the backup copy of the data
+ * file as used in bitmaps of 'packs' returned by page_store_get_packs().
+ */
+void
+get_page_references(pgFile *file, parray *packs)
+{
+	FILE	   *in;
+	PageStoreRef ref;
+	BlockNumber	blknum;
 
-			if (uncompressed_size != BLCKSZ)
-				elog(ERROR, "page of file \"%s\" uncompressed to %d bytes. != BLCKSZ",
-					 file->path, uncompressed_size);
-		}
+	in = fopen(file->path, PG_BINARY_R);
+	if (in == NULL)
+		elog(ERROR, "cannot open backup file \"%s\": %s", file->path,
+			 strerror(errno));
 
-		write_pos = (write_header) ? blknum * (BLCKSZ + sizeof(header)) :
-									 blknum * BLCKSZ;
+	while (read_page_reference(in, file->path, &ref, &blknum))
+	{
+		PagePackUsage key;
+		PagePackUsage **usage;
+
+		key.pack = ref.pack;
+		usage = (PagePackUsage **) parray_bsearch(packs, &key,
+												  page_pack_usage_compare);
+		if (usage && ref.item < (*usage)->n_records)
+			(*usage)->used[ref.item / 8] |= 1 << (ref.item % 8);
+	}
 
-		/*
-		 * Seek and write the restored page.
-		 */
-		if (fseek(out, write_pos, SEEK_SET) < 0)
-			elog(ERROR, "cannot seek block %u of \"%s\": %s",
-				 blknum, to_path, strerror(errno));
+	fclose(in);
+}
 
-		if (write_header)
-		{
-			if (fwrite(&header, 1, sizeof(header), out) != sizeof(header))
-				elog(ERROR, "cannot write header of block %u of \"%s\": %s",
-					 blknum, file->path, strerror(errno));
-		}
+/*
+ * Remove pages of the page store which are not marked as used in 'packs'
+ * and free the list. Returns the number of removed pages.
+ */
+long
+page_store_remove_unused(parray *packs)
+{
+	long		removed = 0;
+	size_t		i;
 
-		if (header.compressed_size < BLCKSZ)
+	for (i = 0; i < parray_num(packs); i++)
+	{
+		PagePackUsage *usage = (PagePackUsage *) parray_get(packs, i);
+		PagePackIndexHeader header;
+		PagePackIndexEntry *entries;
+		char		path[MAXPGPATH];
+		uint32		n_used = 0;
+		uint32		j;
+		int			fd = -1;
+
+		entries = page_pack_read_index(usage->pack, &header);
+		page_pack_get_path(usage->pack, PAGE_PACK_SUFFIX, path);
+
+		for (j = 0; j < header.n_entries; j++)
+			if (page_pack_record_used(usage, entries[j].item))
+				n_used++;
+		removed += header.n_entries - n_used;
+
+		if (n_used == 0)
 		{
-			if (fwrite(page.data, 1, BLCKSZ, out) != BLCKSZ)
-				elog(ERROR, "cannot write block %u of \"%s\": %s",
-					 blknum, file->path, strerror(errno));
+			/* Nothing is used, remove the pack as a whole */
+			if (unlink(path) != 0)
+				elog(ERROR, "could not remove file \"%s\": %s", path,
+					 strerror(errno));
+			page_pack_get_path(usage->pack, PAGE_PACK_INDEX_SUFFIX, path);
+			if (unlink(path) != 0)
+				elog(ERROR, "could not remove file \"%s\": %s", path,
+					 strerror(errno));
 		}
-		else
+		else if (n_used < header.n_entries)
 		{
-			/* if page wasn't compressed, we've read full block */
-			if (fwrite(compressed_page.data, 1, BLCKSZ, out) != BLCKSZ)
-				elog(ERROR, "cannot write block %u of \"%s\": %s",
-					 blknum, file->path, strerror(errno));
-		}
-	}
+			uint32		n_entries = 0;
 
-	/*
-	 * DELTA backup have no knowledge about truncated blocks as PAGE or PTRACK do
-	 * But during DELTA backup we read every file in PGDATA and thus DELTA backup
-	 * knows exact size of every file at the time of backup.
-	 * So when restoring file from DELTA backup we, knowning it`s size at
-	 * a time of a backup, can truncate file to this size.
-	 */
-	if (allow_truncate && file->n_blocks != BLOCKNUM_INVALID && !need_truncate)
-	{
-		size_t		file_size = 0;
+			for (j = 0; j < header.n_entries; j++)
+			{
+				PagePackIndexEntry *entry = &entries[j];
 
-		/* get file current size */
-		fseek(out, 0, SEEK_END);
-		file_size = ftell(out);
+				if (page_pack_record_used(usage, entry->item))
+				{
+					entries[n_entries++] = *entry;
+					continue;
+				}
 
-		if (file_size > file->n_blocks * BLCKSZ)
-		{
-			truncate_from = file->n_blocks;
-			need_truncate = true;
+#ifdef FALLOC_FL_PUNCH_HOLE
+				/*
+				 * Free space of the record, other records stay at their
+				 * offsets. Failure isn't an error, the file system may not
+				 * support it.
+				 */
+				if (fd < 0)
+				{
+					fd = open(path, O_RDWR | PG_BINARY, 0);
+					if (fd < 0)
+						elog(ERROR, "cannot open page pack \"%s\": %s",
+							 path, strerror(errno));
+				}
+				(void) fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+								 entry->offset, entry->size);
+#endif
+			}
+			if (fd >= 0 && close(fd) != 0)
+				elog(ERROR, "cannot write page pack \"%s\": %s", path,
+					 strerror(errno));
+
+			header.n_entries = n_entries;
+			page_pack_write_index(usage->pack, &header, entries);
 		}
+
+		pg_free(entries);
+		free(usage->used);
+		free(usage);
 	}
+	parray_free(packs);
 
-	if (need_truncate)
-	{
-		off_t		write_pos;
+	return removed;
+}
 
-		write_pos = (write_header) ? truncate_from * (BLCKSZ + sizeof(header)) :
-									 truncate_from * BLCKSZ;
+/*
+ * Check that all pages of the page store referenced by the backup data file
+ * exist and match their hashes.
+ */
+bool
+check_page_references(const char *path)
+{
+	FILE	   *in;
+	PageStoreRef ref;
+	BlockNumber	blknum;
+	PageStoreReader reader;
+	DataPage	page;
+	bool		valid = true;
 
-		/*
-		 * Truncate file to this length.
-		 */
-		if (ftruncate(fileno(out), write_pos) != 0)
-			elog(ERROR, "cannot truncate \"%s\": %s",
-				 file->path, strerror(errno));
-		elog(INFO, "Delta truncate file %s to block %u",
-			 file->path, truncate_from);
-	}
+	in = fopen(path, PG_BINARY_R);
+	if (in == NULL)
+		elog(ERROR, "cannot open backup file \"%s\": %s", path,
+			 strerror(errno));
 
-	/* update file permission */
-	if (chmod(to_path, file->mode) == -1)
+	page_store_reader_init(&reader);
+	while (read_page_reference(in, path, &ref, &blknum))
 	{
-		int errno_tmp = errno;
+		if (interrupted)
+			elog(ERROR, "interrupted during checking of page store references");
 
-		if (in)
-			fclose(in);
-		fclose(out);
-		elog(ERROR, "cannot change mode of \"%s\": %s", to_path,
-			 strerror(errno_tmp));
+		if (!read_store_page(&ref, page.data, &reader))
+		{
+			char		name[PAGE_HASH_NAME_LEN];
+
+			page_hash_name(ref.hash, name);
+			elog(WARNING, "Page %s of block %u of backup file \"%s\" is "
+				 "missing in page pack %08X or corrupted",
+				 name, blknum, path, ref.pack);
+			valid = false;
+			break;
+		}
 	}
+	page_store_reader_close(&reader);
+	fclose(in);
 
-	if (fflush(out) != 0 ||
-		fsync(fileno(out)) != 0 ||
-		fclose(out))
-		elog(ERROR, "cannot write \"%s\": %s", to_path, strerror(errno));
-	if (in)
-		fclose(in);
+	return valid;
 }
 
 /*
  * Copy file to backup.
  * We do not apply compression to these files, because
  * it is either small control file or already compressed cfs file.
+ *
+ * If 'sync' is false the file isn't flushed to disk, the caller does it.
  */
 bool
-copy_file(const char *from_root, const char *to_root, pgFile *file)
+copy_file(const char *from_root, const char *to_root, pgFile *file,
+		  bool sync)
 {
 	char		to_path[MAXPGPATH];
 	FILE	   *in;
 	FILE	   *out;
 	size_t		read_len = 0;
 	int			errno_tmp;
-	char		buf[BLCKSZ];
+	char	   *buf;
 	struct stat	st;
 	pg_crc32	crc;
 
@@ -877,11 +4223,17 @@ copy_file(const char *from_root, const char *to_root, pgFile *file)
 	}
 
 	/* copy content and calc CRC */
+	buf = (char *) pgut_malloc(COPY_BUFFER_SIZE);
 	for (;;)
 	{
+		int64		io_start;
+
 		read_len = 0;
 
-		if ((read_len = fread(buf, 1, sizeof(buf), in)) != sizeof(buf))
+		io_start = io_throttle_start(COPY_BUFFER_SIZE);
+		read_len = fread(buf, 1, COPY_BUFFER_SIZE, in);
+		io_throttle_end(io_start);
+		if (read_len != COPY_BUFFER_SIZE)
 			break;
 
 		if (fwrite(buf, 1, read_len, out) != read_len)
@@ -926,6 +4278,8 @@ copy_file(const char *from_root, const char *to_root, pgFile *file)
 		file->read_size += read_len;
 	}
 
+	free(buf);
+
 	file->write_size = (int64) file->read_size;
 	/* finish CRC calculation and store into pgFile */
 	FIN_CRC32C(crc);
@@ -942,7 +4296,7 @@ copy_file(const char *from_root, const char *to_root, pgFile *file)
 	}
 
 	if (fflush(out) != 0 ||
-		fsync(fileno(out)) != 0 ||
+		(sync && fsync(fileno(out)) != 0) ||
 		fclose(out))
 		elog(ERROR, "cannot write \"%s\": %s", to_path, strerror(errno));
 	fclose(in);
@@ -113,6 +113,8 @@ do_delete(time_t backup_id)
 	parray_walk(backup_list, pgBackupFree);
 	parray_free(backup_list);
 
+	delete_unused_pages();
+
 	return 0;
 }
 
@@ -232,6 +234,9 @@ do_retention_purge(void)
 	parray_walk(backup_list, pgBackupFree);
 	parray_free(backup_list);
 
+	if (backup_deleted)
+		delete_unused_pages();
+
 	if (backup_deleted)
 		elog(INFO, "Purging finished");
 	else
@@ -363,7 +368,8 @@ delete_walfiles(XLogRecPtr oldest_lsn, TimeLineID oldest_tli)
 			if (IsXLogFileName(arcde->d_name) ||
 				IsPartialXLogFileName(arcde->d_name) ||
 				IsBackupHistoryFileName(arcde->d_name) ||
-				IsCompressedXLogFileName(arcde->d_name))
+				IsCompressedXLogFileName(arcde->d_name) ||
+				IsWalSummaryFileName(arcde->d_name))
 			{
 				if (XLogRecPtrIsInvalid(oldest_lsn) ||
 					strncmp(arcde->d_name + 8, oldestSegmentNeeded + 8, 16) < 0)
@@ -413,6 +419,86 @@ delete_walfiles(XLogRecPtr oldest_lsn, TimeLineID oldest_tli)
 			 arclog_path, strerror(errno));
 }
 
+/*
+ * Delete pages of the page store which are not referenced by any backup of
+ * the instance. Must be called under the exclusive lock of the catalog.
+ *
+ * References of each backup are marked in bitmaps of records of the packs,
+ * so memory doesn't depend on the number of references.
+ */
+void
+delete_unused_pages(void)
+{
+	parray	   *backup_list;
+	parray	   *packs;
+	size_t		i;
+	long		deleted;
+
+	if (!fileExists(page_store_path))
+		return;
+
+	elog(LOG, "removing unused pages of the page store");
+
+	backup_list = catalog_get_backup_list(INVALID_BACKUP_ID);
+
+	/* The backup is probably running or broken, its pages are kept */
+	for (i = 0; i < parray_num(backup_list); i++)
+	{
+		pgBackup   *backup = (pgBackup *) parray_get(backup_list, i);
+		char		list_path[MAXPGPATH];
+
+		if (!backup->dedup || backup->status == BACKUP_STATUS_DELETED)
+			continue;
+
+		pgBackupGetPath(backup, list_path, lengthof(list_path),
+						DATABASE_FILE_LIST);
+		if (!fileExists(list_path))
+		{
+			elog(WARNING, "file list of backup %s doesn't exist, "
+				 "keep all pages of the page store",
+				 base36enc(backup->start_time));
+			parray_walk(backup_list, pgBackupFree);
+			parray_free(backup_list);
+			return;
+		}
+	}
+
+	/* Mark pages referenced by the remaining backups */
+	packs = page_store_get_packs();
+	for (i = 0; i < parray_num(backup_list); i++)
+	{
+		pgBackup   *backup = (pgBackup *) parray_get(backup_list, i);
+		char		database_path[MAXPGPATH];
+		char		list_path[MAXPGPATH];
+		parray	   *files;
+		size_t		j;
+
+		if (!backup->dedup || backup->status == BACKUP_STATUS_DELETED)
+			continue;
+
+		pgBackupGetPath(backup, database_path, lengthof(database_path),
+						DATABASE_DIR);
+		pgBackupGetPath(backup, list_path, lengthof(list_path),
+						DATABASE_FILE_LIST);
+		files = dir_read_file_list(database_path, list_path);
+		for (j = 0; j < parray_num(files); j++)
+		{
+			pgFile	   *file = (pgFile *) parray_get(files, j);
+
+			if (file->is_datafile && !file->is_cfs &&
+				file->write_size != BYTES_INVALID)
+				get_page_references(file, packs);
+		}
+		parray_walk(files, pgFileFree);
+		parray_free(files);
+	}
+	parray_walk(backup_list, pgBackupFree);
+	parray_free(backup_list);
+
+	deleted = page_store_remove_unused(packs);
+
+	elog(INFO, "removed %ld unused pages of the page store", deleted);
+}
 
 /* Delete all backup files and wal files of given instance. */
 int
@@ -438,6 +524,12 @@ do_delete_instance(void)
 	/* Delete all wal files. */
 	delete_walfiles(InvalidXLogRecPtr, 0);
 
+	/* Delete all pages of the page store. */
+	delete_unused_pages();
+	if (fileExists(page_store_path) && rmdir(page_store_path) != 0)
+		elog(ERROR, "can't remove \"%s\": %s", page_store_path,
+			strerror(errno));
+
 	/* Delete backup instance config file */
 	join_path_components(instance_config_path, backup_instance_path, BACKUP_CATALOG_CONF_FILE);
 	if (remove(instance_config_path))
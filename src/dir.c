@@ -13,12 +13,15 @@
 #include <unistd.h>
 #include <sys/stat.h>
 #include <sys/types.h>
+#include <sys/mman.h>
 #include <dirent.h>
+#include <fcntl.h>
 #include <time.h>
 
 #include "catalog/catalog.h"
 #include "catalog/pg_tablespace.h"
 #include "datapagemap.h"
+#include "utils/thread.h"
 
 /*
  * The contents of these directories are removed or recreated during server
@@ -120,6 +123,10 @@ static int BlackListCompare(const void *str1, const void *str2);
 static bool dir_check_file(const char *root, pgFile *file);
 static void dir_list_file_internal(parray *files, const char *root,
 								   pgFile *parent, bool exclude,
+								   bool omit_symlink, parray *black_list,
+								   parray *database_dirs);
+static void dir_list_database_dirs(parray *files, const char *root,
+								   parray *database_dirs, bool exclude,
 								   bool omit_symlink, parray *black_list);
 
 static void list_data_directories(parray *files, const char *path, bool is_root,
@@ -155,6 +162,43 @@ dir_create_dir(const char *dir, mode_t mode)
 	return 0;
 }
 
+/* Path stored in the same allocation as the pgFile */
+#define pgFileInlinePath(file)	((char *) (file) + sizeof(pgFile))
+
+/*
+ * Names of relation forks. pgFile->forkName points to one of these, so file
+ * lists don't keep a copy of the name for every file.
+ */
+static const char *const fork_names[] = {
+	"fsm",
+	"vm",
+	"init",
+	"ptrack"
+};
+
+static const char *
+intern_fork_name(const char *name)
+{
+	int			i;
+
+	for (i = 0; i < lengthof(fork_names); i++)
+	{
+		if (strcmp(name, fork_names[i]) == 0)
+			return fork_names[i];
+	}
+
+	/* Some unknown fork, it is treated as a non-data file anyway */
+	return "unknown";
+}
+
+static char *
+pgFileNameFromPath(char *path)
+{
+	char	   *file_name = strrchr(path, '/');
+
+	return file_name ? file_name + 1 : path;
+}
+
 pgFile *
 pgFileNew(const char *path, bool omit_symlink)
 {
@@ -174,6 +218,34 @@ pgFileNew(const char *path, bool omit_symlink)
 	file = pgFileInit(path);
 	file->size = st.st_size;
 	file->mode = st.st_mode;
+	file->mtime = st.st_mtime;
+
+	return file;
+}
+
+/*
+ * Same as pgFileNew(), but stat the entry 'name' of the open directory
+ * 'dirfd', which is cheaper than resolving the full path.
+ */
+static pgFile *
+pgFileNewAt(int dirfd, const char *name, const char *path, bool omit_symlink)
+{
+	struct stat		st;
+	pgFile		   *file;
+
+	if (fstatat(dirfd, name, &st, omit_symlink ? 0 : AT_SYMLINK_NOFOLLOW) == -1)
+	{
+		/* file not found is not an error case */
+		if (errno == ENOENT)
+			return NULL;
+		elog(ERROR, "cannot stat file \"%s\": %s", path,
+			strerror(errno));
+	}
+
+	file = pgFileInit(path);
+	file->size = st.st_size;
+	file->mode = st.st_mode;
+	file->mtime = st.st_mtime;
 
 	return file;
 }
@@ -182,14 +254,14 @@ pgFile *
 pgFileInit(const char *path)
 {
 	pgFile	   *file;
-	char	   *file_name;
+	size_t		path_len = strlen(path);
 
-	file = (pgFile *) pgut_malloc(sizeof(pgFile));
-
-	file->name = NULL;
+	/* The path is stored right after the structure */
+	file = (pgFile *) pgut_malloc(sizeof(pgFile) + path_len + 1);
 
 	file->size = 0;
 	file->mode = 0;
+	file->mtime = 0;
 	file->read_size = 0;
 	file->write_size = 0;
 	file->crc = 0;
@@ -203,30 +275,45 @@ pgFileInit(const char *path)
 	file->relOid = 0;
 	file->segno = 0;
 	file->is_database = false;
-	file->forkName = pgut_malloc(MAXPGPATH);
-	file->forkName[0] = '\0';
-
-	file->path = pgut_malloc(strlen(path) + 1);
-	strcpy(file->path, path);		/* enough buffer size guaranteed */
+	file->forkName = "";
 
-	/* Get file name from the path */
-	file_name = strrchr(file->path, '/');
-	if (file_name == NULL)
-		file->name = file->path;
-	else
-	{
-		file_name++;
-		file->name = file_name;
-	}
+	file->path = pgFileInlinePath(file);
+	memcpy(file->path, path, path_len + 1);
+	file->name = pgFileNameFromPath(file->path);
 
 	file->is_cfs = false;
 	file->exists_in_prev = false;	/* can change only in Incremental backup. */
 	/* Number of blocks readed during backup */
 	file->n_blocks = BLOCKNUM_INVALID;
 	file->compress_alg = NOT_DEFINED_COMPRESS;
+	file->parts = NULL;
+	file->n_parts = 0;
 	return file;
 }
 
+/*
+ * Replace path of the file. A path which isn't longer than the current one
+ * is copied in place, it may point into the current path.
+ */
+void
+pgFileSetPath(pgFile *file, const char *path)
+{
+	size_t		path_len = strlen(path);
+
+	if (path_len <= strlen(file->path))
+		memmove(file->path, path, path_len + 1);
+	else
+	{
+		char	   *new_path = pgut_strdup(path);
+
+		if (file->path != pgFileInlinePath(file))
+			free(file->path);
+		file->path = new_path;
+	}
+
+	file->name = pgFileNameFromPath(file->path);
+}
+
 /*
  * Delete file pointed by the pgFile.
  * If the pgFile points directory, the directory must be empty.
@@ -264,9 +351,10 @@ pgFileGetCRC(const char *file_path)
 {
 	FILE	   *fp;
 	pg_crc32	crc = 0;
-	char		buf[1024];
+	char		buf[BLCKSZ];
 	size_t		len;
 	int			errno_tmp;
+	int64		io_start;
 
 	/* open file in binary read mode */
 	fp = fopen(file_path, PG_BINARY_R);
@@ -276,10 +364,16 @@ pgFileGetCRC(const char *file_path)
 
 	/* calc CRC of backup file */
 	INIT_CRC32C(crc);
-	while ((len = fread(buf, 1, sizeof(buf), fp)) == sizeof(buf))
+	for (;;)
 	{
 		if (interrupted)
 			elog(ERROR, "interrupted during CRC calculation");
+
+		io_start = io_throttle_start(sizeof(buf));
+		len = fread(buf, 1, sizeof(buf), fp);
+		io_throttle_end(io_start);
+		if (len != sizeof(buf))
+			break;
 		COMP_CRC32C(crc, buf, len);
 	}
 	errno_tmp = errno;
@@ -295,6 +389,176 @@ pgFileGetCRC(const char *file_path)
 	return crc;
 }
 
+/*
+ * Read the file from 'offset' up to 'offset' + 'len' bytes (up to the end of
+ * the file if 'len' is 0) and calculate CRC of this range. The number of
+ * bytes actually read is returned in *read_len.
+ */
+pg_crc32
+pgFileGetCRCRange(const char *file_path, off_t offset, size_t len,
+				  size_t *read_len)
+{
+	FILE	   *fp;
+	pg_crc32	crc = 0;
+	char		buf[BLCKSZ];
+	size_t		to_read;
+	size_t		n;
+	int64		io_start;
+
+	fp = fopen(file_path, PG_BINARY_R);
+	if (fp == NULL)
+		elog(ERROR, "cannot open file \"%s\": %s",
+			file_path, strerror(errno));
+
+	if (fseek(fp, offset, SEEK_SET) < 0)
+		elog(ERROR, "cannot seek in file \"%s\": %s",
+			file_path, strerror(errno));
+
+	*read_len = 0;
+	INIT_CRC32C(crc);
+	for (;;)
+	{
+		if (interrupted)
+			elog(ERROR, "interrupted during CRC calculation");
+
+		to_read = sizeof(buf);
+		if (len > 0 && len - *read_len < to_read)
+			to_read = len - *read_len;
+		if (to_read == 0)
+			break;
+
+		io_start = io_throttle_start(to_read);
+		n = fread(buf, 1, to_read, fp);
+		io_throttle_end(io_start);
+		if (n > 0)
+		{
+			COMP_CRC32C(crc, buf, n);
+			*read_len += n;
+		}
+		if (n != to_read)
+		{
+			if (!feof(fp))
+				elog(WARNING, "cannot read \"%s\": %s", file_path,
+					strerror(errno));
+			break;
+		}
+	}
+	FIN_CRC32C(crc);
+
+	fclose(fp);
+
+	return crc;
+}
+
+/* Multiply 32x32 bit matrix over GF(2) by vector */
+static uint32
+gf2_matrix_times(const uint32 *mat, uint32 vec)
+{
+	uint32		sum = 0;
+
+	while (vec)
+	{
+		if (vec & 1)
+			sum ^= *mat;
+		vec >>= 1;
+		mat++;
+	}
+	return sum;
+}
+
+static void
+gf2_matrix_square(uint32 *square, const uint32 *mat)
+{
+	int			n;
+
+	for (n = 0; n < 32; n++)
+		square[n] = gf2_matrix_times(mat, mat[n]);
+}
+
+/*
+ * Return CRC-32C of the concatenation of two blocks of data, where 'crc1' is
+ * CRC of the first block and 'crc2' is CRC of the second block of 'len2'
+ * bytes. This is the same algorithm as zlib's crc32_combine() uses, but
+ * with the Castagnoli polynomial.
+ */
+pg_crc32
+pgFileCombineCRC(pg_crc32 crc1, pg_crc32 crc2, size_t len2)
+{
+	uint32		even[32];	/* even-power-of-two zeros operator */
+	uint32		odd[32];	/* odd-power-of-two zeros operator */
+	uint32		row;
+	int			n;
+
+	if (len2 == 0)
+		return crc1;
+
+	/* put operator for one zero bit in odd */
+	odd[0] = 0x82F63B78;		/* reversed CRC-32C polynomial */
+	row = 1;
+	for (n = 1; n < 32; n++)
+	{
+		odd[n] = row;
+		row <<= 1;
+	}
+
+	/* put operator for two zero bits in even */
+	gf2_matrix_square(even, odd);
+	/* put operator for four zero bits in odd */
+	gf2_matrix_square(odd, even);
+
+	/* apply len2 zeros to crc1 */
+	do
+	{
+		gf2_matrix_square(even, odd);
+		if (len2 & 1)
+			crc1 = gf2_matrix_times(even, crc1);
+		len2 >>= 1;
+		if (len2 == 0)
+			break;
+
+		gf2_matrix_square(odd, even);
+		if (len2 & 1)
+			crc1 = gf2_matrix_times(odd, crc1);
+		len2 >>= 1;
+	} while (len2 != 0);
+
+	return crc1 ^ crc2;
+}
+
+/*
+ * Split the file of 'nblocks' blocks into parts of FILE_PART_BLOCKS blocks
+ * and append them to 'parts'. The last part covers everything up to the end
+ * of the file, even if the file grows.
+ */
+void
+pgFileSplit(pgFile *file, BlockNumber nblocks, parray *parts)
+{
+	int			i;
+
+	file->n_parts = (nblocks + FILE_PART_BLOCKS - 1) / FILE_PART_BLOCKS;
+	if (file->n_parts == 0)
+		file->n_parts = 1;
+	file->parts = pgut_newarray(pgFilePart, file->n_parts);
+	pg_atomic_init_u32(&file->n_parts_done, 0);
+
+	for (i = 0; i < file->n_parts; i++)
+	{
+		pgFilePart *part = &file->parts[i];
+
+		MemSet(part, 0, sizeof(pgFilePart));
+		part->file = file;
+		part->partno = i;
+		part->start_blkno = i * FILE_PART_BLOCKS;
+		if (i == file->n_parts - 1)
+			part->end_blkno = InvalidBlockNumber;
+		else
+			part->end_blkno = (i + 1) * FILE_PART_BLOCKS;
+		pg_atomic_clear_flag(&part->lock);
+
+		parray_append(parts, part);
+	}
+}
+
 void
 pgFileFree(void *file)
 {
@@ -308,10 +572,11 @@ pgFileFree(void *file)
 	if (file_ptr->linked)
 		free(file_ptr->linked);
 
-	if (file_ptr->forkName)
-		free(file_ptr->forkName);
+	if (file_ptr->parts)
+		free(file_ptr->parts);
 
-	free(file_ptr->path);
+	if (file_ptr->path != pgFileInlinePath(file_ptr))
+		free(file_ptr->path);
 	free(file);
 }
 
@@ -421,7 +686,20 @@ dir_list_file(parray *files, const char *root, bool exclude, bool omit_symlink,
 	if (add_root)
 		parray_append(files, file);
 
-	dir_list_file_internal(files, root, file, exclude, omit_symlink, black_list);
+	/* Database directories are listed in parallel */
+	if (exclude && num_threads > 1)
+	{
+		parray	   *database_dirs = parray_new();
+
+		dir_list_file_internal(files, root, file, exclude, omit_symlink,
+							   black_list, database_dirs);
+		dir_list_database_dirs(files, root, database_dirs, exclude,
+							   omit_symlink, black_list);
+		parray_free(database_dirs);
+	}
+	else
+		dir_list_file_internal(files, root, file, exclude, omit_symlink,
+							   black_list, NULL);
 }
 
 /*
@@ -577,7 +855,8 @@ dir_check_file(const char *root, pgFile *file)
 			if (fork_name)
 			{
 				/* Auxiliary fork of the relfile */
-				sscanf(file->name, "%u_%s", &(file->relOid), file->forkName);
+				sscanf(file->name, "%u_%s", &(file->relOid), suffix);
+				file->forkName = intern_fork_name(suffix);
 
 				/* Do not backup ptrack files */
 				if (strcmp(file->forkName, "ptrack") == 0)
@@ -606,10 +885,14 @@ dir_check_file(const char *root, pgFile *file)
 /*
  * List files in "root" directory.  If "exclude" is true do not add into "files"
  * files from pgdata_exclude_files and directories from pgdata_exclude_dir.
+ *
+ * If "database_dirs" isn't NULL, database directories are not listed but
+ * added to it to be listed later by dir_list_database_dirs().
  */
 static void
 dir_list_file_internal(parray *files, const char *root, pgFile *parent,
-					   bool exclude, bool omit_symlink, parray *black_list)
+					   bool exclude, bool omit_symlink, parray *black_list,
+					   parray *database_dirs)
 {
 	DIR		    *dir;
 	struct dirent *dent;
@@ -635,26 +918,66 @@ dir_list_file_internal(parray *files, const char *root, pgFile *parent,
 	{
 		pgFile	   *file;
 		char		child[MAXPGPATH];
+		bool		checked = false;
+
+		/* Skip entries point current dir or parent dir */
+		if (strcmp(dent->d_name, ".") == 0 || strcmp(dent->d_name, "..") == 0)
+			continue;
 
 		join_path_components(child, parent->path, dent->d_name);
 
-		file = pgFileNew(child, omit_symlink);
-		if (file == NULL)
-			continue;
+#ifdef _DIRENT_HAVE_D_TYPE
+		/*
+		 * Files are mostly excluded by name, so check regular files before
+		 * calling stat() for them.
+		 */
+		if (dent->d_type == DT_REG && exclude)
+		{
+			struct stat st;
 
-		/* Skip entries point current dir or parent dir */
-		if (S_ISDIR(file->mode) &&
-			(strcmp(dent->d_name, ".") == 0 || strcmp(dent->d_name, "..") == 0))
+			file = pgFileInit(child);
+			file->mode = S_IFREG;
+			if (!dir_check_file(root, file))
+			{
+				pgFileFree(file);
+				/* Skip */
+				continue;
+			}
+
+			if (fstatat(dirfd(dir), dent->d_name, &st,
+						omit_symlink ? 0 : AT_SYMLINK_NOFOLLOW) == -1)
+			{
+				pgFileFree(file);
+				/* file not found is not an error case */
+				if (errno == ENOENT)
+				{
+					errno = 0;
+					continue;
+				}
+				elog(ERROR, "cannot stat file \"%s\": %s", child,
+					 strerror(errno));
+			}
+			file->size = st.st_size;
+			file->mode = st.st_mode;
+			file->mtime = st.st_mtime;
+			checked = true;
+		}
+		else
+#endif
+			file = pgFileNewAt(dirfd(dir), dent->d_name, child, omit_symlink);
+		if (file == NULL)
 		{
-			pgFileFree(file);
+			errno = 0;
 			continue;
 		}
 
 		/*
 		 * Add only files, directories and links. Skip sockets and other
-		 * unexpected file formats.
+		 * unexpected file formats. A regular file checked before stat()
+		 * could be replaced concurrently.
 		 */
-		if (!S_ISDIR(file->mode) && !S_ISREG(file->mode))
+		if ((!S_ISDIR(file->mode) && !S_ISREG(file->mode)) ||
+			(checked && !S_ISREG(file->mode)))
 		{
 			elog(WARNING, "Skip \"%s\": unexpected file format", file->path);
 			pgFileFree(file);
@@ -674,7 +997,7 @@ dir_list_file_internal(parray *files, const char *root, pgFile *parent,
 		if (S_ISDIR(file->mode))
 			parray_append(files, file);
 
-		if (exclude && !dir_check_file(root, file))
+		if (exclude && !checked && !dir_check_file(root, file))
 		{
 			if (S_ISREG(file->mode))
 				pgFileFree(file);
@@ -691,8 +1014,14 @@ dir_list_file_internal(parray *files, const char *root, pgFile *parent,
 		 * recursively.
 		 */
 		if (S_ISDIR(file->mode))
-			dir_list_file_internal(files, root, file, exclude, omit_symlink,
-								   black_list);
+		{
+			if (database_dirs && file->is_database)
+				parray_append(database_dirs, file);
+			else
+				dir_list_file_internal(files, root, file, exclude,
+									   omit_symlink, black_list,
+									   database_dirs);
+		}
 	}
 
 	if (errno && errno != ENOENT)
@@ -705,6 +1034,87 @@ dir_list_file_internal(parray *files, const char *root, pgFile *parent,
 	closedir(dir);
 }
 
+/* An argument for a thread function of dir_list_database_dirs() */
+typedef struct
+{
+	parray	   *database_dirs;
+	pg_atomic_uint32 *next_dir;	/* next directory to list */
+	parray	   *files;			/* files listed by the thread */
+	const char *root;
+	bool		exclude;
+	bool		omit_symlink;
+	parray	   *black_list;
+} dir_list_arg;
+
+static void *
+dir_list_database_dirs_worker(void *arg)
+{
+	dir_list_arg *arguments = (dir_list_arg *) arg;
+	uint32		i;
+
+	while ((i = pg_atomic_fetch_add_u32(arguments->next_dir, 1)) <
+		   parray_num(arguments->database_dirs))
+	{
+		pgFile	   *dir = (pgFile *) parray_get(arguments->database_dirs, i);
+
+		dir_list_file_internal(arguments->files, arguments->root, dir,
+							   arguments->exclude, arguments->omit_symlink,
+							   arguments->black_list, NULL);
+	}
+
+	return NULL;
+}
+
+/*
+ * List database directories by num_threads threads and add their contents
+ * to "files". The directories themselves are already there.
+ */
+static void
+dir_list_database_dirs(parray *files, const char *root, parray *database_dirs,
+					   bool exclude, bool omit_symlink, parray *black_list)
+{
+	pthread_t  *threads;
+	dir_list_arg *threads_args;
+	pg_atomic_uint32 next_dir;
+	int			nthreads = Min(num_threads, parray_num(database_dirs));
+	int			i;
+	size_t		j;
+
+	if (nthreads == 0)
+		return;
+
+	pg_atomic_init_u32(&next_dir, 0);
+	threads = pgut_newarray(pthread_t, nthreads);
+	threads_args = pgut_newarray(dir_list_arg, nthreads);
+
+	for (i = 0; i < nthreads; i++)
+	{
+		dir_list_arg *arg = &threads_args[i];
+
+		arg->database_dirs = database_dirs;
+		arg->next_dir = &next_dir;
+		arg->files = parray_new();
+		arg->root = root;
+		arg->exclude = exclude;
+		arg->omit_symlink = omit_symlink;
+		arg->black_list = black_list;
+
+		pthread_create(&threads[i], NULL, dir_list_database_dirs_worker, arg);
+	}
+
+	for (i = 0; i < nthreads; i++)
+	{
+		pthread_join(threads[i], NULL);
+
+		for (j = 0; j < parray_num(threads_args[i].files); j++)
+			parray_append(files, parray_get(threads_args[i].files, j));
+		parray_free(threads_args[i].files);
+	}
+
+	free(threads);
+	free(threads_args);
+}
+
 /*
  * List data directories excluding directories from
  * pgdata_exclude_dir array.
@@ -994,6 +1404,32 @@ create_data_directories(const char *data_dir, const char *backup_dir,
 							 linked_path, dir_created, link_name);
 				}
 
+				/* Incremental restore reuses the existing symlink */
+				if (restore_incremental)
+				{
+					char		link_path[MAXPGPATH];
+					char		link_target[MAXPGPATH];
+					int			len;
+
+					join_path_components(link_path, data_dir, PG_TBLSPC_DIR);
+					join_path_components(link_path, link_path, link_name);
+					len = readlink(link_path, link_target,
+								   sizeof(link_target) - 1);
+					if (len >= 0)
+					{
+						link_target[len] = '\0';
+						if (strcmp(link_target, linked_path) != 0)
+							elog(ERROR, "symbolic link \"%s\" points to \"%s\" instead of \"%s\"",
+								 link_path, link_target, linked_path);
+
+						set_tablespace_created(link_name, linked_path);
+
+						if (link_sep != NULL && *(link_sep + 1) != '\0')
+							goto create_directory;
+						continue;
+					}
+				}
+
 				/*
 				 * This check was done in check_tablespace_mapping(). But do
 				 * it again.
@@ -1160,7 +1596,11 @@ check_tablespace_mapping(pgBackup *backup)
 			elog(ERROR, "tablespace directory is not an absolute path: %s\n",
 				 linked_path);
 
-		if (!dir_is_empty(linked_path))
+		/*
+		 * Incremental restore reuses tablespaces linked from PGDATA, it is
+		 * checked by create_data_directories().
+		 */
+		if (!restore_incremental && !dir_is_empty(linked_path))
 			elog(ERROR, "restore tablespace destination is not empty: \"%s\"",
 				 linked_path);
 	}
@@ -1180,37 +1620,418 @@ print_file_list(FILE *out, const parray *files, const char *root)
 
 	/* print each file in the list */
 	for (i = 0; i < parray_num(files); i++)
+		print_file_entry(out, (pgFile *) parray_get(files, i), root);
+}
+
+/*
+ * Print a single line of backup content list in the text format.
+ */
+void
+print_file_entry(FILE *out, pgFile *file, const char *root)
+{
+	char	   *path = file->path;
+
+	/* omit root directory portion */
+	if (root && strstr(path, root) == path)
+		path = GetRelativePath(path, root);
+
+	fprintf(out, "{\"path\":\"%s\", \"size\":\"" INT64_FORMAT "\", "
+				 "\"mode\":\"%u\", \"is_datafile\":\"%u\", "
+				 "\"is_cfs\":\"%u\", \"crc\":\"%u\", "
+				 "\"compress_alg\":\"%s\"",
+			path, file->write_size, file->mode,
+			file->is_datafile ? 1 : 0, file->is_cfs ? 1 : 0, file->crc,
+			deparse_compress_alg(file->compress_alg));
+
+	if (file->is_datafile)
+		fprintf(out, ",\"segno\":\"%d\"", file->segno);
+
+	/* Used to find unchanged files by the next incremental backup */
+	if (S_ISREG(file->mode) && file->mtime != 0)
+		fprintf(out, ",\"file_size\":\"" INT64_FORMAT "\", "
+					 "\"mtime\":\"" INT64_FORMAT "\"",
+				(int64) file->size, (int64) file->mtime);
+
+#ifndef WIN32
+	if (S_ISLNK(file->mode))
+#else
+	if (pgwin32_is_junction(file->path))
+#endif
+		fprintf(out, ",\"linked\":\"%s\"", file->linked);
+
+	if (file->n_blocks != BLOCKNUM_INVALID)
+		fprintf(out, ",\"n_blocks\":\"%i\"", file->n_blocks);
+
+	fprintf(out, "}\n");
+}
+
+/*
+ * Binary format of the backup content list:
+ *
+ *	FileListHeader
+ *	FileListEntry[nfiles], sorted by path
+ *	string area with NUL-terminated paths and link targets
+ *	CRC32C of everything above
+ *
+ * Entries have fixed size, so the entry array is an index which allows to
+ * find a file by binary search in the mapped file without parsing the
+ * whole list.
+ */
+#define FILE_LIST_MAGIC		0x4C465042	/* "BPFL" */
+#define FILE_LIST_VERSION	1
+
+typedef struct FileListHeader
+{
+	uint32		magic;
+	uint32		version;
+	uint32		nfiles;
+	uint32		entry_size;		/* sizeof(FileListEntry) */
+	uint64		strings_size;	/* size of the string area */
+} FileListHeader;
+
+/* Flags of FileListEntry */
+#define FILE_LIST_DATAFILE	0x01
+#define FILE_LIST_CFS		0x02
+#define FILE_LIST_LINKED	0x04
+
+typedef struct FileListEntry
+{
+	int64		write_size;
+	int64		size;			/* file_size of the text format */
+	int64		mtime;
+	uint64		path_offset;	/* offsets in the string area */
+	uint64		linked_offset;
+	uint32		mode;
+	uint32		crc;
+	int32		segno;
+	int32		n_blocks;
+	uint8		compress_alg;
+	uint8		flags;
+} FileListEntry;
+
+/* Content list mapped into memory */
+typedef struct FileListMap
+{
+	char	   *data;
+	size_t		size;
+	uint32		nfiles;
+	const FileListEntry *entries;
+	const char *strings;
+} FileListMap;
+
+/* A file of the list and its path relative to the backup root */
+typedef struct FileListItem
+{
+	const char *rel_path;
+	pgFile	   *file;
+} FileListItem;
+
+static int
+file_list_item_compare(const void *a, const void *b)
+{
+	return strcmp(((const FileListItem *) a)->rel_path,
+				  ((const FileListItem *) b)->rel_path);
+}
+
+static void
+file_list_write(FILE *out, const void *data, size_t len, pg_crc32c *crc)
+{
+	if (len == 0)
+		return;
+	COMP_CRC32C(*crc, data, len);
+	if (fwrite(data, 1, len, out) != len)
+		elog(ERROR, "cannot write file list: %s", strerror(errno));
+}
+
+/*
+ * Write backup content list in the binary format. Paths are written relative
+ * to "root".
+ */
+void
+write_file_list(FILE *out, const parray *files, const char *root)
+{
+	size_t		nfiles = parray_num(files);
+	FileListItem *items;
+	FileListHeader header;
+	FileListEntry entry;
+	uint64		strings_size = 0;
+	pg_crc32c	crc;
+	size_t		i;
+
+	items = pgut_newarray(FileListItem, nfiles);
+	for (i = 0; i < nfiles; i++)
 	{
 		pgFile	   *file = (pgFile *) parray_get(files, i);
-		char	   *path = file->path;
+		const char *path = file->path;
 
 		/* omit root directory portion */
 		if (root && strstr(path, root) == path)
 			path = GetRelativePath(path, root);
 
-		fprintf(out, "{\"path\":\"%s\", \"size\":\"" INT64_FORMAT "\", "
-					 "\"mode\":\"%u\", \"is_datafile\":\"%u\", "
-					 "\"is_cfs\":\"%u\", \"crc\":\"%u\", "
-					 "\"compress_alg\":\"%s\"",
-				path, file->write_size, file->mode,
-				file->is_datafile ? 1 : 0, file->is_cfs ? 1 : 0, file->crc,
-				deparse_compress_alg(file->compress_alg));
+		items[i].rel_path = path;
+		items[i].file = file;
+	}
+	qsort(items, nfiles, sizeof(FileListItem), file_list_item_compare);
 
+	INIT_CRC32C(crc);
+
+	MemSet(&header, 0, sizeof(header));
+	header.magic = FILE_LIST_MAGIC;
+	header.version = FILE_LIST_VERSION;
+	header.nfiles = (uint32) nfiles;
+	header.entry_size = sizeof(FileListEntry);
+	for (i = 0; i < nfiles; i++)
+	{
+		strings_size += strlen(items[i].rel_path) + 1;
+		if (items[i].file->linked)
+			strings_size += strlen(items[i].file->linked) + 1;
+	}
+	header.strings_size = strings_size;
+	file_list_write(out, &header, sizeof(header), &crc);
+
+	strings_size = 0;
+	for (i = 0; i < nfiles; i++)
+	{
+		pgFile	   *file = items[i].file;
+
+		/* Zero padding bytes too, they are covered by the CRC */
+		MemSet(&entry, 0, sizeof(entry));
+		entry.write_size = file->write_size;
+		/* Used to find unchanged files by the next incremental backup */
+		if (S_ISREG(file->mode) && file->mtime != 0)
+		{
+			entry.size = (int64) file->size;
+			entry.mtime = (int64) file->mtime;
+		}
+		entry.mode = (uint32) file->mode;
+		entry.crc = file->crc;
+		entry.segno = file->is_datafile ? file->segno : 0;
+		entry.n_blocks = file->n_blocks;
+		entry.compress_alg = (uint8) file->compress_alg;
 		if (file->is_datafile)
-			fprintf(out, ",\"segno\":\"%d\"", file->segno);
+			entry.flags |= FILE_LIST_DATAFILE;
+		if (file->is_cfs)
+			entry.flags |= FILE_LIST_CFS;
 
-#ifndef WIN32
-		if (S_ISLNK(file->mode))
-#else
-		if (pgwin32_is_junction(file->path))
-#endif
-			fprintf(out, ",\"linked\":\"%s\"", file->linked);
+		entry.path_offset = strings_size;
+		strings_size += strlen(items[i].rel_path) + 1;
+		if (file->linked)
+		{
+			entry.flags |= FILE_LIST_LINKED;
+			entry.linked_offset = strings_size;
+			strings_size += strlen(file->linked) + 1;
+		}
+
+		file_list_write(out, &entry, sizeof(entry), &crc);
+	}
 
-		if (file->n_blocks != BLOCKNUM_INVALID)
-			fprintf(out, ",\"n_blocks\":\"%i\"", file->n_blocks);
+	for (i = 0; i < nfiles; i++)
+	{
+		file_list_write(out, items[i].rel_path, strlen(items[i].rel_path) + 1,
+						&crc);
+		if (items[i].file->linked)
+			file_list_write(out, items[i].file->linked,
+							strlen(items[i].file->linked) + 1, &crc);
+	}
+
+	FIN_CRC32C(crc);
+	if (fwrite(&crc, 1, sizeof(crc), out) != sizeof(crc))
+		elog(ERROR, "cannot write file list: %s", strerror(errno));
+
+	free(items);
+}
+
+/*
+ * Map backup content list "path" into memory. Return false if the list is in
+ * the old text format.
+ */
+static bool
+file_list_map(const char *path, FileListMap *map)
+{
+	int			fd;
+	struct stat	st;
+	const FileListHeader *header;
+	uint64		expected_size;
+	pg_crc32c	crc;
+
+	fd = open(path, O_RDONLY | PG_BINARY, 0);
+	if (fd < 0)
+		elog(ERROR, "cannot open \"%s\": %s", path, strerror(errno));
+	if (fstat(fd, &st) < 0)
+		elog(ERROR, "cannot stat \"%s\": %s", path, strerror(errno));
+
+	/* The text format starts with '{' or is empty */
+	if ((size_t) st.st_size < sizeof(FileListHeader) + sizeof(pg_crc32c))
+	{
+		close(fd);
+		return false;
+	}
+
+	map->size = st.st_size;
+	map->data = mmap(NULL, map->size, PROT_READ, MAP_PRIVATE, fd, 0);
+	if (map->data == MAP_FAILED)
+		elog(ERROR, "cannot map \"%s\": %s", path, strerror(errno));
+	close(fd);
+
+	header = (const FileListHeader *) map->data;
+	if (header->magic != FILE_LIST_MAGIC)
+	{
+		munmap(map->data, map->size);
+		return false;
+	}
+
+	if (header->version != FILE_LIST_VERSION)
+		elog(ERROR, "file list \"%s\" has unsupported version %u",
+			 path, header->version);
+
+	expected_size = sizeof(FileListHeader) +
+		(uint64) header->nfiles * header->entry_size +
+		header->strings_size + sizeof(pg_crc32c);
+	if (header->entry_size != sizeof(FileListEntry) ||
+		expected_size != map->size)
+		elog(ERROR, "file list \"%s\" is corrupted", path);
+
+	INIT_CRC32C(crc);
+	COMP_CRC32C(crc, map->data, map->size - sizeof(pg_crc32c));
+	FIN_CRC32C(crc);
+	if (memcmp(&crc, map->data + map->size - sizeof(pg_crc32c),
+			   sizeof(crc)) != 0)
+		elog(ERROR, "file list \"%s\" has invalid checksum", path);
+
+	map->nfiles = header->nfiles;
+	map->entries = (const FileListEntry *) (map->data + sizeof(FileListHeader));
+	map->strings = (const char *) (map->entries + map->nfiles);
+
+	return true;
+}
+
+/*
+ * Create pgFile for the entry "i" of the mapped list. If root is not NULL,
+ * path will be absolute path.
+ */
+static pgFile *
+file_list_get(const FileListMap *map, uint32 i, const char *root)
+{
+	const FileListEntry *entry = &map->entries[i];
+	const char *path = map->strings + entry->path_offset;
+	char		filepath[MAXPGPATH];
+	pgFile	   *file;
 
-		fprintf(out, "}\n");
+	if (root)
+	{
+		join_path_components(filepath, root, path);
+		path = filepath;
 	}
+
+	file = pgFileInit(path);
+	file->write_size = entry->write_size;
+	file->size = (size_t) entry->size;
+	file->mtime = (time_t) entry->mtime;
+	file->mode = (mode_t) entry->mode;
+	file->crc = entry->crc;
+	file->segno = entry->segno;
+	file->n_blocks = entry->n_blocks;
+	file->compress_alg = (CompressAlg) entry->compress_alg;
+	file->is_datafile = (entry->flags & FILE_LIST_DATAFILE) != 0;
+	file->is_cfs = (entry->flags & FILE_LIST_CFS) != 0;
+	if (entry->flags & FILE_LIST_LINKED)
+		file->linked = pgut_strdup(map->strings + entry->linked_offset);
+
+	return file;
+}
+
+/* Backup content list opened for lookups by path */
+struct FileListIndex
+{
+	const char *root;
+	bool		mapped;
+	FileListMap map;
+	parray	   *files;			/* files of the text format list, sorted by
+								 * path, or files returned by file_list_find() */
+};
+
+/*
+ * Open the backup content list "path" to find files by path without loading
+ * the whole list. Lists in the old text format are loaded entirely.
+ */
+FileListIndex *
+file_list_open(const char *root, const char *path)
+{
+	FileListIndex *list = pgut_new(FileListIndex);
+
+	list->root = root;
+	list->mapped = file_list_map(path, &list->map);
+	if (list->mapped)
+		list->files = parray_new();
+	else
+	{
+		list->files = dir_read_file_list(root, path);
+		parray_qsort(list->files, pgFileComparePath);
+	}
+
+	return list;
+}
+
+/*
+ * Find the file by the path relative to the backup root. The returned pgFile
+ * belongs to the list and is freed by file_list_close().
+ */
+pgFile *
+file_list_find(FileListIndex *list, const char *rel_path)
+{
+	if (list->mapped)
+	{
+		uint32		low = 0;
+		uint32		high = list->map.nfiles;
+
+		while (low < high)
+		{
+			uint32		mid = low + (high - low) / 2;
+			int			cmp;
+
+			cmp = strcmp(list->map.strings +
+						 list->map.entries[mid].path_offset, rel_path);
+			if (cmp == 0)
+			{
+				pgFile	   *file = file_list_get(&list->map, mid, list->root);
+
+				parray_append(list->files, file);
+				return file;
+			}
+			else if (cmp < 0)
+				low = mid + 1;
+			else
+				high = mid;
+		}
+		return NULL;
+	}
+	else
+	{
+		char		path[MAXPGPATH];
+		pgFile		key;
+		pgFile	  **file;
+
+		if (list->root)
+		{
+			join_path_components(path, list->root, rel_path);
+			key.path = path;
+		}
+		else
+			key.path = (char *) rel_path;
+		file = (pgFile **) parray_bsearch(list->files, &key, pgFileComparePath);
+
+		return file ? *file : NULL;
+	}
+}
+
+void
+file_list_close(FileListIndex *list)
+{
+	if (list->mapped)
+		munmap(list->map.data, list->map.size);
+	parray_walk(list->files, pgFileFree);
+	parray_free(list->files);
+	free(list);
 }
 
 /* Parsing states for get_control_value() */
@@ -1351,7 +2172,8 @@ bad_format:
 }
 
 /*
- * Construct parray of pgFile from the backup content list.
+ * Construct parray of pgFile from the backup content list, which may be in
+ * the binary or in the old text format.
  * If root is not NULL, path will be absolute path.
  */
 parray *
@@ -1360,7 +2182,21 @@ dir_read_file_list(const char *root, const char *file_txt)
 	FILE   *fp;
 	parray *files;
 	char	buf[MAXPGPATH * 2];
+	FileListMap map;
+
+	if (file_list_map(file_txt, &map))
+	{
+		uint32		i;
 
+		files = parray_new();
+		for (i = 0; i < map.nfiles; i++)
+			parray_append(files, file_list_get(&map, i, root));
+
+		munmap(map.data, map.size);
+		return files;
+	}
+
+	/* The old text format */
 	fp = fopen(file_txt, "rt");
 	if (fp == NULL)
 		elog(errno == ENOENT ? ERROR : ERROR,
@@ -1380,7 +2216,9 @@ dir_read_file_list(const char *root, const char *file_txt)
 					is_cfs,
 					crc,
 					segno,
-					n_blocks;
+					n_blocks,
+					file_size,
+					mtime;
 		pgFile	   *file;
 
 		get_control_value(buf, "path", path, NULL, true);
@@ -1418,6 +2256,12 @@ dir_read_file_list(const char *root, const char *file_txt)
 		if (get_control_value(buf, "n_blocks", NULL, &n_blocks, false))
 			file->n_blocks = (int) n_blocks;
 
+		if (get_control_value(buf, "file_size", NULL, &file_size, false))
+			file->size = (size_t) file_size;
+
+		if (get_control_value(buf, "mtime", NULL, &mtime, false))
+			file->mtime = (time_t) mtime;
+
 		parray_append(files, file);
 	}
 
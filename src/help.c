@@ -99,6 +99,8 @@ help_pg_probackup(void)
 	printf(_("                 [-C] [--stream [-S slot-name]] [--backup-pg-log]\n"));
 	printf(_("                 [-j num-threads] [--archive-timeout=archive-timeout]\n"));
 	printf(_("                 [--progress]\n"));
+	printf(_("                 [--max-read-rate=rate] [--max-iops=iops]\n"));
+	printf(_("                 [--max-read-latency=latency]\n"));
 	printf(_("                 [--log-level-console=log-level-console]\n"));
 	printf(_("                 [--log-level-file=log-level-file]\n"));
 	printf(_("                 [--log-filename=log-filename]\n"));
@@ -112,6 +114,9 @@ help_pg_probackup(void)
 	printf(_("                 [--compress]\n"));
 	printf(_("                 [--compress-algorithm=compress-algorithm]\n"));
 	printf(_("                 [--compress-level=compress-level]\n"));
+	printf(_("                 [--compress-threads=num-threads]\n"));
+	printf(_("                 [--dedup] [--block-index]\n"));
+	printf(_("                 [--resume [-i backup-id]]\n"));
 	printf(_("                 [-d dbname] [-h host] [-p port] [-U username]\n"));
 	printf(_("                 [-w --no-password] [-W --password]\n"));
 	printf(_("                 [--master-db=db_name] [--master-host=host_name]\n"));
@@ -120,15 +125,19 @@ help_pg_probackup(void)
 
 	printf(_("\n  %s restore -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 [-D pgdata-path] [-i backup-id] [--progress]\n"));
+	printf(_("                 [--max-read-rate=rate] [--max-iops=iops]\n"));
+	printf(_("                 [--max-read-latency=latency]\n"));
 	printf(_("                 [--time=time|--xid=xid|--lsn=lsn [--inclusive=boolean]]\n"));
 	printf(_("                 [--timeline=timeline] [-T OLDDIR=NEWDIR]\n"));
 	printf(_("                 [--immediate] [--recovery-target-name=target-name]\n"));
 	printf(_("                 [--recovery-target-action=pause|promote|shutdown]\n"));
 	printf(_("                 [--restore-as-replica]\n"));
-	printf(_("                 [--no-validate]\n"));
+	printf(_("                 [--no-validate] [--incremental]\n"));
 
 	printf(_("\n  %s validate -B backup-path [--instance=instance_name]\n"), PROGRAM_NAME);
 	printf(_("                 [-i backup-id] [--progress]\n"));
+	printf(_("                 [--max-read-rate=rate] [--max-iops=iops]\n"));
+	printf(_("                 [--max-read-latency=latency]\n"));
 	printf(_("                 [--time=time|--xid=xid|--lsn=lsn [--inclusive=boolean]]\n"));
 	printf(_("                 [--recovery-target-name=target-name]\n"));
 	printf(_("                 [--timeline=timeline]\n"));
@@ -155,6 +164,7 @@ help_pg_probackup(void)
 	printf(_("                 [--compress-algorithm=compress-algorithm]\n"));
 	printf(_("                 [--compress-level=compress-level]\n"));
 	printf(_("                 [--overwrite]\n"));
+	printf(_("                 [--wal-summary]\n"));
 
 	printf(_("\n  %s archive-get -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 --wal-file-path=wal-file-path\n"));
@@ -185,6 +195,8 @@ help_backup(void)
 	printf(_("                 [-C] [--stream [-S slot-name]] [--backup-pg-log]\n"));
 	printf(_("                 [-j num-threads] [--archive-timeout=archive-timeout]\n"));
 	printf(_("                 [--progress]\n"));
+	printf(_("                 [--max-read-rate=rate] [--max-iops=iops]\n"));
+	printf(_("                 [--max-read-latency=latency]\n"));
 	printf(_("                 [--log-level-console=log-level-console]\n"));
 	printf(_("                 [--log-level-file=log-level-file]\n"));
 	printf(_("                 [--log-filename=log-filename]\n"));
@@ -198,6 +210,9 @@ help_backup(void)
 	printf(_("                 [--compress]\n"));
 	printf(_("                 [--compress-algorithm=compress-algorithm]\n"));
 	printf(_("                 [--compress-level=compress-level]\n"));
+	printf(_("                 [--compress-threads=num-threads]\n"));
+	printf(_("                 [--dedup] [--block-index]\n"));
+	printf(_("                 [--resume [-i backup-id]]\n"));
 	printf(_("                 [-d dbname] [-h host] [-p port] [-U username]\n"));
 	printf(_("                 [-w --no-password] [-W --password]\n"));
 	printf(_("                 [--master-db=db_name] [--master-host=host_name]\n"));
@@ -214,6 +229,15 @@ help_backup(void)
 	printf(_("  -j, --threads=NUM                number of parallel threads\n"));
 	printf(_("      --archive-timeout=timeout    wait timeout for WAL segment archiving (default: 5min)\n"));
 	printf(_("      --progress                   show progress\n"));
+	printf(_("      --resume                     resume the last backup which was interrupted,\n"));
+	printf(_("                                   unchanged files copied by it are reused\n"));
+	printf(_("  -i, --backup-id=backup-id        ID of the backup to resume\n"));
+	printf(_("      --max-read-rate=rate         limit of the read rate of all threads (default: 0, no limit)\n"));
+	printf(_("                                   available units: 'kB', 'MB', 'GB', 'TB' (default: kB)\n"));
+	printf(_("      --max-iops=iops              limit of read operations per second of all threads\n"));
+	printf(_("                                   (default: 0, no limit)\n"));
+	printf(_("      --max-read-latency=latency   lower the read limits while reads take longer than this\n"));
+	printf(_("                                   available units: 'ms', 's', 'min', 'h', 'd' (default: ms)\n"));
 
 	printf(_("\n  Logging options:\n"));
 	printf(_("      --log-level-console=log-level-console\n"));
@@ -248,9 +272,17 @@ help_backup(void)
 	printf(_("\n  Compression options:\n"));
 	printf(_("      --compress                   compress data files\n"));
 	printf(_("      --compress-algorithm=compress-algorithm\n"));
-	printf(_("                                   available options: 'zlib', 'pglz', 'none' (default: zlib)\n"));
+	printf(_("                                   available options: 'zlib', 'pglz', 'zstd', 'lz4', 'none' (default: zlib)\n"));
 	printf(_("      --compress-level=compress-level\n"));
-	printf(_("                                   level of compression [0-9] (default: 1)\n"));
+	printf(_("                                   level of compression [0-9] (default: 1),\n"));
+	printf(_("                                   zstd also accepts its levels up to 22 and negative fast levels\n"));
+	printf(_("      --compress-threads=num-threads\n"));
+	printf(_("                                   number of threads compressing data pages read by\n"));
+	printf(_("                                   -j threads; 0 compresses in reading threads (default: 0)\n"));
+	printf(_("      --dedup                      store each distinct data page once in the page store\n"));
+	printf(_("                                   shared by backups of the instance\n"));
+	printf(_("      --block-index                write block indexes of data files, so that restore\n"));
+	printf(_("                                   and merge find blocks without scanning the files\n"));
 
 	printf(_("\n  Connection options:\n"));
 	printf(_("  -U, --username=USERNAME          user name to connect as (default: current local user)\n"));
@@ -273,11 +305,14 @@ help_restore(void)
 {
 	printf(_("%s restore -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 [-D pgdata-path] [-i backup-id] [--progress]\n"));
+	printf(_("                 [--max-read-rate=rate] [--max-iops=iops]\n"));
+	printf(_("                 [--max-read-latency=latency]\n"));
 	printf(_("                 [--time=time|--xid=xid|--lsn=lsn [--inclusive=boolean]]\n"));
 	printf(_("                 [--timeline=timeline] [-T OLDDIR=NEWDIR]\n"));
 	printf(_("                 [--immediate] [--recovery-target-name=target-name]\n"));
 	printf(_("                 [--recovery-target-action=pause|promote|shutdown]\n"));
-	printf(_("                 [--restore-as-replica] [--no-validate]\n\n"));
+	printf(_("                 [--restore-as-replica] [--no-validate]\n"));
+	printf(_("                 [--incremental]\n\n"));
 
 	printf(_("  -B, --backup-path=backup-path    location of the backup storage area\n"));
 	printf(_("      --instance=instance_name     name of the instance\n"));
@@ -286,6 +321,12 @@ help_restore(void)
 	printf(_("  -i, --backup-id=backup-id        backup to restore\n"));
 
 	printf(_("      --progress                   show progress\n"));
+	printf(_("      --max-read-rate=rate         limit of the read rate of all threads (default: 0, no limit)\n"));
+	printf(_("                                   available units: 'kB', 'MB', 'GB', 'TB' (default: kB)\n"));
+	printf(_("      --max-iops=iops              limit of read operations per second of all threads\n"));
+	printf(_("                                   (default: 0, no limit)\n"));
+	printf(_("      --max-read-latency=latency   lower the read limits while reads take longer than this\n"));
+	printf(_("                                   available units: 'ms', 's', 'min', 'h', 'd' (default: ms)\n"));
 	printf(_("      --time=time                  time stamp up to which recovery will proceed\n"));
 	printf(_("      --xid=xid                    transaction ID up to which recovery will proceed\n"));
 	printf(_("      --lsn=lsn                    LSN of the write-ahead log location up to which recovery will proceed\n"));
@@ -304,6 +345,8 @@ help_restore(void)
 	printf(_("  -R, --restore-as-replica         write a minimal recovery.conf in the output directory\n"));
 	printf(_("                                   to ease setting up a standby server\n"));
 	printf(_("      --no-validate                disable backup validation during restore\n"));
+	printf(_("      --incremental                rewrite only files and pages of the existing\n"));
+	printf(_("                                   data directory which differ from the backup\n"));
 
 	printf(_("\n  Logging options:\n"));
 	printf(_("      --log-level-console=log-level-console\n"));
@@ -332,6 +375,8 @@ help_validate(void)
 {
 	printf(_("%s validate -B backup-path [--instance=instance_name]\n"), PROGRAM_NAME);
 	printf(_("                 [-i backup-id] [--progress]\n"));
+	printf(_("                 [--max-read-rate=rate] [--max-iops=iops]\n"));
+	printf(_("                 [--max-read-latency=latency]\n"));
 	printf(_("                 [--time=time|--xid=xid|--lsn=lsn [--inclusive=boolean]]\n"));
 	printf(_("                 [--timeline=timeline]\n\n"));
 
@@ -340,6 +385,12 @@ help_validate(void)
 	printf(_("  -i, --backup-id=backup-id        backup to validate\n"));
 
 	printf(_("      --progress                   show progress\n"));
+	printf(_("      --max-read-rate=rate         limit of the read rate of all threads (default: 0, no limit)\n"));
+	printf(_("                                   available units: 'kB', 'MB', 'GB', 'TB' (default: kB)\n"));
+	printf(_("      --max-iops=iops              limit of read operations per second of all threads\n"));
+	printf(_("                                   (default: 0, no limit)\n"));
+	printf(_("      --max-read-latency=latency   lower the read limits while reads take longer than this\n"));
+	printf(_("                                   available units: 'ms', 's', 'min', 'h', 'd' (default: ms)\n"));
 	printf(_("      --time=time                  time stamp up to which recovery will proceed\n"));
 	printf(_("      --xid=xid                    transaction ID up to which recovery will proceed\n"));
 	printf(_("      --lsn=lsn                    LSN of the write-ahead log location up to which recovery will proceed\n"));
@@ -513,9 +564,10 @@ help_set_config(void)
 
 	printf(_("\n  Compression options:\n"));
 	printf(_("      --compress-algorithm=compress-algorithm\n"));
-	printf(_("                                   available options: 'zlib','pglz','none'\n"));
+	printf(_("                                   available options: 'zlib','pglz','zstd','lz4','none'\n"));
 	printf(_("      --compress-level=compress-level\n"));
-	printf(_("                                   level of compression [0-9] (default: 1)\n"));
+	printf(_("                                   level of compression [0-9] (default: 1),\n"));
+	printf(_("                                   zstd also accepts its levels up to 22 and negative fast levels\n"));
 
 	printf(_("\n  Connection options:\n"));
 	printf(_("  -U, --username=USERNAME          user name to connect as (default: current local user)\n"));
@@ -573,7 +625,8 @@ help_archive_push(void)
 	printf(_("                 [--compress]\n"));
 	printf(_("                 [--compress-algorithm=compress-algorithm]\n"));
 	printf(_("                 [--compress-level=compress-level]\n"));
-	printf(_("                 [--overwrite]\n\n"));
+	printf(_("                 [--overwrite]\n"));
+	printf(_("                 [--wal-summary]\n\n"));
 
 	printf(_("  -B, --backup-path=backup-path    location of the backup storage area\n"));
 	printf(_("      --instance=instance_name     name of the instance to delete\n"));
@@ -587,6 +640,8 @@ help_archive_push(void)
 	printf(_("      --compress-level=compress-level\n"));
 	printf(_("                                   level of compression [0-9] (default: 1)\n"));
 	printf(_("      --overwrite                  overwrite archived WAL file\n"));
+	printf(_("      --wal-summary                write summaries of block references of WAL\n"));
+	printf(_("                                   segments to speed up PAGE backups\n"));
 }
 
 static void
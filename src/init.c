@@ -63,7 +63,7 @@ do_add_instance(void)
 						 "(-D, --pgdata)");
 
 	/* Read system_identifier from PGDATA */
-	system_identifier = get_system_identifier(pgdata);
+	system_identifier = get_system_identifier(pgdata, false);
 
 	/* Ensure that all root directories already exist */
 	if (access(backup_path, F_OK) != 0)
@@ -125,6 +125,10 @@ do_merge(time_t backup_id)
 
 	Assert(full_backup_idx != dest_backup_idx);
 
+	/* Don't start merging backups this binary can't read */
+	for (i = full_backup_idx; i >= dest_backup_idx; i--)
+		pgBackupCheckFormat((pgBackup *) parray_get(backups, i));
+
 	/*
 	 * Found target and full backups, merge them and intermediate backups
 	 */
@@ -140,6 +144,9 @@ do_merge(time_t backup_id)
 	parray_walk(backups, pgBackupFree);
 	parray_free(backups);
 
+	/* Pages of the merged backups could become unused */
+	delete_unused_pages();
+
 	elog(LOG, "Merge completed");
 }
 
@@ -168,6 +175,19 @@ merge_backups(pgBackup *to_backup, pgBackup *from_backup)
 
 	elog(LOG, "Merging backup %s with backup %s", from_backup_id, to_backup_id);
 
+	/*
+	 * Pages of the merged backup are put into the page store if any of the
+	 * backups used it.
+	 */
+	to_backup->dedup = to_backup->dedup || from_backup->dedup;
+	current.dedup = to_backup->dedup;
+	/* The same for block indexes of data files */
+	to_backup->block_index = to_backup->block_index || from_backup->block_index;
+	current.block_index = to_backup->block_index;
+	/* The merged backup has the newest format of the two */
+	current.format_version = Max(to_backup->format_version,
+								 from_backup->format_version);
+
 	to_backup->status = BACKUP_STATUS_MERGING;
 	pgBackupWriteBackupControlFile(to_backup);
 
@@ -245,6 +265,10 @@ merge_backups(pgBackup *to_backup, pgBackup *from_backup)
 	if (!merge_isok)
 		elog(ERROR, "Data files merging failed");
 
+	/* Pages put into the page store are flushed to disk at once */
+	if (current.dedup)
+		page_store_finish();
+
 	/*
 	 * Files were copied into to_backup and deleted from from_backup. Remove
 	 * remaining directories from from_backup.
@@ -288,6 +312,8 @@ merge_backups(pgBackup *to_backup, pgBackup *from_backup)
 		if (parray_bsearch(files, file, pgFileComparePathDesc) == NULL)
 		{
 			pgFileDelete(file);
+			if (file->is_datafile)
+				remove_block_index(file->path);
 			elog(LOG, "Deleted \"%s\"", file->path);
 		}
 	}
@@ -304,6 +330,9 @@ merge_backups(pgBackup *to_backup, pgBackup *from_backup)
 	 */
 	pgBackupCopy(to_backup, from_backup);
 	/* Correct metadata */
+	to_backup->dedup = current.dedup;
+	to_backup->block_index = current.block_index;
+	to_backup->format_version = current.format_version;
 	to_backup->backup_mode = BACKUP_MODE_FULL;
 	to_backup->status = BACKUP_STATUS_OK;
 	to_backup->parent_backup = INVALID_BACKUP_ID;
@@ -351,16 +380,10 @@ merge_files(void *arg)
 {
 	merge_files_arg *argument = (merge_files_arg *) arg;
 	pgBackup   *to_backup = argument->to_backup;
-	pgBackup   *from_backup = argument->from_backup;
-	char		tmp_file_path[MAXPGPATH];
 	int			i,
 				num_files = parray_num(argument->files);
 	int			to_root_len = strlen(argument->to_root);
 
-	if (to_backup->compress_alg == PGLZ_COMPRESS ||
-		to_backup->compress_alg == ZLIB_COMPRESS)
-		join_path_components(tmp_file_path, argument->to_root, "tmp");
-
 	for (i = 0; i < num_files; i++)
 	{
 		pgFile	   *file = (pgFile *) parray_get(argument->files, i);
@@ -422,93 +445,67 @@ merge_files(void *arg)
 		if (file->is_datafile && !file->is_cfs)
 		{
 			char		to_path_tmp[MAXPGPATH];	/* Path of target file */
+			char		merge_path[MAXPGPATH];	/* Result of the merge */
+			char		merge_index_path[MAXPGPATH];
+			char		to_index_path[MAXPGPATH];
+			pgFile	  **to_file;
+			pgFile	   *to_version = NULL;
+			parray	   *versions = parray_new();
 
 			join_path_components(to_path_tmp, argument->to_root,
 								 file->path + to_root_len + 1);
+			snprintf(merge_path, MAXPGPATH, "%s.merge", to_path_tmp);
 
 			/*
-			 * We need more complicate algorithm if target file exists and it is
-			 * compressed.
+			 * Pages of the incremental copy take precedence over pages of the
+			 * copy in the target backup, if it exists.
 			 */
-			if (to_backup->compress_alg == PGLZ_COMPRESS ||
-				to_backup->compress_alg == ZLIB_COMPRESS)
+			parray_append(versions, file);
+			to_file = (pgFile **) parray_bsearch(argument->to_files, file,
+												 pgFileComparePathDesc);
+			if (to_file && fileExists(to_path_tmp))
 			{
-				char	   *prev_path;
-
-				/* Start the magic */
-
-				/*
-				 * Merge files:
-				 * - decompress first file
-				 * - decompress second file and merge with first decompressed file
-				 * - compress result file
-				 */
-
-				elog(VERBOSE, "File is compressed, decompress to the temporary file \"%s\"",
-					 tmp_file_path);
-
-				prev_path = file->path;
-				/*
-				 * We need to decompress target file only if it exists.
-				 */
-				if (fileExists(to_path_tmp))
-				{
-					/*
-					 * file->path points to the file in from_root directory. But we
-					 * need the file in directory to_root.
-					 */
-					file->path = to_path_tmp;
-
-					/* Decompress first/target file */
-					restore_data_file(tmp_file_path, file, false, false);
-
-					file->path = prev_path;
-				}
-				/* Merge second/source file with first/target file */
-				restore_data_file(tmp_file_path, file,
-								  from_backup->backup_mode == BACKUP_MODE_DIFF_DELTA,
-								  false);
-
-				elog(VERBOSE, "Compress file and save it to the directory \"%s\"",
-					 argument->to_root);
-
-				/* Again we need change path */
-				file->path = tmp_file_path;
-				/* backup_data_file() requires file size to calculate nblocks */
-				file->size = pgFileSize(file->path);
-				/* Now we can compress the file */
-				backup_data_file(NULL, /* We shouldn't need 'arguments' here */
-								 to_path_tmp, file,
-								 to_backup->start_lsn,
-								 to_backup->backup_mode,
-								 to_backup->compress_alg,
-								 to_backup->compress_level);
-
-				file->path = prev_path;
-
-				/* We can remove temporary file now */
-				if (unlink(tmp_file_path))
-					elog(ERROR, "Could not remove temporary file \"%s\": %s",
-						 tmp_file_path, strerror(errno));
+				to_version = pgFileInit(to_path_tmp);
+				to_version->write_size = (*to_file)->write_size;
+				to_version->compress_alg = (*to_file)->compress_alg;
+				to_version->n_blocks = (*to_file)->n_blocks;
+				to_version->crc = (*to_file)->crc;
+				parray_append(versions, to_version);
 			}
+
 			/*
-			 * Otherwise merging algorithm is simpler.
+			 * Each file is merged into its own temporary file, which replaces
+			 * the target copy. Pages are copied without recompression.
 			 */
-			else
+			merge_data_file(merge_path, versions, file,
+							to_backup->compress_alg, to_backup->compress_level);
+
+			if (rename(merge_path, to_path_tmp) == -1)
+				elog(ERROR, "Could not rename file \"%s\" to \"%s\": %s",
+					 merge_path, to_path_tmp, strerror(errno));
+			if (chmod(to_path_tmp, file->mode) == -1)
+				elog(ERROR, "Could not change mode of \"%s\": %s",
+					 to_path_tmp, strerror(errno));
+
+			/* The block index of the merged file replaces the old one */
+			if (current.block_index)
 			{
-				/* We can merge in-place here */
-				restore_data_file(to_path_tmp, file,
-								  from_backup->backup_mode == BACKUP_MODE_DIFF_DELTA,
-								  true);
-
-				/*
-				 * We need to calculate write_size, restore_data_file() doesn't
-				 * do that.
-				 */
-				file->write_size = pgFileSize(to_path_tmp);
-				file->crc = pgFileGetCRC(to_path_tmp);
+				snprintf(merge_index_path, MAXPGPATH, "%s%s", merge_path,
+						 BLOCK_INDEX_SUFFIX);
+				snprintf(to_index_path, MAXPGPATH, "%s%s", to_path_tmp,
+						 BLOCK_INDEX_SUFFIX);
+				if (rename(merge_index_path, to_index_path) == -1)
+					elog(ERROR, "Could not rename file \"%s\" to \"%s\": %s",
+						 merge_index_path, to_index_path, strerror(errno));
 			}
+			else
+				remove_block_index(to_path_tmp);
+
+			pgFileFree(to_version);
+			parray_free(versions);
+
 			pgFileDelete(file);
+			remove_block_index(file->path);
 		}
 		else
 			move_file(argument->from_root, argument->to_root, file);
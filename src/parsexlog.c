@@ -12,6 +12,8 @@
 
 #include "pg_probackup.h"
 
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include <time.h>
 #include <unistd.h>
 #ifdef HAVE_LIBZ
@@ -81,7 +83,14 @@ typedef struct xl_xact_abort
 	/* xl_xact_twophase follows if XINFO_HAS_TWOPHASE */
 } xl_xact_abort;
 
-static void extractPageInfo(XLogReaderState *record);
+typedef struct WalSummaryBuilder WalSummaryBuilder;
+
+static bool extractPageInfo(XLogReaderState *record, datapagemap_t *pagemaps,
+							WalSummaryBuilder *summary);
+static XLogRecPtr scanBlockReferences(XLogReaderState *xlogreader,
+									  XLogRecPtr startpoint,
+									  XLogRecPtr endpoint,
+									  datapagemap_t *pagemaps);
 static bool getRecordTimestamp(XLogReaderState *record, TimestampTz *recordXtime);
 
 typedef struct XLogPageReadPrivate
@@ -98,9 +107,30 @@ typedef struct XLogPageReadPrivate
 	char		xlogpath[MAXPGPATH];
 	bool		xlogexists;
 
+	/*
+	 * The whole segment in memory: mapped uncompressed segment or
+	 * decompressed one. Pages are read from here if it isn't NULL.
+	 */
+	char	   *xlogbuf;
+	size_t		xlogbuf_len;
+	bool		xlogbuf_mapped;
+	bool		xlog_compressed;
+
+	/* the previous opened segment, to guess direction of reading */
+	XLogSegNo	prev_xlogsegno;
+	bool		prev_xlogsegno_valid;
+
 #ifdef HAVE_LIBZ
-	gzFile		gz_xlogfile;
 	char		gz_xlogpath[MAXPGPATH];
+
+	/* the next compressed segment which is decompressed in background */
+	bool		prefetch_started;
+	pthread_t	prefetch_thread;
+	XLogSegNo	prefetch_segno;
+	char		prefetch_path[MAXPGPATH];
+	char	   *prefetch_buf;
+	size_t		prefetch_len;
+	bool		prefetch_ok;
 #endif
 } XLogPageReadPrivate;
 
@@ -113,6 +143,9 @@ typedef struct
 	XLogRecPtr	endpoint;
 	XLogSegNo	endSegNo;
 
+	/* pagemaps of data files collected by the thread, see pagemap_index */
+	datapagemap_t *pagemaps;
+
 	/*
 	 * Return value from the thread.
 	 * 0 means there is no error, 1 - there is an error.
@@ -128,12 +161,80 @@ static XLogReaderState *InitXLogPageRead(XLogPageReadPrivate *private_data,
 										 const char *archivedir,
 										 TimeLineID tli, bool allocate_reader);
 static void CleanupXLogPageRead(XLogReaderState *xlogreader);
+static void FreeXLogPageRead(XLogReaderState *xlogreader);
 static void PrintXLogCorruptionMsg(XLogPageReadPrivate *private_data,
 								   int elevel);
 
 static XLogSegNo nextSegNoToRead = 0;
 static pthread_mutex_t wal_segment_mutex = PTHREAD_MUTEX_INITIALIZER;
 
+static XLogSegNo next_unsummarized_segno(XLogSegNo segno);
+
+/*
+ * Hash index of data files to back up by relfilenode and segment number.
+ * It is built by extractPageMap() and is used to find the file of a block
+ * referenced by WAL record. Each WAL reader thread collects pages into its
+ * own array of pagemaps, indexed by 'slot', so no locking is needed. The
+ * pagemaps are merged into pgFile.pagemap when all threads are done.
+ */
+typedef struct PagemapIndexEntry
+{
+	RelFileNode rnode;
+	BlockNumber segno;
+	int			slot;			/* index in pagemap_files, -1 if unused */
+} PagemapIndexEntry;
+
+static PagemapIndexEntry *pagemap_index = NULL;
+static uint32 pagemap_index_mask = 0;
+static pgFile **pagemap_files = NULL;
+static int	pagemap_nfiles = 0;
+
+/*
+ * WAL summary files.
+ *
+ * A summary of the WAL segment is a sidecar file '<segment>.summary' in the
+ * archive which contains all main fork blocks referenced by WAL records
+ * starting in the segment. Summaries are written by archive-push with
+ * --wal-summary. extractPageMap() uses them instead of parsing the segments
+ * they describe.
+ *
+ * File format: WalSummaryHeader, then for each relation a WalSummaryRel
+ * followed by 'nblocks' sorted block numbers, then CRC-32C of all the
+ * preceding data.
+ */
+#define WAL_SUMMARY_MAGIC	0x57534D31		/* "WSM1" */
+
+typedef struct WalSummaryHeader
+{
+	uint32		magic;
+	uint32		nrels;
+} WalSummaryHeader;
+
+typedef struct WalSummaryRel
+{
+	RelFileNode rnode;
+	uint32		nblocks;
+} WalSummaryRel;
+
+/* Block referenced by WAL record */
+typedef struct WalSummaryBlock
+{
+	RelFileNode rnode;
+	BlockNumber blkno;
+} WalSummaryBlock;
+
+struct WalSummaryBuilder
+{
+	WalSummaryBlock *blocks;
+	size_t		n;
+	size_t		size;
+};
+
+/* Segments from summary_start_segno which were taken from summaries */
+static bool *segno_summarized = NULL;
+static XLogSegNo summary_start_segno = 0;
+static XLogSegNo summary_end_segno = 0;
+
 /*
  * Do manual switch to the next WAL segment.
  *
@@ -151,8 +252,8 @@ switchToNextWal(XLogReaderState *xlogreader, xlog_thread_arg *arg)
 	/* Critical section */
 	pthread_lock(&wal_segment_mutex);
 	Assert(nextSegNoToRead);
-	private_data->xlogsegno = nextSegNoToRead;
-	nextSegNoToRead++;
+	private_data->xlogsegno = next_unsummarized_segno(nextSegNoToRead);
+	nextSegNoToRead = private_data->xlogsegno + 1;
 	pthread_mutex_unlock(&wal_segment_mutex);
 
 	/* We've reached the end */
@@ -244,7 +345,39 @@ doExtractPageMap(void *arg)
 				break;
 		}
 
-		record = XLogReadRecord(xlogreader, extract_arg->startpoint, &errormsg);
+		/*
+		 * Scan the segment for block references without decoding records.
+		 * The record the scanner stopped at is read in a regular way.
+		 */
+		if (!XLogRecPtrIsInvalid(extract_arg->startpoint))
+		{
+			XLogRecPtr	next;
+
+			next = scanBlockReferences(xlogreader, extract_arg->startpoint,
+									   extract_arg->endpoint,
+									   extract_arg->pagemaps);
+			if (next >= extract_arg->endpoint)
+				break;
+
+			/* All records of the segment were scanned */
+			if (next % XLogSegSize == 0)
+			{
+				private_data->need_switch = true;
+				continue;
+			}
+
+			extract_arg->startpoint = next;
+		}
+
+		/*
+		 * The record following the one just read is read sequentially, the
+		 * reader skips the page header if the record starts a page.
+		 */
+		if (extract_arg->startpoint == xlogreader->EndRecPtr)
+			record = XLogReadRecord(xlogreader, InvalidXLogRecPtr, &errormsg);
+		else
+			record = XLogReadRecord(xlogreader, extract_arg->startpoint,
+									&errormsg);
 
 		if (record == NULL)
 		{
@@ -310,37 +443,285 @@ doExtractPageMap(void *arg)
 			PrintXLogCorruptionMsg(private_data, ERROR);
 		}
 
-		extractPageInfo(xlogreader);
+		extractPageInfo(xlogreader, extract_arg->pagemaps, NULL);
 
-		/* continue reading at next record */
-		extract_arg->startpoint = InvalidXLogRecPtr;
+		/* Go back to the fast scan at the next record */
+		extract_arg->startpoint = xlogreader->EndRecPtr;
 
 		XLByteToSeg(xlogreader->EndRecPtr, nextSegNo);
 	} while (nextSegNo <= extract_arg->endSegNo &&
 			 xlogreader->ReadRecPtr < extract_arg->endpoint);
 
-	CleanupXLogPageRead(xlogreader);
-	XLogReaderFree(xlogreader);
+	FreeXLogPageRead(xlogreader);
 
 	/* Extracting is successful */
 	extract_arg->ret = 0;
 	return NULL;
 }
 
+static uint32
+pagemap_index_hash(RelFileNode rnode, BlockNumber segno)
+{
+	uint32		h = rnode.relNode;
+
+	h = h * 0x9E3779B1 + rnode.dbNode;
+	h = h * 0x9E3779B1 + rnode.spcNode;
+	h = h * 0x9E3779B1 + segno;
+	h ^= h >> 16;
+	h *= 0x85EBCA6B;
+	h ^= h >> 13;
+
+	return h;
+}
+
+/*
+ * Build the hash index over data files of the list.
+ */
+static void
+pagemap_index_build(parray *files)
+{
+	uint32		size = 1024;
+	uint32		i;
+
+	while (size < parray_num(files) * 2)
+		size <<= 1;
+
+	pagemap_index = pgut_newarray(PagemapIndexEntry, size);
+	pagemap_index_mask = size - 1;
+	for (i = 0; i < size; i++)
+		pagemap_index[i].slot = -1;
+
+	pagemap_files = pgut_newarray(pgFile *, parray_num(files));
+	pagemap_nfiles = 0;
+
+	for (i = 0; i < parray_num(files); i++)
+	{
+		pgFile	   *file = (pgFile *) parray_get(files, i);
+		RelFileNode rnode;
+		uint32		pos;
+
+		if (!file->is_datafile)
+			continue;
+
+		rnode.spcNode = file->tblspcOid;
+		rnode.dbNode = file->dbOid;
+		rnode.relNode = file->relOid;
+
+		pos = pagemap_index_hash(rnode, file->segno) & pagemap_index_mask;
+		while (pagemap_index[pos].slot != -1)
+			pos = (pos + 1) & pagemap_index_mask;
+
+		pagemap_index[pos].rnode = rnode;
+		pagemap_index[pos].segno = file->segno;
+		pagemap_index[pos].slot = pagemap_nfiles;
+		pagemap_files[pagemap_nfiles++] = file;
+	}
+}
+
+static void
+pagemap_index_free(void)
+{
+	free(pagemap_index);
+	free(pagemap_files);
+	pagemap_index = NULL;
+	pagemap_files = NULL;
+	pagemap_index_mask = 0;
+	pagemap_nfiles = 0;
+}
+
+/*
+ * Returns slot of the file of the segment 'segno' of relation 'rnode', or -1
+ * if there is no such data file.
+ */
+static int
+pagemap_index_lookup(RelFileNode rnode, BlockNumber segno)
+{
+	uint32		pos = pagemap_index_hash(rnode, segno) & pagemap_index_mask;
+
+	while (pagemap_index[pos].slot != -1)
+	{
+		PagemapIndexEntry *entry = &pagemap_index[pos];
+
+		if (entry->segno == segno && RelFileNodeEquals(entry->rnode, rnode))
+			return entry->slot;
+		pos = (pos + 1) & pagemap_index_mask;
+	}
+
+	return -1;
+}
+
+/*
+ * Add pages of 'src' pagemap into 'dst' and free 'src'.
+ */
+static void
+pagemap_merge(datapagemap_t *dst, datapagemap_t *src)
+{
+	int			i;
+
+	if (src->bitmapsize == 0)
+		return;
+
+	if (dst->bitmapsize == 0)
+	{
+		pg_free(dst->bitmap);
+		*dst = *src;
+		src->bitmap = NULL;
+		src->bitmapsize = 0;
+		return;
+	}
+
+	if (dst->bitmapsize < src->bitmapsize)
+	{
+		dst->bitmap = pg_realloc(dst->bitmap, src->bitmapsize);
+		memset(dst->bitmap + dst->bitmapsize, 0,
+			   src->bitmapsize - dst->bitmapsize);
+		dst->bitmapsize = src->bitmapsize;
+	}
+
+	for (i = 0; i < src->bitmapsize; i++)
+		dst->bitmap[i] |= src->bitmap[i];
+
+	pg_free(src->bitmap);
+	src->bitmap = NULL;
+	src->bitmapsize = 0;
+}
+
+static void
+wal_summary_path(char *path, const char *archivedir, TimeLineID tli,
+				 XLogSegNo segno)
+{
+	char		xlogfname[MAXFNAMELEN];
+
+	XLogFileName(xlogfname, tli, segno);
+	snprintf(path, MAXPGPATH, "%s/%s%s", archivedir, xlogfname,
+			 WAL_SUMMARY_SUFFIX);
+}
+
+/*
+ * Returns the first segment starting from 'segno' which wasn't taken from a
+ * summary.
+ */
+static XLogSegNo
+next_unsummarized_segno(XLogSegNo segno)
+{
+	while (segno >= summary_start_segno && segno <= summary_end_segno &&
+		   segno_summarized[segno - summary_start_segno])
+		segno++;
+
+	return segno;
+}
+
+/*
+ * Add blocks of the WAL summary file 'path' to pagemaps of the files.
+ * Returns false if there is no valid summary.
+ */
+static bool
+apply_wal_summary(const char *path)
+{
+	FILE	   *in;
+	struct stat st;
+	char	   *buf;
+	char	   *ptr;
+	char	   *end;
+	WalSummaryHeader *header;
+	pg_crc32c	crc;
+	uint32		i;
+
+	in = fopen(path, PG_BINARY_R);
+	if (in == NULL)
+		return false;
+
+	if (fstat(fileno(in), &st) != 0 ||
+		st.st_size < sizeof(WalSummaryHeader) + sizeof(pg_crc32c))
+	{
+		fclose(in);
+		elog(WARNING, "Invalid WAL summary file \"%s\"", path);
+		return false;
+	}
+
+	buf = pgut_malloc(st.st_size);
+	if (fread(buf, 1, st.st_size, in) != st.st_size)
+	{
+		elog(WARNING, "Cannot read WAL summary file \"%s\": %s",
+			 path, strerror(errno));
+		fclose(in);
+		free(buf);
+		return false;
+	}
+	fclose(in);
+
+	end = buf + st.st_size - sizeof(pg_crc32c);
+	INIT_CRC32C(crc);
+	COMP_CRC32C(crc, buf, end - buf);
+	FIN_CRC32C(crc);
+
+	header = (WalSummaryHeader *) buf;
+	if (header->magic != WAL_SUMMARY_MAGIC ||
+		memcmp(&crc, end, sizeof(pg_crc32c)) != 0)
+	{
+		elog(WARNING, "Invalid WAL summary file \"%s\"", path);
+		free(buf);
+		return false;
+	}
+
+	/* Check the whole file before changing pagemaps */
+	ptr = buf + sizeof(WalSummaryHeader);
+	for (i = 0; i < header->nrels; i++)
+	{
+		WalSummaryRel *rel = (WalSummaryRel *) ptr;
+
+		if (ptr + sizeof(WalSummaryRel) > end ||
+			ptr + sizeof(WalSummaryRel) + sizeof(BlockNumber) * rel->nblocks > end)
+		{
+			elog(WARNING, "Invalid WAL summary file \"%s\"", path);
+			free(buf);
+			return false;
+		}
+		ptr += sizeof(WalSummaryRel) + sizeof(BlockNumber) * rel->nblocks;
+	}
+
+	ptr = buf + sizeof(WalSummaryHeader);
+	for (i = 0; i < header->nrels; i++)
+	{
+		WalSummaryRel *rel = (WalSummaryRel *) ptr;
+		BlockNumber *blocks = (BlockNumber *) (ptr + sizeof(WalSummaryRel));
+		uint32		j;
+
+		for (j = 0; j < rel->nblocks; j++)
+		{
+			int			slot = pagemap_index_lookup(rel->rnode,
+													blocks[j] / RELSEG_SIZE);
+
+			if (slot >= 0)
+				datapagemap_add(&pagemap_files[slot]->pagemap,
+								blocks[j] % RELSEG_SIZE);
+		}
+		ptr += sizeof(WalSummaryRel) + sizeof(BlockNumber) * rel->nblocks;
+	}
+
+	free(buf);
+	return true;
+}
+
 /*
  * Read WAL from the archive directory, from 'startpoint' to 'endpoint' on the
  * given timeline. Collect data blocks touched by the WAL records into a page map.
  *
  * Pagemap extracting is processed using threads. Eeach thread reads single WAL
- * file.
+ * file and collects pages into its own pagemaps. Segments which have WAL
+ * summaries are not read at all.
  */
 void
 extractPageMap(const char *archivedir, XLogRecPtr startpoint, TimeLineID tli,
 			   XLogRecPtr endpoint, parray *files)
 {
-	int			i;
+	int			i,
+				j;
 	int			threads_need = 0;
+	XLogSegNo	startSegNo;
 	XLogSegNo	endSegNo;
+	XLogSegNo	segno;
+	int			n_summarized = 0;
 	bool		extract_isok = true;
 	pthread_t  *threads;
 	xlog_thread_arg *thread_args;
@@ -356,11 +737,32 @@ extractPageMap(const char *archivedir, XLogRecPtr startpoint, TimeLineID tli,
 		elog(ERROR, "Invalid endpoint value %X/%X",
 			 (uint32) (endpoint >> 32), (uint32) (endpoint));
 
+	XLByteToSeg(startpoint, startSegNo);
 	XLByteToSeg(endpoint, endSegNo);
 
-	nextSegNoToRead = 0;
 	time(&start_time);
 
+	pagemap_index_build(files);
+
+	/* Take blocks of the segments which have summaries from the summaries */
+	summary_start_segno = startSegNo;
+	summary_end_segno = endSegNo;
+	segno_summarized = pgut_newarray(bool, endSegNo - startSegNo + 1);
+	for (segno = startSegNo; segno <= endSegNo; segno++)
+	{
+		char		summary_path[MAXPGPATH];
+
+		wal_summary_path(summary_path, archivedir, tli, segno);
+		segno_summarized[segno - startSegNo] = apply_wal_summary(summary_path);
+		if (segno_summarized[segno - startSegNo])
+			n_summarized++;
+	}
+	if (n_summarized > 0)
+		elog(LOG, "Pagemap of %d WAL segments is taken from WAL summaries",
+			 n_summarized);
+
+	nextSegNoToRead = startSegNo;
+
 	threads = (pthread_t *) palloc(sizeof(pthread_t) * num_threads);
 	thread_args = (xlog_thread_arg *) palloc(sizeof(xlog_thread_arg)*num_threads);
 
@@ -372,29 +774,35 @@ extractPageMap(const char *archivedir, XLogRecPtr startpoint, TimeLineID tli,
 	 */
 	for (i = 0; i < num_threads; i++)
 	{
+		/*
+		 * If we need to read less WAL segments than num_threads, create less
+		 * threads.
+		 */
+		segno = next_unsummarized_segno(nextSegNoToRead);
+		if (segno > endSegNo)
+			break;
+
+		/* The first segment is read from 'startpoint' */
+		if (segno != startSegNo)
+			XLogSegNoOffsetToRecPtr(segno, 0, startpoint);
+		nextSegNoToRead = segno + 1;
+
 		InitXLogPageRead(&thread_args[i].private_data, archivedir, tli, false);
 		thread_args[i].private_data.thread_num = i + 1;
 
 		thread_args[i].startpoint = startpoint;
 		thread_args[i].endpoint = endpoint;
 		thread_args[i].endSegNo = endSegNo;
+		thread_args[i].pagemaps = pgut_newarray(datapagemap_t, pagemap_nfiles);
+		for (j = 0; j < pagemap_nfiles; j++)
+		{
+			thread_args[i].pagemaps[j].bitmap = NULL;
+			thread_args[i].pagemaps[j].bitmapsize = PageBitmapIsEmpty;
+		}
 		/* By default there is some error */
 		thread_args[i].ret = 1;
 
 		threads_need++;
-
-		/* Adjust startpoint to the next thread */
-		if (nextSegNoToRead == 0)
-			XLByteToSeg(startpoint, nextSegNoToRead);
-
-		nextSegNoToRead++;
-		/*
-		 * If we need to read less WAL segments than num_threads, create less
-		 * threads.
-		 */
-		if (nextSegNoToRead > endSegNo)
-			break;
-		XLogSegNoOffsetToRecPtr(nextSegNoToRead, 0, startpoint);
 	}
 
 	/* Run threads */
@@ -412,6 +820,18 @@ extractPageMap(const char *archivedir, XLogRecPtr startpoint, TimeLineID tli,
 			extract_isok = false;
 	}
 
+	/* Merge pagemaps collected by the threads */
+	for (i = 0; i < threads_need; i++)
+	{
+		for (j = 0; j < pagemap_nfiles; j++)
+			pagemap_merge(&pagemap_files[j]->pagemap,
+						  &thread_args[i].pagemaps[j]);
+		free(thread_args[i].pagemaps);
+	}
+	pagemap_index_free();
+	free(segno_summarized);
+	segno_summarized = NULL;
+
 	pfree(threads);
 	pfree(thread_args);
 
@@ -481,8 +901,7 @@ validate_backup_wal_from_start_to_stop(pgBackup *backup,
 	}
 
 	/* clean */
-	CleanupXLogPageRead(xlogreader);
-	XLogReaderFree(xlogreader);
+	FreeXLogPageRead(xlogreader);
 }
 
 /*
@@ -652,8 +1071,7 @@ validate_wal(pgBackup *backup,
 	}
 
 	/* clean */
-	CleanupXLogPageRead(xlogreader);
-	XLogReaderFree(xlogreader);
+	FreeXLogPageRead(xlogreader);
 }
 
 /*
@@ -722,8 +1140,7 @@ read_recovery_info(const char *archivedir, TimeLineID tli,
 	res = false;
 
 cleanup:
-	CleanupXLogPageRead(xlogreader);
-	XLogReaderFree(xlogreader);
+	FreeXLogPageRead(xlogreader);
 
 	return res;
 }
@@ -750,8 +1167,7 @@ wal_contains_lsn(const char *archivedir, XLogRecPtr target_lsn,
 	res = XLogReadRecord(xlogreader, target_lsn, &errormsg) != NULL;
 	/* Didn't find 'target_lsn' and there is no error, return false */
 
-	CleanupXLogPageRead(xlogreader);
-	XLogReaderFree(xlogreader);
+	FreeXLogPageRead(xlogreader);
 
 	return res;
 }
@@ -772,8 +1188,156 @@ get_gz_error(gzFile gzf)
 	else
 		return errmsg;
 }
+
+/*
+ * Decompress the whole WAL segment 'path' into memory.
+ * On failure returns false and 'errmsg' if it isn't NULL.
+ */
+static bool
+decompress_wal_segment(const char *path, char **buf, size_t *len,
+					   const char **errmsg)
+{
+	gzFile		gz_in;
+	int			read_len;
+
+	*buf = NULL;
+	*len = 0;
+
+	gz_in = gzopen(path, "rb");
+	if (gz_in == NULL)
+	{
+		if (errmsg)
+			*errmsg = strerror(errno);
+		return false;
+	}
+
+	*buf = pgut_malloc(XLogSegSize);
+	while (*len < XLogSegSize &&
+		   (read_len = gzread(gz_in, *buf + *len, XLogSegSize - *len)) > 0)
+		*len += read_len;
+
+	if (read_len < 0)
+	{
+		if (errmsg)
+			*errmsg = get_gz_error(gz_in);
+		gzclose(gz_in);
+		free(*buf);
+		*buf = NULL;
+		*len = 0;
+		return false;
+	}
+
+	gzclose(gz_in);
+	return true;
+}
+
+static void *
+prefetch_wal_segment(void *arg)
+{
+	XLogPageReadPrivate *private_data = (XLogPageReadPrivate *) arg;
+
+	private_data->prefetch_ok =
+		decompress_wal_segment(private_data->prefetch_path,
+							   &private_data->prefetch_buf,
+							   &private_data->prefetch_len, NULL);
+	return NULL;
+}
+
+/*
+ * Wait for the background decompression. If the prefetched segment is
+ * 'segno', make it the current segment and return true.
+ */
+static bool
+finish_wal_prefetch(XLogPageReadPrivate *private_data, XLogSegNo segno)
+{
+	bool		taken = false;
+
+	if (!private_data->prefetch_started)
+		return false;
+
+	pthread_join(private_data->prefetch_thread, NULL);
+	private_data->prefetch_started = false;
+
+	if (private_data->prefetch_ok && private_data->prefetch_segno == segno)
+	{
+		private_data->xlogbuf = private_data->prefetch_buf;
+		private_data->xlogbuf_len = private_data->prefetch_len;
+		private_data->xlogbuf_mapped = false;
+		taken = true;
+	}
+	else
+		pg_free(private_data->prefetch_buf);
+
+	private_data->prefetch_buf = NULL;
+	private_data->prefetch_len = 0;
+
+	return taken;
+}
+
+/*
+ * Start decompression of the segment which is likely to be read next:
+ * WAL is read either forward or backward, see read_recovery_info().
+ */
+static void
+start_wal_prefetch(XLogPageReadPrivate *private_data)
+{
+	XLogSegNo	segno = private_data->xlogsegno;
+	char		xlogfname[MAXFNAMELEN];
+
+	if (private_data->prev_xlogsegno_valid &&
+		private_data->prev_xlogsegno == segno + 1)
+	{
+		if (segno == 0)
+			return;
+		segno--;
+	}
+	else
+		segno++;
+
+	XLogFileName(xlogfname, private_data->tli, segno);
+	snprintf(private_data->prefetch_path, MAXPGPATH, "%s/%s.gz",
+			 private_data->archivedir, xlogfname);
+	if (!fileExists(private_data->prefetch_path))
+		return;
+
+	private_data->prefetch_segno = segno;
+	private_data->prefetch_buf = NULL;
+	private_data->prefetch_len = 0;
+	private_data->prefetch_ok = false;
+	if (pthread_create(&private_data->prefetch_thread, NULL,
+					   prefetch_wal_segment, private_data) == 0)
+		private_data->prefetch_started = true;
+}
 #endif
 
+/*
+ * Map the whole uncompressed segment into memory. If it isn't possible,
+ * pages are read from the file.
+ */
+static void
+map_wal_segment(XLogPageReadPrivate *private_data)
+{
+	struct stat st;
+	void	   *addr;
+
+	if (fstat(private_data->xlogfile, &st) != 0 || st.st_size == 0)
+		return;
+
+	addr = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED,
+				private_data->xlogfile, 0);
+	if (addr == MAP_FAILED)
+		return;
+
+#ifdef MADV_WILLNEED
+	/* The segment will be read entirely, read it ahead */
+	madvise(addr, st.st_size, MADV_WILLNEED);
+#endif
+
+	private_data->xlogbuf = (char *) addr;
+	private_data->xlogbuf_len = st.st_size;
+	private_data->xlogbuf_mapped = true;
+}
+
 /* XLogreader callback function, to read a WAL page */
 static int
 SimpleXLogPageRead(XLogReaderState *xlogreader, XLogRecPtr targetPagePtr,
@@ -845,6 +1409,7 @@ SimpleXLogPageRead(XLogReaderState *xlogreader, XLogRecPtr targetPagePtr,
 				private_data->xlogpath);
 
 			private_data->xlogexists = true;
+			private_data->xlog_compressed = false;
 			private_data->xlogfile = open(private_data->xlogpath,
 										  O_RDONLY | PG_BINARY, 0);
 
@@ -856,6 +1421,8 @@ SimpleXLogPageRead(XLogReaderState *xlogreader, XLogRecPtr targetPagePtr,
 					strerror(errno));
 				return -1;
 			}
+
+			map_wal_segment(private_data);
 		}
 #ifdef HAVE_LIBZ
 		/* Try to open compressed WAL segment */
@@ -864,27 +1431,55 @@ SimpleXLogPageRead(XLogReaderState *xlogreader, XLogRecPtr targetPagePtr,
 			snprintf(private_data->gz_xlogpath,
 					 sizeof(private_data->gz_xlogpath), "%s.gz",
 					 private_data->xlogpath);
-			if (fileExists(private_data->gz_xlogpath))
+
+			/*
+			 * Compressed segment is decompressed into memory at once, so
+			 * reading of pages in any order doesn't restart decompression.
+			 */
+			if (finish_wal_prefetch(private_data, private_data->xlogsegno))
+			{
+				elog(LOG, "Thread [%d]: Opening prefetched compressed WAL segment \"%s\"",
+					 private_data->thread_num, private_data->gz_xlogpath);
+
+				private_data->xlogexists = true;
+				private_data->xlog_compressed = true;
+			}
+			else if (fileExists(private_data->gz_xlogpath))
 			{
+				const char *errmsg = NULL;
+
 				elog(LOG, "Thread [%d]: Opening compressed WAL segment \"%s\"",
 					 private_data->thread_num, private_data->gz_xlogpath);
 
 				private_data->xlogexists = true;
-				private_data->gz_xlogfile = gzopen(private_data->gz_xlogpath,
-												   "rb");
-				if (private_data->gz_xlogfile == NULL)
+				private_data->xlog_compressed = true;
+				if (!decompress_wal_segment(private_data->gz_xlogpath,
+											&private_data->xlogbuf,
+											&private_data->xlogbuf_len,
+											&errmsg))
 				{
-					elog(WARNING, "Thread [%d]: Could not open compressed WAL segment \"%s\": %s",
-						 private_data->thread_num, private_data->gz_xlogpath, strerror(errno));
+					elog(WARNING, "Thread [%d]: Could not read compressed WAL segment \"%s\": %s",
+						 private_data->thread_num, private_data->gz_xlogpath,
+						 errmsg);
 					return -1;
 				}
 			}
+
+			/*
+			 * WAL reader threads of extractPageMap() choose segments
+			 * themselves, otherwise segments are read one after another.
+			 */
+			if (private_data->xlogexists && !private_data->manual_switch)
+				start_wal_prefetch(private_data);
 		}
 #endif
 
 		/* Exit without error if WAL segment doesn't exist */
 		if (!private_data->xlogexists)
 			return -1;
+
+		private_data->prev_xlogsegno = private_data->xlogsegno;
+		private_data->prev_xlogsegno_valid = true;
 	}
 
 	/*
@@ -893,44 +1488,35 @@ SimpleXLogPageRead(XLogReaderState *xlogreader, XLogRecPtr targetPagePtr,
 	Assert(private_data->xlogexists);
 
 	/* Read the requested page */
-	if (private_data->xlogfile != -1)
+	if (private_data->xlogbuf != NULL)
 	{
-		if (lseek(private_data->xlogfile, (off_t) targetPageOff, SEEK_SET) < 0)
+		if (targetPageOff + XLOG_BLCKSZ > private_data->xlogbuf_len)
 		{
-			elog(WARNING, "Thread [%d]: Could not seek in WAL segment \"%s\": %s",
-				private_data->thread_num, private_data->xlogpath, strerror(errno));
+			elog(WARNING, "Thread [%d]: Could not read from WAL segment \"%s\": unexpected end of file",
+				 private_data->thread_num,
+				 private_data->xlog_compressed ?
+					private_data->gz_xlogpath : private_data->xlogpath);
 			return -1;
 		}
 
-		if (read(private_data->xlogfile, readBuf, XLOG_BLCKSZ) != XLOG_BLCKSZ)
-		{
-			elog(WARNING, "Thread [%d]: Could not read from WAL segment \"%s\": %s",
-				private_data->thread_num, private_data->xlogpath, strerror(errno));
-			return -1;
-		}
+		memcpy(readBuf, private_data->xlogbuf + targetPageOff, XLOG_BLCKSZ);
 	}
-#ifdef HAVE_LIBZ
 	else
 	{
-		if (gzseek(private_data->gz_xlogfile, (z_off_t) targetPageOff, SEEK_SET) == -1)
+		if (lseek(private_data->xlogfile, (off_t) targetPageOff, SEEK_SET) < 0)
 		{
-			elog(WARNING, "Thread [%d]: Could not seek in compressed WAL segment \"%s\": %s",
-				 private_data->thread_num,
-				 private_data->gz_xlogpath,
-				 get_gz_error(private_data->gz_xlogfile));
+			elog(WARNING, "Thread [%d]: Could not seek in WAL segment \"%s\": %s",
+				private_data->thread_num, private_data->xlogpath, strerror(errno));
 			return -1;
 		}
 
-		if (gzread(private_data->gz_xlogfile, readBuf, XLOG_BLCKSZ) != XLOG_BLCKSZ)
+		if (read(private_data->xlogfile, readBuf, XLOG_BLCKSZ) != XLOG_BLCKSZ)
 		{
-			elog(WARNING, "Thread [%d]: Could not read from compressed WAL segment \"%s\": %s",
-				 private_data->thread_num,
-				 private_data->gz_xlogpath,
-				 get_gz_error(private_data->gz_xlogfile));
+			elog(WARNING, "Thread [%d]: Could not read from WAL segment \"%s\": %s",
+				private_data->thread_num, private_data->xlogpath, strerror(errno));
 			return -1;
 		}
 	}
-#endif
 
 	*pageTLI = private_data->tli;
 	return XLOG_BLCKSZ;
@@ -970,19 +1556,45 @@ CleanupXLogPageRead(XLogReaderState *xlogreader)
 	XLogPageReadPrivate *private_data;
 
 	private_data = (XLogPageReadPrivate *) xlogreader->private_data;
+	if (private_data->xlogbuf != NULL)
+	{
+		if (private_data->xlogbuf_mapped)
+			munmap(private_data->xlogbuf, private_data->xlogbuf_len);
+		else
+			free(private_data->xlogbuf);
+		private_data->xlogbuf = NULL;
+		private_data->xlogbuf_len = 0;
+		private_data->xlogbuf_mapped = false;
+	}
 	if (private_data->xlogfile >= 0)
 	{
 		close(private_data->xlogfile);
 		private_data->xlogfile = -1;
 	}
+	private_data->xlogexists = false;
+}
+
+/*
+ * Cleanup after WAL reading is finished and free the reader.
+ */
+static void
+FreeXLogPageRead(XLogReaderState *xlogreader)
+{
 #ifdef HAVE_LIBZ
-	else if (private_data->gz_xlogfile != NULL)
+	XLogPageReadPrivate *private_data;
+
+	private_data = (XLogPageReadPrivate *) xlogreader->private_data;
+	if (private_data->prefetch_started)
 	{
-		gzclose(private_data->gz_xlogfile);
-		private_data->gz_xlogfile = NULL;
+		pthread_join(private_data->prefetch_thread, NULL);
+		pg_free(private_data->prefetch_buf);
+		private_data->prefetch_buf = NULL;
+		private_data->prefetch_started = false;
 	}
 #endif
-	private_data->xlogexists = false;
+
+	CleanupXLogPageRead(xlogreader);
+	XLogReaderFree(xlogreader);
 }
 
 static void
@@ -998,13 +1610,13 @@ PrintXLogCorruptionMsg(XLogPageReadPrivate *private_data, int elevel)
 			elog(elevel, "Thread [%d]: WAL segment \"%s\" is absent",
 				private_data->thread_num,
 				private_data->xlogpath);
-		else if (private_data->xlogfile != -1)
+		else if (!private_data->xlog_compressed)
 			elog(elevel, "Thread [%d]: Possible WAL corruption. "
 						 "Error has occured during reading WAL segment \"%s\"",
 				 private_data->thread_num,
 				 private_data->xlogpath);
 #ifdef HAVE_LIBZ
-		else if (private_data->gz_xlogfile != NULL)
+		else
 			elog(elevel, "Thread [%d]: Possible WAL corruption. "
 						 "Error has occured during reading WAL segment \"%s\"",
 				 private_data->thread_num,
@@ -1014,24 +1626,18 @@ PrintXLogCorruptionMsg(XLogPageReadPrivate *private_data, int elevel)
 }
 
 /*
- * Extract information about blocks modified in this record.
+ * Is this a special record type that I recognize?
  */
-static void
-extractPageInfo(XLogReaderState *record)
+static bool
+special_rel_update_is_known(RmgrId rmid, uint8 rminfo)
 {
-	uint8		block_id;
-	RmgrId		rmid = XLogRecGetRmid(record);
-	uint8		info = XLogRecGetInfo(record);
-	uint8		rminfo = info & ~XLR_INFO_MASK;
-
-	/* Is this a special record type that I recognize? */
-
 	if (rmid == RM_DBASE_ID && rminfo == XLOG_DBASE_CREATE)
 	{
 		/*
 		 * New databases can be safely ignored. They would be completely
 		 * copied if found.
 		 */
+		return true;
 	}
 	else if (rmid == RM_DBASE_ID && rminfo == XLOG_DBASE_DROP)
 	{
@@ -1039,6 +1645,7 @@ extractPageInfo(XLogReaderState *record)
 		 * An existing database was dropped. It is fine to ignore that
 		 * they will be removed appropriately.
 		 */
+		return true;
 	}
 	else if (rmid == RM_SMGR_ID && rminfo == XLOG_SMGR_CREATE)
 	{
@@ -1046,6 +1653,7 @@ extractPageInfo(XLogReaderState *record)
 		 * We can safely ignore these. The file will be removed when
 		 * combining the backups in the case of differential on.
 		 */
+		return true;
 	}
 	else if (rmid == RM_SMGR_ID && rminfo == XLOG_SMGR_TRUNCATE)
 	{
@@ -1054,14 +1662,40 @@ extractPageInfo(XLogReaderState *record)
 		 * we'll notice that they differ, and copy the missing tail from
 		 * source system.
 		 */
+		return true;
 	}
-	else if (info & XLR_SPECIAL_REL_UPDATE)
+
+	return false;
+}
+
+/*
+ * Extract information about blocks modified in this record.
+ *
+ * Blocks are added either to 'pagemaps' of the data files or to the WAL
+ * summary being built. Returns false if the record modifies a relation in a
+ * way we can't track and we are building a summary, otherwise throws an
+ * error in that case.
+ */
+static bool
+extractPageInfo(XLogReaderState *record, datapagemap_t *pagemaps,
+				WalSummaryBuilder *summary)
+{
+	uint8		block_id;
+	RmgrId		rmid = XLogRecGetRmid(record);
+	uint8		info = XLogRecGetInfo(record);
+	uint8		rminfo = info & ~XLR_INFO_MASK;
+
+	if ((info & XLR_SPECIAL_REL_UPDATE) &&
+		!special_rel_update_is_known(rmid, rminfo))
 	{
 		/*
 		 * This record type modifies a relation file in some special way, but
 		 * we don't recognize the type. That's bad - we don't know how to
 		 * track that change.
 		 */
+		if (summary)
+			return false;
+
 		elog(ERROR, "WAL record modifies a relation, but record type is not recognized\n"
 			 "lsn: %X/%X, rmgr: %s, info: %02X",
 		  (uint32) (record->ReadRecPtr >> 32), (uint32) (record->ReadRecPtr),
@@ -1073,6 +1707,7 @@ extractPageInfo(XLogReaderState *record)
 		RelFileNode rnode;
 		ForkNumber	forknum;
 		BlockNumber blkno;
+		int			slot;
 
 		if (!XLogRecGetBlockTag(record, block_id, &rnode, &forknum, &blkno))
 			continue;
@@ -1081,8 +1716,483 @@ extractPageInfo(XLogReaderState *record)
 		if (forknum != MAIN_FORKNUM)
 			continue;
 
-		process_block_change(forknum, rnode, blkno);
+		/*
+		 * If we don't have any record of this file in the file map, it means
+		 * that it's a relation that did not have much activity since the last
+		 * backup. We can safely ignore it. If it is a new relation file, the
+		 * backup would simply copy it as-is.
+		 */
+		if (summary)
+		{
+			if (summary->n == summary->size)
+			{
+				summary->size = Max(summary->size * 2, 1024);
+				summary->blocks = (WalSummaryBlock *)
+					pg_realloc(summary->blocks,
+							   sizeof(WalSummaryBlock) * summary->size);
+			}
+			summary->blocks[summary->n].rnode = rnode;
+			summary->blocks[summary->n].blkno = blkno;
+			summary->n++;
+			continue;
+		}
+
+		slot = pagemap_index_lookup(rnode, blkno / RELSEG_SIZE);
+		if (slot >= 0)
+			datapagemap_add(&pagemaps[slot], blkno % RELSEG_SIZE);
+	}
+
+	return true;
+}
+
+/*
+ * Cursor over the logical stream of WAL record bytes of the segment in
+ * memory, page headers are skipped transparently.
+ */
+typedef struct WalScanCursor
+{
+	const char *buf;			/* the whole segment */
+	size_t		len;
+	XLogRecPtr	segstart;		/* LSN of the segment start */
+	uint32		off;			/* current offset in the segment */
+	bool		in_record;		/* next page should continue a record */
+} WalScanCursor;
+
+/*
+ * Read 'n' bytes of the stream into 'dst', or skip them if 'dst' is NULL.
+ * Returns false if the bytes are beyond the segment or a page header is
+ * not what we expect.
+ */
+static bool
+wal_scan_read(WalScanCursor *cursor, void *dst, uint32 n)
+{
+	while (n > 0)
+	{
+		uint32		chunk;
+
+		if (cursor->off % XLOG_BLCKSZ == 0)
+		{
+			XLogPageHeader page;
+
+			if (cursor->off + XLOG_BLCKSZ > cursor->len)
+				return false;
+
+			page = (XLogPageHeader) (cursor->buf + cursor->off);
+			if (page->xlp_magic != XLOG_PAGE_MAGIC ||
+				page->xlp_pageaddr != cursor->segstart + cursor->off ||
+				((page->xlp_info & XLP_FIRST_IS_CONTRECORD) != 0) !=
+					cursor->in_record)
+				return false;
+
+			cursor->off += XLogPageHeaderSize(page);
+		}
+
+		chunk = Min(n, XLOG_BLCKSZ - cursor->off % XLOG_BLCKSZ);
+		if (dst)
+		{
+			memcpy(dst, cursor->buf + cursor->off, chunk);
+			dst = (char *) dst + chunk;
+		}
+		cursor->off += chunk;
+		n -= chunk;
+	}
+
+	return true;
+}
+
+/*
+ * Scan WAL records of the current segment starting from 'startpoint' and
+ * add main fork blocks they reference to 'pagemaps'.
+ *
+ * Only record headers and block reference headers are parsed, data and
+ * full-page images are jumped over and record CRCs are not computed. The
+ * scan stops at the first record which is not entirely in the segment,
+ * starts at or after 'endpoint', or looks unusual in any way. Returns LSN
+ * of that record, it should be read by XLogReadRecord(), which checks it
+ * thoroughly and reports errors. The start of the next segment is returned
+ * if all records of the segment were scanned.
+ */
+static XLogRecPtr
+scanBlockReferences(XLogReaderState *xlogreader, XLogRecPtr startpoint,
+					XLogRecPtr endpoint, datapagemap_t *pagemaps)
+{
+	XLogPageReadPrivate *private_data;
+	WalScanCursor cursor;
+	XLogRecPtr	prev = InvalidXLogRecPtr;
+	XLogRecPtr	recptr = startpoint;
+
+	private_data = (XLogPageReadPrivate *) xlogreader->private_data;
+
+	/* The scanner works with the segment loaded into memory */
+	if (!private_data->xlogexists || private_data->xlogbuf == NULL ||
+		!XLByteInSeg(startpoint, private_data->xlogsegno))
+		return startpoint;
+
+	cursor.buf = private_data->xlogbuf;
+	cursor.len = Min(private_data->xlogbuf_len, XLogSegSize);
+	cursor.segstart = startpoint - startpoint % XLogSegSize;
+	cursor.off = startpoint % XLogSegSize;
+
+	while (recptr < endpoint)
+	{
+		XLogRecord	header;
+		RelFileNode rnodes[XLR_MAX_BLOCK_ID + 1];
+		BlockNumber blknos[XLR_MAX_BLOCK_ID + 1];
+		int			nblocks = 0;
+		RelFileNode rnode;
+		bool		have_rnode = false;
+		uint32		remaining;
+		uint32		datatotal = 0;
+		uint8		rminfo;
+		int			i;
+
+		if (interrupted)
+			elog(ERROR, "Thread [%d]: Interrupted during WAL reading",
+				private_data->thread_num);
+
+		/* The next record is in the next segment */
+		if (cursor.off == XLogSegSize)
+			return cursor.segstart + XLogSegSize;
+
+		/* A record at the page boundary starts after the page header */
+		if (cursor.off % XLOG_BLCKSZ == 0)
+		{
+			if (cursor.off + XLOG_BLCKSZ > cursor.len)
+				return recptr + SizeOfXLogShortPHD;
+			recptr += XLogPageHeaderSize((XLogPageHeader) (cursor.buf + cursor.off));
+		}
+
+		cursor.in_record = false;
+		if (!wal_scan_read(&cursor, &header, SizeOfXLogRecord))
+			return recptr;
+		cursor.in_record = true;
+
+		if (header.xl_tot_len < SizeOfXLogRecord ||
+			header.xl_rmid > RM_MAX_ID ||
+			(!XLogRecPtrIsInvalid(prev) && header.xl_prev != prev))
+			return recptr;
+
+		rminfo = header.xl_info & ~XLR_INFO_MASK;
+		/* Let XLogReadRecord() throw the error */
+		if ((header.xl_info & XLR_SPECIAL_REL_UPDATE) &&
+			!special_rel_update_is_known(header.xl_rmid, rminfo))
+			return recptr;
+
+		/* Parse block reference headers like DecodeXLogRecord() does */
+		remaining = header.xl_tot_len - SizeOfXLogRecord;
+		while (remaining > datatotal)
+		{
+			uint8		block_id;
+
+			if (!wal_scan_read(&cursor, &block_id, sizeof(uint8)))
+				return recptr;
+			remaining -= sizeof(uint8);
+
+			if (block_id == XLR_BLOCK_ID_DATA_SHORT)
+			{
+				uint8		main_data_len;
+
+				if (remaining < sizeof(uint8) ||
+					!wal_scan_read(&cursor, &main_data_len, sizeof(uint8)))
+					return recptr;
+				remaining -= sizeof(uint8);
+				datatotal += main_data_len;
+				break;
+			}
+			else if (block_id == XLR_BLOCK_ID_DATA_LONG)
+			{
+				uint32		main_data_len;
+
+				if (remaining < sizeof(uint32) ||
+					!wal_scan_read(&cursor, &main_data_len, sizeof(uint32)))
+					return recptr;
+				remaining -= sizeof(uint32);
+				datatotal += main_data_len;
+				break;
+			}
+			else if (block_id == XLR_BLOCK_ID_ORIGIN)
+			{
+				if (remaining < sizeof(RepOriginId) ||
+					!wal_scan_read(&cursor, NULL, sizeof(RepOriginId)))
+					return recptr;
+				remaining -= sizeof(RepOriginId);
+			}
+			else if (block_id <= XLR_MAX_BLOCK_ID)
+			{
+				uint8		fork_flags;
+				uint16		data_len;
+
+				if (remaining < sizeof(uint8) + sizeof(uint16) ||
+					!wal_scan_read(&cursor, &fork_flags, sizeof(uint8)) ||
+					!wal_scan_read(&cursor, &data_len, sizeof(uint16)))
+					return recptr;
+				remaining -= sizeof(uint8) + sizeof(uint16);
+				datatotal += data_len;
+
+				if (fork_flags & BKPBLOCK_HAS_IMAGE)
+				{
+					uint16		bimg_len;
+					uint8		bimg_info;
+
+					if (remaining < SizeOfXLogRecordBlockImageHeader ||
+						!wal_scan_read(&cursor, &bimg_len, sizeof(uint16)) ||
+						!wal_scan_read(&cursor, NULL, sizeof(uint16)) ||
+						!wal_scan_read(&cursor, &bimg_info, sizeof(uint8)))
+						return recptr;
+					remaining -= SizeOfXLogRecordBlockImageHeader;
+					datatotal += bimg_len;
+
+					if ((bimg_info & BKPIMAGE_HAS_HOLE) &&
+						(bimg_info & BKPIMAGE_IS_COMPRESSED))
+					{
+						if (remaining < SizeOfXLogRecordBlockCompressHeader ||
+							!wal_scan_read(&cursor, NULL,
+										   SizeOfXLogRecordBlockCompressHeader))
+							return recptr;
+						remaining -= SizeOfXLogRecordBlockCompressHeader;
+					}
+				}
+
+				if (!(fork_flags & BKPBLOCK_SAME_REL))
+				{
+					if (remaining < sizeof(RelFileNode) ||
+						!wal_scan_read(&cursor, &rnode, sizeof(RelFileNode)))
+						return recptr;
+					remaining -= sizeof(RelFileNode);
+					have_rnode = true;
+				}
+				else if (!have_rnode)
+					return recptr;
+				rnodes[nblocks] = rnode;
+
+				if (remaining < sizeof(BlockNumber) ||
+					!wal_scan_read(&cursor, &blknos[nblocks],
+								   sizeof(BlockNumber)))
+					return recptr;
+				remaining -= sizeof(BlockNumber);
+
+				/* We only care about the main fork; others are copied in toto */
+				if ((fork_flags & BKPBLOCK_FORK_MASK) == MAIN_FORKNUM)
+					nblocks++;
+			}
+			else
+				return recptr;
+		}
+
+		/* Jump over data and images */
+		if (remaining != datatotal ||
+			!wal_scan_read(&cursor, NULL, datatotal))
+			return recptr;
+
+		for (i = 0; i < nblocks; i++)
+		{
+			int			slot = pagemap_index_lookup(rnodes[i],
+													blknos[i] / RELSEG_SIZE);
+
+			if (slot >= 0)
+				datapagemap_add(&pagemaps[slot], blknos[i] % RELSEG_SIZE);
+		}
+
+		/* The rest of the segment after XLOG_SWITCH is empty */
+		if (header.xl_rmid == RM_XLOG_ID && rminfo == XLOG_SWITCH)
+			return cursor.segstart + XLogSegSize;
+
+		prev = recptr;
+		cursor.off = MAXALIGN(cursor.off);
+		recptr = cursor.segstart + cursor.off;
+	}
+
+	return recptr;
+}
+
+static int
+wal_summary_block_compare(const void *a, const void *b)
+{
+	const WalSummaryBlock *block1 = (const WalSummaryBlock *) a;
+	const WalSummaryBlock *block2 = (const WalSummaryBlock *) b;
+
+	if (block1->rnode.spcNode != block2->rnode.spcNode)
+		return block1->rnode.spcNode > block2->rnode.spcNode ? 1 : -1;
+	if (block1->rnode.dbNode != block2->rnode.dbNode)
+		return block1->rnode.dbNode > block2->rnode.dbNode ? 1 : -1;
+	if (block1->rnode.relNode != block2->rnode.relNode)
+		return block1->rnode.relNode > block2->rnode.relNode ? 1 : -1;
+	if (block1->blkno != block2->blkno)
+		return block1->blkno > block2->blkno ? 1 : -1;
+	return 0;
+}
+
+/*
+ * Write blocks of the summary into the WAL summary file 'path'.
+ */
+static bool
+write_wal_summary(const char *path, WalSummaryBuilder *summary)
+{
+	char		path_temp[MAXPGPATH];
+	FILE	   *out;
+	WalSummaryHeader header;
+	pg_crc32c	crc;
+	size_t		i,
+				j;
+	bool		ok = true;
+
+	if (summary->n > 0)
+		qsort(summary->blocks, summary->n, sizeof(WalSummaryBlock),
+			  wal_summary_block_compare);
+
+	snprintf(path_temp, sizeof(path_temp), "%s.partial", path);
+	out = fopen(path_temp, PG_BINARY_W);
+	if (out == NULL)
+	{
+		elog(WARNING, "Cannot open WAL summary file \"%s\": %s",
+			 path_temp, strerror(errno));
+		return false;
+	}
+
+	header.magic = WAL_SUMMARY_MAGIC;
+	header.nrels = 0;
+	for (i = 0; i < summary->n; i++)
+		if (i == 0 ||
+			!RelFileNodeEquals(summary->blocks[i].rnode,
+							   summary->blocks[i - 1].rnode))
+			header.nrels++;
+
+	INIT_CRC32C(crc);
+	COMP_CRC32C(crc, &header, sizeof(header));
+	ok = fwrite(&header, 1, sizeof(header), out) == sizeof(header);
+
+	for (i = 0; ok && i < summary->n; i = j)
+	{
+		WalSummaryRel rel;
+		BlockNumber prev_blkno = InvalidBlockNumber;
+
+		/* Count distinct blocks of the relation */
+		rel.rnode = summary->blocks[i].rnode;
+		rel.nblocks = 0;
+		for (j = i; j < summary->n &&
+			 RelFileNodeEquals(summary->blocks[j].rnode, rel.rnode); j++)
+		{
+			if (summary->blocks[j].blkno != prev_blkno)
+				rel.nblocks++;
+			prev_blkno = summary->blocks[j].blkno;
+		}
+
+		COMP_CRC32C(crc, &rel, sizeof(rel));
+		ok = fwrite(&rel, 1, sizeof(rel), out) == sizeof(rel);
+
+		prev_blkno = InvalidBlockNumber;
+		for (j = i; ok && j < summary->n &&
+			 RelFileNodeEquals(summary->blocks[j].rnode, rel.rnode); j++)
+		{
+			BlockNumber blkno = summary->blocks[j].blkno;
+
+			if (blkno == prev_blkno)
+				continue;
+			prev_blkno = blkno;
+
+			COMP_CRC32C(crc, &blkno, sizeof(blkno));
+			ok = fwrite(&blkno, 1, sizeof(blkno), out) == sizeof(blkno);
+		}
+	}
+	FIN_CRC32C(crc);
+
+	if (ok)
+		ok = fwrite(&crc, 1, sizeof(crc), out) == sizeof(crc);
+
+	if (!ok || fflush(out) != 0 || fsync(fileno(out)) != 0)
+	{
+		elog(WARNING, "Cannot write WAL summary file \"%s\": %s",
+			 path_temp, strerror(errno));
+		fclose(out);
+		unlink(path_temp);
+		return false;
+	}
+
+	if (fclose(out) != 0 || rename(path_temp, path) < 0)
+	{
+		elog(WARNING, "Cannot write WAL summary file \"%s\": %s",
+			 path, strerror(errno));
+		unlink(path_temp);
+		return false;
+	}
+
+	return true;
+}
+
+/*
+ * Build the summary of WAL segment 'segno' in the archive 'archivedir'.
+ *
+ * The last record of the segment may continue in the next segment, so the
+ * next segment should be in the archive already. Failure to build the
+ * summary is not an error, extractPageMap() reads segments without
+ * summaries.
+ */
+void
+summarize_wal_segment(const char *archivedir, TimeLineID tli, XLogSegNo segno)
+{
+	XLogReaderState *xlogreader;
+	XLogPageReadPrivate private;
+	XLogRecPtr	startpoint;
+	XLogRecPtr	found;
+	XLogSegNo	record_segno;
+	WalSummaryBuilder summary;
+	char		summary_path[MAXPGPATH];
+	char	   *errormsg;
+	bool		ok = true;
+
+	wal_summary_path(summary_path, archivedir, tli, segno);
+	if (fileExists(summary_path))
+		return;
+
+	summary.blocks = NULL;
+	summary.n = 0;
+	summary.size = 0;
+
+	xlogreader = InitXLogPageRead(&private, archivedir, tli, true);
+
+	/* Skip over the page header and contrecord if any */
+	XLogSegNoOffsetToRecPtr(segno, 0, startpoint);
+	found = XLogFindNextRecord(xlogreader, startpoint);
+	if (XLogRecPtrIsInvalid(found))
+		ok = false;
+	startpoint = found;
+
+	while (ok)
+	{
+		XLogRecord *record;
+
+		record = XLogReadRecord(xlogreader, startpoint, &errormsg);
+		if (record == NULL)
+		{
+			if (errormsg)
+				elog(WARNING, "%s", errormsg);
+			ok = false;
+			break;
+		}
+
+		/* Records starting in the next segment belong to its summary */
+		XLByteToSeg(xlogreader->ReadRecPtr, record_segno);
+		if (record_segno != segno)
+			break;
+
+		ok = extractPageInfo(xlogreader, NULL, &summary);
+		startpoint = InvalidXLogRecPtr;
+
+		/* The rest of the segment after XLOG_SWITCH is empty */
+		XLByteToSeg(xlogreader->EndRecPtr, record_segno);
+		if (record_segno != segno)
+			break;
 	}
+
+	FreeXLogPageRead(xlogreader);
+
+	if (ok && write_wal_summary(summary_path, &summary))
+		elog(LOG, "WAL summary is written to \"%s\"", summary_path);
+	else
+		elog(WARNING, "Cannot build WAL summary \"%s\", the segment will be "
+			 "parsed by PAGE backups", summary_path);
+
+	pg_free(summary.blocks);
 }
 
 /*
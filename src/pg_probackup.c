@@ -19,7 +19,11 @@
 #include <unistd.h>
 #include "pg_getopt.h"
 
-const char *PROGRAM_VERSION	= "2.0.19";
+#ifdef HAVE_LIBZSTD
+#include <zstd.h>
+#endif
+
+const char *PROGRAM_VERSION	= "2.0.20";
 const char *PROGRAM_URL		= "https://github.com/postgrespro/pg_probackup";
 const char *PROGRAM_EMAIL	= "https://github.com/postgrespro/pg_probackup/issues";
 
@@ -36,12 +40,21 @@ char		backup_instance_path[MAXPGPATH];
  * $BACKUP_PATH/wal/instance_name
  */
 char		arclog_path[MAXPGPATH] = "";
+/*
+ * Store of data pages shared by backups of the instance
+ * $BACKUP_PATH/pages/instance_name
+ */
+char		page_store_path[MAXPGPATH] = "";
 
 /* common options */
 static char *backup_id_string = NULL;
 int			num_threads = 1;
 bool		stream_wal = false;
 bool		progress = false;
+/* I/O throttling, 0 means no limit */
+uint32		max_read_rate = 0;		/* in kilobytes per second */
+uint32		max_iops = 0;
+uint32		max_read_latency = 0;	/* in milliseconds */
 #if PG_VERSION_NUM >= 100000
 char	   *replication_slot = NULL;
 #endif
@@ -49,6 +62,9 @@ char	   *replication_slot = NULL;
 /* backup options */
 bool		backup_logs = false;
 bool		smooth_checkpoint;
+bool		dedup = false;
+bool		block_index = false;
+bool		resume_backup = false;
 bool		is_remote_backup = false;
 /* Wait timeout for WAL segment archiving */
 uint32		archive_timeout = ARCHIVE_TIMEOUT_DEFAULT;
@@ -72,6 +88,7 @@ static pgRecoveryTarget *recovery_target_options = NULL;
 
 bool restore_as_replica = false;
 bool restore_no_validate = false;
+bool restore_incremental = false;
 
 /* delete options */
 bool		delete_wal = false;
@@ -87,6 +104,7 @@ uint32		retention_window = 0;
 CompressAlg compress_alg = COMPRESS_ALG_DEFAULT;
 int			compress_level = COMPRESS_LEVEL_DEFAULT;
 bool 		compress_shortcut = false;
+int			compress_threads = 0;
 
 
 /* other options */
@@ -97,6 +115,7 @@ uint64		system_identifier = 0;
 static char *wal_file_path;
 static char *wal_file_name;
 static bool	file_overwrite = false;
+static bool	wal_summary = false;
 
 /* show options */
 ShowFormat show_format = SHOW_PLAIN;
@@ -125,6 +144,9 @@ static pgut_option options[] =
 	{ 'u', 'j', "threads",				&num_threads,		SOURCE_CMDLINE },
 	{ 'b', 2, "stream",					&stream_wal,		SOURCE_CMDLINE },
 	{ 'b', 3, "progress",				&progress,			SOURCE_CMDLINE },
+	{ 'u', 4, "max-read-rate",			&max_read_rate,		SOURCE_CMDLINE,	SOURCE_DEFAULT,	OPTION_UNIT_KB },
+	{ 'u', 5, "max-iops",				&max_iops,			SOURCE_CMDLINE },
+	{ 'u', 6, "max-read-latency",		&max_read_latency,	SOURCE_CMDLINE,	SOURCE_DEFAULT,	OPTION_UNIT_MS },
 	{ 's', 'i', "backup-id",			&backup_id_string, SOURCE_CMDLINE },
 	/* backup options */
 	{ 'b', 10, "backup-pg-log",			&backup_logs,		SOURCE_CMDLINE },
@@ -139,6 +161,9 @@ static pgut_option options[] =
 	{ 's', 16, "master-port",			&master_port,		SOURCE_CMDLINE, },
 	{ 's', 17, "master-user",			&master_user,		SOURCE_CMDLINE, },
 	{ 'u', 18, "replica-timeout",		&replica_timeout,	SOURCE_CMDLINE,	SOURCE_DEFAULT,	OPTION_UNIT_S },
+	{ 'b', 19, "dedup",					&dedup,				SOURCE_CMDLINE },
+	{ 'b', 164, "resume",				&resume_backup,		SOURCE_CMDLINE },
+	{ 'b', 165, "block-index",			&block_index,		SOURCE_CMDLINE },
 	/* TODO not completed feature. Make it unavailiable from user level
 	 { 'b', 18, "remote",				&is_remote_backup,	SOURCE_CMDLINE, }, */
 	/* restore options */
@@ -153,6 +178,7 @@ static pgut_option options[] =
 	{ 'b', 'R', "restore-as-replica",	&restore_as_replica,	SOURCE_CMDLINE },
 	{ 'b', 27, "no-validate",			&restore_no_validate,	SOURCE_CMDLINE },
 	{ 's', 28, "lsn",					&target_lsn,		SOURCE_CMDLINE },
+	{ 'b', 29, "incremental",			&restore_incremental,	SOURCE_CMDLINE },
 	/* delete options */
 	{ 'b', 130, "wal",					&delete_wal,		SOURCE_CMDLINE },
 	{ 'b', 131, "expired",				&delete_expired,	SOURCE_CMDLINE },
@@ -164,8 +190,9 @@ static pgut_option options[] =
 	{ 'u', 135, "retention-window",		&retention_window,	SOURCE_CMDLINE },
 	/* compression options */
 	{ 'f', 136, "compress-algorithm",	opt_compress_alg,	SOURCE_CMDLINE },
-	{ 'u', 137, "compress-level",		&compress_level,	SOURCE_CMDLINE },
+	{ 'i', 137, "compress-level",		&compress_level,	SOURCE_CMDLINE },
 	{ 'b', 138, "compress",				&compress_shortcut,	SOURCE_CMDLINE },
+	{ 'u', 139, "compress-threads",		&compress_threads,	SOURCE_CMDLINE },
 	/* logging options */
 	{ 'f', 140, "log-level-console",	opt_log_level_console,	SOURCE_CMDLINE },
 	{ 'f', 141, "log-level-file",		opt_log_level_file,	SOURCE_CMDLINE },
@@ -188,6 +215,7 @@ static pgut_option options[] =
 	{ 's', 160, "wal-file-path",		&wal_file_path,		SOURCE_CMDLINE },
 	{ 's', 161, "wal-file-name",		&wal_file_name,		SOURCE_CMDLINE },
 	{ 'b', 162, "overwrite",			&file_overwrite,	SOURCE_CMDLINE },
+	{ 'b', 163, "wal-summary",			&wal_summary,		SOURCE_CMDLINE },
 	/* show options */
 	{ 'f', 170, "format",				opt_show_format,	SOURCE_CMDLINE },
 	{ 0 }
@@ -366,6 +394,8 @@ main(int argc, char *argv[])
 		sprintf(backup_instance_path, "%s/%s/%s",
 				backup_path, BACKUPS_DIR, instance_name);
 		sprintf(arclog_path, "%s/%s/%s", backup_path, "wal", instance_name);
+		sprintf(page_store_path, "%s/%s/%s",
+				backup_path, PAGES_DIR, instance_name);
 
 		/*
 		 * Ensure that requested backup instance exists.
@@ -410,6 +440,7 @@ main(int argc, char *argv[])
 	if (backup_id_string != NULL)
 	{
 		if (backup_subcmd != RESTORE_CMD &&
+			!(backup_subcmd == BACKUP_CMD && resume_backup) &&
 			backup_subcmd != VALIDATE_CMD &&
 			backup_subcmd != DELETE_CMD &&
 			backup_subcmd != MERGE_CMD &&
@@ -452,13 +483,17 @@ main(int argc, char *argv[])
 	if (num_threads < 1)
 		num_threads = 1;
 
+	if (max_read_latency > 0 && max_read_rate == 0 && max_iops == 0)
+		elog(ERROR, "--max-read-latency requires --max-read-rate or --max-iops");
+
 	compress_init();
 
 	/* do actual operation */
 	switch (backup_subcmd)
 	{
 		case ARCHIVE_PUSH_CMD:
-			return do_archive_push(wal_file_path, wal_file_name, file_overwrite);
+			return do_archive_push(wal_file_path, wal_file_name, file_overwrite,
+								   wal_summary);
 		case ARCHIVE_GET_CMD:
 			return do_archive_get(wal_file_path, wal_file_name);
 		case ADD_INSTANCE_CMD:
@@ -476,9 +511,15 @@ main(int argc, char *argv[])
 				backup_mode = deparse_backup_mode(current.backup_mode);
 				current.stream = stream_wal;
 
-				elog(INFO, "Backup start, pg_probackup version: %s, backup ID: %s, backup mode: %s, instance: %s, stream: %s, remote: %s",
-						  PROGRAM_VERSION, base36enc(start_time), backup_mode, instance_name,
-						  stream_wal ? "true" : "false", is_remote_backup ? "true" : "false");
+				/* ID of the resumed backup is known after the catalog is locked */
+				if (resume_backup)
+					elog(INFO, "Backup resume, pg_probackup version: %s, backup mode: %s, instance: %s, stream: %s, remote: %s",
+							  PROGRAM_VERSION, backup_mode, instance_name,
+							  stream_wal ? "true" : "false", is_remote_backup ? "true" : "false");
+				else
+					elog(INFO, "Backup start, pg_probackup version: %s, backup ID: %s, backup mode: %s, instance: %s, stream: %s, remote: %s",
+							  PROGRAM_VERSION, base36enc(start_time), backup_mode, instance_name,
+							  stream_wal ? "true" : "false", is_remote_backup ? "true" : "false");
 
 				return do_backup(start_time);
 			}
@@ -586,10 +627,21 @@ compress_init(void)
 			elog(ERROR, "Cannot specify compress-level option without compress-alg option");
 	}
 
-	if (compress_level < 0 || compress_level > 9)
+	if (compress_alg == ZSTD_COMPRESS)
+	{
+#ifdef HAVE_LIBZSTD
+		/* Negative levels are "fast" levels of zstd */
+		if (compress_level < ZSTD_minCLevel() ||
+			compress_level > ZSTD_maxCLevel())
+			elog(ERROR, "--compress-level value for zstd must be in the range from %d to %d",
+				 ZSTD_minCLevel(), ZSTD_maxCLevel());
+#endif
+	}
+	else if (compress_level < 0 || compress_level > 9)
 		elog(ERROR, "--compress-level value must be in the range from 0 to 9");
 
-	if (compress_level == 0)
+	/* Level 0 of zstd is its default level, not "no compression" */
+	if (compress_level == 0 && compress_alg != ZSTD_COMPRESS)
 		compress_alg = NOT_DEFINED_COMPRESS;
 
 	if (backup_subcmd == BACKUP_CMD || backup_subcmd == ARCHIVE_PUSH_CMD)
@@ -599,7 +651,18 @@ compress_init(void)
 			elog(ERROR, "This build does not support zlib compression");
 		else
 #endif
-		if (compress_alg == PGLZ_COMPRESS && num_threads > 1)
+#ifndef HAVE_LIBZSTD
+		if (compress_alg == ZSTD_COMPRESS)
+			elog(ERROR, "This build does not support zstd compression");
+		else
+#endif
+#ifndef HAVE_LIBLZ4
+		if (compress_alg == LZ4_COMPRESS)
+			elog(ERROR, "This build does not support lz4 compression");
+		else
+#endif
+		if (compress_alg == PGLZ_COMPRESS &&
+			(num_threads > 1 || compress_threads > 1))
 			elog(ERROR, "Multithread backup does not support pglz compression");
 	}
 }
@@ -48,6 +48,7 @@
 /* Directory/File names */
 #define DATABASE_DIR			"database"
 #define BACKUPS_DIR				"backups"
+#define PAGES_DIR				"pages"
 #if PG_VERSION_NUM >= 100000
 #define PG_XLOG_DIR				"pg_wal"
 #else
@@ -59,6 +60,7 @@
 #define BACKUP_CATALOG_CONF_FILE	"pg_probackup.conf"
 #define BACKUP_CATALOG_PID		"pg_probackup.pid"
 #define DATABASE_FILE_LIST		"backup_content.control"
+#define DATABASE_FILE_JOURNAL	"backup_content.journal"
 #define PG_BACKUP_LABEL_FILE	"backup_label"
 #define PG_BLACK_LIST			"black_list"
 #define PG_TABLESPACE_MAP_FILE "tablespace_map"
@@ -78,40 +80,112 @@ typedef enum CompressAlg
 	NONE_COMPRESS,
 	PGLZ_COMPRESS,
 	ZLIB_COMPRESS,
+	ZSTD_COMPRESS,
+	LZ4_COMPRESS,
 } CompressAlg;
 
-/* Information about single file (or dir) in backup */
+/*
+ * Information about single file (or dir) in backup.
+ *
+ * File lists may hold millions of entries, so fields are ordered to avoid
+ * padding. The path is allocated together with the structure, see
+ * pgFileInit().
+ */
 typedef struct pgFile
 {
 	char	*name;			/* file or directory name */
-	mode_t	mode;			/* protection (file type and permission) */
+	char	*path;			/* absolute path of the file */
+	char	*linked;		/* path of the linked file */
+	const char *forkName;	/* forkName extracted from path, if applicable,
+							 * points to a static string */
 	size_t	size;			/* size of the file */
+	time_t	mtime;			/* time of last modification of the file */
 	size_t	read_size;		/* size of the portion read (if only some pages are
 							   backed up, it's different from size) */
 	int64	write_size;		/* size of the backed-up file. BYTES_INVALID means
 							   that the file existed but was not backed up
 							   because not modified since last backup. */
 							/* we need int64 here to store '-1' value */
+	datapagemap_t pagemap;	/* bitmap of pages updated since previous backup */
+	struct pgFilePart *parts; /* parts of the large file processed by several
+							   * threads, NULL if the file isn't split */
+	mode_t	mode;			/* protection (file type and permission) */
 	pg_crc32 crc;			/* CRC value of the file, regular file only */
-	char	*linked;		/* path of the linked file */
-	bool	is_datafile;	/* true if the file is PostgreSQL data file */
-	char	*path;			/* absolute path of the file */
 	Oid		tblspcOid;		/* tblspcOid extracted from path, if applicable */
 	Oid		dbOid;			/* dbOid extracted from path, if applicable */
 	Oid		relOid;			/* relOid extracted from path, if applicable */
-	char	*forkName;		/* forkName extracted from path, if applicable */
 	int		segno;			/* Segment number for ptrack */
 	int		n_blocks;		/* size of the file in blocks, readed during DELTA backup */
+	CompressAlg compress_alg; /* compression algorithm applied to the file */
+	int		n_parts;		/* number of elements in parts */
+	pg_atomic_uint32 n_parts_done; /* number of already processed parts */
+	bool	is_datafile;	/* true if the file is PostgreSQL data file */
 	bool	is_cfs;			/* Flag to distinguish files compressed by CFS*/
 	bool	is_database;
 	bool	exists_in_prev;	/* Mark files, both data and regular, that exists in previous backup */
-	CompressAlg compress_alg; /* compression algorithm applied to the file */
-	volatile pg_atomic_flag lock;	/* lock for synchronization of parallel threads  */
-	datapagemap_t pagemap;	/* bitmap of pages updated since previous backup */
 	bool	pagemap_isabsent; /* Used to mark files with unknown state of pagemap,
 							   * i.e. datafiles without _ptrack */
+	volatile pg_atomic_flag lock;	/* lock for synchronization of parallel threads  */
 } pgFile;
 
+/*
+ * Large files are split into ranges of FILE_PART_BLOCKS blocks, so several
+ * threads can process different parts of a single file.
+ */
+#define FILE_PART_SIZE		(32 * 1024 * 1024)
+#define FILE_PART_BLOCKS	(FILE_PART_SIZE / BLCKSZ)
+
+/*
+ * Entry of the block index of a backup data file. The index is kept in the
+ * file "<backup file>" BLOCK_INDEX_SUFFIX next to the backup file, entries
+ * are sorted by block number.
+ */
+typedef struct BlockIndexEntry
+{
+	uint64		offset;			/* offset of the block data in the file */
+	BlockNumber	block;
+	int32		compressed_size;
+	pg_crc32	crc;			/* CRC of the page header and data */
+	uint32		padding;
+} BlockIndexEntry;
+
+#define BLOCK_INDEX_SUFFIX	".bix"
+
+/* Block range of a large file */
+typedef struct pgFilePart
+{
+	pgFile	   *file;			/* file the part belongs to */
+	int			partno;			/* number of the part, starting with 0 */
+	BlockNumber	start_blkno;	/* first block of the range */
+	BlockNumber	end_blkno;		/* block next to the last one of the range,
+								 * InvalidBlockNumber for the last part */
+
+	/* Results of the part processing */
+	bool		exists;			/* false if the file wasn't found */
+	bool		truncated;		/* the file was truncated within the range */
+	int			n_blocks_read;
+	int			n_blocks_skipped;
+	size_t		read_size;
+	int64		write_size;
+	pg_crc32	crc;
+	CompressAlg compress_alg;
+	/* Block index of the part file, if --block-index is used */
+	BlockIndexEntry *index_entries;
+	uint32		n_index_entries;
+	BlockNumber	index_truncated;
+
+	volatile pg_atomic_flag lock;	/* lock for synchronization of parallel threads  */
+} pgFilePart;
+
+/* Location of the newest copy of a block in the chain of backups */
+typedef struct BlockLocation
+{
+	int			version;		/* index of the file copy, -1 if the block is
+								 * absent */
+	int32		compressed_size;
+	off_t		offset;			/* offset of the block data in the copy */
+} BlockLocation;
+
 /* Special values of datapagemap_t bitmapsize */
 #define PageBitmapIsEmpty 0		/* Used to mark unchanged datafiles */
 
@@ -169,6 +243,16 @@ typedef enum ShowFormat
 #define BYTES_INVALID		(-1)
 #define BLOCKNUM_INVALID	(-1)
 
+/*
+ * Format version of the backup files.
+ *  1 - original format, every stored page has a payload.
+ *  2 - zero pages are stored without payload and pages may be references
+ *      to the page store of the instance. Such backups can be read by
+ *      pg_probackup 2.0.20 and newer only.
+ * Backups of version 1 don't have format-version in backup.control.
+ */
+#define BACKUP_FORMAT_VERSION	2
+
 typedef struct pgBackupConfig
 {
 	uint64		system_identifier;
@@ -232,6 +316,9 @@ struct pgBackup
 	int64			data_bytes;
 	/* Size of WAL files in archive needed to restore this backup */
 	int64			wal_bytes;
+	/* Number of reads of data pages failed verification and time spent on them */
+	int64			page_retries;
+	int64			page_retry_time;	/* in milliseconds */
 
 	CompressAlg		compress_alg;
 	int				compress_level;
@@ -240,6 +327,7 @@ struct pgBackup
 	uint32			block_size;
 	uint32			wal_block_size;
 	uint32			checksum_version;
+	uint32			format_version;	/* Format version of the backup files */
 
 	char			program_version[100];
 	char			server_version[100];
@@ -247,6 +335,9 @@ struct pgBackup
 	bool			stream;			/* Was this backup taken in stream mode?
 									 * i.e. does it include all needed WAL files? */
 	bool			from_replica;	/* Was this backup taken from replica */
+	bool			dedup;			/* Are data pages stored in the page store
+									 * of the instance? */
+	bool			block_index;	/* Do data files have block indexes? */
 	time_t			parent_backup; 	/* Identifier of the previous backup.
 									 * Which is basic backup for this
 									 * incremental backup. */
@@ -292,8 +383,10 @@ typedef struct
 	const char *to_root;
 
 	parray	   *files_list;
+	parray	   *parts_list;		/* parts of large data files */
 	parray	   *prev_filelist;
 	XLogRecPtr	prev_start_lsn;
+	time_t		prev_start_time;
 
 	PGconn	   *backup_conn;
 	PGcancel   *cancel_conn;
@@ -324,16 +417,28 @@ typedef struct
 	 strspn(fname, "0123456789ABCDEF") == XLOG_FNAME_LEN &&		\
 	 strcmp((fname) + XLOG_FNAME_LEN, ".gz") == 0)
 
+/* Summary of block references of the WAL segment, see parsexlog.c */
+#define WAL_SUMMARY_SUFFIX	".summary"
+
+#define IsWalSummaryFileName(fname) \
+	(strlen(fname) == XLOG_FNAME_LEN + strlen(WAL_SUMMARY_SUFFIX) &&	\
+	 strspn(fname, "0123456789ABCDEF") == XLOG_FNAME_LEN &&		\
+	 strcmp((fname) + XLOG_FNAME_LEN, WAL_SUMMARY_SUFFIX) == 0)
+
 /* directory options */
 extern char	   *backup_path;
 extern char		backup_instance_path[MAXPGPATH];
 extern char	   *pgdata;
 extern char		arclog_path[MAXPGPATH];
+extern char		page_store_path[MAXPGPATH];
 
 /* common options */
 extern int		num_threads;
 extern bool		stream_wal;
 extern bool		progress;
+extern uint32	max_read_rate;
+extern uint32	max_iops;
+extern uint32	max_read_latency;
 #if PG_VERSION_NUM >= 100000
 /* In pre-10 'replication_slot' is defined in receivelog.h */
 extern char	   *replication_slot;
@@ -341,6 +446,9 @@ extern char	   *replication_slot;
 
 /* backup options */
 extern bool		smooth_checkpoint;
+extern bool		dedup;
+extern bool		block_index;
+extern bool		resume_backup;
 #define ARCHIVE_TIMEOUT_DEFAULT 300
 extern uint32	archive_timeout;
 extern bool		is_remote_backup;
@@ -357,6 +465,7 @@ extern bool exclusive_backup;
 
 /* restore options */
 extern bool restore_as_replica;
+extern bool restore_incremental;
 
 /* delete options */
 extern bool		delete_wal;
@@ -375,6 +484,7 @@ extern uint32	retention_window;
 extern CompressAlg compress_alg;
 extern int		compress_level;
 extern bool		compress_shortcut;
+extern int		compress_threads;
 
 #define COMPRESS_ALG_DEFAULT NOT_DEFINED_COMPRESS
 #define COMPRESS_LEVEL_DEFAULT 1
@@ -400,13 +510,11 @@ extern const char *pgdata_exclude_dir[];
 extern int do_backup(time_t start_time);
 extern BackupMode parse_backup_mode(const char *value);
 extern const char *deparse_backup_mode(BackupMode mode);
-extern void process_block_change(ForkNumber forknum, RelFileNode rnode,
-								 BlockNumber blkno);
 
-extern char *pg_ptrack_get_block(backup_files_arg *arguments,
+extern void pg_ptrack_get_blocks(backup_files_arg *arguments,
 								 Oid dbOid, Oid tblsOid, Oid relOid,
-								 BlockNumber blknum,
-								 size_t *result_size);
+								 BlockNumber *blknums, int n,
+								 char **pages, size_t *page_sizes);
 /* in restore.c */
 extern int do_restore_or_validate(time_t target_backup_id,
 					  pgRecoveryTarget *rt,
@@ -430,7 +538,7 @@ extern int do_add_instance(void);
 
 /* in archive.c */
 extern int do_archive_push(char *wal_file_path, char *wal_file_name,
-						   bool overwrite);
+						   bool overwrite, bool wal_summary);
 extern int do_archive_get(char *wal_file_path, char *wal_file_name);
 
 
@@ -448,6 +556,7 @@ extern int do_show(time_t requested_backup_id);
 extern int do_delete(time_t backup_id);
 extern int do_retention_purge(void);
 extern int do_delete_instance(void);
+extern void delete_unused_pages(void);
 
 /* in fetch.c */
 extern char *slurpFile(const char *datadir,
@@ -483,6 +592,7 @@ extern void pgBackupGetPath2(const pgBackup *backup, char *path, size_t len,
 extern int pgBackupCreateDir(pgBackup *backup);
 extern void pgBackupInit(pgBackup *backup);
 extern void pgBackupCopy(pgBackup *dst, pgBackup *src);
+extern void pgBackupCheckFormat(pgBackup *backup);
 extern void pgBackupFree(void *backup);
 extern int pgBackupCompareId(const void *f1, const void *f2);
 extern int pgBackupCompareIdDesc(const void *f1, const void *f2);
@@ -501,7 +611,15 @@ extern void opt_tablespace_map(pgut_option *opt, const char *arg);
 extern void check_tablespace_mapping(pgBackup *backup);
 
 extern void print_file_list(FILE *out, const parray *files, const char *root);
+extern void print_file_entry(FILE *out, pgFile *file, const char *root);
 extern parray *dir_read_file_list(const char *root, const char *file_txt);
+extern void write_file_list(FILE *out, const parray *files, const char *root);
+
+typedef struct FileListIndex FileListIndex;
+
+extern FileListIndex *file_list_open(const char *root, const char *path);
+extern pgFile *file_list_find(FileListIndex *list, const char *rel_path);
+extern void file_list_close(FileListIndex *list);
 
 extern int dir_create_dir(const char *path, mode_t mode);
 extern bool dir_is_empty(const char *path);
@@ -511,24 +629,59 @@ extern size_t pgFileSize(const char *path);
 
 extern pgFile *pgFileNew(const char *path, bool omit_symlink);
 extern pgFile *pgFileInit(const char *path);
+extern void pgFileSetPath(pgFile *file, const char *path);
 extern void pgFileDelete(pgFile *file);
 extern void pgFileFree(void *file);
 extern pg_crc32 pgFileGetCRC(const char *file_path);
+extern pg_crc32 pgFileGetCRCRange(const char *file_path, off_t offset,
+								  size_t len, size_t *read_len);
+extern pg_crc32 pgFileCombineCRC(pg_crc32 crc1, pg_crc32 crc2, size_t len2);
+extern void pgFileSplit(pgFile *file, BlockNumber nblocks, parray *parts);
 extern int pgFileComparePath(const void *f1, const void *f2);
 extern int pgFileComparePathDesc(const void *f1, const void *f2);
 extern int pgFileCompareLinked(const void *f1, const void *f2);
 extern int pgFileCompareSize(const void *f1, const void *f2);
 
 /* in data.c */
+extern void start_compress_workers(int n_threads);
+extern void stop_compress_workers(void);
 extern bool backup_data_file(backup_files_arg* arguments,
 							 const char *to_path, pgFile *file,
 							 XLogRecPtr prev_backup_start_lsn,
 							 BackupMode backup_mode,
 							 CompressAlg calg, int clevel);
+extern void backup_data_file_part(backup_files_arg* arguments,
+								  const char *to_path, pgFilePart *part,
+								  XLogRecPtr prev_backup_start_lsn,
+								  BackupMode backup_mode,
+								  CompressAlg calg, int clevel);
+extern bool join_data_file_parts(const char *to_path, pgFile *file,
+								 BackupMode backup_mode);
 extern void restore_data_file(const char *to_path,
 							  pgFile *file, bool allow_truncate,
 							  bool write_header);
-extern bool copy_file(const char *from_root, const char *to_root, pgFile *file);
+extern BlockLocation *map_data_file_chain(parray *versions,
+										  BlockNumber *nblocks);
+extern void restore_data_file_range(const char *to_path, parray *versions,
+									BlockLocation *map, BlockNumber nblocks,
+									BlockNumber start_blkno,
+									BlockNumber end_blkno);
+extern void restore_data_file_finish(const char *to_path, mode_t mode,
+									 BlockNumber nblocks);
+extern void restore_data_file_chain(const char *to_path, parray *versions,
+									mode_t mode);
+extern void merge_data_file(const char *to_path, parray *versions,
+							pgFile *file, CompressAlg calg, int clevel);
+extern BlockIndexEntry *read_block_index(pgFile *file, uint32 *n_entries,
+										 BlockNumber *truncated);
+extern void remove_block_index(const char *path);
+extern void page_store_finish(void);
+extern parray *page_store_get_packs(void);
+extern void get_page_references(pgFile *file, parray *packs);
+extern long page_store_remove_unused(parray *packs);
+extern bool check_page_references(const char *path);
+extern bool copy_file(const char *from_root, const char *to_root, pgFile *file,
+					  bool sync);
 extern void move_file(const char *from_root, const char *to_root, pgFile *file);
 extern void push_wal_file(const char *from_path, const char *to_path,
 						  bool is_compress, bool overwrite);
@@ -554,6 +707,8 @@ extern bool read_recovery_info(const char *archivedir, TimeLineID tli,
 							   TransactionId *recovery_xid);
 extern bool wal_contains_lsn(const char *archivedir, XLogRecPtr target_lsn,
 							 TimeLineID target_tli);
+extern void summarize_wal_segment(const char *archivedir, TimeLineID tli,
+								  XLogSegNo segno);
 
 /* in util.c */
 extern TimeLineID get_current_timeline(bool safe);
@@ -566,10 +721,12 @@ extern uint32 get_data_checksum_version(bool safe);
 extern const char *base36enc(long unsigned int value);
 extern char *base36enc_dup(long unsigned int value);
 extern long unsigned int base36dec(const char *text);
-extern uint64 get_system_identifier(char *pgdata);
+extern uint64 get_system_identifier(char *pgdata, bool safe);
 extern uint64 get_remote_system_identifier(PGconn *conn);
 extern pg_time_t timestamptz_to_time_t(TimestampTz t);
 extern int parse_server_version(char *server_version_str);
+extern int64 io_throttle_start(size_t bytes);
+extern void io_throttle_end(int64 start_time);
 
 /* in status.c */
 extern bool is_pg_running(void);
@@ -19,10 +19,44 @@
 #include "utils/logger.h"
 #include "utils/thread.h"
 
+/* Block map of a large data file, which is restored by several threads */
 typedef struct
 {
-	parray	   *files;
-	pgBackup   *backup;
+	pthread_mutex_t lock;
+	bool		ready;			/* map is built by the first thread */
+	BlockLocation *blocks;
+	BlockNumber	nblocks;
+} restore_file_map;
+
+/*
+ * Restore plan of a single file of the destination backup.
+ */
+typedef struct
+{
+	pgFile	   *file;			/* file entry of the destination backup */
+
+	/*
+	 * Data files: copies of the file in the backup chain, ordered from the
+	 * destination backup down to the FULL backup.
+	 */
+	parray	   *versions;
+
+	/*
+	 * Large data files: block range restored by this item and block map
+	 * shared by all parts of the file.
+	 */
+	pgFilePart *part;
+	restore_file_map *map;
+
+	/* Other files: the newest copy of the file and root of its backup */
+	pgFile	   *source;
+	const char *source_root;
+} restore_file_plan;
+
+typedef struct
+{
+	parray	   *plan;
+	const char *dest_root;
 
 	/*
 	 * Return value from the thread.
@@ -31,12 +65,17 @@ typedef struct
 	int			ret;
 } restore_files_arg;
 
-static void restore_backup(pgBackup *backup);
+static void restore_chain(parray *backups, int base_full_backup_index,
+						  int dest_backup_index);
 static void create_recovery_conf(time_t backup_id,
 								 pgRecoveryTarget *rt,
 								 pgBackup *backup);
+static void remove_extra_files(parray *dest_files, const char *dest_root);
+static bool file_is_restored(pgFile *source, const char *rel_path);
+static void split_data_file(restore_file_plan *item, parray *parts_plan);
+static void restore_part(restore_file_plan *item, const char *rel_path);
 static void *restore_files(void *arg);
-static void remove_deleted_files(pgBackup *backup);
+static void *sync_files(void *arg);
 
 
 /*
@@ -62,8 +101,21 @@ do_restore_or_validate(time_t target_backup_id, pgRecoveryTarget *rt,
 		if (pgdata == NULL)
 			elog(ERROR,
 				"required parameter not specified: PGDATA (-D, --pgdata)");
+		if (restore_incremental)
+		{
+			uint64		system_id = get_system_identifier(pgdata, true);
+
+			if (is_pg_running())
+				elog(ERROR, "Postmaster is running in \"%s\", stop it before incremental restore",
+					 pgdata);
+			/* Empty or partially restored PGDATA has no pg_control */
+			if (system_id != 0 && system_id != system_identifier)
+				elog(ERROR, "Data directory \"%s\" was initialized for system id " UINT64_FORMAT ", "
+					 "but backups are of system id " UINT64_FORMAT,
+					 pgdata, system_id, system_identifier);
+		}
 		/* Check if restore destination empty */
-		if (!dir_is_empty(pgdata))
+		else if (!dir_is_empty(pgdata))
 			elog(ERROR, "restore destination is not empty: \"%s\"", pgdata);
 	}
 
@@ -306,16 +358,14 @@ do_restore_or_validate(time_t target_backup_id, pgRecoveryTarget *rt,
 			if (rt->lsn_specified && parse_server_version(backup->server_version) < 100000)
 				elog(ERROR, "Backup %s was created for version %s which doesn't support recovery_target_lsn",
 						base36enc(dest_backup->start_time), dest_backup->server_version);
-
-			restore_backup(backup);
 		}
 
 		/*
-		 * Delete files which are not in dest backup file list. Files which were
-		 * deleted between previous and current backup are not in the list.
+		 * Restore the whole chain from base_full_backup to dest_backup at
+		 * once. Only files of dest backup file list are restored, so files
+		 * which were deleted between backups of the chain are not created.
 		 */
-		if (dest_backup->backup_mode != BACKUP_MODE_FULL)
-			remove_deleted_files(dest_backup);
+		restore_chain(backups, base_full_backup_index, dest_backup_index);
 
 		/* Create recovery.conf with given recovery target parameters */
 		create_recovery_conf(target_backup_id, rt, dest_backup);
@@ -331,22 +381,11 @@ do_restore_or_validate(time_t target_backup_id, pgRecoveryTarget *rt,
 }
 
 /*
- * Restore one backup.
+ * Check that the backup can be restored by this build of pg_probackup.
  */
-void
-restore_backup(pgBackup *backup)
+static void
+check_backup_restorable(pgBackup *backup)
 {
-	char		timestamp[100];
-	char		this_backup_path[MAXPGPATH];
-	char		database_path[MAXPGPATH];
-	char		list_path[MAXPGPATH];
-	parray	   *files;
-	int			i;
-	/* arrays with meta info for multi threaded backup */
-	pthread_t  *threads;
-	restore_files_arg *threads_args;
-	bool		restore_isok = true;
-
 	if (backup->status != BACKUP_STATUS_OK)
 		elog(ERROR, "Backup %s cannot be restored because it is not valid",
 			 base36enc(backup->start_time));
@@ -360,46 +399,206 @@ restore_backup(pgBackup *backup)
 		elog(ERROR,
 			"XLOG_BLCKSZ(%d) is not compatible(%d expected)",
 			backup->wal_block_size, XLOG_BLCKSZ);
+	/* confirm that backup files can be read */
+	pgBackupCheckFormat(backup);
+}
 
-	time2iso(timestamp, lengthof(timestamp), backup->start_time);
-	elog(LOG, "restoring database from backup %s", timestamp);
+/*
+ * If the data file is large, split it into block ranges restored by
+ * different threads and append restore plans of the ranges to 'parts_plan'.
+ *
+ * We don't know the exact size of the file, so estimate it using sizes of
+ * its copies in backups. The last range covers the rest of the file anyway.
+ */
+static void
+split_data_file(restore_file_plan *item, parray *parts_plan)
+{
+	BlockNumber	nblocks = 0;
+	parray	   *parts;
+	restore_file_map *map;
+	int			i;
 
-	/*
-	 * Restore backup directories.
-	 * this_backup_path = $BACKUP_PATH/backups/instance_name/backup_id
-	 */
-	pgBackupGetPath(backup, this_backup_path, lengthof(this_backup_path), NULL);
-	create_data_directories(pgdata, this_backup_path, true);
+	for (i = 0; i < parray_num(item->versions); i++)
+	{
+		pgFile	   *version = (pgFile *) parray_get(item->versions, i);
+
+		if (version->write_size != BYTES_INVALID)
+			nblocks = Max(nblocks, version->write_size / BLCKSZ);
+		if (version->n_blocks != BLOCKNUM_INVALID)
+			nblocks = Max(nblocks, version->n_blocks);
+	}
+
+	if (nblocks <= FILE_PART_BLOCKS)
+		return;
+
+	map = pgut_new(restore_file_map);
+	pthread_mutex_init(&map->lock, NULL);
+	map->ready = false;
+	map->blocks = NULL;
+	map->nblocks = 0;
+
+	parts = parray_new();
+	pgFileSplit(item->file, nblocks, parts);
+	for (i = 0; i < parray_num(parts); i++)
+	{
+		restore_file_plan *part_item = pgut_new(restore_file_plan);
+
+		memcpy(part_item, item, sizeof(restore_file_plan));
+		part_item->part = (pgFilePart *) parray_get(parts, i);
+		part_item->map = map;
+		parray_append(parts_plan, part_item);
+	}
+	parray_free(parts);
+}
+
+/*
+ * Restore the chain of backups from base full backup to dest backup.
+ *
+ * File lists of all backups of the chain are read first. Then for every
+ * file of dest backup we find the newest copy of the file (for data files -
+ * the list of copies to take each block from the newest backup containing
+ * it). So every file and every block is written into PGDATA only once.
+ */
+static void
+restore_chain(parray *backups, int base_full_backup_index,
+			  int dest_backup_index)
+{
+	pgBackup   *dest_backup;
+	int			nbackups = base_full_backup_index - dest_backup_index + 1;
+	char		dest_backup_path[MAXPGPATH];
+	char	  **roots;
+	FileListIndex **filelists;
+	parray	   *plan;
+	parray	   *parts_plan;
+	parray	   *dest_files = NULL;
+	int			i;
+	/* arrays with meta info for multi threaded restore */
+	pthread_t  *threads;
+	restore_files_arg *threads_args;
+	bool		restore_isok = true;
+
+	dest_backup = (pgBackup *) parray_get(backups, dest_backup_index);
+
+	roots = pgut_newarray(char *, nbackups);
+	filelists = pgut_newarray(FileListIndex *, nbackups);
 
 	/*
-	 * Get list of files which need to be restored.
+	 * Open file lists of the chain. Element with index 0 belongs to dest
+	 * backup, the last one - to base full backup. Only the list of dest
+	 * backup is read entirely, files of older backups are looked up by path.
 	 */
-	pgBackupGetPath(backup, database_path, lengthof(database_path), DATABASE_DIR);
-	pgBackupGetPath(backup, list_path, lengthof(list_path), DATABASE_FILE_LIST);
-	files = dir_read_file_list(database_path, list_path);
+	for (i = 0; i < nbackups; i++)
+	{
+		pgBackup   *backup = (pgBackup *) parray_get(backups,
+													 dest_backup_index + i);
+		char		timestamp[100];
+		char		list_path[MAXPGPATH];
 
-	threads = (pthread_t *) palloc(sizeof(pthread_t) * num_threads);
-	threads_args = (restore_files_arg *) palloc(sizeof(restore_files_arg)*num_threads);
+		check_backup_restorable(backup);
 
-	/* setup threads */
-	for (i = 0; i < parray_num(files); i++)
+		time2iso(timestamp, lengthof(timestamp), backup->start_time);
+		elog(LOG, "reading file list of backup %s", timestamp);
+
+		roots[i] = pgut_malloc(MAXPGPATH);
+		pgBackupGetPath(backup, roots[i], MAXPGPATH, DATABASE_DIR);
+		pgBackupGetPath(backup, list_path, lengthof(list_path),
+						DATABASE_FILE_LIST);
+		if (i == 0)
+		{
+			dest_files = dir_read_file_list(roots[i], list_path);
+			parray_qsort(dest_files, pgFileComparePath);
+			filelists[i] = NULL;
+		}
+		else
+			filelists[i] = file_list_open(roots[i], list_path);
+	}
+
+	if (restore_incremental)
+		remove_extra_files(dest_files, roots[0]);
+
+	/*
+	 * Restore backup directories.
+	 * dest_backup_path = $BACKUP_PATH/backups/instance_name/backup_id
+	 */
+	pgBackupGetPath(dest_backup, dest_backup_path, lengthof(dest_backup_path),
+					NULL);
+	create_data_directories(pgdata, dest_backup_path, true);
+
+	/* Build restore plan for each file of dest backup */
+	plan = parray_new();
+	parts_plan = parray_new();
+	for (i = 0; i < parray_num(dest_files); i++)
 	{
-		pgFile	   *file = (pgFile *) parray_get(files, i);
+		pgFile	   *file = (pgFile *) parray_get(dest_files, i);
+		restore_file_plan *item;
+		char	   *rel_path;
+		int			j;
 
 		pg_atomic_clear_flag(&file->lock);
+
+		item = pgut_new(restore_file_plan);
+		item->file = file;
+		item->versions = NULL;
+		item->part = NULL;
+		item->map = NULL;
+		item->source = NULL;
+		item->source_root = NULL;
+		parray_append(plan, item);
+
+		if (S_ISDIR(file->mode))
+			continue;
+
+		if (file->is_datafile && !file->is_cfs)
+			item->versions = parray_new();
+
+		rel_path = GetRelativePath(file->path, roots[0]);
+		for (j = 0; j < nbackups; j++)
+		{
+			pgFile	   *version;
+
+			version = (j == 0) ? file : file_list_find(filelists[j], rel_path);
+
+			/*
+			 * The file didn't exist at the moment of this backup. It was fully
+			 * copied by the next backup of the chain, older copies are stale.
+			 */
+			if (version == NULL)
+				break;
+
+			if (item->versions)
+				parray_append(item->versions, version);
+			else if (version->write_size != BYTES_INVALID)
+			{
+				item->source = version;
+				item->source_root = roots[j];
+				break;
+			}
+		}
+
+		/* Split large data file into block ranges */
+		if (item->versions && num_threads > 1)
+			split_data_file(item, parts_plan);
 	}
 
+	/* Restore parts of large files first for load balancing */
+	parray_concat(parts_plan, plan);
+	parray_free(plan);
+	plan = parts_plan;
+
+	threads = (pthread_t *) palloc(sizeof(pthread_t) * num_threads);
+	threads_args = (restore_files_arg *) palloc(sizeof(restore_files_arg)*num_threads);
+
 	/* Restore files into target directory */
 	for (i = 0; i < num_threads; i++)
 	{
 		restore_files_arg *arg = &(threads_args[i]);
 
-		arg->files = files;
-		arg->backup = backup;
+		arg->plan = plan;
+		arg->dest_root = roots[0];
 		/* By default there are some error */
 		threads_args[i].ret = 1;
 
-		elog(LOG, "Start thread for num:%li", parray_num(files));
+		elog(LOG, "Start thread for num:%li", parray_num(plan));
 
 		pthread_create(&threads[i], NULL, restore_files, arg);
 	}
@@ -414,60 +613,164 @@ restore_backup(pgBackup *backup)
 	if (!restore_isok)
 		elog(ERROR, "Data files restoring failed");
 
+	/*
+	 * Files are not flushed one by one while they are restored. Flush all
+	 * of them now, several threads wait for the disk at the same time.
+	 */
+	elog(LOG, "sync restored files to disk");
+	for (i = 0; i < parray_num(plan); i++)
+	{
+		restore_file_plan *item = (restore_file_plan *) parray_get(plan, i);
+
+		if (item->part == NULL)
+			pg_atomic_clear_flag(&item->file->lock);
+	}
+	for (i = 0; i < num_threads; i++)
+	{
+		threads_args[i].ret = 1;
+		pthread_create(&threads[i], NULL, sync_files, &threads_args[i]);
+	}
+	for (i = 0; i < num_threads; i++)
+	{
+		pthread_join(threads[i], NULL);
+		if (threads_args[i].ret == 1)
+			restore_isok = false;
+	}
+	if (!restore_isok)
+		elog(ERROR, "Data files syncing failed");
+
 	pfree(threads);
 	pfree(threads_args);
 
 	/* cleanup */
-	parray_walk(files, pgFileFree);
-	parray_free(files);
+	for (i = 0; i < parray_num(plan); i++)
+	{
+		restore_file_plan *item = (restore_file_plan *) parray_get(plan, i);
+
+		/* Parts of the file share versions and map with the whole file */
+		if (item->part == NULL)
+		{
+			if (item->versions)
+				parray_free(item->versions);
+		}
+		else if (item->part->partno == 0)
+		{
+			pg_free(item->map->blocks);
+			pthread_mutex_destroy(&item->map->lock);
+			free(item->map);
+		}
+		free(item);
+	}
+	parray_free(plan);
+
+	parray_walk(dest_files, pgFileFree);
+	parray_free(dest_files);
+	for (i = 0; i < nbackups; i++)
+	{
+		if (filelists[i])
+			file_list_close(filelists[i]);
+		free(roots[i]);
+	}
+	free(filelists);
+	free(roots);
 
 	if (log_level_console <= LOG || log_level_file <= LOG)
-		elog(LOG, "restore %s backup completed", base36enc(backup->start_time));
+		elog(LOG, "restore %s backup completed",
+			 base36enc(dest_backup->start_time));
 }
 
 /*
- * Delete files which are not in backup's file list from target pgdata.
- * It is necessary to restore incremental backup correctly.
- * Files which were deleted between previous and current backup
- * are not in the backup's filelist.
+ * Incremental restore: remove files and directories of PGDATA which are
+ * absent in the destination backup, or which are of other type there.
+ * Remaining files are compared with the backup by restore_files().
  */
 static void
-remove_deleted_files(pgBackup *backup)
+remove_extra_files(parray *dest_files, const char *dest_root)
 {
-	parray	   *files;
-	parray	   *files_restored;
-	char		filelist_path[MAXPGPATH];
+	parray	   *files = parray_new();
 	int			i;
 
-	pgBackupGetPath(backup, filelist_path, lengthof(filelist_path), DATABASE_FILE_LIST);
-	/* Read backup's filelist using target database path as base path */
-	files = dir_read_file_list(pgdata, filelist_path);
-	parray_qsort(files, pgFileComparePathDesc);
+	elog(LOG, "scan existing data directory \"%s\"", pgdata);
 
-	/* Get list of files actually existing in target database */
-	files_restored = parray_new();
-	dir_list_file(files_restored, pgdata, true, true, false);
+	/* Excluded directories are cleaned too, as after usual restore */
+	dir_list_file(files, pgdata, false, true, false);
 	/* To delete from leaf, sort in reversed order */
-	parray_qsort(files_restored, pgFileComparePathDesc);
+	parray_qsort(files, pgFileComparePathDesc);
 
-	for (i = 0; i < parray_num(files_restored); i++)
+	for (i = 0; i < parray_num(files); i++)
 	{
-		pgFile	   *file = (pgFile *) parray_get(files_restored, i);
+		pgFile	   *file = (pgFile *) parray_get(files, i);
+		char	   *rel_path = GetRelativePath(file->path, pgdata);
+		char		path[MAXPGPATH];
+		pgFile		key;
+		pgFile	  **dest_file;
+
+		join_path_components(path, dest_root, rel_path);
+		key.path = path;
+		dest_file = (pgFile **) parray_bsearch(dest_files, &key,
+											   pgFileComparePath);
+
+		/* tablespace_map is not restored, see restore_files() */
+		if (dest_file &&
+			S_ISDIR((*dest_file)->mode) == S_ISDIR(file->mode) &&
+			!path_is_prefix_of_path(PG_TABLESPACE_MAP_FILE, rel_path))
+			continue;
 
-		/* If the file is not in the file list, delete it */
-		if (parray_bsearch(files, file, pgFileComparePathDesc) == NULL)
-		{
-			pgFileDelete(file);
-			if (log_level_console <= LOG || log_level_file <= LOG)
-				elog(LOG, "deleted %s", GetRelativePath(file->path, pgdata));
-		}
+		elog(VERBOSE, "Remove \"%s\", it is absent in the backup", file->path);
+		pgFileDelete(file);
 	}
 
-	/* cleanup */
 	parray_walk(files, pgFileFree);
 	parray_free(files);
-	parray_walk(files_restored, pgFileFree);
-	parray_free(files_restored);
+}
+
+/*
+ * Incremental restore: check if the file in PGDATA is the same as its copy
+ * in the backup.
+ */
+static bool
+file_is_restored(pgFile *source, const char *rel_path)
+{
+	char		path[MAXPGPATH];
+	struct stat	st;
+
+	join_path_components(path, pgdata, rel_path);
+	if (stat(path, &st) != 0 || !S_ISREG(st.st_mode) ||
+		st.st_size != source->write_size)
+		return false;
+
+	return pgFileGetCRC(path) == source->crc;
+}
+
+/*
+ * Restore block range of a large data file. The thread which comes first
+ * builds the block map of the file, the thread which finishes the last range
+ * flushes the file.
+ */
+static void
+restore_part(restore_file_plan *item, const char *rel_path)
+{
+	pgFile	   *file = item->file;
+	pgFilePart *part = item->part;
+	restore_file_map *map = item->map;
+	char		to_path[MAXPGPATH];
+
+	elog(VERBOSE, "Restoring part %d of file %s", part->partno, file->path);
+
+	pthread_lock(&map->lock);
+	if (!map->ready)
+	{
+		map->blocks = map_data_file_chain(item->versions, &map->nblocks);
+		map->ready = true;
+	}
+	pthread_mutex_unlock(&map->lock);
+
+	join_path_components(to_path, pgdata, rel_path);
+	restore_data_file_range(to_path, item->versions, map->blocks,
+							map->nblocks, part->start_blkno, part->end_blkno);
+
+	if (pg_atomic_add_fetch_u32(&file->n_parts_done, 1) == file->n_parts)
+		restore_data_file_finish(to_path, file->mode, map->nblocks);
 }
 
 /*
@@ -479,41 +782,35 @@ restore_files(void *arg)
 	int			i;
 	restore_files_arg *arguments = (restore_files_arg *)arg;
 
-	for (i = 0; i < parray_num(arguments->files); i++)
+	for (i = 0; i < parray_num(arguments->plan); i++)
 	{
-		char		from_root[MAXPGPATH];
 		char	   *rel_path;
-		pgFile	   *file = (pgFile *) parray_get(arguments->files, i);
+		restore_file_plan *item = (restore_file_plan *) parray_get(arguments->plan, i);
+		pgFile	   *file = item->file;
 
-		if (!pg_atomic_test_set_flag(&file->lock))
+		if (!pg_atomic_test_set_flag(item->part ? &item->part->lock :
+												  &file->lock))
 			continue;
 
-		pgBackupGetPath(arguments->backup, from_root,
-						lengthof(from_root), DATABASE_DIR);
-
 		/* check for interrupt */
 		if (interrupted)
 			elog(ERROR, "interrupted during restore database");
 
-		rel_path = GetRelativePath(file->path,from_root);
+		rel_path = GetRelativePath(file->path, arguments->dest_root);
 
-		if (progress)
-			elog(LOG, "Progress: (%d/%lu). Process file %s ",
-				 i + 1, (unsigned long) parray_num(arguments->files), rel_path);
-
-		/*
-		 * For PAGE and PTRACK backups skip files which haven't changed
-		 * since previous backup and thus were not backed up.
-		 * We cannot do the same when restoring DELTA backup because we need information
-		 * about every file to correctly truncate them.
-		 */
-		if (file->write_size == BYTES_INVALID &&
-			(arguments->backup->backup_mode == BACKUP_MODE_DIFF_PAGE
-			|| arguments->backup->backup_mode == BACKUP_MODE_DIFF_PTRACK))
+		/* Restore block range of a large data file */
+		if (item->part)
 		{
-			elog(VERBOSE, "The file didn`t change. Skip restore: %s", file->path);
+			restore_part(item, rel_path);
 			continue;
 		}
+		/* The file is restored by parts */
+		else if (file->parts)
+			continue;
+
+		if (progress)
+			elog(LOG, "Progress: (%d/%lu). Process file %s ",
+				 i + 1, (unsigned long) parray_num(arguments->plan), rel_path);
 
 		/* Directories were created before */
 		if (S_ISDIR(file->mode))
@@ -537,23 +834,31 @@ restore_files(void *arg)
 		 */
 		elog(VERBOSE, "Restoring file %s, is_datafile %i, is_cfs %i",
 			 file->path, file->is_datafile?1:0, file->is_cfs?1:0);
-		if (file->is_datafile && !file->is_cfs)
+		if (item->versions)
 		{
 			char		to_path[MAXPGPATH];
 
-			join_path_components(to_path, pgdata,
-								 file->path + strlen(from_root) + 1);
-			restore_data_file(to_path, file,
-							  arguments->backup->backup_mode == BACKUP_MODE_DIFF_DELTA,
-							  false);
+			join_path_components(to_path, pgdata, rel_path);
+			restore_data_file_chain(to_path, item->versions, file->mode);
 		}
-		else
-			copy_file(from_root, pgdata, file);
+		else if (item->source)
+		{
+			if (restore_incremental && file_is_restored(item->source, rel_path))
+			{
+				elog(VERBOSE, "File %s is the same as in the backup, skip",
+					 file->path);
+				continue;
+			}
 
-		/* print size of restored file */
-		if (file->write_size != BYTES_INVALID)
+			copy_file(item->source_root, pgdata, item->source, false);
+
+			/* print size of restored file */
 			elog(LOG, "Restored file %s : " INT64_FORMAT " bytes",
-				 file->path, file->write_size);
+				 item->source->path, item->source->write_size);
+		}
+		else
+			elog(VERBOSE, "The file is absent in all backups. Skip restore: %s",
+				 file->path);
 	}
 
 	/* Data files restoring is successful */
@@ -562,6 +867,58 @@ restore_files(void *arg)
 	return NULL;
 }
 
+/*
+ * Flush restored files and directories of PGDATA to disk.
+ */
+static void *
+sync_files(void *arg)
+{
+	int			i;
+	restore_files_arg *arguments = (restore_files_arg *) arg;
+
+	for (i = 0; i < parray_num(arguments->plan); i++)
+	{
+		restore_file_plan *item = (restore_file_plan *) parray_get(arguments->plan, i);
+		pgFile	   *file = item->file;
+		char		to_path[MAXPGPATH];
+		int			fd;
+
+		/* Parts of large files share the file entry */
+		if (item->part)
+			continue;
+
+		if (!pg_atomic_test_set_flag(&file->lock))
+			continue;
+
+		/* check for interrupt */
+		if (interrupted)
+			elog(ERROR, "interrupted during restore database");
+
+		join_path_components(to_path, pgdata,
+							 GetRelativePath(file->path, arguments->dest_root));
+
+		fd = open(to_path, (S_ISDIR(file->mode) ? O_RDONLY : O_RDWR) | PG_BINARY,
+				  0);
+		if (fd < 0)
+		{
+			/* The file wasn't restored, see restore_files() */
+			if (errno == ENOENT)
+				continue;
+			elog(ERROR, "cannot open \"%s\": %s", to_path, strerror(errno));
+		}
+
+		/* Some platforms don't allow to flush directories */
+		if (fsync(fd) != 0 &&
+			!(S_ISDIR(file->mode) && (errno == EBADF || errno == EINVAL)))
+			elog(ERROR, "cannot sync \"%s\": %s", to_path, strerror(errno));
+		close(fd);
+	}
+
+	arguments->ret = 0;
+
+	return NULL;
+}
+
 /* Create recovery.conf with given recovery target parameters */
 static void
 create_recovery_conf(time_t backup_id,
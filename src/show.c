@@ -480,6 +480,14 @@ show_instance_json(parray *backup_list)
 			appendPQExpBuffer(buf, INT64_FORMAT, backup->wal_bytes);
 		}
 
+		if (backup->page_retries > 0)
+		{
+			json_add_key(buf, "page-retries", json_level, true);
+			appendPQExpBuffer(buf, INT64_FORMAT, backup->page_retries);
+			json_add_key(buf, "page-retry-time", json_level, true);
+			appendPQExpBuffer(buf, INT64_FORMAT, backup->page_retry_time);
+		}
+
 		if (backup->primary_conninfo)
 			json_add_value(buf, "primary_conninfo", backup->primary_conninfo,
 						   json_level, true);
@@ -9,8 +9,10 @@
  */
 
 #include "pg_probackup.h"
+#include "utils/thread.h"
 
 #include <time.h>
+#include <sys/time.h>
 
 #include "storage/bufpage.h"
 
@@ -122,16 +124,20 @@ get_current_timeline(bool safe)
 	return ControlFile.checkPointCopy.ThisTimeLineID;
 }
 
+/*
+ * Get system identifier of the data directory. If 'safe' is true, 0 is
+ * returned when pg_control can't be read.
+ */
 uint64
-get_system_identifier(char *pgdata_path)
+get_system_identifier(char *pgdata_path, bool safe)
 {
 	ControlFileData ControlFile;
 	char	   *buffer;
 	size_t		size;
 
 	/* First fetch file... */
-	buffer = slurpFile(pgdata_path, "global/pg_control", &size, false);
-	if (buffer == NULL)
+	buffer = slurpFile(pgdata_path, "global/pg_control", &size, safe);
+	if (safe && buffer == NULL)
 		return 0;
 	digestControlFile(&ControlFile, buffer, size);
 	pg_free(buffer);
@@ -323,3 +329,93 @@ remove_not_digit(char *buf, size_t len, const char *str)
 	}
 	buf[j] = '\0';
 }
+
+/*
+ * I/O throttling.
+ *
+ * Reads of all threads are scheduled by a single virtual clock. Each read
+ * moves io_next_time forward by the time it takes under --max-read-rate and
+ * --max-iops limits, and the thread sleeps until the start of its slot. Idle
+ * time is accumulated only up to IO_MAX_BURST_USEC, so a short burst is
+ * allowed after a pause.
+ *
+ * If --max-read-latency is set, the limits are halved every time a read
+ * takes longer than the threshold and are slowly raised back while reads are
+ * fast.
+ */
+#define IO_MAX_BURST_USEC	100000
+#define IO_MIN_RATE_SCALE	0.05
+#define IO_RATE_SCALE_STEP	0.01
+
+static pthread_mutex_t io_throttle_lock = PTHREAD_MUTEX_INITIALIZER;
+static int64 io_next_time = 0;
+static double io_rate_scale = 1.0;
+
+static int64
+io_time_usec(void)
+{
+	struct timeval tv;
+
+	gettimeofday(&tv, NULL);
+	return (int64) tv.tv_sec * 1000000 + tv.tv_usec;
+}
+
+/*
+ * Wait for the slot to read 'bytes' bytes. Returns the time of the read start
+ * to pass to io_throttle_end(), or 0 if the latency is not measured.
+ */
+int64
+io_throttle_start(size_t bytes)
+{
+	int64		cost = 0;
+	int64		now;
+	int64		slot;
+
+	if (max_read_rate == 0 && max_iops == 0)
+		return 0;
+
+	if (max_read_rate > 0)
+		cost = (int64) bytes * 1000000 / ((int64) max_read_rate * 1024);
+	if (max_iops > 0)
+		cost = Max(cost, 1000000 / (int64) max_iops);
+
+	now = io_time_usec();
+
+	pthread_lock(&io_throttle_lock);
+	if (io_next_time < now - IO_MAX_BURST_USEC)
+		io_next_time = now - IO_MAX_BURST_USEC;
+	slot = io_next_time;
+	io_next_time += (int64) (cost / io_rate_scale);
+	pthread_mutex_unlock(&io_throttle_lock);
+
+	if (slot > now)
+		pg_usleep(slot - now);
+
+	return (max_read_latency > 0) ? io_time_usec() : 0;
+}
+
+/*
+ * Adjust the limits using the latency of the read started at 'start_time'.
+ */
+void
+io_throttle_end(int64 start_time)
+{
+	int64		latency;
+
+	if (start_time == 0)
+		return;
+
+	latency = io_time_usec() - start_time;
+
+	pthread_lock(&io_throttle_lock);
+	if (latency > (int64) max_read_latency * 1000)
+	{
+		if (io_rate_scale > IO_MIN_RATE_SCALE)
+			elog(VERBOSE, "read latency " INT64_FORMAT " us is above the threshold, "
+				 "reduce read rate", latency);
+		io_rate_scale = Max(io_rate_scale / 2, IO_MIN_RATE_SCALE);
+	}
+	else
+		io_rate_scale = Min(io_rate_scale + IO_RATE_SCALE_STEP, 1.0);
+	pthread_mutex_unlock(&io_throttle_lock);
+}
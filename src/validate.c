@@ -16,6 +16,10 @@
 #include "utils/thread.h"
 
 static void *pgBackupValidateFiles(void *arg);
+static bool validate_file_size(pgFile *file);
+static bool validate_file_part(pgFilePart *part, bool dedup,
+							   bool block_index);
+static void check_block_index(pgFile *file);
 static void do_validate_instance(void);
 
 static bool corrupted_backup_found = false;
@@ -23,6 +27,9 @@ static bool corrupted_backup_found = false;
 typedef struct
 {
 	parray	   *files;
+	parray	   *parts;		/* parts of large files */
+	bool		dedup;		/* check references to the page store */
+	bool		block_index;	/* check block indexes of data files */
 	bool		corrupted;
 
 	/*
@@ -41,6 +48,7 @@ pgBackupValidate(pgBackup *backup)
 	char		base_path[MAXPGPATH];
 	char		path[MAXPGPATH];
 	parray	   *files;
+	parray	   *parts;
 	bool		corrupted = false;
 	bool		validation_isok = true;
 	/* arrays with meta info for multi threaded validate */
@@ -65,6 +73,8 @@ pgBackupValidate(pgBackup *backup)
 	else
 		elog(INFO, "Revalidating backup %s", base36enc(backup->start_time));
 
+	pgBackupCheckFormat(backup);
+
 	if (backup->backup_mode != BACKUP_MODE_FULL &&
 		backup->backup_mode != BACKUP_MODE_DIFF_PAGE &&
 		backup->backup_mode != BACKUP_MODE_DIFF_PTRACK &&
@@ -76,10 +86,16 @@ pgBackupValidate(pgBackup *backup)
 	files = dir_read_file_list(base_path, path);
 
 	/* setup threads */
+	parts = parray_new();
 	for (i = 0; i < parray_num(files); i++)
 	{
 		pgFile	   *file = (pgFile *) parray_get(files, i);
 		pg_atomic_clear_flag(&file->lock);
+
+		/* Split large files, so that several threads can compute the CRC */
+		if (num_threads > 1 && S_ISREG(file->mode) && !file->is_cfs &&
+			file->write_size > FILE_PART_SIZE)
+			pgFileSplit(file, file->write_size / BLCKSZ, parts);
 	}
 
 	/* init thread args with own file lists */
@@ -93,6 +109,9 @@ pgBackupValidate(pgBackup *backup)
 		validate_files_arg *arg = &(threads_args[i]);
 
 		arg->files = files;
+		arg->parts = parts;
+		arg->dedup = backup->dedup;
+		arg->block_index = backup->block_index;
 		arg->corrupted = false;
 		/* By default there are some error */
 		threads_args[i].ret = 1;
@@ -118,6 +137,7 @@ pgBackupValidate(pgBackup *backup)
 	pfree(threads_args);
 
 	/* cleanup */
+	parray_free(parts);
 	parray_walk(files, pgFileFree);
 	parray_free(files);
 
@@ -144,14 +164,36 @@ pgBackupValidateFiles(void *arg)
 	validate_files_arg *arguments = (validate_files_arg *)arg;
 	pg_crc32	crc;
 
-	for (i = 0; i < parray_num(arguments->files); i++)
+	/* Compute CRC of parts of large files */
+	for (i = 0; i < parray_num(arguments->parts); i++)
+	{
+		pgFilePart *part = (pgFilePart *) parray_get(arguments->parts, i);
+
+		if (!pg_atomic_test_set_flag(&part->lock))
+			continue;
+
+		if (interrupted)
+			elog(ERROR, "Interrupted during validate");
+
+		if (!validate_file_part(part, arguments->dedup,
+								arguments->block_index))
+		{
+			arguments->corrupted = true;
+			break;
+		}
+	}
+
+	for (i = 0; i < parray_num(arguments->files) && !arguments->corrupted; i++)
 	{
-		struct stat st;
 		pgFile	   *file = (pgFile *) parray_get(arguments->files, i);
 
 		if (!pg_atomic_test_set_flag(&file->lock))
 			continue;
 
+		/* The file is validated by parts */
+		if (file->parts)
+			continue;
+
 		if (interrupted)
 			elog(ERROR, "Interrupted during validate");
 
@@ -176,33 +218,30 @@ pgBackupValidateFiles(void *arg)
 		elog(VERBOSE, "Validate files: (%d/%lu) %s",
 			 i + 1, (unsigned long) parray_num(arguments->files), file->path);
 
-		if (stat(file->path, &st) == -1)
+		if (!validate_file_size(file))
 		{
-			if (errno == ENOENT)
-				elog(WARNING, "Backup file \"%s\" is not found", file->path);
-			else
-				elog(WARNING, "Cannot stat backup file \"%s\": %s",
-					file->path, strerror(errno));
 			arguments->corrupted = true;
 			break;
 		}
 
-		if (file->write_size != st.st_size)
+		crc = pgFileGetCRC(file->path);
+		if (crc != file->crc)
 		{
-			elog(WARNING, "Invalid size of backup file \"%s\" : " INT64_FORMAT ". Expected %lu",
-				 file->path, file->write_size, (unsigned long) st.st_size);
+			elog(WARNING, "Invalid CRC of backup file \"%s\" : %X. Expected %X",
+					file->path, file->crc, crc);
 			arguments->corrupted = true;
 			break;
 		}
 
-		crc = pgFileGetCRC(file->path);
-		if (crc != file->crc)
+		if (arguments->dedup && file->is_datafile &&
+			!check_page_references(file->path))
 		{
-			elog(WARNING, "Invalid CRC of backup file \"%s\" : %X. Expected %X",
-					file->path, file->crc, crc);
 			arguments->corrupted = true;
 			break;
 		}
+
+		if (arguments->block_index && file->is_datafile)
+			check_block_index(file);
 	}
 
 	/* Data files validation is successful */
@@ -211,6 +250,106 @@ pgBackupValidateFiles(void *arg)
 	return NULL;
 }
 
+/*
+ * Check that the backup file exists and has expected size.
+ */
+static bool
+validate_file_size(pgFile *file)
+{
+	struct stat st;
+
+	if (stat(file->path, &st) == -1)
+	{
+		if (errno == ENOENT)
+			elog(WARNING, "Backup file \"%s\" is not found", file->path);
+		else
+			elog(WARNING, "Cannot stat backup file \"%s\": %s",
+				file->path, strerror(errno));
+		return false;
+	}
+
+	if (file->write_size != st.st_size)
+	{
+		elog(WARNING, "Invalid size of backup file \"%s\" : " INT64_FORMAT ". Expected %lu",
+			 file->path, file->write_size, (unsigned long) st.st_size);
+		return false;
+	}
+
+	return true;
+}
+
+/*
+ * Compute CRC of the part of a large backup file. The thread which finishes
+ * the last part of the file combines CRC of the parts into CRC of the whole
+ * file, checks its references to the page store if 'dedup' is true and its
+ * block index if 'block_index' is true.
+ */
+static bool
+validate_file_part(pgFilePart *part, bool dedup, bool block_index)
+{
+	pgFile	   *file = part->file;
+	size_t		len = 0;
+	pg_crc32	crc;
+	int			i;
+
+	if (!validate_file_size(file))
+		return false;
+
+	elog(VERBOSE, "Validate part %d of file %s", part->partno, file->path);
+
+	if (part->end_blkno != InvalidBlockNumber)
+		len = (size_t) (part->end_blkno - part->start_blkno) * BLCKSZ;
+	part->crc = pgFileGetCRCRange(file->path,
+								  (off_t) part->start_blkno * BLCKSZ, len,
+								  &part->read_size);
+
+	if (pg_atomic_add_fetch_u32(&file->n_parts_done, 1) < file->n_parts)
+		return true;
+
+	crc = file->parts[0].crc;
+	for (i = 1; i < file->n_parts; i++)
+		crc = pgFileCombineCRC(crc, file->parts[i].crc,
+							   file->parts[i].read_size);
+
+	if (crc != file->crc)
+	{
+		elog(WARNING, "Invalid CRC of backup file \"%s\" : %X. Expected %X",
+				file->path, file->crc, crc);
+		return false;
+	}
+
+	if (dedup && file->is_datafile && !check_page_references(file->path))
+		return false;
+
+	if (block_index && file->is_datafile)
+		check_block_index(file);
+
+	return true;
+}
+
+/*
+ * Report the missing or damaged block index of the valid backup data file.
+ * The backup stays valid, readers of the file scan it instead. Validation
+ * doesn't change the backup, so the index isn't rebuilt here.
+ */
+static void
+check_block_index(pgFile *file)
+{
+	BlockIndexEntry *index;
+	uint32		n_entries;
+	BlockNumber	truncated;
+
+	index = read_block_index(file, &n_entries, &truncated);
+	if (index)
+	{
+		pg_free(index);
+		return;
+	}
+
+	elog(LOG, "Block index of backup file \"%s\" is missing or doesn't match the file",
+		 file->path);
+}
+
 /*
  * Validate all backups in the backup catalog.
  * If --instance option was provided, validate only backups of this instance.
@@ -253,6 +392,8 @@ do_validate_all(void)
 			instance_name = dent->d_name;
 			sprintf(backup_instance_path, "%s/%s/%s", backup_path, BACKUPS_DIR, instance_name);
 			sprintf(arclog_path, "%s/%s/%s", backup_path, "wal", instance_name);
+			sprintf(page_store_path, "%s/%s/%s", backup_path, PAGES_DIR,
+					instance_name);
 			do_validate_instance();
 		}
 	}
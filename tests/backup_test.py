@@ -1,6 +1,6 @@
 import unittest
 import os
-from time import sleep
+from time import sleep, time
 from .helpers.ptrack_helpers import ProbackupTest, ProbackupException
 from .helpers.cfs_helpers import find_by_name
 
@@ -341,6 +341,10 @@ class BackupTest(ProbackupTest, unittest.TestCase):
             self.show_pb(backup_dir, 'node')[1]['status'] == 'OK',
             "Backup Status should be OK")
 
+        # The page was read again before fetching it via SQL
+        self.assertGreater(
+            self.show_pb(backup_dir, 'node')[1]['page-retries'], 0)
+
         # Clean after yourself
         self.del_test_dir(module_name, fname)
 
@@ -520,3 +524,449 @@ class BackupTest(ProbackupTest, unittest.TestCase):
         if self.paranoia:
             pgdata_restored = self.pgdata_content(node.data_dir)
             self.compare_pgdata(pgdata, pgdata_restored)
+
+    # @unittest.skip("skip")
+    def test_backup_large_file_by_parts(self):
+        """
+        make node, create table larger than a file part,
+        take full and page backups in several threads,
+        validate and restore them in several threads
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'wal_level': 'replica',
+                'autovacuum': 'off'}
+            )
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, "
+            "md5(i::text) as text, repeat(md5(i::text), 10) as filler "
+            "from generate_series(0,300000) i")
+
+        self.backup_node(
+            backup_dir, 'node', node,
+            options=["-j", "4", "--compress"])
+
+        node.safe_psql(
+            "postgres",
+            "update t_heap set text = md5(text) where id % 100 = 0; "
+            "delete from t_heap where id > 250000; vacuum t_heap")
+
+        backup_id = self.backup_node(
+            backup_dir, 'node', node, backup_type="page",
+            options=["-j", "4"])
+
+        self.validate_pb(backup_dir, 'node', options=["-j", "4"])
+
+        pgdata = self.pgdata_content(node.data_dir)
+        node.stop()
+        node.cleanup()
+
+        self.restore_node(
+            backup_dir, 'node', node, backup_id=backup_id,
+            options=["-j", "4"])
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_backup_zero_pages(self):
+        """
+        make node, append zero pages to a table, take compressed full
+        backup, check that zero pages are stored without payload and
+        restored correctly
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'wal_level': 'replica',
+                'max_wal_senders': '2',
+                'autovacuum': 'off'}
+            )
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text "
+            "from generate_series(0,100) i")
+        relpath = node.safe_psql(
+            "postgres",
+            "select pg_relation_filepath('t_heap')").rstrip()
+
+        # Zero pages are valid new pages of the relation
+        node.stop()
+        with open(os.path.join(node.data_dir, relpath), 'ab') as f:
+            f.write(b'\0' * 8192 * 1000)
+        node.start()
+
+        backup_id = self.backup_node(
+            backup_dir, 'node', node,
+            options=["--stream", "--compress"])
+
+        backup_file = os.path.join(
+            backup_dir, 'backups', 'node', backup_id, 'database', relpath)
+        self.assertLess(os.path.getsize(backup_file), 1000 * 16 + 8192)
+
+        pgdata = self.pgdata_content(node.data_dir)
+        node.stop()
+        node.cleanup()
+
+        self.restore_node(backup_dir, 'node', node, backup_id=backup_id)
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        self.assertEqual(
+            101,
+            node.execute("postgres", "select count(*) from t_heap")[0][0])
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_backup_dedup(self):
+        """
+        make node, take two full backups with --dedup, check that pages
+        of the second backup are taken from the page store, delete the
+        first backup and check that the second one can be restored
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'wal_level': 'replica',
+                'max_wal_senders': '2'}
+            )
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text "
+            "from generate_series(0,100000) i")
+        relpath = node.safe_psql(
+            "postgres",
+            "select pg_relation_filepath('t_heap')").rstrip()
+
+        first_id = self.backup_node(
+            backup_dir, 'node', node, options=["--stream", "--dedup"])
+        second_id = self.backup_node(
+            backup_dir, 'node', node, options=["--stream", "--dedup"])
+
+        # Backup files contain only references to the page store
+        relsize = os.path.getsize(os.path.join(node.data_dir, relpath))
+        backup_file = os.path.join(
+            backup_dir, 'backups', 'node', second_id, 'database', relpath)
+        self.assertLess(os.path.getsize(backup_file), relsize / 10)
+
+        pgdata = self.pgdata_content(node.data_dir)
+
+        # Pages used by the second backup survive deletion of the first one
+        self.delete_pb(backup_dir, 'node', first_id)
+        self.assertTrue(
+            os.listdir(os.path.join(backup_dir, 'pages', 'node')))
+
+        node.stop()
+        node.cleanup()
+
+        self.restore_node(backup_dir, 'node', node, backup_id=second_id)
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        self.assertEqual(
+            100001,
+            node.execute("postgres", "select count(*) from t_heap")[0][0])
+
+        # Nothing is left in the page store after deletion of all backups
+        self.delete_pb(backup_dir, 'node', second_id)
+        self.assertFalse(
+            os.listdir(os.path.join(backup_dir, 'pages', 'node')))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_backup_dedup_corrupted_pack(self):
+        """
+        make node, take full backup with --dedup, corrupt the pack of
+        the page store, check that validate finds the corruption
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'wal_level': 'replica',
+                'max_wal_senders': '2'}
+            )
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text "
+            "from generate_series(0,100000) i")
+
+        backup_id = self.backup_node(
+            backup_dir, 'node', node, options=["--stream", "--dedup"])
+
+        # Pages are kept in pack files with their indexes
+        store_path = os.path.join(backup_dir, 'pages', 'node')
+        packs = [f for f in os.listdir(store_path) if f.endswith('.pack')]
+        self.assertEqual(len(packs), 1)
+        self.assertTrue(os.path.isfile(
+            os.path.join(store_path, packs[0][:-5] + '.idx')))
+
+        # Damage bytes in the middle of the pack
+        pack_path = os.path.join(store_path, packs[0])
+        with open(pack_path, "rb+", 0) as f:
+            f.seek(os.path.getsize(pack_path) // 2)
+            f.write(b"blahblahblahblah")
+            f.flush()
+            f.close
+
+        try:
+            self.validate_pb(backup_dir, 'node', backup_id)
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because of page store corruption.\n"
+                " Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertTrue(
+                'is missing in page pack' in e.message and
+                'WARNING: Backup {0} data files are corrupted'.format(
+                    backup_id) in e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        self.assertEqual(
+            self.show_pb(backup_dir, 'node', backup_id)['status'], 'CORRUPT')
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_incremental_unchanged_files(self):
+        """
+        make node, take full backup, change configuration file, take
+        delta backup, check that unchanged non-data files are not copied
+        into delta backup, merge and restore the backups
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'wal_level': 'replica',
+                'max_wal_senders': '2'}
+            )
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        node.start()
+
+        self.backup_node(backup_dir, 'node', node, options=["--stream"])
+
+        node.safe_psql(
+            "postgres",
+            "alter system set work_mem = '8MB'")
+
+        backup_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='delta',
+            options=["--stream"])
+
+        database_dir = os.path.join(
+            backup_dir, 'backups', 'node', backup_id, 'database')
+        self.assertFalse(
+            os.path.exists(os.path.join(database_dir, 'PG_VERSION')))
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(database_dir, 'postgresql.auto.conf')))
+
+        pgdata = self.pgdata_content(node.data_dir)
+        node.stop()
+        node.cleanup()
+
+        self.restore_node(backup_dir, 'node', node, backup_id=backup_id)
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        # Merged backup gets the files from the full backup
+        self.merge_backup(backup_dir, 'node', backup_id)
+        node.cleanup()
+
+        self.restore_node(backup_dir, 'node', node, backup_id=backup_id)
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        self.assertEqual(
+            '8MB',
+            node.safe_psql("postgres", "show work_mem").rstrip())
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_backup_max_read_rate(self):
+        """
+        make node, take full backup with read rate limit, check that the
+        backup is not faster than the limit and can be restored
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'wal_level': 'replica',
+                'max_wal_senders': '2'}
+            )
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text "
+            "from generate_series(0,300000) i")
+        relpath = node.safe_psql(
+            "postgres",
+            "select pg_relation_filepath('t_heap')").rstrip()
+        relsize = os.path.getsize(os.path.join(node.data_dir, relpath))
+
+        start = time()
+        backup_id = self.backup_node(
+            backup_dir, 'node', node,
+            options=["--stream", "-j", "4", "--max-read-rate=10MB",
+                     "--max-iops=10000", "--max-read-latency=1s"])
+        self.assertGreaterEqual(time() - start, relsize / (10 * 1024 * 1024))
+
+        pgdata = self.pgdata_content(node.data_dir)
+        node.stop()
+        node.cleanup()
+
+        self.restore_node(
+            backup_dir, 'node', node, backup_id=backup_id,
+            options=["--max-read-rate=10MB"])
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_backup_resume(self):
+        """
+        make node, kill full backup in the middle of copying files,
+        resume the backup, check that the files copied before are reused
+        and the backup can be restored
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'wal_level': 'replica',
+                'max_wal_senders': '2'}
+            )
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text "
+            "from generate_series(0,100000) i")
+        node.safe_psql("postgres", "checkpoint")
+        # Files must be older than the start of the interrupted backup
+        sleep(1)
+
+        gdb = self.backup_node(
+            backup_dir, 'node', node, options=["--stream"], gdb=True)
+
+        gdb.set_breakpoint('journal_file')
+        gdb.run_until_break()
+
+        if gdb.continue_execution_until_break(20) != 'breakpoint-hit':
+            print('Failed to hit breakpoint')
+            exit(1)
+
+        gdb._execute('signal SIGKILL')
+
+        backup_id = self.show_pb(backup_dir, 'node')[0]['id']
+        self.assertEqual(
+            'RUNNING', self.show_pb(backup_dir, 'node')[0]['status'])
+
+        node.safe_psql(
+            "postgres",
+            "insert into t_heap select i as id, md5(i::text) as text "
+            "from generate_series(100001,200000) i")
+
+        self.assertEqual(
+            backup_id,
+            self.backup_node(
+                backup_dir, 'node', node,
+                options=["--stream", "--resume", "--log-level-file=verbose"]))
+        self.assertEqual(
+            'OK', self.show_pb(backup_dir, 'node', backup_id)['status'])
+
+        with open(os.path.join(backup_dir, 'log', 'pg_probackup.log')) as f:
+            self.assertIn('it is copied by the interrupted backup', f.read())
+        self.assertFalse(
+            os.path.exists(
+                os.path.join(
+                    backup_dir, 'backups', 'node', backup_id,
+                    'backup_content.journal')))
+
+        pgdata = self.pgdata_content(node.data_dir)
+        node.stop()
+        node.cleanup()
+
+        self.restore_node(backup_dir, 'node', node, backup_id=backup_id)
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        self.assertEqual(
+            200001,
+            node.execute("postgres", "select count(*) from t_heap")[0][0])
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
@@ -494,3 +494,164 @@ class CompressionTest(ProbackupTest, unittest.TestCase):
 
         # Clean after yourself
         self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_compression_stream_zstd_lz4(self):
+        """
+        make node, make full backup with zstd fast level and page backup
+        with lz4, check data correctness in restored instance
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'wal_level': 'replica',
+                'max_wal_senders': '2',
+                'checkpoint_timeout': '30s'}
+            )
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.start()
+
+        # FULL BACKUP
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text, "
+            "md5(repeat(i::text,10))::tsvector as tsvector "
+            "from generate_series(0,256) i")
+        full_result = node.execute("postgres", "SELECT * FROM t_heap")
+        full_backup_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='full',
+            options=[
+                '--stream',
+                '--compress-algorithm=zstd',
+                '--compress-level=-5'])
+
+        # PAGE BACKUP
+        node.safe_psql(
+            "postgres",
+            "insert into t_heap select i as id, md5(i::text) as text, "
+            "md5(repeat(i::text,10))::tsvector as tsvector "
+            "from generate_series(256,512) i")
+        page_result = node.execute("postgres", "SELECT * FROM t_heap")
+        page_backup_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='page',
+            options=['--stream', '--compress-algorithm=lz4'])
+
+        self.assertEqual(
+            self.show_pb(backup_dir, 'node', full_backup_id)['compress-alg'],
+            'zstd')
+        self.assertEqual(
+            self.show_pb(backup_dir, 'node', page_backup_id)['compress-alg'],
+            'lz4')
+
+        # Level 0 of zstd means its default level
+        zstd_default_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='full',
+            options=[
+                '--stream',
+                '--compress-algorithm=zstd',
+                '--compress-level=0'])
+        self.assertEqual(
+            self.show_pb(backup_dir, 'node', zstd_default_id)['compress-alg'],
+            'zstd')
+
+        # Drop Node
+        node.cleanup()
+
+        # Check full backup
+        self.restore_node(
+            backup_dir, 'node', node, backup_id=full_backup_id,
+            options=[
+                "-j", "4", "--immediate",
+                "--recovery-target-action=promote"])
+        node.slow_start()
+
+        full_result_new = node.execute("postgres", "SELECT * FROM t_heap")
+        self.assertEqual(full_result, full_result_new)
+        node.cleanup()
+
+        # Check page backup
+        self.restore_node(
+            backup_dir, 'node', node, backup_id=page_backup_id,
+            options=[
+                "-j", "4", "--immediate",
+                "--recovery-target-action=promote"])
+        node.slow_start()
+
+        page_result_new = node.execute("postgres", "SELECT * FROM t_heap")
+        self.assertEqual(page_result, page_result_new)
+        node.cleanup()
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_compression_threads(self):
+        """
+        make node, make full and page backups compressed by separate
+        compression threads, check data correctness in restored instance
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'wal_level': 'replica',
+                'max_wal_senders': '2',
+                'checkpoint_timeout': '30s'}
+            )
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.start()
+
+        # FULL BACKUP
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text, "
+            "md5(repeat(i::text,10))::tsvector as tsvector "
+            "from generate_series(0,20000) i")
+        self.backup_node(
+            backup_dir, 'node', node, backup_type='full',
+            options=[
+                '--stream', '-j', '2', '--compress-threads=4',
+                '--compress-algorithm=zlib'])
+
+        # PAGE BACKUP
+        node.safe_psql(
+            "postgres",
+            "update t_heap set text = md5(text) where id % 3 = 0")
+        page_backup_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='page',
+            options=[
+                '--stream', '-j', '2', '--compress-threads=4',
+                '--compress-algorithm=zlib'])
+
+        pgdata = self.pgdata_content(node.data_dir)
+        result = node.execute("postgres", "SELECT * FROM t_heap")
+
+        self.validate_pb(backup_dir)
+
+        node.cleanup()
+        self.restore_node(
+            backup_dir, 'node', node, backup_id=page_backup_id,
+            options=["-j", "4"])
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        self.assertEqual(
+            result, node.execute("postgres", "SELECT * FROM t_heap"))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
@@ -13,6 +13,8 @@ import psycopg2
 from time import sleep
 import re
 import json
+import struct
+import stat
 
 idx_ptrack = {
     't_heap': {
@@ -788,6 +790,57 @@ class ProbackupTest(object):
                 out_dict[name] = var
         return out_dict
 
+    def convert_file_list_to_text(self, backup_dir, instance, backup_id):
+        """
+        Rewrite backup_content.control of the backup in the text format
+        written by older versions of pg_probackup
+        """
+        list_path = os.path.join(
+            backup_dir, 'backups', instance, backup_id,
+            'backup_content.control')
+        with open(list_path, 'rb') as f:
+            data = f.read()
+
+        header_format = '=IIIIQ'
+        entry_format = '=qqqQQIIiiBB6x'
+        magic, version, nfiles, entry_size, strings_size = struct.unpack_from(
+            header_format, data, 0)
+        self.assertEqual(magic, 0x4C465042)
+        self.assertEqual(entry_size, struct.calcsize(entry_format))
+        strings = struct.calcsize(header_format) + nfiles * entry_size
+        compress_algs = ['none', 'none', 'pglz', 'zlib', 'zstd', 'lz4']
+
+        def get_string(offset):
+            start = strings + offset
+            return data[start:data.index(b'\0', start)].decode('utf-8')
+
+        lines = []
+        for i in range(nfiles):
+            (write_size, file_size, mtime, path_offset, linked_offset, mode,
+             crc, segno, n_blocks, compress_alg, flags) = struct.unpack_from(
+                entry_format, data,
+                struct.calcsize(header_format) + i * entry_size)
+            line = (
+                '{{"path":"{0}", "size":"{1}", "mode":"{2}", '
+                '"is_datafile":"{3}", "is_cfs":"{4}", "crc":"{5}", '
+                '"compress_alg":"{6}"'.format(
+                    get_string(path_offset), write_size, mode,
+                    1 if flags & 0x01 else 0, 1 if flags & 0x02 else 0,
+                    crc, compress_algs[compress_alg]))
+            if flags & 0x01:
+                line += ',"segno":"{0}"'.format(segno)
+            if stat.S_ISREG(mode) and mtime != 0:
+                line += ',"file_size":"{0}", "mtime":"{1}"'.format(
+                    file_size, mtime)
+            if flags & 0x04:
+                line += ',"linked":"{0}"'.format(get_string(linked_offset))
+            if n_blocks != -1:
+                line += ',"n_blocks":"{0}"'.format(n_blocks)
+            lines.append(line + '}\n')
+
+        with open(list_path, 'w') as f:
+            f.write(''.join(lines))
+
     def get_recovery_conf(self, node):
         out_dict = {}
         with open(
@@ -802,7 +855,8 @@ class ProbackupTest(object):
         return out_dict
 
     def set_archiving(
-            self, backup_dir, instance, node, replica=False, overwrite=False):
+            self, backup_dir, instance, node, replica=False, overwrite=False,
+            wal_summary=False):
 
         if replica:
             archive_mode = 'always'
@@ -828,6 +882,9 @@ class ProbackupTest(object):
             if overwrite:
                 archive_command = archive_command + "--overwrite "
 
+            if wal_summary:
+                archive_command = archive_command + "--wal-summary "
+
             archive_command = archive_command + "--wal-file-path %p --wal-file-name %f"
 
         node.append_conf(
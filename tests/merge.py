@@ -162,6 +162,65 @@ class MergeTest(ProbackupTest, unittest.TestCase):
         node.cleanup()
         self.del_test_dir(module_name, fname)
 
+    # @unittest.skip("skip")
+    def test_merge_different_compression(self):
+        """
+        Test MERGE command of backups compressed by different algorithms
+        """
+        fname = self.id().split(".")[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, "backup")
+
+        # Initialize instance and backup directory
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            initdb_params=["--data-checksums"]
+        )
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, "node", node)
+        self.set_archiving(backup_dir, "node", node)
+        node.start()
+
+        node.pgbench_init(scale=5)
+
+        # Do full compressed backup
+        self.backup_node(backup_dir, "node", node, options=[
+            '--compress-algorithm=zlib'])
+
+        pgbench = node.pgbench(options=['-T', '10', '-c', '2', '--no-vacuum'])
+        pgbench.wait()
+
+        # Do page backup compressed by another algorithm
+        page_id = self.backup_node(
+            backup_dir, "node", node, backup_type="page",
+            options=['--compress-algorithm=pglz'])
+
+        if self.paranoia:
+            pgdata = self.pgdata_content(node.data_dir)
+
+        # Merge all backups
+        self.merge_backup(backup_dir, "node", page_id)
+        show_backups = self.show_pb(backup_dir, "node")
+
+        self.assertEqual(len(show_backups), 1)
+        self.assertEqual(show_backups[0]["status"], "OK")
+        self.assertEqual(show_backups[0]["backup-mode"], "FULL")
+
+        self.validate_pb(backup_dir, "node")
+
+        # Drop node and restore it
+        node.cleanup()
+        self.restore_node(backup_dir, 'node', node)
+
+        # Physical comparison
+        if self.paranoia:
+            pgdata_restored = self.pgdata_content(node.data_dir)
+            self.compare_pgdata(pgdata, pgdata_restored)
+
+        # Clean after yourself
+        node.cleanup()
+        self.del_test_dir(module_name, fname)
+
     # @unittest.skip("skip")
     def test_merge_tablespaces(self):
         """
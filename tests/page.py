@@ -373,6 +373,103 @@ class PageBackupTest(ProbackupTest, unittest.TestCase):
         # Clean after yourself
         self.del_test_dir(module_name, fname)
 
+    # @unittest.skip("skip")
+    def test_page_full_page_images(self):
+        """
+        Make node with compressed full page images in WAL, write records
+        crossing WAL page and segment boundaries, take page backup,
+        check that restored data is the same
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'wal_level': 'replica',
+                'max_wal_senders': '2',
+                'autovacuum': 'off',
+                'full_page_writes': 'on',
+                'wal_compression': 'on'
+                }
+            )
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text "
+            "from generate_series(0,100000) i")
+        # Rows almost as large as a page, stored inline, so that their
+        # records cross WAL page boundaries
+        node.safe_psql(
+            "postgres",
+            "create table t_wide (id int, data text); "
+            "alter table t_wide alter column data set storage plain")
+
+        self.backup_node(backup_dir, 'node', node)
+
+        # The first change of each page after checkpoint is logged
+        # with the full page image
+        node.safe_psql("postgres", "checkpoint")
+        node.safe_psql(
+            "postgres",
+            "update t_heap set text = md5(text) where id % 10 = 0")
+
+        # More than a WAL segment of large records
+        node.safe_psql(
+            "postgres",
+            "insert into t_wide select i, repeat(md5(i::text), 200) "
+            "from generate_series(0,3000) i")
+        self.switch_wal_segment(node)
+
+        node.safe_psql("postgres", "checkpoint")
+        node.safe_psql(
+            "postgres",
+            "update t_wide set data = repeat(md5(data), 150) "
+            "where id % 3 = 0")
+        node.safe_psql(
+            "postgres",
+            "delete from t_heap where id % 7 = 0")
+
+        self.backup_node(
+            backup_dir, 'node', node, backup_type='page',
+            options=["-j", "4"])
+
+        pgdata = self.pgdata_content(node.data_dir)
+        result = node.safe_psql(
+            "postgres",
+            "select count(*), sum(length(data)) from t_wide")
+        result_heap = node.safe_psql(
+            "postgres", "select * from t_heap order by id")
+
+        node.stop()
+        node.cleanup()
+
+        self.restore_node(backup_dir, 'node', node, options=["-j", "4"])
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        self.assertEqual(
+            result,
+            node.safe_psql(
+                "postgres",
+                "select count(*), sum(length(data)) from t_wide"),
+            'data is lost')
+        self.assertEqual(
+            result_heap,
+            node.safe_psql("postgres", "select * from t_heap order by id"),
+            'data is lost')
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
     # @unittest.skip("skip")
     def test_page_delete(self):
         """
@@ -661,6 +758,65 @@ class PageBackupTest(ProbackupTest, unittest.TestCase):
         node.cleanup()
         self.del_test_dir(module_name, fname)
 
+    # @unittest.skip("skip")
+    def test_page_wal_summary(self):
+        """
+        make archive node with WAL summaries, take full backup,
+        generate several WAL segments, take page backup,
+        check that pagemap is built from summaries and
+        restored data is correct
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            initdb_params=['--data-checksums'],
+            pg_options={'wal_level': 'replica'}
+        )
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node, wal_summary=True)
+        node.start()
+
+        self.backup_node(backup_dir, 'node', node)
+
+        node.pgbench_init(scale=10)
+        self.switch_wal_segment(node)
+
+        self.backup_node(
+            backup_dir, 'node', node, backup_type='page',
+            options=['-j', '4', '--log-level-file=verbose'])
+
+        wal_dir = os.path.join(backup_dir, 'wal', 'node')
+        summaries = [
+            f for f in os.listdir(wal_dir) if f.endswith('.summary')]
+        self.assertTrue(summaries, 'WAL summaries are not written')
+
+        with open(os.path.join(backup_dir, 'log', 'pg_probackup.log')) as f:
+            log_content = f.read()
+            self.assertIn('is taken from WAL summaries', log_content)
+
+        if self.paranoia:
+            pgdata = self.pgdata_content(node.data_dir)
+
+        result = node.safe_psql("postgres", "select * from pgbench_accounts")
+
+        node.cleanup()
+        self.restore_node(backup_dir, 'node', node)
+
+        if self.paranoia:
+            pgdata_restored = self.pgdata_content(node.data_dir)
+            self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        self.assertEqual(
+            result,
+            node.safe_psql("postgres", "select * from pgbench_accounts"))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
     # @unittest.skip("skip")
     def test_page_backup_with_lost_wal_segment(self):
         """
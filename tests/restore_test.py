@@ -3,6 +3,7 @@ import unittest
 from .helpers.ptrack_helpers import ProbackupTest, ProbackupException
 import subprocess
 from datetime import datetime
+import struct
 import sys
 import time
 
@@ -1241,3 +1242,357 @@ class RestoreTest(ProbackupTest, unittest.TestCase):
 
         # Clean after yourself
         self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_restore_long_page_chain(self):
+        """
+        make node, take full backup, change the same pages in several
+        page backups, truncate and extend relation between them,
+        restore the last backup of the chain and check data correctness
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'wal_level': 'replica',
+                'autovacuum': 'off'}
+            )
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, "
+            "md5(i::text) as text from generate_series(0,10000) i")
+
+        self.backup_node(backup_dir, 'node', node)
+
+        for i in range(4):
+            node.safe_psql(
+                "postgres",
+                "update t_heap set text = md5(text) where id < 100")
+            self.backup_node(
+                backup_dir, 'node', node, backup_type='page')
+
+        node.safe_psql(
+            "postgres",
+            "delete from t_heap where id > 5000; vacuum t_heap")
+        self.backup_node(backup_dir, 'node', node, backup_type='page')
+
+        node.safe_psql(
+            "postgres",
+            "insert into t_heap select i as id, md5(i::text) as text "
+            "from generate_series(10001,12000) i")
+        backup_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='page')
+
+        pgdata = self.pgdata_content(node.data_dir)
+        before = node.execute("postgres", "SELECT * FROM t_heap")
+
+        node.stop()
+        node.cleanup()
+
+        self.assertIn(
+            "INFO: Restore of backup {0} completed.".format(backup_id),
+            self.restore_node(
+                backup_dir, 'node', node,
+                options=["-j", "4", "--recovery-target-action=promote"]),
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+
+        # Physical comparison
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+
+        after = node.execute("postgres", "SELECT * FROM t_heap")
+        self.assertEqual(before, after)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_restore_incremental(self):
+        """
+        make node, take full backup, change and extend data, create and
+        drop tables, restore the backup into the existing data directory
+        with --incremental and check data correctness
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'wal_level': 'replica',
+                'autovacuum': 'off'}
+            )
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, "
+            "md5(i::text) as text from generate_series(0,10000) i")
+        node.safe_psql(
+            "postgres",
+            "create table t_drop as select i as id "
+            "from generate_series(0,1000) i")
+
+        backup_id = self.backup_node(
+            backup_dir, 'node', node, options=['--stream'])
+
+        before = node.execute("postgres", "SELECT * FROM t_heap")
+
+        node.safe_psql(
+            "postgres",
+            "update t_heap set text = 'changed' where id % 100 = 0")
+        node.safe_psql(
+            "postgres",
+            "insert into t_heap select i as id, md5(i::text) as text "
+            "from generate_series(10001,20000) i")
+        node.safe_psql("postgres", "drop table t_drop")
+        node.safe_psql(
+            "postgres",
+            "create table t_new as select i as id "
+            "from generate_series(0,1000) i")
+        node.safe_psql("postgres", "checkpoint")
+
+        # Server must be stopped
+        try:
+            self.restore_node(
+                backup_dir, 'node', node, options=['--incremental'])
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because postmaster is running.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertIn(
+                'Postmaster is running', e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        node.stop()
+
+        self.assertIn(
+            "INFO: Restore of backup {0} completed.".format(backup_id),
+            self.restore_node(
+                backup_dir, 'node', node,
+                options=["-j", "4", "--incremental"]),
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+
+        node.slow_start()
+
+        after = node.execute("postgres", "SELECT * FROM t_heap")
+        self.assertEqual(before, after)
+        self.assertEqual(
+            node.safe_psql(
+                "postgres",
+                "select count(*) from pg_class where relname = 't_new'"
+                ).rstrip(), '0')
+        self.assertEqual(
+            node.safe_psql(
+                "postgres", "select count(*) from t_drop").rstrip(), '1001')
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_restore_chain_text_file_list(self):
+        """
+        make node, take full backup, rewrite its file list in the text
+        format of older versions, take delta backup, check that the file
+        list of the full backup isn't changed and the chain is restored
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'wal_level': 'replica',
+                'max_wal_senders': '2'}
+            )
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, "
+            "md5(i::text) as text from generate_series(0,10000) i")
+
+        full_id = self.backup_node(
+            backup_dir, 'node', node, options=['--stream'])
+        self.convert_file_list_to_text(backup_dir, 'node', full_id)
+
+        node.safe_psql(
+            "postgres",
+            "update t_heap set text = 'changed' where id % 10 = 0")
+        node.safe_psql(
+            "postgres",
+            "insert into t_heap select i as id, md5(i::text) as text "
+            "from generate_series(10001,20000) i")
+
+        self.backup_node(
+            backup_dir, 'node', node, backup_type='delta',
+            options=['--stream'])
+
+        # Older versions must still be able to read the full backup
+        list_path = os.path.join(
+            backup_dir, 'backups', 'node', full_id, 'backup_content.control')
+        with open(list_path, 'r') as f:
+            self.assertEqual(f.read(1), '{')
+
+        before = node.execute("postgres", "SELECT * FROM t_heap")
+        pgdata = self.pgdata_content(node.data_dir)
+
+        node.stop()
+        node.cleanup()
+
+        self.restore_node(backup_dir, 'node', node, options=["-j", "4"])
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        after = node.execute("postgres", "SELECT * FROM t_heap")
+        self.assertEqual(before, after)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_restore_incremental_no_pg_control(self):
+        """
+        make node, take full backup, restore it with --incremental into
+        an empty data directory and into the data directory without
+        pg_control, check data correctness
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            initdb_params=['--data-checksums'],
+            pg_options={'wal_level': 'replica'}
+            )
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, "
+            "md5(i::text) as text from generate_series(0,10000) i")
+
+        backup_id = self.backup_node(
+            backup_dir, 'node', node, options=['--stream'])
+
+        before = node.execute("postgres", "SELECT * FROM t_heap")
+        pgdata = self.pgdata_content(node.data_dir)
+
+        node.stop()
+
+        # Empty data directory
+        node.cleanup()
+        self.restore_node(
+            backup_dir, 'node', node, options=["-j", "4", "--incremental"])
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        # Data directory left by interrupted restore, without pg_control
+        os.remove(os.path.join(node.data_dir, 'global', 'pg_control'))
+        self.assertIn(
+            "INFO: Restore of backup {0} completed.".format(backup_id),
+            self.restore_node(
+                backup_dir, 'node', node,
+                options=["-j", "4", "--incremental"]),
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+
+        after = node.execute("postgres", "SELECT * FROM t_heap")
+        self.assertEqual(before, after)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_restore_broken_block_order(self):
+        """
+        make node, take full backup, make the order of blocks in the backup
+        of a data file go backwards twice, check that restore fails
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            initdb_params=['--data-checksums'],
+            pg_options={'wal_level': 'replica'}
+        )
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text "
+            "from generate_series(0,10000) i")
+        heap_path = node.safe_psql(
+            "postgres",
+            "select pg_relation_filepath('t_heap')").rstrip()
+
+        backup_id = self.backup_node(backup_dir, 'node', node)
+
+        # Renumber the first three blocks as 2, 1, 0
+        file_path = os.path.join(
+            backup_dir, 'backups', 'node', backup_id, 'database', heap_path)
+        with open(file_path, 'rb+') as f:
+            offset = 0
+            for blknum in [2, 1, 0]:
+                f.seek(offset)
+                block, size = struct.unpack('=Ii', f.read(8))
+                f.seek(offset)
+                f.write(struct.pack('=Ii', blknum, size))
+                if size == -4:
+                    size = 0
+                elif size == -5:
+                    size = 48
+                offset += 8 + ((size + 7) & ~7)
+
+        node.stop()
+        node.cleanup()
+
+        try:
+            self.restore_node(
+                backup_dir, 'node', node, options=['--no-validate'])
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because of broken order of blocks.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertTrue(
+                'ERROR: backup is broken at file->path' in e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
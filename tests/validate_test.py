@@ -1667,3 +1667,169 @@ class ValidateTest(ProbackupTest, unittest.TestCase):
 
         # Clean after yourself
         self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_validate_block_index(self):
+        """
+        make node, take full backup with block indexes, remove block index
+        of a data file, run validate, check that validate doesn't build
+        the index again and restore works without it
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            initdb_params=['--data-checksums'],
+            pg_options={'wal_level': 'replica'}
+        )
+
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text "
+            "from generate_series(0,10000) i")
+
+        heap_path = node.safe_psql(
+            "postgres",
+            "select pg_relation_filepath('t_heap')").rstrip()
+
+        # Without the option there are no indexes
+        backup_id = self.backup_node(
+            backup_dir, 'node', node, options=['--compress'])
+        self.assertFalse(os.path.isfile(os.path.join(
+            backup_dir, 'backups', 'node', backup_id, 'database',
+            heap_path + '.bix')))
+
+        backup_id = self.backup_node(
+            backup_dir, 'node', node, options=['--compress', '--block-index'])
+
+        index_file = os.path.join(
+            backup_dir, 'backups', 'node', backup_id, 'database',
+            heap_path + '.bix')
+        self.assertTrue(os.path.isfile(index_file))
+
+        os.remove(index_file)
+
+        self.validate_pb(backup_dir, 'node', backup_id)
+        self.assertFalse(os.path.isfile(index_file))
+        self.assertEqual(
+            'OK', self.show_pb(backup_dir, 'node', backup_id)['status'])
+
+        if self.paranoia:
+            pgdata = self.pgdata_content(node.data_dir)
+
+        node.stop()
+        node.cleanup()
+
+        self.restore_node(backup_dir, 'node', node, backup_id=backup_id)
+        self.assertFalse(os.path.isfile(index_file))
+
+        if self.paranoia:
+            pgdata_restored = self.pgdata_content(node.data_dir)
+            self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        self.assertEqual(
+            node.safe_psql("postgres", "select count(*) from t_heap").rstrip(),
+            '10001')
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_validate_newer_format_version(self):
+        """
+        make node, take full and page backups, set format version of page
+        backup greater than supported one, check that validate, restore
+        and merge fail with clear error
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir="{0}/{1}/node".format(module_name, fname),
+            initdb_params=['--data-checksums'],
+            pg_options={'wal_level': 'replica'}
+        )
+
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text "
+            "from generate_series(0,10000) i")
+
+        self.backup_node(backup_dir, 'node', node)
+
+        node.safe_psql(
+            "postgres",
+            "insert into t_heap select i as id, md5(i::text) as text "
+            "from generate_series(10001,20000) i")
+
+        backup_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='page')
+
+        with open(os.path.join(
+                backup_dir, 'backups', 'node', backup_id,
+                'backup.control'), 'a') as conf:
+            conf.write('format-version = 99\n')
+
+        error = 'ERROR: Backup {0} has format version 99'.format(backup_id)
+
+        try:
+            self.validate_pb(backup_dir, 'node', backup_id)
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because of unsupported format version.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertTrue(
+                error in e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        node.stop()
+        node.cleanup()
+
+        try:
+            self.restore_node(
+                backup_dir, 'node', node, options=['--no-validate'])
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because of unsupported format version.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertTrue(
+                error in e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        try:
+            self.merge_backup(backup_dir, 'node', backup_id)
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because of unsupported format version.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertTrue(
+                error in e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        # Backups are left untouched
+        self.assertEqual(
+            'OK', self.show_pb(backup_dir, 'node', backup_id)['status'])
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)